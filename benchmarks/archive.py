@@ -0,0 +1,311 @@
+"""
+Benchmark :py:func:`gmail_archiver.utils.archive_emails` against the fake Gmail IMAP server.
+
+Each configuration runs in its own process so peak RSS is not shared between configurations. The
+server runs in a background thread with its own event loop; CPU time is measured for the archiving
+thread only. Peak RSS covers the whole process, including the synthetic mailbox held by the server
+(reported as ``mailbox_bytes``).
+
+Run from the repository root::
+
+    python -m benchmarks.archive -o results.json
+    python -m benchmarks.archive --compare results.json
+"""
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, TypedDict, cast
+import asyncio
+import json
+import platform
+import queue
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import threading
+import time
+
+from anyio import Path as AsyncPath
+from gmail_archiver.profiling import peak_rss
+from gmail_archiver.stats import RunStats
+from gmail_archiver.utils import archive_emails
+from tests.fake_imap_server import FakeGmailServer, generate_mailbox
+import aioimaplib  # type: ignore[import-untyped]
+import click
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Mapping
+
+    from tests.fake_imap_server import FakeMessage
+
+__all__ = ('CONFIGS', 'compare_results', 'main', 'run_benchmark')
+
+
+class BenchmarkConfig(TypedDict):
+    """Mailbox shape of a benchmark configuration."""
+    count: int
+    """Number of messages."""
+    mean_size: int
+    """Median message size in bytes."""
+    sigma: float
+    """Shape of the log-normal size distribution."""
+
+
+class BenchmarkResult(TypedDict):
+    """Measurements of one configuration."""
+    adaptive: bool
+    """Whether adaptive batching was used."""
+    bytes: int
+    """Message bytes archived."""
+    compress: bool
+    """Whether ``COMPRESS=DEFLATE`` was negotiated."""
+    cpu_seconds: float
+    """CPU time of the archiving thread."""
+    latency: float
+    """Simulated server latency per command in seconds."""
+    mailbox_bytes: int
+    """Size of the synthetic mailbox held in memory by the server."""
+    mb_per_second: float
+    """Throughput in MB (10^6 bytes) per second."""
+    messages: int
+    """Messages archived."""
+    messages_per_second: float
+    """Throughput in messages per second."""
+    name: str
+    """Configuration name."""
+    peak_rss_kib: int
+    """Peak resident set size of the process in KiB."""
+    seconds: float
+    """Wall time of the run."""
+
+
+CONFIGS: dict[str, BenchmarkConfig] = {
+    'tiny': {
+        'count': 10_000,
+        'mean_size': 1024,
+        'sigma': 0.2
+    },
+    'huge': {
+        'count': 1000,
+        'mean_size': 1024 * 1024,
+        'sigma': 0.5
+    },
+    'mixed': {
+        'count': 2000,
+        'mean_size': 20_000,
+        'sigma': 1.5
+    },
+}
+"""Benchmark configurations by name."""
+_MB = 1_000_000
+
+
+def _serve(messages: list[FakeMessage], latency: float, ports: queue.Queue[int],
+           stop: threading.Event) -> None:
+    async def serve() -> None:
+        async with FakeGmailServer(messages, latency=latency) as server:
+            ports.put(server.port)
+            while not stop.is_set():  # noqa: ASYNC110
+                await asyncio.sleep(0.05)
+
+    asyncio.run(serve())
+
+
+async def _archive(port: int, out_dir: Path, *, adaptive: bool, compress: bool) -> RunStats:
+    imap_conn = aioimaplib.IMAP4('127.0.0.1', port, timeout=600)
+    await imap_conn.wait_hello_from_server()
+    stats = RunStats()
+    await archive_emails(imap_conn,
+                         'user@example.com',
+                         'token',
+                         AsyncPath(out_dir),
+                         adaptive=adaptive,
+                         compress=compress,
+                         stats=stats)
+    stats.finish()
+    await imap_conn.logout()
+    return stats
+
+
+def run_benchmark(name: str,
+                  *,
+                  adaptive: bool = True,
+                  compress: bool = True,
+                  latency: float = 0.0,
+                  scale: float = 1.0) -> BenchmarkResult:
+    """
+    Run one configuration in the current process.
+
+    Parameters
+    ----------
+    name : str
+        Key of :py:data:`CONFIGS`.
+    adaptive : bool
+        Use adaptive batching.
+    compress : bool
+        Negotiate ``COMPRESS=DEFLATE``.
+    latency : float
+        Simulated server latency per command in seconds.
+    scale : float
+        Multiplier for the number of messages.
+
+    Returns
+    -------
+    BenchmarkResult
+        The measurements.
+    """
+    config = CONFIGS[name]
+    messages = generate_mailbox(max(1, round(config['count'] * scale)),
+                                mean_size=config['mean_size'],
+                                sigma=config['sigma'])
+    ports: queue.Queue[int] = queue.Queue()
+    stop = threading.Event()
+    thread = threading.Thread(target=_serve, args=(messages, latency, ports, stop), daemon=True)
+    thread.start()
+    try:
+        port = ports.get(timeout=30)
+        with tempfile.TemporaryDirectory(prefix='gmail-archiver-benchmark-') as out_dir:
+            cpu_started = time.thread_time()
+            stats = asyncio.run(_archive(port, Path(out_dir), adaptive=adaptive, compress=compress))
+            cpu_seconds = time.thread_time() - cpu_started
+    finally:
+        stop.set()
+        thread.join()
+    return {
+        'adaptive': adaptive,
+        'bytes': stats.bytes_downloaded,
+        'compress': compress,
+        'cpu_seconds': cpu_seconds,
+        'latency': latency,
+        'mailbox_bytes': sum(len(x.body) for x in messages),
+        'mb_per_second': stats.throughput / _MB,
+        'messages': stats.messages,
+        'messages_per_second': stats.messages / stats.elapsed if stats.elapsed else 0.0,
+        'name': name,
+        'peak_rss_kib': (peak_rss() or 0) // 1024,
+        'seconds': stats.elapsed
+    }
+
+
+def compare_results(results: Iterable[BenchmarkResult],
+                    baseline: Iterable[BenchmarkResult]) -> list[str]:
+    """
+    Describe the change of each configuration against a previous run.
+
+    Parameters
+    ----------
+    results : Iterable[BenchmarkResult]
+        Current results.
+    baseline : Iterable[BenchmarkResult]
+        Results of the previous run.
+
+    Returns
+    -------
+    list[str]
+        One line per configuration present in both.
+    """
+    previous: Mapping[str, BenchmarkResult] = {x['name']: x for x in baseline}
+    ret = []
+    for result in results:
+        if not (old := previous.get(result['name'])):
+            continue
+        changes = []
+        for key in ('messages_per_second', 'mb_per_second', 'peak_rss_kib', 'cpu_seconds'):
+            before = old[key]
+            after = result[key]
+            changes.append(f'{key} {(after - before) / before:+.1%}' if before else f'{key} n/a')
+        ret.append(f'{result["name"]}: {", ".join(changes)}')
+    return ret
+
+
+def _git_revision() -> str | None:
+    if not (git := shutil.which('git')):
+        return None
+    try:
+        return sp.run((git, 'rev-parse', 'HEAD'), check=True, capture_output=True,
+                      text=True).stdout.strip()
+    except sp.CalledProcessError:
+        return None
+
+
+@click.command(context_settings={'help_option_names': ('-h', '--help')})
+@click.option('-c',
+              '--config',
+              'names',
+              help='Configuration to run. May be given more than once. Defaults to all.',
+              type=click.Choice(tuple(CONFIGS)),
+              multiple=True)
+@click.option('--latency',
+              help='Simulated server latency per command in seconds.',
+              type=click.FloatRange(min=0),
+              default=0.0)
+@click.option('--scale',
+              help='Multiply the number of messages of each configuration.',
+              type=click.FloatRange(min=0, min_open=True),
+              default=1.0)
+@click.option('--no-adaptive-batching', help='Fetch one message per command.', is_flag=True)
+@click.option('--no-compress', help='Do not negotiate COMPRESS=DEFLATE.', is_flag=True)
+@click.option('-o',
+              '--output',
+              help='Write results as JSON to this file.',
+              type=click.Path(dir_okay=False, path_type=Path))
+@click.option('--compare',
+              'baseline_file',
+              help='Compare with results of a previous run.',
+              type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.option('--worker', hidden=True, is_flag=True)
+def main(names: tuple[str, ...] = (),
+         latency: float = 0.0,
+         scale: float = 1.0,
+         output: Path | None = None,
+         baseline_file: Path | None = None,
+         *,
+         no_adaptive_batching: bool = False,
+         no_compress: bool = False,
+         worker: bool = False) -> None:
+    """Benchmark archiving against a local IMAP stand-in."""
+    options = ('--latency', str(latency), '--scale', str(scale),
+               *(('--no-adaptive-batching',) if no_adaptive_batching else
+                 ()), *(('--no-compress',) if no_compress else ()))
+    if worker:
+        click.echo(
+            json.dumps(
+                run_benchmark(names[0],
+                              adaptive=not no_adaptive_batching,
+                              compress=not no_compress,
+                              latency=latency,
+                              scale=scale)))
+        return
+    results: list[BenchmarkResult] = []
+    for name in names or tuple(CONFIGS):
+        process = sp.run(
+            (sys.executable, '-m', 'benchmarks.archive', '--worker', '-c', name, *options),
+            check=True,
+            capture_output=True,
+            text=True)
+        result = cast('BenchmarkResult', json.loads(process.stdout))
+        results.append(result)
+        click.echo(f'{name}: {result["messages_per_second"]:.1f} messages/s, '
+                   f'{result["mb_per_second"]:.2f} MB/s, peak RSS {result["peak_rss_kib"]} KiB, '
+                   f'CPU {result["cpu_seconds"]:.2f} s')
+    if baseline_file:
+        baseline = json.loads(baseline_file.read_text(encoding='utf-8'))['results']
+        for line in compare_results(results, baseline):
+            click.echo(line)
+    if output:
+        output.write_text(json.dumps(
+            {
+                'finished': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'results': results,
+                'revision': _git_revision()
+            },
+            indent=2,
+            sort_keys=True) + '\n',
+                          encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
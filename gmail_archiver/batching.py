@@ -0,0 +1,103 @@
+"""Adaptive batch sizing."""
+from __future__ import annotations
+
+import logging
+
+from .stats import format_size
+
+__all__ = ('AdaptiveBatchSize',)
+
+log = logging.getLogger(__name__)
+
+_EWMA_WEIGHT = 0.3
+
+
+class AdaptiveBatchSize:
+    """
+    AIMD controller for the fetch batch size and the in-flight window.
+
+    After every fetch the measured round-trip latency, byte throughput and outcome are recorded.
+    While latency stays under ``target_latency`` the batch size grows additively; a slow fetch or a
+    server error cuts it multiplicatively. The in-flight window (number of batches being written
+    while the next one is fetched) grows while throughput keeps up with its moving average and is
+    halved on errors or when throughput collapses.
+
+    Parameters
+    ----------
+    initial_size : int
+        Starting batch size.
+    min_size : int
+        Smallest batch size.
+    max_size : int
+        Largest batch size.
+    initial_window : int
+        Starting in-flight window.
+    max_window : int
+        Largest in-flight window.
+    target_latency : float
+        Round-trip time in seconds above which the batch size is reduced.
+    increase : int
+        Additive increase of the batch size.
+    decrease : float
+        Multiplicative decrease factor.
+    """
+    def __init__(self,
+                 initial_size: int = 10,
+                 min_size: int = 1,
+                 max_size: int = 500,
+                 initial_window: int = 2,
+                 max_window: int = 8,
+                 target_latency: float = 5.0,
+                 increase: int = 5,
+                 decrease: float = 0.5) -> None:
+        self.batch_size = initial_size
+        """Current number of messages per fetch."""
+        self.decrease = decrease
+        """Multiplicative decrease factor."""
+        self.errors = 0
+        """Number of failed fetches recorded."""
+        self.increase = increase
+        """Additive increase of the batch size."""
+        self.max_size = max_size
+        """Largest batch size."""
+        self.max_window = max_window
+        """Largest in-flight window."""
+        self.min_size = min_size
+        """Smallest batch size."""
+        self.target_latency = target_latency
+        """Round-trip time in seconds above which the batch size is reduced."""
+        self.throughput = 0.0
+        """Moving average of bytes per second."""
+        self.window = initial_window
+        """Current number of batches that may be written while the next one is fetched."""
+
+    def record(self, latency: float, size: int, *, ok: bool = True) -> None:
+        """
+        Record a fetch and adjust the batch size and window.
+
+        Parameters
+        ----------
+        latency : float
+            Round-trip time of the fetch in seconds.
+        size : int
+            Number of bytes received.
+        ok : bool
+            Whether the server completed the fetch successfully.
+        """
+        if not ok:
+            self.errors += 1
+            self.batch_size = max(self.min_size, int(self.batch_size * self.decrease))
+            self.window = max(1, int(self.window * self.decrease))
+        elif latency > self.target_latency:
+            self.batch_size = max(self.min_size, int(self.batch_size * self.decrease))
+        else:
+            self.batch_size = min(self.max_size, self.batch_size + self.increase)
+            current = size / latency if latency > 0 else 0.0
+            if current >= self.throughput:
+                self.window = min(self.max_window, self.window + 1)
+            elif current < self.throughput * self.decrease:
+                self.window = max(1, int(self.window * self.decrease))
+            self.throughput = (current if not self.throughput else _EWMA_WEIGHT * current +
+                               (1 - _EWMA_WEIGHT) * self.throughput)
+        log.debug('Batch size %d, window %d (latency %.2f s, %s/s, ok: %s).', self.batch_size,
+                  self.window, latency, format_size(self.throughput), ok)
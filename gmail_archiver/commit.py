@@ -0,0 +1,131 @@
+"""Group commit of archived messages before they are moved to the trash."""
+from __future__ import annotations
+
+from contextlib import nullcontext
+from pathlib import Path
+from typing import TYPE_CHECKING
+import asyncio
+import logging
+import os
+import sys
+
+from .tracing import span
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable, Iterable, Sequence
+
+    from .stats import RunStats
+
+__all__ = ('DEFAULT_GROUP_SIZE', 'GroupCommit')
+
+log = logging.getLogger(__name__)
+
+DEFAULT_GROUP_SIZE = 256
+"""Number of messages made durable together."""
+
+
+def _fsync(path: Path) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _directories(files: Iterable[Path], root: Path) -> set[Path]:
+    ret: set[Path] = set()
+    for file in files:
+        for parent in file.parents:
+            if parent in ret or not parent.is_relative_to(root):
+                break
+            ret.add(parent)
+    return ret
+
+
+class GroupCommit:
+    """
+    Makes written messages durable in groups before acting on them.
+
+    The action (moving the messages to the trash) is run on exactly the messages of each group.
+
+    Syncing every message on its own costs a disk flush per message. Instead the files of up to
+    ``size`` messages are synced together: all files at once, so the file system can combine them
+    into few journal commits, then the directories containing them up to ``root`` (including
+    directories created for the messages). Only then is ``action`` called, so a message is never
+    removed from the server before its copy is on stable storage. Files shared by several messages
+    (such as an mbox) are synced once per group.
+
+    Parameters
+    ----------
+    root : Path
+        Output directory. Directories from the written files up to this one are synced.
+    action : Callable[[list[str]], Awaitable[None]]
+        Called with the message numbers of each group once the group is durable.
+    size : int
+        Number of messages per group.
+    prepare : Callable[[], Awaitable[None]] | None
+        Called before each group is synced, for example to write out buffered messages.
+    stats : RunStats | None
+        Statistics object in which syncing is recorded as the ``sync`` phase.
+    """
+    def __init__(self,
+                 root: Path,
+                 action: Callable[[list[str]], Awaitable[None]],
+                 *,
+                 size: int = DEFAULT_GROUP_SIZE,
+                 prepare: Callable[[], Awaitable[None]] | None = None,
+                 stats: RunStats | None = None) -> None:
+        self.action = action
+        """Called with the message numbers of each durable group."""
+        self.prepare = prepare
+        """Called before each group is synced."""
+        self.root = root
+        """Output directory."""
+        self.size = size
+        """Number of messages per group."""
+        self.stats = stats
+        """Statistics object."""
+        self._files: list[Path] = []
+        self._lock = asyncio.Lock()
+        self._nums: list[str] = []
+
+    @property
+    def pending(self) -> int:
+        """Number of messages waiting for the next group commit."""
+        return len(self._nums)
+
+    async def add(self, nums: Sequence[str], files: Iterable[os.PathLike[str]]) -> None:
+        """
+        Add written messages to the current group, committing it if it is full.
+
+        Parameters
+        ----------
+        nums : Sequence[str]
+            Message numbers.
+        files : Iterable[os.PathLike[str]]
+            Files written for the messages.
+        """
+        self._nums.extend(nums)
+        self._files.extend(Path(x) for x in files)
+        if len(self._nums) >= self.size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Sync the files of the current group and run the action on its messages."""
+        async with self._lock:
+            nums, files = self._nums, list(dict.fromkeys(self._files))
+            self._nums, self._files = [], []
+            if not nums:
+                return
+            if self.prepare:
+                await self.prepare()
+            with span(
+                    'sync', count=len(nums),
+                    files=len(files)), (self.stats.timed('sync') if self.stats else nullcontext()):
+                await asyncio.gather(*(asyncio.to_thread(_fsync, x) for x in files))
+                # Directories cannot be opened for syncing on Windows.
+                if sys.platform != 'win32':
+                    await asyncio.gather(*(asyncio.to_thread(_fsync, x)
+                                           for x in _directories(files, self.root)))
+            log.debug('Synced %d files of %d messages.', len(files), len(nums))
+            await self.action(nums)
@@ -0,0 +1,89 @@
+"""IMAP ``COMPRESS=DEFLATE`` (RFC 4978) support."""
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any
+import logging
+import zlib
+
+from .lazy import lazy_import
+
+if TYPE_CHECKING:
+    import asyncio
+
+    import aioimaplib  # type: ignore[import-untyped]
+
+    from .stats import RunStats
+else:
+    aioimaplib = lazy_import('aioimaplib')
+
+__all__ = ('enable_compression',)
+
+log = logging.getLogger(__name__)
+
+_CAPABILITY = 'COMPRESS=DEFLATE'
+_WBITS = -15
+"""Raw deflate stream without zlib header, as required by RFC 4978."""
+
+
+class _DeflateTransport:
+    """Transport proxy compressing everything written to it."""
+    def __init__(self, transport: asyncio.Transport, stats: RunStats | None = None) -> None:
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, _WBITS)
+        self._stats = stats
+        self._transport = transport
+
+    def write(self, data: bytes) -> None:
+        out = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self._stats:
+            self._stats.add_compressed_sent(len(out), len(data))
+        self._transport.write(out)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._transport, name)
+
+
+async def enable_compression(imap_conn: aioimaplib.IMAP4_SSL,
+                             stats: RunStats | None = None) -> bool:
+    """
+    Negotiate ``COMPRESS=DEFLATE`` and wrap the connection transparently.
+
+    Must be called after authentication and before selecting a mailbox. Gmail only advertises the
+    extension once authenticated, so the capabilities are refreshed if needed.
+
+    Parameters
+    ----------
+    imap_conn : aioimaplib.IMAP4_SSL
+        The authenticated IMAP connection.
+    stats : RunStats | None
+        Statistics object receiving compressed and uncompressed byte counts.
+
+    Returns
+    -------
+    bool
+        ``True`` if compression is active.
+    """
+    if not imap_conn.has_capability(_CAPABILITY):
+        await imap_conn.protocol.capability()
+        if not imap_conn.has_capability(_CAPABILITY):
+            log.debug('Server does not support %s.', _CAPABILITY)
+            return False
+    protocol = imap_conn.protocol
+    # simple_command() refuses COMPRESS, so the command is executed directly.
+    response = await protocol.execute(
+        aioimaplib.Command('COMPRESS', protocol.new_tag(), 'DEFLATE', loop=protocol.loop))
+    if response.result != 'OK':
+        log.warning('Could not enable compression: %s', response.lines)
+        return False
+    decompressor = zlib.decompressobj(_WBITS)
+    data_received = protocol.data_received
+
+    def decompressing_data_received(data: bytes) -> None:
+        out = decompressor.decompress(data)
+        if stats:
+            stats.add_compressed_received(len(data), len(out))
+        data_received(out)
+
+    protocol.data_received = decompressing_data_received
+    protocol.transport = _DeflateTransport(protocol.transport, stats)
+    log.debug('Compression enabled.')
+    return True
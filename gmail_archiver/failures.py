@@ -0,0 +1,182 @@
+"""Manifest of messages that could not be archived normally."""
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, cast
+import json
+import logging
+
+from .tokens import file_lock
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Mapping
+
+    from anyio import Path as AsyncPath
+
+    from .typing import FailureDB, FailureManifest, FailureRecord
+
+__all__ = ('SNIPPET_LENGTH', 'ErrorManifest')
+
+log = logging.getLogger(__name__)
+
+SNIPPET_LENGTH = 200
+"""Maximum number of characters of a server response kept with a failure."""
+
+
+def _snippet(data: Iterable[bytes | bytearray | str] | bytes | str | None) -> str:
+    if data is None:
+        return ''
+    if isinstance(data, str):
+        return data[:SNIPPET_LENGTH]
+    if isinstance(data, bytes):
+        return data[:SNIPPET_LENGTH].decode(errors='backslashreplace')
+    parts: list[str] = []
+    length = 0
+    for line in data:
+        part = (line if isinstance(line, str) else bytes(line[:SNIPPET_LENGTH]).decode(
+            errors='backslashreplace'))
+        parts.append(part)
+        length += len(part) + 1
+        if length >= SNIPPET_LENGTH:
+            break
+    return ' '.join(parts)[:SNIPPET_LENGTH]
+
+
+class ErrorManifest:
+    """
+    Failures of an archive run, persisted so the next run can retry them.
+
+    A message is identified by its UID together with the mailbox ``UIDVALIDITY``, as sequence
+    numbers change between runs. The manifest file can be shared by several accounts (and
+    mailboxes); saving replaces the failures of one account with those of the current run under a
+    lock, so concurrent runs do not overwrite each other's records.
+
+    Parameters
+    ----------
+    path : AsyncPath
+        Path to the JSON manifest.
+    email : str
+        The account. Used as the key of the record in the manifest.
+    """
+    def __init__(self, path: AsyncPath, email: str) -> None:
+        self.email = email
+        """The account."""
+        self.failures: list[FailureRecord] = []
+        """Failures of the current run."""
+        self.path = path
+        """Path to the JSON manifest."""
+        self.previous: FailureManifest = {}
+        """Failures of the previous run, set by :py:meth:`load`."""
+
+    async def _load_db(self) -> FailureDB:
+        if not await self.path.exists():
+            return {}
+        try:
+            data = json.loads(await self.path.read_text(encoding='utf-8'))
+        except json.JSONDecodeError:
+            log.warning('Ignoring invalid error manifest %s.', self.path)
+            return {}
+        return cast('FailureDB', data) if isinstance(data, dict) else {}
+
+    async def load(self) -> None:
+        """Load the failures of the previous run of the account."""
+        self.previous = (await self._load_db()).get(self.email, {})
+
+    async def save(self, uidvalidity: str | None = None) -> None:
+        """
+        Write the failures of the current run, keeping other accounts intact.
+
+        The account is removed from the manifest if there were no failures.
+
+        Parameters
+        ----------
+        uidvalidity : str | None
+            ``UIDVALIDITY`` of the mailbox.
+        """
+        async with file_lock(Path(self.path.with_name(f'.{self.path.name}.lock'))):
+            db = await self._load_db()
+            if self.failures:
+                record: FailureManifest = {'failures': self.failures}
+                if uidvalidity:
+                    record['uidvalidity'] = uidvalidity
+                db[self.email] = record
+            elif db.pop(self.email, None) is None:
+                return
+            tmp = self.path.with_name(f'.{self.path.name}.tmp')
+            await tmp.write_text(json.dumps(db, allow_nan=False, sort_keys=True, indent=2),
+                                 encoding='utf-8')
+            await tmp.replace(self.path)
+
+    def add(self,
+            number: str,
+            reason: str,
+            data: Iterable[bytes | bytearray | str] | bytes | str | None = None,
+            *,
+            archived: bool = False) -> None:
+        """
+        Record a failure.
+
+        Parameters
+        ----------
+        number : str
+            Message sequence number.
+        reason : str
+            What went wrong.
+        data : Iterable[bytes | bytearray | str] | bytes | str | None
+            Server response lines or header value. The start is kept as the snippet.
+        archived : bool
+            Whether the message was archived anyway.
+        """
+        self.failures.append({
+            'archived': archived,
+            'number': number,
+            'reason': reason,
+            'snippet': _snippet(data),
+            'time': datetime.now(timezone.utc).isoformat(),
+            'uid': None
+        })
+
+    @property
+    def numbers(self) -> list[str]:
+        """Sequence numbers of the failed messages of the current run."""
+        return [x['number'] for x in self.failures]
+
+    def set_uids(self, uids: Mapping[str, str]) -> None:
+        """
+        Attach UIDs to the failures of the current run.
+
+        Parameters
+        ----------
+        uids : Mapping[str, str]
+            UIDs keyed by message sequence number.
+        """
+        for failure in self.failures:
+            failure['uid'] = uids.get(failure['number'])
+
+    def retry_uids(self, uidvalidity: str | None) -> list[str]:
+        """
+        Get the UIDs of messages of the previous run to retry.
+
+        Messages archived under ``unknown-date`` are not retried.
+
+        Parameters
+        ----------
+        uidvalidity : str | None
+            ``UIDVALIDITY`` of the selected mailbox.
+
+        Returns
+        -------
+        list[str]
+            The UIDs. Empty if the mailbox ``UIDVALIDITY`` changed since the failures were
+            recorded.
+        """
+        if not self.previous.get('failures'):
+            return []
+        if self.previous.get('uidvalidity') != uidvalidity:
+            log.warning('UIDVALIDITY of the mailbox changed; failed messages cannot be retried.')
+            return []
+        return [
+            uid for x in self.previous.get('failures', [])
+            if not x['archived'] and (uid := x['uid']) is not None
+        ]
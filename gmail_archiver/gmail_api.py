@@ -0,0 +1,362 @@
+"""Gmail REST API client."""
+from __future__ import annotations
+
+from base64 import urlsafe_b64decode
+from types import MappingProxyType
+from typing import TYPE_CHECKING, Any, cast
+import asyncio
+import json
+import logging
+import re
+import secrets
+
+from .lazy import lazy_import
+from .tracing import span
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+    import niquests
+
+    from .stats import RunStats
+    from .typing import ApiMessage, BatchResult
+else:
+    niquests = lazy_import('niquests')
+
+__all__ = ('API_UIDVALIDITY', 'DEFAULT_CONCURRENCY', 'GMAIL_API_URL', 'MAX_BATCH_SIZE',
+           'MAX_MODIFY_SIZE', 'SYSTEM_LABELS', 'GmailApiClient', 'decode_raw', 'encode_batch',
+           'message_id', 'message_number', 'parse_batch_response')
+
+log = logging.getLogger(__name__)
+
+API_UIDVALIDITY = 'gmail-api'
+"""Stands in for ``UIDVALIDITY`` in the error manifest for failures recorded by the API backend.
+
+Message IDs do not change, so failures are always retried by the API backend and never by IMAP.
+"""
+DEFAULT_CONCURRENCY = 4
+"""Number of batch requests in flight at the same time."""
+GMAIL_API_URL = 'https://gmail.googleapis.com'
+"""Base URL of the Gmail API."""
+MAX_BATCH_SIZE = 100
+"""Maximum number of requests in one batch request."""
+MAX_MODIFY_SIZE = 1000
+"""Maximum number of messages changed by one ``messages.batchModify`` request."""
+SYSTEM_LABELS = MappingProxyType({
+    'DRAFT': '\\Draft',
+    'IMPORTANT': '\\Important',
+    'INBOX': '\\Inbox',
+    'SENT': '\\Sent',
+    'SPAM': '\\Spam',
+    'STARRED': '\\Starred',
+    'TRASH': '\\Trash'
+})
+"""System label IDs and the names IMAP uses for them in ``X-GM-LABELS``.
+
+Other system labels (``UNREAD`` and the categories) have no ``X-GM-LABELS`` equivalent and are
+left out of the label output.
+"""
+_BOUNDARY_RE = re.compile(r'boundary="?([^";]+)"?', re.IGNORECASE)
+_CONTENT_ID_RE = re.compile(rb'^Content-ID:\s*<response-([^>]+)>', re.IGNORECASE | re.MULTILINE)
+_HEAD_END_RE = re.compile(rb'\r?\n\r?\n')
+_LIST_PAGE_SIZE = 500
+_MAX_ATTEMPTS = 5
+_MESSAGES_PATH = '/gmail/v1/users/me/messages'
+_OK = 200
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+def message_number(message_id: str) -> str:
+    """
+    Convert a Gmail API message ID to the decimal ``X-GM-MSGID`` used as the message number.
+
+    Parameters
+    ----------
+    message_id : str
+        Hexadecimal message ID.
+
+    Returns
+    -------
+    str
+        The decimal message ID.
+    """
+    return str(int(message_id, 16))
+
+
+def message_id(number: str) -> str:
+    """
+    Convert a message number from :py:func:`message_number` back to a Gmail API message ID.
+
+    Parameters
+    ----------
+    number : str
+        The decimal message ID.
+
+    Returns
+    -------
+    str
+        Hexadecimal message ID.
+    """
+    return f'{int(number):x}'
+
+
+def decode_raw(message: ApiMessage) -> bytes | None:
+    """
+    Decode the ``raw`` field of a message resource.
+
+    Parameters
+    ----------
+    message : ApiMessage
+        Message resource fetched with ``format=raw``.
+
+    Returns
+    -------
+    bytes | None
+        The complete message, or ``None`` if the resource has no ``raw`` field.
+    """
+    if not (raw := message.get('raw')):
+        return None
+    return urlsafe_b64decode(raw + '=' * (-len(raw) % 4))
+
+
+def encode_batch(paths: Sequence[str], boundary: str) -> bytes:
+    """
+    Encode ``GET`` requests as the ``multipart/mixed`` body of a batch request.
+
+    Parameters
+    ----------
+    paths : Sequence[str]
+        Request paths including the query string. The index of each path is its ``Content-ID``.
+    boundary : str
+        Multipart boundary.
+
+    Returns
+    -------
+    bytes
+        The request body.
+    """
+    return ''.join([
+        *(f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <{i}>\r\n\r\n'
+          f'GET {path}\r\n\r\n' for i, path in enumerate(paths)), f'--{boundary}--\r\n'
+    ]).encode()
+
+
+def parse_batch_response(content_type: str, body: bytes) -> dict[str, BatchResult]:
+    """
+    Split the ``multipart/mixed`` response of a batch request.
+
+    Parameters
+    ----------
+    content_type : str
+        ``Content-Type`` header of the response, which carries the boundary.
+    body : bytes
+        The response body.
+
+    Returns
+    -------
+    dict[str, BatchResult]
+        Status code and decoded JSON body keyed by the ``Content-ID`` of the request.
+
+    Raises
+    ------
+    ValueError
+        If the content type has no boundary.
+    """
+    if not (match := _BOUNDARY_RE.search(content_type)):
+        msg = f'No boundary in batch response content type {content_type!r}.'
+        raise ValueError(msg)
+    ret: dict[str, BatchResult] = {}
+    for part in body.split(f'--{match.group(1)}'.encode())[1:]:
+        if part.startswith(b'--'):
+            break
+        part_head, _, response = _split_head(part.lstrip(b'\r\n'))
+        if not (content_id := _CONTENT_ID_RE.search(part_head)):
+            continue
+        status_head, _, content = _split_head(response)
+        content = content.strip()
+        ret[content_id.group(1).decode()] = (int(status_head.split(
+            None, 2)[1]), json.loads(content) if content else None)
+    return ret
+
+
+def _split_head(data: bytes) -> tuple[bytes, bytes, bytes]:
+    if not (match := _HEAD_END_RE.search(data)):
+        return data, b'', b''
+    return data[:match.start()], data[match.start():match.end()], data[match.end():]
+
+
+class GmailApiClient:
+    """
+    Client for the parts of the Gmail API used to archive messages.
+
+    Requests that fail with a rate limit or server error (as a whole or within a batch) are retried
+    with exponential backoff. Over HTTPS the session negotiates HTTP/2, so concurrent batches share
+    one connection.
+
+    Parameters
+    ----------
+    session : niquests.AsyncSession
+        Session to send requests with.
+    access_token : str
+        OAuth2 access token with the ``https://mail.google.com/`` scope.
+    base_url : str
+        Base URL of the API.
+    retry_delay : float
+        Seconds to wait before the first retry. The delay doubles with every attempt.
+    stats : RunStats | None
+        Statistics object in which retries are counted.
+    """
+    def __init__(self,
+                 session: niquests.AsyncSession,
+                 access_token: str,
+                 *,
+                 base_url: str = GMAIL_API_URL,
+                 retry_delay: float = 1.0,
+                 stats: RunStats | None = None) -> None:
+        self.base_url = base_url.rstrip('/')
+        """Base URL of the API."""
+        self.headers = {'Authorization': f'Bearer {access_token}'}
+        """Headers sent with every request."""
+        self.retry_delay = retry_delay
+        """Seconds to wait before the first retry."""
+        self.session = session
+        """Session to send requests with."""
+        self.stats = stats
+        """Statistics object."""
+
+    async def _backoff(self, attempt: int) -> None:
+        if self.stats:
+            self.stats.retries += 1
+        await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+    async def _request(self, method: str, path: str, **kwargs: Any) -> niquests.Response:
+        headers = {**self.headers, **kwargs.pop('headers', {})}
+        for attempt in range(_MAX_ATTEMPTS):
+            response = await self.session.request(method,
+                                                  f'{self.base_url}{path}',
+                                                  headers=headers,
+                                                  timeout=60,
+                                                  **kwargs)
+            if response.status_code not in _RETRY_STATUSES or attempt == _MAX_ATTEMPTS - 1:
+                break
+            log.debug('%s %s returned %d. Retrying.', method, path, response.status_code)
+            await self._backoff(attempt)
+        response.raise_for_status()
+        return cast('niquests.Response', response)
+
+    async def list_messages(self, query: str) -> list[str]:
+        """
+        List the IDs of all messages matching a search query, following every page.
+
+        Spam and trash are not included, as with ``[Gmail]/All Mail`` over IMAP.
+
+        Parameters
+        ----------
+        query : str
+            Gmail search query such as ``before:2024/01/31``.
+
+        Returns
+        -------
+        list[str]
+            Message IDs, newest first.
+        """
+        ids: list[str] = []
+        params = {'maxResults': str(_LIST_PAGE_SIZE), 'q': query}
+        while True:
+            response = await self._request('GET', _MESSAGES_PATH, params=params)
+            data = response.json()
+            ids.extend(x['id'] for x in data.get('messages', []))
+            if not (page_token := data.get('nextPageToken')):
+                return ids
+            params['pageToken'] = page_token
+
+    async def labels(self) -> dict[str, str]:
+        """
+        Get the names of the labels of the account as IMAP reports them in ``X-GM-LABELS``.
+
+        Returns
+        -------
+        dict[str, str]
+            Label names keyed by label ID. System labels without an IMAP equivalent are left out.
+        """
+        response = await self._request('GET', '/gmail/v1/users/me/labels')
+        return {
+            x['id']: SYSTEM_LABELS[x['id']] if x.get('type') == 'system' else x['name']
+            for x in response.json().get('labels', [])
+            if x.get('type') != 'system' or x['id'] in SYSTEM_LABELS
+        }
+
+    async def get_raw(self, ids: Sequence[str]) -> dict[str, BatchResult]:
+        """
+        Fetch complete messages with one batch request of ``messages.get`` with ``format=raw``.
+
+        Parameters
+        ----------
+        ids : Sequence[str]
+            Up to :py:data:`MAX_BATCH_SIZE` message IDs.
+
+        Returns
+        -------
+        dict[str, BatchResult]
+            Status code and message resource (or error) keyed by message ID. Requests still
+            rate limited after the last attempt keep their error status.
+        """
+        results: dict[str, BatchResult] = {}
+        pending = list(ids)
+        for attempt in range(_MAX_ATTEMPTS):
+            boundary = f'batch_{secrets.token_hex(8)}'
+            with span('api-batch', count=len(pending)):
+                response = await self._request(
+                    'POST',
+                    '/batch/gmail/v1',
+                    data=encode_batch([f'{_MESSAGES_PATH}/{x}?format=raw' for x in pending],
+                                      boundary),
+                    headers={'Content-Type': f'multipart/mixed; boundary={boundary}'})
+            parts = parse_batch_response(response.headers.get('Content-Type', ''), response.content
+                                         or b'')
+            retry: list[str] = []
+            for i, id_ in enumerate(pending):
+                results[id_] = parts.get(str(i), (0, None))
+                if results[id_][0] in _RETRY_STATUSES or results[id_][0] == 0:
+                    retry.append(id_)
+            if not retry or attempt == _MAX_ATTEMPTS - 1:
+                break
+            log.debug('Retrying %d of %d requests of a batch.', len(retry), len(pending))
+            pending = retry
+            await self._backoff(attempt)
+        return results
+
+    async def trash(self, ids: Sequence[str]) -> None:
+        """
+        Move messages to the trash with ``messages.batchModify``.
+
+        Parameters
+        ----------
+        ids : Sequence[str]
+            Message IDs. Split into requests of at most :py:data:`MAX_MODIFY_SIZE`.
+        """
+        for start in range(0, len(ids), MAX_MODIFY_SIZE):
+            await self._request('POST',
+                                f'{_MESSAGES_PATH}/batchModify',
+                                json={
+                                    'addLabelIds': ['TRASH'],
+                                    'ids': list(ids[start:start + MAX_MODIFY_SIZE])
+                                })
+
+    @staticmethod
+    def message(result: BatchResult) -> ApiMessage | None:
+        """
+        Get the message resource of a successful request of a batch.
+
+        Parameters
+        ----------
+        result : BatchResult
+            Entry of :py:meth:`get_raw`.
+
+        Returns
+        -------
+        ApiMessage | None
+            The resource, or ``None`` if the request failed.
+        """
+        status, body = result
+        return cast('ApiMessage', body) if status == _OK and isinstance(body, dict) else None
@@ -0,0 +1,105 @@
+"""Throughput history of previous runs."""
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, cast
+import json
+import logging
+
+from .tokens import file_lock
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from anyio import Path as AsyncPath
+
+    from .stats import RunStats
+    from .typing import HistoryDB, RunRecord
+
+__all__ = ('MAX_HISTORY_ENTRIES', 'average_throughput', 'load_history', 'record_run')
+
+log = logging.getLogger(__name__)
+
+MAX_HISTORY_ENTRIES = 20
+"""Number of runs kept per account."""
+
+
+async def load_history(path: AsyncPath) -> HistoryDB:
+    """
+    Load the run history database.
+
+    Parameters
+    ----------
+    path : AsyncPath
+        Path to the history JSON file.
+
+    Returns
+    -------
+    HistoryDB
+        Runs keyed by account. Empty if the file is missing or invalid.
+    """
+    if not await path.exists():
+        return {}
+    try:
+        data = json.loads(await path.read_text(encoding='utf-8'))
+    except json.JSONDecodeError:
+        log.warning('Ignoring invalid history file %s.', path)
+        return {}
+    return cast('HistoryDB', data) if isinstance(data, dict) else {}
+
+
+async def record_run(path: AsyncPath, email: str, stats: RunStats) -> None:
+    """
+    Append a finished run to the history database.
+
+    Only the most recent :py:data:`MAX_HISTORY_ENTRIES` runs are kept for each account. The file is
+    read and replaced under a lock, and replaced atomically so concurrent runs do not lose each
+    other's records.
+
+    Parameters
+    ----------
+    path : AsyncPath
+        Path to the history JSON file.
+    email : str
+        The account.
+    stats : RunStats
+        Statistics of the run.
+    """
+    async with file_lock(Path(path.with_name(f'.{path.name}.lock'))):
+        db = await load_history(path)
+        runs = db.setdefault(email, [])
+        runs.append({
+            'bytes': stats.bytes_downloaded,
+            'finished': datetime.now(timezone.utc).isoformat(),
+            'messages': stats.messages,
+            'seconds': stats.elapsed
+        })
+        db[email] = runs[-MAX_HISTORY_ENTRIES:]
+        tmp = path.with_name(f'.{path.name}.tmp')
+        await tmp.write_text(json.dumps(db, allow_nan=False, sort_keys=True, indent=2),
+                             encoding='utf-8')
+        await tmp.replace(path)
+
+
+def average_throughput(runs: Iterable[RunRecord]) -> float | None:
+    """
+    Calculate the byte throughput across previous runs.
+
+    Parameters
+    ----------
+    runs : Iterable[RunRecord]
+        Previous runs.
+
+    Returns
+    -------
+    float | None
+        Bytes per second, or ``None`` if no run downloaded anything.
+    """
+    total_bytes = 0
+    total_seconds = 0.0
+    for run in runs:
+        if run.get('bytes', 0) > 0 and run.get('seconds', 0) > 0:
+            total_bytes += run['bytes']
+            total_seconds += run['seconds']
+    return total_bytes / total_seconds if total_seconds else None
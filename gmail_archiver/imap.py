@@ -0,0 +1,200 @@
+"""IMAP response parsing helpers."""
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+import re
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from .typing import FetchedMessage
+
+__all__ = ('parse_exists', 'parse_fetch_response', 'parse_highestmodseq', 'parse_labels',
+           'parse_msgid', 'parse_thrid', 'parse_uids', 'parse_uidvalidity')
+
+_EXISTS_RE = re.compile(rb'^(\d+) EXISTS')
+_FETCH_START_RE = re.compile(rb'^(\d+) FETCH \(')
+_HIGHESTMODSEQ_RE = re.compile(rb'\[HIGHESTMODSEQ (\d+)\]')
+_LABELS_START = b'X-GM-LABELS ('
+_LABEL_TOKEN_RE = re.compile(rb'\s*(?:"((?:[^"\\]|\\.)*)"|([^\s()"]+)|(\)))')
+_MSGID_RE = re.compile(rb'[( ]X-GM-MSGID (\d+)')
+_THRID_RE = re.compile(rb'[( ]X-GM-THRID (\d+)')
+_UID_RE = re.compile(rb'[( ]UID (\d+)')
+_UIDVALIDITY_RE = re.compile(rb'\[UIDVALIDITY (\d+)\]')
+
+
+def parse_labels(data: bytes) -> list[str] | None:
+    """
+    Extract the ``X-GM-LABELS`` list from FETCH message data.
+
+    Parameters
+    ----------
+    data : bytes
+        Message data such as ``1 FETCH (X-GM-LABELS (Work "My label"))``.
+
+    Returns
+    -------
+    list[str] | None
+        The labels, or ``None`` if the data has no ``X-GM-LABELS`` item.
+    """
+    if (start := data.find(_LABELS_START)) == -1:
+        return None
+    labels: list[str] = []
+    pos = start + len(_LABELS_START)
+    while match := _LABEL_TOKEN_RE.match(data, pos):
+        pos = match.end()
+        if match.group(3):
+            break
+        if match.group(1) is not None:
+            labels.append(re.sub(rb'\\(.)', rb'\1', match.group(1)).decode())
+        else:
+            labels.append(match.group(2).decode())
+    return labels
+
+
+def parse_fetch_response(lines: Iterable[bytes | bytearray | str]) -> dict[str, FetchedMessage]:
+    """
+    Split a multi-message ``FETCH`` response into per-message records.
+
+    Each message starts with a ``<number> FETCH (`` line. A literal (the message body) following
+    that line becomes ``raw``; the text around it is kept in ``data`` for parsing other items.
+
+    Parameters
+    ----------
+    lines : Iterable[bytes | bytearray | str]
+        Response lines as returned by :py:mod:`aioimaplib`.
+
+    Returns
+    -------
+    dict[str, FetchedMessage]
+        Records keyed by message sequence number.
+    """
+    ret: dict[str, FetchedMessage] = {}
+    current: FetchedMessage | None = None
+    for line in lines:
+        if isinstance(line, bytearray):
+            if current is not None and current['raw'] is None:
+                current['raw'] = bytes(line)
+            continue
+        if not isinstance(line, bytes):
+            continue
+        if match := _FETCH_START_RE.match(line):
+            current = {'data': line, 'number': match.group(1).decode(), 'raw': None}
+            ret[current['number']] = current
+        elif current is not None:
+            current['data'] += b' ' + line
+    return ret
+
+
+def parse_uids(lines: Iterable[bytes | bytearray | str]) -> dict[str, str]:
+    """
+    Extract the ``UID`` of each message from a ``FETCH`` response.
+
+    Parameters
+    ----------
+    lines : Iterable[bytes | bytearray | str]
+        Response lines as returned by :py:mod:`aioimaplib`.
+
+    Returns
+    -------
+    dict[str, str]
+        UIDs keyed by message sequence number.
+    """
+    return {
+        number: match.group(1).decode()
+        for number, record in parse_fetch_response(lines).items()
+        if (match := _UID_RE.search(record['data']))
+    }
+
+
+def parse_uidvalidity(lines: Iterable[bytes | bytearray | str]) -> str | None:
+    """
+    Extract ``UIDVALIDITY`` from a ``SELECT`` or ``EXAMINE`` response.
+
+    Parameters
+    ----------
+    lines : Iterable[bytes | bytearray | str]
+        Response lines as returned by :py:mod:`aioimaplib`.
+
+    Returns
+    -------
+    str | None
+        The value, or ``None`` if the response does not include it.
+    """
+    return _response_code(lines, _UIDVALIDITY_RE)
+
+
+def parse_exists(lines: Iterable[bytes | bytearray | str]) -> int | None:
+    """
+    Extract the number of messages from a ``SELECT`` or ``EXAMINE`` response.
+
+    Parameters
+    ----------
+    lines : Iterable[bytes | bytearray | str]
+        Response lines as returned by :py:mod:`aioimaplib`.
+
+    Returns
+    -------
+    int | None
+        The ``EXISTS`` count, or ``None`` if the response does not include it.
+    """
+    return int(value) if (value := _response_code(lines, _EXISTS_RE)) is not None else None
+
+
+def parse_highestmodseq(lines: Iterable[bytes | bytearray | str]) -> str | None:
+    """
+    Extract ``HIGHESTMODSEQ`` (RFC 7162) from a ``SELECT`` or ``EXAMINE`` response.
+
+    Parameters
+    ----------
+    lines : Iterable[bytes | bytearray | str]
+        Response lines as returned by :py:mod:`aioimaplib`.
+
+    Returns
+    -------
+    str | None
+        The value, or ``None`` if the server does not support ``CONDSTORE``.
+    """
+    return _response_code(lines, _HIGHESTMODSEQ_RE)
+
+
+def parse_msgid(data: bytes) -> str | None:
+    """
+    Extract ``X-GM-MSGID`` from FETCH message data.
+
+    Parameters
+    ----------
+    data : bytes
+        Message data such as ``1 FETCH (X-GM-MSGID 1278455344230334865)``.
+
+    Returns
+    -------
+    str | None
+        The Gmail message ID, or ``None`` if the data has no ``X-GM-MSGID`` item.
+    """
+    return match.group(1).decode() if (match := _MSGID_RE.search(data)) else None
+
+
+def parse_thrid(data: bytes) -> str | None:
+    """
+    Extract ``X-GM-THRID`` from FETCH message data.
+
+    Parameters
+    ----------
+    data : bytes
+        Message data such as ``1 FETCH (X-GM-THRID 1278455344230334865)``.
+
+    Returns
+    -------
+    str | None
+        The Gmail thread ID, or ``None`` if the data has no ``X-GM-THRID`` item.
+    """
+    return match.group(1).decode() if (match := _THRID_RE.search(data)) else None
+
+
+def _response_code(lines: Iterable[bytes | bytearray | str],
+                   pattern: re.Pattern[bytes]) -> str | None:
+    for line in lines:
+        if isinstance(line, bytes) and (match := pattern.search(line)):
+            return match.group(1).decode()
+    return None
@@ -0,0 +1,275 @@
+"""Index of archived messages by Gmail message ID."""
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, cast
+import asyncio
+import json
+import logging
+
+if TYPE_CHECKING:
+    from os import PathLike
+
+    from anyio import Path as AsyncPath
+
+    from .typing import IndexEntry, MessageIndexData
+
+__all__ = ('INDEX_FILE', 'MessageIndex')
+
+log = logging.getLogger(__name__)
+
+INDEX_FILE = '.index.json'
+"""Name of the index in the directory of an account."""
+
+
+class MessageIndex:
+    """
+    Archived messages of an account keyed by ``X-GM-MSGID``.
+
+    Sequence numbers change as messages are removed from the mailbox, but the Gmail message ID does
+    not. Files are named by it, and the index records the files written for each message so they can
+    be found again, for example to update labels with :py:func:`~gmail_archiver.utils.sync_labels`.
+    Messages already in the index are not archived again.
+
+    The ``X-GM-THRID`` of each message is kept as well, so the messages of a conversation can be
+    looked up with :py:meth:`thread`.
+
+    Messages written to a tar archive or to object storage are recorded by the names of their
+    members or objects (see :py:meth:`is_member`). There are no such files to check for or to
+    update.
+
+    It also holds the mailbox ``HIGHESTMODSEQ`` (RFC 7162) as of the last time all indexed labels
+    were known to be current, so a label sync only asks for changes since then.
+
+    One index can be shared by concurrent runs over several mailboxes of the account. Messages are
+    claimed by the run that archives them (see :py:meth:`claim`) and loading keeps the entries
+    already added.
+
+    Parameters
+    ----------
+    path : AsyncPath
+        Path to the JSON index in the directory of the account. Paths of files are stored relative
+        to its directory.
+    """
+    def __init__(self, path: AsyncPath) -> None:
+        self.highestmodseq: str | None = None
+        """``HIGHESTMODSEQ`` of the mailbox when labels were last known to be current."""
+        self.messages: dict[str, IndexEntry] = {}
+        """Files keyed by ``X-GM-MSGID``."""
+        self.path = path
+        """Path to the JSON index."""
+        self.uidvalidity: str | None = None
+        """``UIDVALIDITY`` of the mailbox :py:attr:`highestmodseq` belongs to."""
+        self._claimed: set[str] = set()
+        self._dirty = False
+        self._lock = asyncio.Lock()
+        self._threads: dict[str, list[str]] = {}
+
+    async def load(self) -> None:
+        """Read the index, keeping entries added since it was last saved.
+
+        A missing or invalid index is treated as empty.
+        """
+        if not await self.path.exists():
+            return
+        try:
+            data = json.loads(await self.path.read_text(encoding='utf-8'))
+        except json.JSONDecodeError:
+            log.warning('Ignoring invalid message index %s.', self.path)
+            return
+        if not isinstance(data, dict):
+            log.warning('Ignoring message index %s that is not an object.', self.path)
+            return
+        data = cast('MessageIndexData', data)
+        self.highestmodseq = data.get('highestmodseq')
+        self.messages = {**data.get('messages', {}), **self.messages}
+        self.uidvalidity = data.get('uidvalidity')
+        self._threads = {}
+        for msgid, entry in self.messages.items():
+            if thread := entry.get('thread'):
+                self._threads.setdefault(thread, []).append(msgid)
+
+    async def save(self) -> None:
+        """Write the index if it changed."""
+        async with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            data: MessageIndexData = {'messages': self.messages}
+            if self.highestmodseq and self.uidvalidity:
+                data['highestmodseq'] = self.highestmodseq
+                data['uidvalidity'] = self.uidvalidity
+            await self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(f'.{self.path.name}.tmp')
+            await tmp.write_text(json.dumps(data, sort_keys=True), encoding='utf-8')
+            await tmp.replace(self.path)
+
+    def add(self,
+            msgid: str,
+            message: PathLike[str],
+            labels: PathLike[str],
+            thread: str | None = None,
+            *,
+            member: bool = False) -> None:
+        """
+        Record the files of an archived message.
+
+        Parameters
+        ----------
+        msgid : str
+            ``X-GM-MSGID`` of the message.
+        message : PathLike[str]
+            Message file.
+        labels : PathLike[str]
+            Labels file, whether or not it was written.
+        thread : str | None
+            ``X-GM-THRID`` of the message.
+        member : bool
+            Whether ``message`` and ``labels`` name tar members or objects in storage, not files.
+        """
+        entry: IndexEntry = {'labels': self._relative(labels), 'message': self._relative(message)}
+        if member:
+            entry['member'] = True
+        if thread:
+            entry['thread'] = thread
+            if msgid not in (msgids := self._threads.setdefault(thread, [])):
+                msgids.append(msgid)
+        self.messages[msgid] = entry
+        self._dirty = True
+
+    def archived(self, msgid: str) -> bool:
+        """
+        Check if a message is in the index.
+
+        Parameters
+        ----------
+        msgid : str
+            ``X-GM-MSGID`` of the message.
+
+        Returns
+        -------
+        bool
+            ``True`` if the message was archived.
+        """
+        return msgid in self.messages
+
+    def claim(self, msgid: str) -> bool:
+        """
+        Claim a message for archiving by the current run.
+
+        Parameters
+        ----------
+        msgid : str
+            ``X-GM-MSGID`` of the message.
+
+        Returns
+        -------
+        bool
+            ``True`` if the message was not claimed yet.
+        """
+        if msgid in self._claimed:
+            return False
+        self._claimed.add(msgid)
+        return True
+
+    def is_member(self, msgid: str) -> bool:
+        """
+        Check if an archived message was written to a tar archive or object storage.
+
+        Parameters
+        ----------
+        msgid : str
+            ``X-GM-MSGID`` of the message.
+
+        Returns
+        -------
+        bool
+            ``True`` if the paths of the message name tar members or objects in storage.
+        """
+        return (entry := self.messages.get(msgid)) is not None and entry.get('member', False)
+
+    def message_file(self, msgid: str) -> AsyncPath | None:
+        """
+        Get the file of an archived message.
+
+        Parameters
+        ----------
+        msgid : str
+            ``X-GM-MSGID`` of the message.
+
+        Returns
+        -------
+        AsyncPath | None
+            The path, or ``None`` if the message is not in the index.
+        """
+        return self.path.parent / entry['message'] if (entry := self.messages.get(msgid)) else None
+
+    def thread(self, thrid: str) -> list[AsyncPath]:
+        """
+        Get the files of the archived messages of a conversation.
+
+        Parameters
+        ----------
+        thrid : str
+            ``X-GM-THRID`` of the conversation.
+
+        Returns
+        -------
+        list[AsyncPath]
+            Message files in the order the messages were archived.
+        """
+        return [
+            self.path.parent / self.messages[x]['message'] for x in self._threads.get(thrid, [])
+        ]
+
+    def labels_file(self, msgid: str) -> AsyncPath | None:
+        """
+        Get the labels file of an archived message.
+
+        Parameters
+        ----------
+        msgid : str
+            ``X-GM-MSGID`` of the message.
+
+        Returns
+        -------
+        AsyncPath | None
+            The path, or ``None`` if the message is not in the index.
+        """
+        return self.path.parent / entry['labels'] if (entry := self.messages.get(msgid)) else None
+
+    def set_modseq(self, uidvalidity: str | None, highestmodseq: str | None) -> None:
+        """
+        Record the mailbox state all indexed labels are current as of.
+
+        Parameters
+        ----------
+        uidvalidity : str | None
+            ``UIDVALIDITY`` of the mailbox.
+        highestmodseq : str | None
+            ``HIGHESTMODSEQ`` of the mailbox.
+        """
+        self.highestmodseq = highestmodseq
+        self.uidvalidity = uidvalidity
+        self._dirty = True
+
+    def changed_since(self, uidvalidity: str | None) -> str | None:
+        """
+        Get the modification sequence to ask for label changes since.
+
+        Parameters
+        ----------
+        uidvalidity : str | None
+            ``UIDVALIDITY`` of the selected mailbox.
+
+        Returns
+        -------
+        str | None
+            The stored ``HIGHESTMODSEQ``, or ``None`` if all labels must be fetched because there is
+            none or the mailbox was recreated.
+        """
+        if self.highestmodseq and self.uidvalidity == uidvalidity:
+            return self.highestmodseq
+        return None
+
+    def _relative(self, path: PathLike[str]) -> str:
+        return str(type(self.path)(path).relative_to(self.path.parent))
@@ -0,0 +1,49 @@
+"""Deferred imports of modules that are slow to import."""
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+import importlib.util
+import sys
+
+if TYPE_CHECKING:
+    from types import ModuleType
+
+__all__ = ('lazy_import',)
+
+
+def lazy_import(name: str) -> ModuleType:
+    """
+    Import a module on first attribute access.
+
+    The module is registered in :py:data:`sys.modules` (and as an attribute of its parent package)
+    straight away, so ``import`` statements elsewhere get the same object. Its code runs the first
+    time an attribute is read, including by :py:func:`unittest.mock.patch`.
+
+    Parameters
+    ----------
+    name : str
+        Absolute module name.
+
+    Returns
+    -------
+    ModuleType
+        The module, or the already imported module if there is one.
+
+    Raises
+    ------
+    ModuleNotFoundError
+        If the module cannot be found.
+    """
+    if (module := sys.modules.get(name)) is not None:
+        return module
+    if (spec := importlib.util.find_spec(name)) is None or spec.loader is None:
+        msg = f'No module named {name!r}'
+        raise ModuleNotFoundError(msg, name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
@@ -5,12 +5,11 @@ from base64 import urlsafe_b64encode
 from collections.abc import Mapping, MutableMapping
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import TYPE_CHECKING, cast
+from typing import TYPE_CHECKING, Any, cast
 from urllib.parse import urlencode
 import asyncio
 import contextlib
 import hashlib
-import http.server
 import json
 import logging
 import secrets
@@ -19,21 +18,58 @@ import urllib.parse
 from anyio import Path as AsyncPath
 from bascom import setup_logging
 from platformdirs import user_cache_path, user_config_path
-import aioimaplib  # type: ignore[import-untyped]
 import click
-import tomlkit
 
+from .failures import ErrorManifest
+from .history import average_throughput, load_history, record_run
+from .index import INDEX_FILE, MessageIndex
+from .lazy import lazy_import
+from .metrics import MetricsExporter
+from .planning import DEFAULT_LARGE_MESSAGE_SIZE
+from .profiling import profiled
+from .s3 import DEFAULT_REGION, DEFAULT_UPLOAD_CONCURRENCY, S3Client
+from .stats import RunStats, format_size
+from .throttle import DEFAULT_DAILY_LIMIT, DailyQuota, TokenBucket
+from .tokens import TokenStore
+from .tracing import DEFAULT_SAMPLE_RATE, Tracer
 from .utils import (
     GoogleOAuthClient,
     archive_emails,
+    archive_emails_api,
+    archive_mailboxes,
     authorize_tokens,
+    estimate_archive,
     get_auth_http_handler,
     get_localhost_redirect_uri,
+    oauth_session,
     refresh_token,
+    sync_labels,
 )
+from .writers import create_writer
 
 if TYPE_CHECKING:
-    from .typing import Config
+    from collections.abc import AsyncIterator
+    import http.server as http_server
+
+    import aioimaplib  # type: ignore[import-untyped]
+    import niquests
+    import tomlkit
+
+    from .typing import (
+        Backend,
+        Config,
+        Estimate,
+        MailboxConfig,
+        OutputFormat,
+        S3Config,
+        WorkOrder,
+    )
+    from .writers import MessageWriter
+else:
+    http_server = lazy_import('http.server')
+    aioimaplib = lazy_import('aioimaplib')
+    niquests = lazy_import('niquests')
+    tomlkit = lazy_import('tomlkit')
 
 __all__ = ('main',)
 
@@ -44,23 +80,46 @@ async def _async_main(email: str,
                       days: int = 90,
                       out_dir: Path | None = None,
                       *,
+                      adaptive: bool = True,
                       auth_only: bool = False,
+                      backend: Backend = 'imap',
+                      compress: bool = True,
+                      daily_limit: int = DEFAULT_DAILY_LIMIT,
                       debug_imap: bool = False,
                       delete: bool = True,
-                      force_refresh: bool = False) -> None:
+                      dry_run: bool = False,
+                      force_refresh: bool = False,
+                      keep_going: bool = False,
+                      label_sync: bool = False,
+                      large_message_size: int = DEFAULT_LARGE_MESSAGE_SIZE,
+                      max_rate: int = 0,
+                      metrics_file: Path | None = None,
+                      metrics_port: int | None = None,
+                      order: WorkOrder = 'small-first',
+                      output_format: OutputFormat = 'eml',
+                      plan: bool = False,
+                      query: str | None = None,
+                      retry_failed: bool = False,
+                      stats_file: Path | None = None,
+                      tar_file: Path | None = None) -> None:
+    if (output_format == 'tar' and not tar_file and delete
+            and not (auth_only or dry_run or label_sync)):
+        # A pipe cannot be synced, so messages could be trashed before their copy is stored.
+        msg = ('Messages written to standard output cannot be synced. Pass --no-delete or '
+               '--tar-file.')
+        raise click.UsageError(msg)
     oauth_path = AsyncPath(user_cache_path('gmail-archiver', ensure_exists=True))
     config_path = AsyncPath(user_config_path('gmail-archiver', ensure_exists=True))
     oauth_file = oauth_path / 'oauth.json'
+    errors_file = oauth_path / 'errors.json'
+    history_file = oauth_path / 'history.json'
+    quota_file = oauth_path / 'quota.json'
     config_file = config_path / 'config.toml'
-    oauth_exists, config_exists = await asyncio.gather(oauth_file.exists(), config_file.exists())
-    try:
-        auth_data_db = json.loads(await oauth_file.read_text(
-            encoding='utf-8')) if oauth_exists else {}
-    except json.JSONDecodeError:
-        auth_data_db = {}
+    token_store = TokenStore(oauth_file)
+    auth_data_db, config_exists = await asyncio.gather(token_store.load(), config_file.exists())
     config: Config = {}
-    click.echo(f'Using authorisation database: {oauth_file}')
-    click.echo(f'Using authorisation file: {config_file}')
+    click.echo(f'Using authorisation database: {oauth_file}', err=True)
+    click.echo(f'Using authorisation file: {config_file}', err=True)
     if config_exists:
         config_text = await config_file.read_text()
         config = cast('Config',
@@ -68,112 +127,436 @@ async def _async_main(email: str,
     if 'client_id' not in config or 'client_secret' not in config:
         click.echo('client_id and client_secret must be set in the config file.', err=True)
         raise click.Abort
+    mailboxes = _mailboxes(config)
+    s3 = _s3_config(config) if output_format == 's3' else None
+    if mailboxes and backend != 'imap':
+        log.warning('Mailboxes in the config file are only archived over IMAP. Archiving all mail.')
+        mailboxes = []
     out_dir = out_dir or Path() / email
     out_dir_async = AsyncPath(out_dir)
     await out_dir_async.mkdir(parents=True, exist_ok=True)
-    expiration_time = (auth_data_db.get(email, {}).get('expiration_time')
-                       if auth_data_db and isinstance(auth_data_db, Mapping) else None)
-    if (not auth_data_db or not isinstance(auth_data_db, Mapping) or email not in auth_data_db
-            or 'refresh_token' not in auth_data_db[email]
-            or 'expiration_time' not in auth_data_db[email]):
-        if not auth_data_db or not isinstance(auth_data_db, Mapping):
-            log.debug('Empty authorisation database or is not a mapping.')
-            auth_data_db = {}
-        # region Authorisation
-        client = GoogleOAuthClient(config['client_id'], config['client_secret'])
-        await client.discover()
-        verifier = secrets.token_urlsafe(90)
-        challenge = urlsafe_b64encode(hashlib.sha256(verifier.encode()).digest())[:-1]
-        listen_port, redirect_uri = get_localhost_redirect_uri()
-        base_params = {
-            'client_id': client.client_id,
-            'login_hint': email,
-            'response_type': 'code',
-            'redirect_uri': redirect_uri,
-            'code_challenge': challenge,
-            'code_challenge_method': 'S256',
-            'scope': 'https://mail.google.com/'
-        }
-        log.debug('Parameters: %s', base_params)
-        click.echo(f'\n{client.authorization_endpoint}'
-                   f'?{urlencode(base_params, quote_via=urllib.parse.quote)}')
-        click.echo('\nVisit displayed URL to authorise this application. Waiting...')
-        auth_code = ''
-
-        def set_auth_code(x: str) -> None:  # pragma: no cover
-            nonlocal auth_code
-            auth_code = x
-
-        def _run_auth_server(listen_port: int, handler_cls: type) -> None:
-            with (http.server.HTTPServer(('127.0.0.1', listen_port), handler_cls) as
-                  httpd, contextlib.suppress(KeyboardInterrupt)):
-                httpd.handle_request()
-
-        await asyncio.to_thread(_run_auth_server, listen_port, get_auth_http_handler(set_auth_code))
-        if not auth_code:
-            click.echo('Did not obtain an authorisation code.', err=True)
-            raise click.exceptions.Exit(1)
-        # endregion
-        auth_data = await authorize_tokens(client.token_endpoint, config['client_id'],
-                                           config['client_secret'], auth_code, verifier,
-                                           redirect_uri)
-        expires_in = auth_data['expires_in']
-        auth_data['expiration_time'] = (datetime.now(tz=timezone.utc) +
-                                        timedelta(seconds=expires_in)).isoformat()
-        log.debug('New auth data for %s: %s', email, auth_data)
-        if not isinstance(auth_data_db, MutableMapping):
-            click.echo('Authorisation database must be a JSON object.', err=True)
-            raise click.Abort
-        auth_data_db[email] = auth_data
-        if 'refresh_token' not in auth_data_db[email]:
-            click.echo('Authorisation response did not include a refresh_token.', err=True)
-            raise click.Abort
-        await oauth_file.write_text(
-            json.dumps(auth_data_db, allow_nan=False, sort_keys=True, indent=2))
-    elif ((expiration_time and
-           (datetime.fromisoformat(expiration_time) <= datetime.now(timezone.utc)))
-          or force_refresh):
-        log.debug('Refreshing token.')
-        ref_token = auth_data_db[email]['refresh_token']
-        client = GoogleOAuthClient(config['client_id'], config['client_secret'])
-        await client.discover()
-        auth_data = await refresh_token(client.token_endpoint, config['client_id'],
-                                        config['client_secret'], ref_token)
-        expires_in = auth_data['expires_in']
-        auth_data['expiration_time'] = (datetime.now(timezone.utc) +
-                                        timedelta(seconds=expires_in)).isoformat()
-        if not isinstance(auth_data_db, MutableMapping):
-            click.echo('Authorisation database must be a JSON object.', err=True)
-            raise click.Abort
-        auth_data_db[email] = auth_data
-        log.debug('New auth data for %s: %s', email, auth_data)
-        auth_data_db[email]['refresh_token'] = ref_token
-        await oauth_file.write_text(
-            json.dumps(auth_data_db, allow_nan=False, sort_keys=True, indent=2))
-    await oauth_file.chmod(0o600)
+    index = MessageIndex((await out_dir_async.resolve()) / email / INDEX_FILE)
+    # The estimate and label sync are only available over IMAP. Several mailboxes are archived
+    # over connections of their own.
+    use_imap = (backend == 'imap' and not mailboxes) or dry_run or label_sync
+    # Connection setup does not depend on the token, so it overlaps with a refresh. It is not
+    # started before an interactive authorisation, which may take longer than the server waits.
+    imap_conn = (aioimaplib.IMAP4_SSL('imap.gmail.com') if use_imap and not auth_only
+                 and _has_refresh_token(auth_data_db, email) else None)
+    connecting = asyncio.create_task(_connect_imap(imap_conn)) if imap_conn else None
+    try:
+        auth_data_db = await _ensure_token(email,
+                                           config,
+                                           token_store,
+                                           oauth_path / 'discovery.json',
+                                           force_refresh=force_refresh)
+        await oauth_file.chmod(0o600)
+    except BaseException:
+        if imap_conn and connecting:
+            await _abandon_connection(imap_conn, connecting)
+        raise
     log.info('Logging in.')
     if auth_only:
         return
-    imap_conn = aioimaplib.IMAP4_SSL('imap.gmail.com')
-    await imap_conn.wait_hello_from_server()
+    imap_conn = await (connecting or _connect_imap()) if use_imap else None
+    stats = RunStats()
     try:
-        ret = await archive_emails(imap_conn,
-                                   email,
-                                   auth_data_db[email]['access_token'],
-                                   out_dir_async,
-                                   days=days,
-                                   debug=debug_imap,
-                                   delete=delete)
+        if imap_conn and dry_run:
+            ret = await _run_estimate(imap_conn,
+                                      email,
+                                      auth_data_db[email]['access_token'],
+                                      history_file,
+                                      days,
+                                      debug_imap=debug_imap,
+                                      query=query)
+        elif imap_conn and label_sync:
+            ret = await sync_labels(imap_conn,
+                                    email,
+                                    auth_data_db[email]['access_token'],
+                                    index,
+                                    compress=compress,
+                                    debug=debug_imap,
+                                    stats=stats)
+        else:
+            ret = await _run_archive(imap_conn,
+                                     email,
+                                     auth_data_db[email]['access_token'],
+                                     out_dir_async,
+                                     days,
+                                     quota_file,
+                                     stats,
+                                     errors=ErrorManifest(errors_file, email),
+                                     index=index,
+                                     adaptive=adaptive,
+                                     compress=compress,
+                                     daily_limit=daily_limit,
+                                     debug_imap=debug_imap,
+                                     delete=delete,
+                                     keep_going=keep_going,
+                                     large_message_size=large_message_size,
+                                     mailboxes=mailboxes,
+                                     max_rate=max_rate,
+                                     metrics_file=metrics_file,
+                                     metrics_port=metrics_port,
+                                     order=order,
+                                     output_format=output_format,
+                                     plan=plan,
+                                     query=query,
+                                     retry_failed=retry_failed,
+                                     s3=s3,
+                                     stats_file=stats_file,
+                                     tar_file=tar_file,
+                                     token_expiry=datetime.fromisoformat(
+                                         auth_data_db[email]['expiration_time']))
     finally:
-        log.debug('Closing.')
-        try:
-            await imap_conn.close()
-        except aioimaplib.AioImapException:  # pragma: no cover
-            log.exception('Exception caught while closing.')
-        log.debug('Logging out')
-        await imap_conn.logout()
+        if imap_conn:
+            await _close_imap(imap_conn)
     if ret != 0:
         raise click.exceptions.Exit(ret)
+    if stats.messages:
+        await record_run(history_file, email, stats)
+
+
+def _is_query(query: object) -> bool:
+    # A search query is sent as an IMAP quoted string, which cannot span lines.
+    return isinstance(query, str) and '\r' not in query and '\n' not in query
+
+
+def _check_query(_ctx: click.Context, _param: click.Parameter, value: str | None) -> str | None:
+    if value is not None and not _is_query(value):
+        msg = 'The search query must be on one line.'
+        raise click.BadParameter(msg)
+    return value
+
+
+def _mailboxes(config: Config) -> list[MailboxConfig]:
+    mailboxes = config.get('mailboxes', [])
+    if not isinstance(mailboxes, list) or not all(
+            isinstance(x, dict) and isinstance(x.get('name'), str)
+            and isinstance(x.get('days', 0), int) and _is_query(x.get('query', ''))
+            for x in mailboxes):
+        click.echo(
+            'mailboxes must be a list of tables with a name and optionally days and a query on '
+            'one line.',
+            err=True)
+        raise click.Abort
+    return mailboxes
+
+
+def _s3_config(config: Config) -> S3Config:
+    s3 = config.get('s3')
+    if not isinstance(s3, dict) or not all(
+            isinstance(s3.get(x), str)
+            for x in ('access_key_id', 'bucket', 'endpoint', 'secret_access_key')) or not all(
+                isinstance(s3.get(x, ''), str) for x in ('prefix', 'region')):
+        click.echo(
+            's3 must be a table with an endpoint, bucket, access_key_id and secret_access_key '
+            'and optionally a prefix and region.',
+            err=True)
+        raise click.Abort
+    return s3
+
+
+def _has_refresh_token(auth_data_db: Any, email: str) -> bool:
+    return (isinstance(auth_data_db, Mapping) and isinstance(auth_data_db.get(email), Mapping)
+            and 'refresh_token' in auth_data_db[email])
+
+
+async def _connect_imap(imap_conn: aioimaplib.IMAP4_SSL | None = None) -> aioimaplib.IMAP4_SSL:
+    imap_conn = imap_conn or aioimaplib.IMAP4_SSL('imap.gmail.com')
+    await imap_conn.wait_hello_from_server()
+    return imap_conn
+
+
+@contextlib.asynccontextmanager
+async def _imap_connection() -> AsyncIterator[aioimaplib.IMAP4_SSL]:
+    imap_conn = await _connect_imap()
+    try:
+        yield imap_conn
+    finally:
+        await _close_imap(imap_conn)
+
+
+async def _close_imap(imap_conn: aioimaplib.IMAP4_SSL) -> None:
+    log.debug('Closing.')
+    try:
+        await imap_conn.close()
+    except aioimaplib.AioImapException:  # pragma: no cover
+        log.exception('Exception caught while closing.')
+    log.debug('Logging out')
+    await imap_conn.logout()
+
+
+async def _abandon_connection(imap_conn: aioimaplib.IMAP4_SSL,
+                              connecting: asyncio.Task[aioimaplib.IMAP4_SSL]) -> None:
+    if connecting.cancel():
+        # The cancellation reaches the connection task of aioimaplib only while it is awaited, so
+        # wait for it to settle before looking at the transport.
+        await asyncio.wait((connecting,))
+    elif not connecting.exception():
+        with contextlib.suppress(aioimaplib.AioImapException, OSError, asyncio.TimeoutError):
+            await imap_conn.logout()
+    # A socket opened before the greeting arrived, or one a failed LOGOUT left behind, is not
+    # closed by aioimaplib.
+    if (transport := imap_conn.protocol.transport) and not transport.is_closing():
+        transport.close()
+
+
+async def _ensure_token(email: str, config: Config, token_store: TokenStore,
+                        discovery_file: AsyncPath, *, force_refresh: bool) -> Any:
+    # Another process may have refreshed the token while this one waited for the lock. The HTTP
+    # session is only opened when a request is made, so a valid token never loads niquests.
+    async with token_store.lock(email), contextlib.AsyncExitStack() as stack:
+        auth_data_db = await token_store.load()
+        expiration_time = (auth_data_db.get(email, {}).get('expiration_time')
+                           if auth_data_db and isinstance(auth_data_db, Mapping) else None)
+        if (not auth_data_db or not isinstance(auth_data_db, Mapping) or email not in auth_data_db
+                or 'refresh_token' not in auth_data_db[email]
+                or 'expiration_time' not in auth_data_db[email]):
+            if not auth_data_db or not isinstance(auth_data_db, Mapping):
+                log.debug('Empty authorisation database or is not a mapping.')
+                auth_data_db = {}
+            # region Authorisation
+            session = await stack.enter_async_context(oauth_session())
+            client = GoogleOAuthClient(config['client_id'],
+                                       config['client_secret'],
+                                       cache_file=discovery_file,
+                                       session=session)
+            await client.discover()
+            verifier = secrets.token_urlsafe(90)
+            challenge = urlsafe_b64encode(hashlib.sha256(verifier.encode()).digest())[:-1]
+            listen_port, redirect_uri = get_localhost_redirect_uri()
+            base_params = {
+                'client_id': client.client_id,
+                'login_hint': email,
+                'response_type': 'code',
+                'redirect_uri': redirect_uri,
+                'code_challenge': challenge,
+                'code_challenge_method': 'S256',
+                'scope': 'https://mail.google.com/'
+            }
+            log.debug('Parameters: %s', base_params)
+            click.echo(
+                f'\n{client.authorization_endpoint}'
+                f'?{urlencode(base_params, quote_via=urllib.parse.quote)}',
+                err=True)
+            click.echo('\nVisit displayed URL to authorise this application. Waiting...', err=True)
+            auth_code = ''
+
+            def set_auth_code(x: str) -> None:  # pragma: no cover
+                nonlocal auth_code
+                auth_code = x
+
+            def _run_auth_server(listen_port: int, handler_cls: type) -> None:
+                with (http_server.HTTPServer(('127.0.0.1', listen_port), handler_cls) as
+                      httpd, contextlib.suppress(KeyboardInterrupt)):
+                    httpd.handle_request()
+
+            await asyncio.to_thread(_run_auth_server, listen_port,
+                                    get_auth_http_handler(set_auth_code))
+            if not auth_code:
+                click.echo('Did not obtain an authorisation code.', err=True)
+                raise click.exceptions.Exit(1)
+            # endregion
+            auth_data = await authorize_tokens(client.token_endpoint,
+                                               config['client_id'],
+                                               config['client_secret'],
+                                               auth_code,
+                                               verifier,
+                                               redirect_uri,
+                                               session=session)
+            expires_in = auth_data['expires_in']
+            auth_data['expiration_time'] = (datetime.now(tz=timezone.utc) +
+                                            timedelta(seconds=expires_in)).isoformat()
+            log.debug('New auth data for %s: %s', email, auth_data)
+            if not isinstance(auth_data_db, MutableMapping):
+                click.echo('Authorisation database must be a JSON object.', err=True)
+                raise click.Abort
+            auth_data_db[email] = auth_data
+            if 'refresh_token' not in auth_data_db[email]:
+                click.echo('Authorisation response did not include a refresh_token.', err=True)
+                raise click.Abort
+            await token_store.save(email, auth_data_db[email])
+        elif ((expiration_time and
+               (datetime.fromisoformat(expiration_time) <= datetime.now(timezone.utc)))
+              or force_refresh):
+            log.debug('Refreshing token.')
+            ref_token = auth_data_db[email]['refresh_token']
+            session = await stack.enter_async_context(oauth_session())
+            client = GoogleOAuthClient(config['client_id'],
+                                       config['client_secret'],
+                                       cache_file=discovery_file,
+                                       session=session)
+            await client.discover()
+            auth_data = await refresh_token(client.token_endpoint,
+                                            config['client_id'],
+                                            config['client_secret'],
+                                            ref_token,
+                                            session=session)
+            expires_in = auth_data['expires_in']
+            auth_data['expiration_time'] = (datetime.now(timezone.utc) +
+                                            timedelta(seconds=expires_in)).isoformat()
+            if not isinstance(auth_data_db, MutableMapping):
+                click.echo('Authorisation database must be a JSON object.', err=True)
+                raise click.Abort
+            auth_data_db[email] = auth_data
+            log.debug('New auth data for %s: %s', email, auth_data)
+            auth_data_db[email]['refresh_token'] = ref_token
+            await token_store.save(email, auth_data_db[email])
+    return auth_data_db
+
+
+@contextlib.asynccontextmanager
+async def _open_writer(output_format: OutputFormat, out_dir: AsyncPath, stats: RunStats,
+                       tar_file: Path | None, s3: S3Config | None) -> AsyncIterator[MessageWriter]:
+    async with contextlib.AsyncExitStack() as stack:
+        # A tar archive goes to standard output unless a file is given.
+        stream = (await AsyncPath(tar_file).open('wb')
+                  if output_format == 'tar' and tar_file else None)
+        if stream:
+            stack.push_async_callback(stream.aclose)
+        client = None
+        if s3:
+            # Enough pooled connections for the parts of a multipart upload and the labels.
+            session = await stack.enter_async_context(
+                niquests.AsyncSession(pool_maxsize=DEFAULT_UPLOAD_CONCURRENCY + 1))
+            client = S3Client(session,
+                              s3['endpoint'],
+                              s3['bucket'],
+                              access_key_id=s3['access_key_id'],
+                              secret_access_key=s3['secret_access_key'],
+                              region=s3.get('region', DEFAULT_REGION),
+                              prefix=s3.get('prefix', ''),
+                              stats=stats)
+        writer = create_writer(output_format,
+                               await out_dir.resolve(),
+                               stats=stats,
+                               stream=stream,
+                               client=client)
+        try:
+            yield writer
+        finally:
+            await writer.close()
+
+
+async def _run_archive(imap_conn: aioimaplib.IMAP4_SSL | None, email: str, access_token: str,
+                       out_dir: AsyncPath, days: int, quota_file: AsyncPath, stats: RunStats, *,
+                       adaptive: bool, compress: bool, daily_limit: int, debug_imap: bool,
+                       delete: bool, errors: ErrorManifest, index: MessageIndex, keep_going: bool,
+                       large_message_size: int, mailboxes: list[MailboxConfig], max_rate: int,
+                       metrics_file: Path | None, metrics_port: int | None, order: WorkOrder,
+                       output_format: OutputFormat, plan: bool, query: str | None,
+                       retry_failed: bool, s3: S3Config | None, stats_file: Path | None,
+                       tar_file: Path | None, token_expiry: datetime) -> int:
+    exporter = MetricsExporter()
+    exporter.add_account(email, stats, token_expiry)
+    quota = DailyQuota(quota_file, email, daily_limit) if daily_limit else None
+    rate_limiter = TokenBucket(max_rate) if max_rate else None
+    async with exporter.serve(port=metrics_port,
+                              textfile=AsyncPath(metrics_file) if metrics_file else None), \
+            _open_writer(output_format, out_dir, stats, tar_file, s3) as writer:
+        if mailboxes:
+            ret = await archive_mailboxes(_imap_connection,
+                                          email,
+                                          access_token,
+                                          out_dir,
+                                          mailboxes,
+                                          days=days,
+                                          adaptive=adaptive,
+                                          compress=compress,
+                                          debug=debug_imap,
+                                          delete=delete,
+                                          errors=errors,
+                                          index=index,
+                                          keep_going=keep_going,
+                                          large_message_size=large_message_size,
+                                          order=order,
+                                          plan=plan,
+                                          query=query,
+                                          quota=quota,
+                                          rate_limiter=rate_limiter,
+                                          retry_failed=retry_failed,
+                                          stats=stats,
+                                          writer=writer)
+        elif imap_conn is None:
+            ret = await archive_emails_api(email,
+                                           access_token,
+                                           out_dir,
+                                           days=days,
+                                           delete=delete,
+                                           errors=errors,
+                                           index=index,
+                                           keep_going=keep_going,
+                                           query=query,
+                                           quota=quota,
+                                           rate_limiter=rate_limiter,
+                                           retry_failed=retry_failed,
+                                           stats=stats,
+                                           writer=writer)
+        else:
+            ret = await archive_emails(imap_conn,
+                                       email,
+                                       access_token,
+                                       out_dir,
+                                       days=days,
+                                       adaptive=adaptive,
+                                       compress=compress,
+                                       debug=debug_imap,
+                                       delete=delete,
+                                       errors=errors,
+                                       index=index,
+                                       keep_going=keep_going,
+                                       large_message_size=large_message_size,
+                                       order=order,
+                                       plan=plan,
+                                       query=query,
+                                       quota=quota,
+                                       rate_limiter=rate_limiter,
+                                       retry_failed=retry_failed,
+                                       stats=stats,
+                                       writer=writer)
+    stats.finish()
+    log.info('%s', stats.summary())
+    for line in stats.phase_report():
+        log.info('  %s', line)
+    if stats_file:
+        await AsyncPath(stats_file).write_text(
+            json.dumps(stats.report(), indent=2, sort_keys=True) + '\n', encoding='utf-8')
+    return ret
+
+
+async def _run_estimate(imap_conn: aioimaplib.IMAP4_SSL,
+                        email: str,
+                        access_token: str,
+                        history_file: AsyncPath,
+                        days: int,
+                        *,
+                        debug_imap: bool = False,
+                        query: str | None = None) -> int:
+    estimate = await estimate_archive(imap_conn,
+                                      email,
+                                      access_token,
+                                      days,
+                                      debug=debug_imap,
+                                      query=query)
+    if estimate is None:
+        return 1
+    runs = (await load_history(history_file)).get(email, [])
+    _print_estimate(estimate, average_throughput(runs))
+    return 0
+
+
+def _print_estimate(estimate: Estimate, throughput: float | None) -> None:
+    click.echo(f'Messages: {estimate["count"]}')
+    click.echo(f'Total size: {format_size(estimate["total_bytes"])}')
+    for year, entry in sorted(estimate['by_year'].items(), key=lambda x: (x[0] is None, x[0])):
+        click.echo(f'  {year or "unknown"}: {entry["count"]} messages, '
+                   f'{format_size(entry["bytes"])}')
+    if throughput:
+        eta = timedelta(seconds=round(estimate['total_bytes'] / throughput))
+        click.echo(f'Estimated time: {eta} (at {format_size(throughput)}/s from previous runs)')
+    else:
+        click.echo('Estimated time: unknown (no previous runs recorded)')
 
 
 @click.command(context_settings={'help_option_names': ('-h', '--help')})
@@ -182,35 +565,178 @@ async def _async_main(email: str,
                 type=click.Path(file_okay=False, dir_okay=True, path_type=Path),
                 required=False)
 @click.option('--no-delete', help='Do not move emails to trash.', is_flag=True)
+@click.option('--no-compress',
+              help='Do not negotiate COMPRESS=DEFLATE with the server.',
+              is_flag=True)
+@click.option('--no-adaptive-batching',
+              help='Fetch one message per command instead of adaptively sized batches.',
+              is_flag=True)
 @click.option('-a', '--auth-only', help='Only authorise the user.', is_flag=True)
+@click.option('-b',
+              '--backend',
+              help='Fetch messages over IMAP or with batched Gmail REST API requests. IMAP options '
+              'such as --plan, --order and batching do not apply to the API.',
+              type=click.Choice(('imap', 'api')),
+              default='imap',
+              show_default=True)
 @click.option('-d', '--debug', help='Enable debug level logging.', is_flag=True)
 @click.option('-D',
               '--days',
               help='Archive emails older than this many days. Set to 0 to archive everything.',
               type=int,
               default=90)
+@click.option('-q',
+              '--query',
+              help='Only archive messages that also match this Gmail search query, such as '
+              "'-category:promotions larger:5M'. The server does the filtering (X-GM-RAW).",
+              callback=_check_query)
+@click.option(
+    '-f',
+    '--format',
+    'output_format',
+    help='Write each message to its own .eml file in a directory per day, to a Maildir, to '
+    'an mbox file per month, to a tar archive of the .eml layout streamed to standard output or '
+    'upload the .eml layout to the S3-compatible object storage set in the config file.',
+    type=click.Choice(('eml', 'maildir', 'mbox', 's3', 'tar')),
+    default='eml',
+    show_default=True)
+@click.option('--tar-file',
+              help='With --format tar, write the archive to this file instead of standard output.',
+              type=click.Path(dir_okay=False, path_type=Path))
 @click.option('--debug-imap', help='Enable debug level logging for IMAP.', is_flag=True)
 @click.option('-r', '--force-refresh', help='Force refresh the token.', is_flag=True)
+@click.option('-n',
+              '--dry-run',
+              '--estimate',
+              help='Only report how many messages and bytes would be archived and an estimated '
+              'duration. Nothing is downloaded or moved to the trash.',
+              is_flag=True)
+@click.option('-k',
+              '--keep-going',
+              help='Continue past messages that cannot be archived. Failures are recorded in '
+              'errors.json next to the authorisation database and messages with an unparseable '
+              'date are archived under unknown-date.',
+              is_flag=True)
+@click.option('--retry-failed',
+              help='Only archive the messages that failed in the previous run.',
+              is_flag=True)
+@click.option('--sync-labels',
+              'label_sync',
+              help='Only update the label files of archived messages whose labels changed on the '
+              'server since the last sync. Nothing is downloaded or moved to the trash.',
+              is_flag=True)
+@click.option('--plan',
+              help='Fetch message sizes before downloading to order the work and stream large '
+              'messages.',
+              is_flag=True)
+@click.option('--order',
+              help='Order in which messages are archived when planning.',
+              type=click.Choice(('small-first', 'large-first', 'oldest-first', 'sequence')),
+              default='small-first')
+@click.option('--large-message-size',
+              help='When planning, stream messages larger than this many bytes to disk in chunks.',
+              type=click.IntRange(min=1),
+              default=DEFAULT_LARGE_MESSAGE_SIZE)
+@click.option('--daily-limit',
+              help='Stop before downloading more than this many bytes for the account in a rolling '
+              'day. Set to 0 to disable.',
+              type=click.IntRange(min=0),
+              default=DEFAULT_DAILY_LIMIT,
+              show_default=True)
+@click.option('--max-rate',
+              help='Limit downloads to this many bytes per second. Set to 0 to disable.',
+              type=click.IntRange(min=0),
+              default=0)
+@click.option('--metrics-port',
+              help='Serve Prometheus metrics on 127.0.0.1 at this port while archiving.',
+              type=click.IntRange(min=0, max=65535))
+@click.option('--metrics-file',
+              help='Periodically write Prometheus metrics to this file (for the node_exporter '
+              'textfile collector).',
+              type=click.Path(dir_okay=False, path_type=Path))
+@click.option('--profile-cpu',
+              help='Profile with cProfile and write pstats data to this file.',
+              type=click.Path(dir_okay=False, path_type=Path))
+@click.option('--profile-memory',
+              help='Trace allocations with tracemalloc and write peak memory, peak RSS and the top '
+              'allocation sites to this file.',
+              type=click.Path(dir_okay=False, path_type=Path))
+@click.option(
+    '--trace-file',
+    help='Append tracing spans of authentication, IMAP commands and disk I/O to this file '
+    'as JSON Lines.',
+    type=click.Path(dir_okay=False, path_type=Path))
+@click.option('--trace-sample-rate',
+              help='Fraction of messages to trace. One-off operations such as authentication are '
+              'always traced.',
+              type=click.FloatRange(min=0, max=1),
+              default=DEFAULT_SAMPLE_RATE,
+              show_default=True)
+@click.option('--stats-file',
+              help='Write run statistics including per-phase timings to this file as JSON.',
+              type=click.Path(dir_okay=False, path_type=Path))
 def main(email: str,
          days: int = 90,
          out_dir: Path | None = None,
          *,
          auth_only: bool = False,
+         backend: Backend = 'imap',
+         daily_limit: int = DEFAULT_DAILY_LIMIT,
          debug: bool = False,
          debug_imap: bool = False,
+         dry_run: bool = False,
          force_refresh: bool = False,
-         no_delete: bool = False) -> None:
+         keep_going: bool = False,
+         label_sync: bool = False,
+         large_message_size: int = DEFAULT_LARGE_MESSAGE_SIZE,
+         max_rate: int = 0,
+         metrics_file: Path | None = None,
+         metrics_port: int | None = None,
+         no_adaptive_batching: bool = False,
+         no_compress: bool = False,
+         no_delete: bool = False,
+         order: WorkOrder = 'small-first',
+         output_format: OutputFormat = 'eml',
+         plan: bool = False,
+         profile_cpu: Path | None = None,
+         query: str | None = None,
+         profile_memory: Path | None = None,
+         retry_failed: bool = False,
+         stats_file: Path | None = None,
+         tar_file: Path | None = None,
+         trace_file: Path | None = None,
+         trace_sample_rate: float = DEFAULT_SAMPLE_RATE) -> None:
     """Archive Gmail emails and move them to the trash."""
     setup_logging(debug=debug,
                   loggers={'gmail_archiver': {
                       'handlers': ('console',),
                       'propagate': False
                   }})
-    asyncio.run(
-        _async_main(email,
-                    days=days,
-                    out_dir=out_dir,
-                    auth_only=auth_only,
-                    debug_imap=debug_imap,
-                    delete=not no_delete,
-                    force_refresh=force_refresh))
+    with (profiled(cpu_file=profile_cpu, memory_file=profile_memory),
+          Tracer(trace_file, trace_sample_rate) if trace_file else contextlib.nullcontext()):
+        asyncio.run(
+            _async_main(email,
+                        days=days,
+                        out_dir=out_dir,
+                        adaptive=not no_adaptive_batching,
+                        auth_only=auth_only,
+                        backend=backend,
+                        compress=not no_compress,
+                        daily_limit=daily_limit,
+                        debug_imap=debug_imap,
+                        delete=not no_delete,
+                        dry_run=dry_run,
+                        force_refresh=force_refresh,
+                        keep_going=keep_going,
+                        label_sync=label_sync,
+                        large_message_size=large_message_size,
+                        max_rate=max_rate,
+                        metrics_file=metrics_file,
+                        metrics_port=metrics_port,
+                        order=order,
+                        output_format=output_format,
+                        plan=plan,
+                        query=query,
+                        retry_failed=retry_failed,
+                        stats_file=stats_file,
+                        tar_file=tar_file))
@@ -0,0 +1,216 @@
+"""Prometheus metrics for archive progress."""
+from __future__ import annotations
+
+from contextlib import asynccontextmanager, suppress
+from typing import TYPE_CHECKING
+import asyncio
+import logging
+import threading
+
+from .lazy import lazy_import
+from .stats import LATENCY_BUCKETS, PhaseTimer
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Iterable
+    from datetime import datetime
+    import http.server as http_server
+
+    from anyio import Path as AsyncPath
+
+    from .stats import RunStats
+else:
+    http_server = lazy_import('http.server')
+
+__all__ = ('CONTENT_TYPE', 'DEFAULT_TEXTFILE_INTERVAL', 'FETCH_LATENCY_BUCKETS', 'MetricsExporter')
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+"""Content type of the Prometheus text exposition format."""
+DEFAULT_TEXTFILE_INTERVAL = 10.0
+"""Seconds between writes of the textfile."""
+FETCH_LATENCY_BUCKETS = LATENCY_BUCKETS
+"""Upper bounds in seconds of the fetch latency histogram buckets."""
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels: str) -> str:
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _family(name: str, kind: str, description: str, samples: Iterable[tuple[str, str,
+                                                                            float]]) -> list[str]:
+    return [
+        f'# HELP {name} {description}', f'# TYPE {name} {kind}',
+        *(f'{name}{suffix}{labels} {value!r}' for suffix, labels, value in samples)
+    ]
+
+
+class MetricsExporter:
+    """
+    Exposes :py:class:`~gmail_archiver.stats.RunStats` of one or more accounts to Prometheus.
+
+    The statistics objects are read whenever the metrics are rendered, so the values are live while
+    :py:func:`~gmail_archiver.utils.archive_emails` runs. Metrics can be served over HTTP on
+    localhost, written periodically to a file for the node_exporter textfile collector, or both
+    (see :py:meth:`serve`).
+    """
+    def __init__(self) -> None:
+        self._accounts: dict[str, tuple[RunStats, datetime | None]] = {}
+
+    def add_account(self,
+                    email: str,
+                    stats: RunStats,
+                    token_expiry: datetime | None = None) -> None:
+        """
+        Export the statistics of an account.
+
+        Parameters
+        ----------
+        email : str
+            The account, used as the ``account`` label.
+        stats : RunStats
+            Statistics updated while archiving.
+        token_expiry : datetime | None
+            Expiration time of the account's access token.
+        """
+        self._accounts[email] = (stats, token_expiry)
+
+    def render(self) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format.
+
+        Returns
+        -------
+        str
+            The metrics text.
+        """
+        accounts = sorted(self._accounts.items())
+        lines = [
+            *_family('gmail_archiver_messages_archived_total', 'counter', 'Messages archived.',
+                     (('', _labels(account=email), stats.messages)
+                      for email, (stats, _) in accounts)),
+            *_family('gmail_archiver_downloaded_bytes_total', 'counter',
+                     'Message bytes downloaded.',
+                     (('', _labels(account=email), stats.bytes_downloaded)
+                      for email, (stats, _) in accounts)),
+            *_family('gmail_archiver_written_bytes_total', 'counter', 'Bytes written to disk.',
+                     (('', _labels(account=email),
+                       stats.phases['write'].bytes if 'write' in stats.phases else 0)
+                      for email, (stats, _) in accounts)),
+            *_family(
+                'gmail_archiver_retries_total', 'counter', 'Fetches retried after a server error.',
+                (('', _labels(account=email), stats.retries) for email, (stats, _) in accounts)),
+            *_family('gmail_archiver_pending_messages', 'gauge', 'Messages left to archive.',
+                     (('', _labels(account=email), stats.pending)
+                      for email, (stats, _) in accounts)),
+            *_family('gmail_archiver_in_flight_batches', 'gauge',
+                     'Fetched batches waiting to be written.',
+                     (('', _labels(account=email), stats.in_flight)
+                      for email, (stats, _) in accounts)),
+            *_family('gmail_archiver_fetch_latency_seconds', 'histogram',
+                     'Round-trip time of message fetches.',
+                     (x for email, (stats, _) in accounts for x in self._histogram(email, stats))),
+            *_family('gmail_archiver_token_expiry_timestamp_seconds', 'gauge',
+                     'Expiration time of the access token as a Unix timestamp.',
+                     (('', _labels(account=email), expiry.timestamp())
+                      for email, (_, expiry) in accounts if expiry))
+        ]
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _histogram(email: str, stats: RunStats) -> list[tuple[str, str, float]]:
+        timer = stats.phases.get('fetch') or PhaseTimer()
+        return [
+            *(('_bucket', _labels(account=email, le=f'{bound:g}'), count)
+              for bound, count in zip(FETCH_LATENCY_BUCKETS, timer.histogram, strict=True)),
+            ('_bucket', _labels(account=email, le='+Inf'), timer.count),
+            ('_sum', _labels(account=email), timer.total),
+            ('_count', _labels(account=email), timer.count)
+        ]
+
+    async def write_textfile(self, path: AsyncPath) -> None:
+        """
+        Write the metrics for the node_exporter textfile collector.
+
+        The file is replaced atomically so the collector never reads a partial file.
+
+        Parameters
+        ----------
+        path : AsyncPath
+            Destination, normally ending in ``.prom``.
+        """
+        tmp = path.with_name(f'.{path.name}.tmp')
+        await tmp.write_text(self.render(), encoding='utf-8')
+        await tmp.replace(path)
+
+    def _handler(self) -> type[http_server.BaseHTTPRequestHandler]:
+        exporter = self
+
+        class MetricsHandler(http_server.BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split('?')[0] not in {'/', '/metrics'}:
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: object) -> None:  # noqa: A002, PLR6301
+                log.debug(format, *args)
+
+        return MetricsHandler
+
+    async def _write_periodically(self, path: AsyncPath, interval: float) -> None:
+        while True:
+            await self.write_textfile(path)
+            await asyncio.sleep(interval)
+
+    @asynccontextmanager
+    async def serve(self,
+                    *,
+                    port: int | None = None,
+                    textfile: AsyncPath | None = None,
+                    interval: float = DEFAULT_TEXTFILE_INTERVAL) -> AsyncIterator[int | None]:
+        """
+        Expose the metrics while the body of an ``async with`` statement runs.
+
+        Parameters
+        ----------
+        port : int | None
+            Serve ``/metrics`` on ``127.0.0.1`` at this port. ``0`` picks a free port.
+        textfile : AsyncPath | None
+            Write the metrics to this file every ``interval`` seconds and once more on exit.
+        interval : float
+            Seconds between textfile writes.
+
+        Yields
+        ------
+        int | None
+            The port the HTTP server listens on, if any.
+        """
+        server = None
+        task = None
+        if port is not None:
+            server = http_server.ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            log.info('Serving metrics on http://127.0.0.1:%d/metrics.', server.server_port)
+        if textfile:
+            task = asyncio.create_task(self._write_periodically(textfile, interval))
+        try:
+            yield server.server_port if server else None
+        finally:
+            if task and textfile:
+                task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await task
+                await self.write_textfile(textfile)
+            if server:
+                await asyncio.to_thread(server.shutdown)
+                server.server_close()
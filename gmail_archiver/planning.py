@@ -0,0 +1,212 @@
+"""Size-aware work planning."""
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from itertools import islice
+from typing import TYPE_CHECKING, Any
+import heapq
+import logging
+import re
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable, Sequence
+
+    import aioimaplib  # type: ignore[import-untyped]
+
+    from .typing import MessageInfo, WorkOrder, WorkPlan
+
+__all__ = ('DEFAULT_INFO_BATCH_SIZE', 'DEFAULT_LARGE_MESSAGE_SIZE', 'fetch_message_info',
+           'message_set', 'parse_message_info', 'parse_message_set', 'plan_work')
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INFO_BATCH_SIZE = 5000
+"""Number of messages per ``RFC822.SIZE``/``INTERNALDATE`` fetch during planning."""
+DEFAULT_LARGE_MESSAGE_SIZE = 10 * 1024 * 1024
+"""Messages larger than this many bytes are downloaded with the streaming path."""
+
+_FETCH_NUMBER_RE = re.compile(rb'^(\d+) FETCH \(')
+_INTERNALDATE_RE = re.compile(rb'INTERNALDATE "([^"]+)"')
+_MIN_DATE = datetime.min.replace(tzinfo=timezone.utc)
+_SIZE_RE = re.compile(rb'RFC822\.SIZE (\d+)')
+
+
+def message_set(numbers: Iterable[int | str]) -> str:
+    """
+    Build a compact IMAP message set from message numbers.
+
+    Consecutive numbers are collapsed into ranges, so ``1 2 3 5`` becomes ``1:3,5``.
+
+    Parameters
+    ----------
+    numbers : Iterable[int | str]
+        Message sequence numbers.
+
+    Returns
+    -------
+    str
+        The message set.
+    """
+    ranges: list[str] = []
+    start = end = None
+    for number in sorted({int(x) for x in numbers}):
+        if end is not None and number == end + 1:
+            end = number
+            continue
+        if start is not None:
+            ranges.append(str(start) if start == end else f'{start}:{end}')
+        start = end = number
+    if start is not None:
+        ranges.append(str(start) if start == end else f'{start}:{end}')
+    return ','.join(ranges)
+
+
+def parse_message_set(value: str) -> list[str]:
+    """
+    Expand an IMAP message set built by :py:func:`message_set`.
+
+    Parameters
+    ----------
+    value : str
+        The message set, such as ``1:3,5``.
+
+    Returns
+    -------
+    list[str]
+        Message sequence numbers.
+    """
+    ret: list[str] = []
+    for part in filter(None, value.split(',')):
+        start, _, end = part.partition(':')
+        ret.extend(str(x) for x in range(int(start), int(end or start) + 1))
+    return ret
+
+
+def parse_message_info(lines: Iterable[bytes | bytearray | str]) -> list[MessageInfo]:
+    """
+    Parse the untagged lines of a ``FETCH (RFC822.SIZE INTERNALDATE)`` response.
+
+    Lines that are not message data (such as the completion text) are ignored.
+
+    Parameters
+    ----------
+    lines : Iterable[bytes | bytearray | str]
+        Response lines.
+
+    Returns
+    -------
+    list[MessageInfo]
+        One entry per message found in the response.
+    """
+    ret: list[MessageInfo] = []
+    for line in lines:
+        if not isinstance(line, (bytes, bytearray)):
+            continue
+        if not (number_match := _FETCH_NUMBER_RE.match(line)):
+            continue
+        if not (size_match := _SIZE_RE.search(line)):
+            continue
+        internal_date = None
+        if date_match := _INTERNALDATE_RE.search(line):
+            try:
+                internal_date = datetime.strptime(
+                    date_match.group(1).decode().strip(), '%d-%b-%Y %H:%M:%S %z')
+            except ValueError:
+                log.debug('Ignoring unparseable INTERNALDATE: %s', date_match.group(1))
+        ret.append({
+            'internal_date': internal_date,
+            'number': number_match.group(1).decode(),
+            'size': int(size_match.group(1))
+        })
+    return ret
+
+
+async def fetch_message_info(imap_conn: aioimaplib.IMAP4_SSL,
+                             messages: Sequence[str],
+                             batch_size: int = DEFAULT_INFO_BATCH_SIZE) -> list[MessageInfo]:
+    """
+    Fetch the size and arrival time of messages without downloading their bodies.
+
+    Messages are requested in batches of ``batch_size`` using compact message sets, so even very
+    large mailboxes need only a handful of round trips.
+
+    Parameters
+    ----------
+    imap_conn : aioimaplib.IMAP4_SSL
+        The IMAP connection with a mailbox selected.
+    messages : Sequence[str]
+        Message sequence numbers.
+    batch_size : int
+        Number of messages per fetch command.
+
+    Returns
+    -------
+    list[MessageInfo]
+        Information for every message the server reported on.
+    """
+    ret: list[MessageInfo] = []
+    it = iter(messages)
+    while batch := list(islice(it, batch_size)):
+        response = await imap_conn.fetch(message_set(batch), '(RFC822.SIZE INTERNALDATE)')
+        if response.result != 'OK':
+            log.warning('Size fetch failed for %d messages.', len(batch))
+            continue
+        ret.extend(parse_message_info(response.lines))
+    return ret
+
+
+def _sort_key(order: WorkOrder) -> Callable[[MessageInfo], Any]:
+    match order:
+        case 'large-first':
+            return lambda x: (-x['size'], int(x['number']))
+        case 'oldest-first':
+            return lambda x: (x['internal_date'] is None, x['internal_date'] or _MIN_DATE,
+                              int(x['number']))
+        case 'sequence':
+            return lambda x: int(x['number'])
+        case _:
+            return lambda x: (x['size'], int(x['number']))
+
+
+def plan_work(infos: Iterable[MessageInfo],
+              connections: int = 1,
+              large_message_size: int = DEFAULT_LARGE_MESSAGE_SIZE,
+              order: WorkOrder = 'small-first') -> WorkPlan:
+    """
+    Distribute messages across connections and order the work.
+
+    Messages are bin-packed by size with the longest-processing-time heuristic so that every
+    connection receives roughly the same number of bytes. Each bin is then sorted by ``order``.
+    ``small-first`` maximises the number of messages archived before a quota is reached.
+
+    Parameters
+    ----------
+    infos : Iterable[MessageInfo]
+        Message information from :py:func:`fetch_message_info`.
+    connections : int
+        Number of bins to produce.
+    large_message_size : int
+        Messages above this size are also listed in ``large``.
+    order : WorkOrder
+        Ordering within each bin.
+
+    Returns
+    -------
+    WorkPlan
+        The plan.
+    """
+    all_infos = list(infos)
+    bins: list[list[MessageInfo]] = [[] for _ in range(max(connections, 1))]
+    heap = [(0, i) for i in range(len(bins))]
+    for info in sorted(all_infos, key=lambda x: (-x['size'], int(x['number']))):
+        load, index = heapq.heappop(heap)
+        bins[index].append(info)
+        heapq.heappush(heap, (load + info['size'], index))
+    key = _sort_key(order)
+    for bin_ in bins:
+        bin_.sort(key=key)
+    return {
+        'bins': bins,
+        'large': [x for x in all_infos if x['size'] > large_message_size],
+        'total_bytes': sum(x['size'] for x in all_infos)
+    }
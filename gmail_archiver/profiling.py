@@ -0,0 +1,103 @@
+"""CPU and memory profiling hooks."""
+from __future__ import annotations
+
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+import cProfile
+import logging
+import sys
+import tracemalloc
+
+from .stats import format_size
+
+if sys.platform != 'win32':
+    import resource
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from pathlib import Path
+
+__all__ = ('DEFAULT_TOP_ALLOCATIONS', 'peak_rss', 'profiled')
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TOP_ALLOCATIONS = 25
+"""Number of allocation sites listed in the memory report."""
+
+
+def peak_rss() -> int | None:
+    """
+    Get the peak resident set size of the process.
+
+    Returns
+    -------
+    int | None
+        Size in bytes, or ``None`` on platforms without :py:mod:`resource`.
+    """
+    if sys.platform == 'win32':
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _memory_report(snapshot: tracemalloc.Snapshot, peak_traced: int, top: int) -> str:
+    rss = peak_rss()
+    lines = [
+        f'Peak traced memory: {format_size(peak_traced)}',
+        f'Peak RSS: {format_size(rss) if rss is not None else "unknown"}',
+        f'Top {top} allocation sites:'
+    ]
+    for i, stat in enumerate(snapshot.statistics('lineno')[:top], 1):
+        frame = stat.traceback[0]
+        lines.append(f'{i:3d}. {frame.filename}:{frame.lineno}: {format_size(stat.size)} in '
+                     f'{stat.count} blocks')
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def profiled(*,
+             cpu_file: Path | None = None,
+             memory_file: Path | None = None,
+             top: int = DEFAULT_TOP_ALLOCATIONS) -> Iterator[None]:
+    """
+    Profile the body of a ``with`` statement.
+
+    The results are written when the block exits, including when it raises, so a run that is
+    interrupted or fails still produces data for a bug report. :py:mod:`cProfile` only profiles the
+    calling thread; :py:mod:`tracemalloc` traces all threads.
+
+    Parameters
+    ----------
+    cpu_file : Path | None
+        Write :py:mod:`cProfile` statistics to this file. Load it with :py:class:`pstats.Stats`.
+    memory_file : Path | None
+        Trace allocations with :py:mod:`tracemalloc` and write the peak traced memory, peak RSS and
+        the largest allocation sites still alive at exit to this file.
+    top : int
+        Number of allocation sites in the memory report.
+
+    Yields
+    ------
+    None
+        Control to the profiled block.
+    """
+    profiler = cProfile.Profile() if cpu_file else None
+    if memory_file:
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler and cpu_file:
+            profiler.disable()
+            profiler.dump_stats(cpu_file)
+            log.info('Wrote CPU profile to %s.', cpu_file)
+        if memory_file:
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                (tracemalloc.Filter(inclusive=False, filename_pattern=tracemalloc.__file__),))
+            _, peak_traced = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            memory_file.write_text(_memory_report(snapshot, peak_traced, top), encoding='utf-8')
+            log.info('Wrote memory profile to %s.', memory_file)
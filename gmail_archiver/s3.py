@@ -0,0 +1,372 @@
+"""Client for S3-compatible object storage."""
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from hashlib import sha256
+from typing import TYPE_CHECKING
+from urllib.parse import parse_qsl, quote, urlencode, urlsplit
+import asyncio
+import contextlib
+import hmac
+import logging
+import re
+
+from .lazy import lazy_import
+
+if TYPE_CHECKING:
+    from collections.abc import Mapping
+
+    from anyio import Path as AsyncPath
+    import niquests
+
+    from .stats import RunStats
+else:
+    niquests = lazy_import('niquests')
+
+__all__ = ('DEFAULT_PART_SIZE', 'DEFAULT_REGION', 'DEFAULT_UPLOAD_CONCURRENCY', 'MIN_PART_SIZE',
+           'S3Client', 'S3Error', 'sign_request')
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+"""Size of the parts of multipart uploads."""
+DEFAULT_REGION = 'us-east-1'
+"""Region requests are signed for. Most S3-compatible servers accept any region."""
+DEFAULT_UPLOAD_CONCURRENCY = 4
+"""Number of parts of one multipart upload sent at the same time."""
+MIN_PART_SIZE = 5 * 1024 * 1024
+"""Smallest size S3 accepts for the parts of a multipart upload other than the last one."""
+_ALGORITHM = 'AWS4-HMAC-SHA256'
+_ERROR_RE = re.compile(rb'<Error>.*?<Code>([^<]+)</Code>', re.DOTALL)
+_MAX_ATTEMPTS = 5
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+_UNRESERVED = '-_.~'
+_UPLOAD_ID_RE = re.compile(rb'<UploadId>([^<]+)</UploadId>')
+
+
+class S3Error(Exception):
+    """Raised when the server reports an error in a successful response."""
+
+
+def _hmac(key: bytes, message: str) -> bytes:
+    return hmac.new(key, message.encode(), sha256).digest()
+
+
+def sign_request(method: str,
+                 url: str,
+                 headers: Mapping[str, str],
+                 payload_hash: str,
+                 *,
+                 access_key_id: str,
+                 secret_access_key: str,
+                 region: str = DEFAULT_REGION,
+                 now: datetime | None = None) -> dict[str, str]:
+    """
+    Sign a request to S3 with AWS Signature Version 4.
+
+    The path of ``url`` must already be URI-encoded. The ``Host`` header is signed as the network
+    location of ``url`` but not returned, as the HTTP client sends it.
+
+    Parameters
+    ----------
+    method : str
+        HTTP method.
+    url : str
+        Full URL of the request.
+    headers : Mapping[str, str]
+        Headers to sign and send.
+    payload_hash : str
+        Hexadecimal SHA-256 digest of the body.
+    access_key_id : str
+        Access key ID.
+    secret_access_key : str
+        Secret access key.
+    region : str
+        Region of the endpoint.
+    now : datetime | None
+        Time of the request. Defaults to the current time.
+
+    Returns
+    -------
+    dict[str, str]
+        ``headers`` with the ``Authorization``, ``x-amz-content-sha256`` and ``x-amz-date``
+        headers added.
+    """
+    amz_date = f'{(now or datetime.now(timezone.utc)):%Y%m%dT%H%M%SZ}'
+    parts = urlsplit(url)
+    signed = {k.lower(): ' '.join(v.split()) for k, v in headers.items()}
+    signed.update({
+        'host': parts.netloc,
+        'x-amz-content-sha256': payload_hash,
+        'x-amz-date': amz_date
+    })
+    names = sorted(signed)
+    query = '&'.join(f'{quote(k, safe=_UNRESERVED)}={quote(v, safe=_UNRESERVED)}'
+                     for k, v in sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    canonical_request = '\n'.join(
+        (method, parts.path
+         or '/', query, *(f'{x}:{signed[x]}' for x in names), '', ';'.join(names), payload_hash))
+    scope = f'{amz_date[:8]}/{region}/s3/aws4_request'
+    string_to_sign = '\n'.join(
+        (_ALGORITHM, amz_date, scope, sha256(canonical_request.encode()).hexdigest()))
+    key = f'AWS4{secret_access_key}'.encode()
+    for part in scope.split('/'):
+        key = _hmac(key, part)
+    signature = hmac.new(key, string_to_sign.encode(), sha256).hexdigest()
+    return {
+        **headers, 'Authorization': f'{_ALGORITHM} Credential={access_key_id}/{scope}, '
+                                    f'SignedHeaders={";".join(names)}, Signature={signature}',
+        'x-amz-content-sha256': payload_hash,
+        'x-amz-date': amz_date
+    }
+
+
+class S3Client:
+    """
+    Client for the parts of the S3 API used to store archived messages.
+
+    Objects are addressed path-style (``endpoint/bucket/key``), which S3 and S3-compatible servers
+    such as MinIO support. Requests that fail with a rate limit, a server error or a connection
+    error are retried with exponential backoff. The session pools connections, so concurrent
+    uploads reuse them.
+
+    Files larger than ``part_size`` are sent as multipart uploads with up to ``concurrency`` parts
+    in flight. At most that many parts are held in memory.
+
+    Parameters
+    ----------
+    session : niquests.AsyncSession
+        Session to send requests with.
+    endpoint : str
+        Base URL of the server, such as ``https://s3.us-east-1.amazonaws.com``.
+    bucket : str
+        Bucket objects are stored in.
+    access_key_id : str
+        Access key ID.
+    secret_access_key : str
+        Secret access key.
+    region : str
+        Region requests are signed for.
+    prefix : str
+        Prefix of the key of every object.
+    part_size : int
+        Size of the parts of multipart uploads. Must be at least :py:data:`MIN_PART_SIZE` for S3.
+    concurrency : int
+        Number of parts of one multipart upload sent at the same time.
+    retry_delay : float
+        Seconds to wait before the first retry. The delay doubles with every attempt.
+    stats : RunStats | None
+        Statistics object in which retries are counted.
+    """
+    def __init__(self,
+                 session: niquests.AsyncSession,
+                 endpoint: str,
+                 bucket: str,
+                 *,
+                 access_key_id: str,
+                 secret_access_key: str,
+                 region: str = DEFAULT_REGION,
+                 prefix: str = '',
+                 part_size: int = DEFAULT_PART_SIZE,
+                 concurrency: int = DEFAULT_UPLOAD_CONCURRENCY,
+                 retry_delay: float = 1.0,
+                 stats: RunStats | None = None) -> None:
+        self.access_key_id = access_key_id
+        """Access key ID."""
+        self.bucket = bucket
+        """Bucket objects are stored in."""
+        self.concurrency = concurrency
+        """Number of parts of one multipart upload sent at the same time."""
+        self.endpoint = endpoint.rstrip('/')
+        """Base URL of the server."""
+        self.part_size = part_size
+        """Size of the parts of multipart uploads."""
+        self.prefix = prefix
+        """Prefix of the key of every object."""
+        self.region = region
+        """Region requests are signed for."""
+        self.retry_delay = retry_delay
+        """Seconds to wait before the first retry."""
+        self.session = session
+        """Session to send requests with."""
+        self.stats = stats
+        """Statistics object."""
+        self._secret_access_key = secret_access_key
+
+    def url(self, key: str, params: Mapping[str, str] | None = None) -> str:
+        """
+        Get the URL of an object.
+
+        Parameters
+        ----------
+        key : str
+            Key of the object without :py:attr:`prefix`.
+        params : Mapping[str, str] | None
+            Query parameters.
+
+        Returns
+        -------
+        str
+            The URL.
+        """
+        url = f'{self.endpoint}/{self.bucket}/{quote(self.prefix + key, safe="/" + _UNRESERVED)}'
+        return f'{url}?{urlencode(params, quote_via=quote)}' if params else url
+
+    async def _backoff(self, attempt: int) -> None:
+        if self.stats:
+            self.stats.retries += 1
+        await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+    async def _request(self,
+                       method: str,
+                       key: str,
+                       params: Mapping[str, str] | None = None,
+                       data: bytes = b'',
+                       headers: Mapping[str, str] | None = None) -> niquests.Response:
+        url = self.url(key, params)
+        payload_hash = sha256(data).hexdigest()
+        for attempt in range(_MAX_ATTEMPTS):
+            # Signatures expire, so every attempt is signed again.
+            signed = sign_request(method,
+                                  url,
+                                  headers or {},
+                                  payload_hash,
+                                  access_key_id=self.access_key_id,
+                                  secret_access_key=self._secret_access_key,
+                                  region=self.region)
+            try:
+                response = await self.session.request(method,
+                                                      url,
+                                                      data=data,
+                                                      headers=signed,
+                                                      timeout=60)
+            except (niquests.ConnectionError, niquests.Timeout) as e:
+                if attempt == _MAX_ATTEMPTS - 1:
+                    raise
+                log.debug('%s %s failed: %s. Retrying.', method, key, e)
+            else:
+                if response.status_code not in _RETRY_STATUSES or attempt == _MAX_ATTEMPTS - 1:
+                    break
+                log.debug('%s %s returned %d. Retrying.', method, key, response.status_code)
+            await self._backoff(attempt)
+        response.raise_for_status()
+        return response
+
+    async def put_object(self,
+                         key: str,
+                         data: bytes,
+                         content_type: str = 'application/octet-stream') -> None:
+        """
+        Store an object.
+
+        Parameters
+        ----------
+        key : str
+            Key of the object without :py:attr:`prefix`.
+        data : bytes
+            Content of the object.
+        content_type : str
+            Media type of the object.
+        """
+        await self._request('PUT', key, data=data, headers={'Content-Type': content_type})
+
+    async def _create_multipart_upload(self, key: str, content_type: str) -> str:
+        response = await self._request('POST',
+                                       key, {'uploads': ''},
+                                       headers={'Content-Type': content_type})
+        if not (match := _UPLOAD_ID_RE.search(response.content or b'')):
+            msg = f'No upload ID in the response to creating a multipart upload of {key}.'
+            raise S3Error(msg)
+        return match[1].decode()
+
+    async def _upload_part(self, key: str, upload_id: str, number: int, data: bytes) -> str:
+        response = await self._request('PUT',
+                                       key, {
+                                           'partNumber': str(number),
+                                           'uploadId': upload_id
+                                       },
+                                       data=data)
+        return response.headers['ETag']
+
+    async def _upload_parts(self, key: str, upload_id: str, path: AsyncPath,
+                            suffix: bytes) -> list[str]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def upload(number: int, data: bytes) -> str:
+            try:
+                return await self._upload_part(key, upload_id, number, data)
+            finally:
+                semaphore.release()
+
+        tasks: list[asyncio.Task[str]] = []
+
+        async def start_uploads() -> None:
+            remaining = (await path.stat()).st_size
+            async with await path.open('rb') as f:
+                while remaining or not tasks:
+                    # Reading waits for a free slot, so at most `concurrency` parts are in memory.
+                    await semaphore.acquire()
+                    data = await f.read(min(self.part_size, remaining))
+                    # Nothing is read if the file was truncated. What was read is uploaded.
+                    remaining = remaining - len(data) if data else 0
+                    if not remaining:
+                        data += suffix
+                    tasks.append(asyncio.create_task(upload(len(tasks) + 1, data)))
+
+        try:
+            await start_uploads()
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def _complete_multipart_upload(self, key: str, upload_id: str, etags: list[str]) -> None:
+        body = ''.join(('<CompleteMultipartUpload xmlns="http://s3.amazonaws.com/doc/2006-03-01/">',
+                        *(f'<Part><PartNumber>{i}</PartNumber><ETag>{etag}</ETag></Part>'
+                          for i, etag in enumerate(etags, 1)), '</CompleteMultipartUpload>'))
+        response = await self._request('POST',
+                                       key, {'uploadId': upload_id},
+                                       data=body.encode(),
+                                       headers={'Content-Type': 'application/xml'})
+        # Completing can fail after the server has answered with 200.
+        if match := _ERROR_RE.search(response.content or b''):
+            msg = f'Completing the multipart upload of {key} failed: {match[1].decode()}.'
+            raise S3Error(msg)
+
+    async def upload_file(self,
+                          key: str,
+                          path: AsyncPath,
+                          *,
+                          content_type: str = 'application/octet-stream',
+                          suffix: bytes = b'') -> None:
+        """
+        Store a file as an object, with a multipart upload if it is larger than one part.
+
+        A failed multipart upload is aborted so its parts are not kept (and billed) by the server.
+        :py:class:`S3Error` is raised if the server reports an error in a successful response.
+
+        Parameters
+        ----------
+        key : str
+            Key of the object without :py:attr:`prefix`.
+        path : AsyncPath
+            The file.
+        content_type : str
+            Media type of the object.
+        suffix : bytes
+            Bytes appended to the content of the file.
+        """
+        if (await path.stat()).st_size + len(suffix) <= self.part_size:
+            await self.put_object(key, await path.read_bytes() + suffix, content_type)
+            return
+        upload_id = await self._create_multipart_upload(key, content_type)
+        try:
+            etags = await self._upload_parts(key, upload_id, path, suffix)
+            await self._complete_multipart_upload(key, upload_id, etags)
+        except BaseException:
+            log.debug('Aborting the multipart upload of %s.', key)
+            with contextlib.suppress(niquests.RequestException):
+                await self._request('DELETE', key, {'uploadId': upload_id})
+            raise
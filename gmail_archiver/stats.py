@@ -0,0 +1,350 @@
+"""Run statistics."""
+from __future__ import annotations
+
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+import bisect
+import math
+import time
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+    from .typing import PhaseReport, StatsReport
+
+__all__ = ('LATENCY_BUCKETS', 'PhaseTimer', 'RunStats', 'bucket_bounds', 'format_size')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+"""Upper bounds in seconds of the buckets of :py:attr:`PhaseTimer.histogram`."""
+
+_BUCKETS_PER_OCTAVE = 16
+_KIB = 1024
+_MIN_SECONDS = 1e-9
+_MS = 1000
+
+
+def format_size(size: float) -> str:
+    """
+    Format a byte count for display.
+
+    Parameters
+    ----------
+    size : float
+        Number of bytes.
+
+    Returns
+    -------
+    str
+        The size with a binary unit suffix, such as ``1.5 MiB``.
+    """
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < _KIB:
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= _KIB
+    return f'{size:.1f} TiB'
+
+
+def bucket_bounds(index: int) -> tuple[float, float]:
+    """
+    Get the range of durations counted in a bucket of :py:attr:`PhaseTimer.buckets`.
+
+    Parameters
+    ----------
+    index : int
+        Bucket index.
+
+    Returns
+    -------
+    tuple[float, float]
+        Lower (inclusive) and upper (exclusive) bound in seconds.
+    """
+    return 2 ** (index / _BUCKETS_PER_OCTAVE), 2 ** ((index + 1) / _BUCKETS_PER_OCTAVE)
+
+
+class PhaseTimer:
+    """
+    Durations and byte counts recorded for one phase of a run.
+
+    Durations are counted in log-scale buckets, 16 per doubling, instead of being kept, so memory
+    does not grow with the number of calls. Percentiles are accurate to about 2%. Calls are also
+    counted against the fixed bounds of :py:data:`LATENCY_BUCKETS` for exporting.
+    """
+    def __init__(self) -> None:
+        self.buckets: dict[int, int] = {}
+        """Number of calls by bucket index (see :py:func:`bucket_bounds`)."""
+        self.bytes = 0
+        """Bytes handled by the phase."""
+        self.count = 0
+        """Number of recorded calls."""
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+        """Cumulative number of calls no longer than each bound of :py:data:`LATENCY_BUCKETS`."""
+        self.max = 0.0
+        """Longest recorded duration in seconds."""
+        self.min = math.inf
+        """Shortest recorded duration in seconds."""
+        self.total = 0.0
+        """Total duration in seconds."""
+
+    def add(self, seconds: float, size: int = 0) -> None:
+        """
+        Record one call.
+
+        Parameters
+        ----------
+        seconds : float
+            Duration of the call.
+        size : int
+            Bytes handled by the call.
+        """
+        index = math.floor(math.log2(max(seconds, _MIN_SECONDS)) * _BUCKETS_PER_OCTAVE)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        for i in range(bisect.bisect_left(LATENCY_BUCKETS, seconds), len(LATENCY_BUCKETS)):
+            self.histogram[i] += 1
+        self.bytes += size
+        self.count += 1
+        self.max = max(self.max, seconds)
+        self.min = min(self.min, seconds)
+        self.total += seconds
+
+    def percentile(self, fraction: float) -> float:
+        """
+        Get a duration percentile using the nearest-rank method.
+
+        The duration is the geometric middle of the bucket holding the call of that rank, limited
+        to the shortest and longest recorded durations.
+
+        Parameters
+        ----------
+        fraction : float
+            Percentile as a fraction, such as ``0.95``.
+
+        Returns
+        -------
+        float
+            The duration in seconds, or ``0.0`` if nothing was recorded.
+        """
+        if not self.count:
+            return 0.0
+        if (rank := max(1, math.ceil(fraction * self.count))) == self.count:
+            return self.max
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                break
+        low, high = bucket_bounds(index)
+        return min(max(math.sqrt(low * high), self.min), self.max)
+
+    def report(self) -> PhaseReport:
+        """
+        Summarise the phase.
+
+        Returns
+        -------
+        PhaseReport
+            Count, totals and latency percentiles.
+        """
+        return {
+            'bytes': self.bytes,
+            'count': self.count,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'total': self.total
+        }
+
+
+class RunStats:
+    """Counters collected while archiving."""
+    def __init__(self) -> None:
+        self.batch_size: int | None = None
+        """Final fetch batch size when adaptive batching was used."""
+        self.bytes_downloaded = 0
+        """Number of message bytes downloaded."""
+        self.compressed_received = 0
+        """Bytes received on the wire while ``COMPRESS=DEFLATE`` was active."""
+        self.compressed_sent = 0
+        """Bytes sent on the wire while ``COMPRESS=DEFLATE`` was active."""
+        self.in_flight = 0
+        """Number of fetched batches currently waiting to be written."""
+        self.messages = 0
+        """Number of messages archived."""
+        self.pending = 0
+        """Number of messages left to archive."""
+        self.phases: dict[str, PhaseTimer] = {}
+        """Timers keyed by phase name, such as ``fetch`` or ``write``."""
+        self.retries = 0
+        """Number of fetches retried after a server error."""
+        self.started = time.monotonic()
+        """Monotonic time the run started."""
+        self.uncompressed_received = 0
+        """Bytes received after decompression."""
+        self.uncompressed_sent = 0
+        """Bytes sent before compression."""
+        self.finished: float | None = None
+        """Monotonic time the run finished, set by :py:meth:`finish`."""
+        self.window: int | None = None
+        """Final in-flight window when adaptive batching was used."""
+
+    def add_message(self, size: int) -> None:
+        """
+        Count an archived message.
+
+        Parameters
+        ----------
+        size : int
+            Size of the message in bytes.
+        """
+        self.messages += 1
+        self.bytes_downloaded += size
+
+    def add_compressed_received(self, compressed: int, uncompressed: int) -> None:
+        """
+        Count data received over a compressed connection.
+
+        Parameters
+        ----------
+        compressed : int
+            Bytes received on the wire.
+        uncompressed : int
+            Bytes after decompression.
+        """
+        self.compressed_received += compressed
+        self.uncompressed_received += uncompressed
+
+    def add_compressed_sent(self, compressed: int, uncompressed: int) -> None:
+        """
+        Count data sent over a compressed connection.
+
+        Parameters
+        ----------
+        compressed : int
+            Bytes sent on the wire.
+        uncompressed : int
+            Bytes before compression.
+        """
+        self.compressed_sent += compressed
+        self.uncompressed_sent += uncompressed
+
+    def add_timing(self, phase: str, seconds: float, size: int = 0) -> None:
+        """
+        Record the duration of one call of a phase.
+
+        Parameters
+        ----------
+        phase : str
+            Phase name.
+        seconds : float
+            Duration of the call.
+        size : int
+            Bytes handled by the call.
+        """
+        if (timer := self.phases.get(phase)) is None:
+            timer = self.phases[phase] = PhaseTimer()
+        timer.add(seconds, size)
+
+    @contextmanager
+    def timed(self, phase: str, size: int = 0) -> Iterator[None]:
+        """
+        Time the body of a ``with`` statement as one call of a phase.
+
+        Parameters
+        ----------
+        phase : str
+            Phase name.
+        size : int
+            Bytes handled by the call.
+
+        Yields
+        ------
+        None
+            Control to the timed block.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_timing(phase, time.perf_counter() - started, size)
+
+    def finish(self) -> None:
+        """Mark the run as finished."""
+        self.finished = time.monotonic()
+
+    @property
+    def elapsed(self) -> float:
+        """Seconds since the run started, or the total duration once finished."""
+        return (self.finished if self.finished is not None else time.monotonic()) - self.started
+
+    @property
+    def compression_savings(self) -> float:
+        """Fraction of received bytes saved by compression."""
+        return (1 - self.compressed_received / self.uncompressed_received
+                if self.uncompressed_received else 0.0)
+
+    @property
+    def throughput(self) -> float:
+        """Bytes downloaded per second."""
+        return self.bytes_downloaded / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        """
+        Describe the run for the end-of-run report.
+
+        Returns
+        -------
+        str
+            A one-line summary.
+        """
+        ret = (f'Archived {self.messages} messages ({format_size(self.bytes_downloaded)}) in '
+               f'{self.elapsed:.1f} s ({format_size(self.throughput)}/s).')
+        if self.batch_size is not None:
+            ret += (f' Final batch size {self.batch_size}, window {self.window}, '
+                    f'{self.retries} retries.')
+        if self.uncompressed_received:
+            ret += (f' Received {format_size(self.compressed_received)} compressed for '
+                    f'{format_size(self.uncompressed_received)} '
+                    f'({self.compression_savings:.0%} saved).')
+        return ret
+
+    def phase_report(self) -> list[str]:
+        """
+        Describe every phase for the end-of-run report.
+
+        Returns
+        -------
+        list[str]
+            One line per phase, slowest phase first.
+        """
+        return [
+            f'{name}: {timer.count} calls, {timer.total:.3f} s total, p50 '
+            f'{timer.percentile(0.5) * _MS:.1f} ms, p95 {timer.percentile(0.95) * _MS:.1f} ms, '
+            f'p99 {timer.percentile(0.99) * _MS:.1f} ms' +
+            (f', {format_size(timer.bytes)}' if timer.bytes else '')
+            for name, timer in sorted(self.phases.items(), key=lambda x: -x[1].total)
+        ]
+
+    def report(self) -> StatsReport:
+        """
+        Collect all statistics in a form suitable for JSON.
+
+        Returns
+        -------
+        StatsReport
+            Totals of the run and a report for every phase.
+        """
+        return {
+            'batch_size': self.batch_size,
+            'bytes': self.bytes_downloaded,
+            'compressed_received': self.compressed_received,
+            'compressed_sent': self.compressed_sent,
+            'messages': self.messages,
+            'phases': {
+                name: timer.report()
+                for name, timer in sorted(self.phases.items())
+            },
+            'retries': self.retries,
+            'seconds': self.elapsed,
+            'uncompressed_received': self.uncompressed_received,
+            'uncompressed_sent': self.uncompressed_sent,
+            'window': self.window
+        }
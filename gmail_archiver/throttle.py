@@ -0,0 +1,273 @@
+"""Bandwidth throttling and daily download quota."""
+from __future__ import annotations
+
+from pathlib import Path
+from typing import TYPE_CHECKING, cast
+import asyncio
+import json
+import logging
+import time
+
+from .planning import message_set, parse_message_set
+from .tokens import file_lock
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Sequence
+
+    from anyio import Path as AsyncPath
+
+    from .typing import QuotaDB
+
+__all__ = ('DEFAULT_DAILY_LIMIT', 'DailyQuota', 'TokenBucket')
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DAILY_LIMIT = 2_400_000_000
+"""Default number of bytes that may be downloaded per account in a rolling day.
+
+Gmail locks IMAP access for a while after roughly 2.5 GB of downloads in a day, so this leaves some
+headroom for other clients.
+"""
+_BUCKET_SECONDS = 60
+_WINDOW_SECONDS = 86400
+
+
+class TokenBucket:
+    """
+    Token bucket limiting a byte rate.
+
+    Consumption may exceed the available tokens (a single large message can be bigger than the
+    bucket). The deficit is repaid by sleeping, so the average rate never exceeds ``rate``.
+
+    Parameters
+    ----------
+    rate : float
+        Bytes per second.
+    capacity : float | None
+        Maximum burst size in bytes. Defaults to one second worth of tokens.
+    clock : Callable[[], float]
+        Monotonic clock.
+    """
+    def __init__(self,
+                 rate: float,
+                 capacity: float | None = None,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.capacity = capacity if capacity is not None else rate
+        """Maximum number of tokens."""
+        self.rate = rate
+        """Tokens added per second."""
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def consume(self, amount: int) -> None:
+        """
+        Take ``amount`` tokens, sleeping if the bucket is in deficit.
+
+        Parameters
+        ----------
+        amount : int
+            Number of bytes transferred.
+        """
+        self._refill()
+        self._tokens -= amount
+        if self._tokens < 0:
+            delay = -self._tokens / self.rate
+            log.debug('Throttling for %.2f seconds.', delay)
+            await asyncio.sleep(delay)
+
+
+class DailyQuota:
+    """
+    Bytes downloaded for an account over a rolling day, persisted across runs.
+
+    Usage is kept in one-minute buckets so the state file stays small. The state file can be shared
+    by several accounts; records are read and replaced under a lock, and the file is replaced
+    atomically so an interrupted run never leaves it truncated. Usage added since the last
+    :py:meth:`save` is merged into the usage in the file rather than overwriting it, so concurrent
+    runs of the same account (and concurrent mailbox runs sharing one instance) all count towards
+    the same budget.
+
+    When a run without deletion stops because the budget is spent, the messages it archived are
+    stored per mailbox by UID together with the mailbox ``UIDVALIDITY`` (see :py:meth:`set_resume`),
+    as sequence numbers change whenever messages are expunged.
+
+    Parameters
+    ----------
+    path : AsyncPath
+        Path to the JSON state file.
+    email : str
+        The account. Used as the key of the record in the state file.
+    limit : int
+        Maximum number of bytes in any 24 hour window.
+    clock : Callable[[], float]
+        Wall clock returning seconds since the epoch.
+    """
+    def __init__(self,
+                 path: AsyncPath,
+                 email: str,
+                 limit: int = DEFAULT_DAILY_LIMIT,
+                 clock: Callable[[], float] = time.time) -> None:
+        self.email = email
+        """The account."""
+        self.limit = limit
+        """Maximum number of bytes in any 24 hour window."""
+        self.path = path
+        """Path to the JSON state file."""
+        self._clock = clock
+        self._pending: dict[str, int] = {}
+        self._usage: dict[str, int] = {}
+
+    def _recent(self, usage: dict[str, int]) -> dict[str, int]:
+        oldest = int((self._clock() - _WINDOW_SECONDS) // _BUCKET_SECONDS)
+        return {k: v for k, v in usage.items() if int(k) > oldest}
+
+    def _prune(self) -> None:
+        self._pending = self._recent(self._pending)
+        self._usage = self._recent(self._usage)
+
+    async def _load_db(self) -> QuotaDB:
+        if not await self.path.exists():
+            return {}
+        try:
+            data = json.loads(await self.path.read_text(encoding='utf-8'))
+        except json.JSONDecodeError:
+            log.warning('Ignoring invalid quota file %s.', self.path)
+            return {}
+        return cast('QuotaDB', data) if isinstance(data, dict) else {}
+
+    def _lock_file(self) -> Path:
+        return Path(self.path.with_name(f'.{self.path.name}.lock'))
+
+    async def _write_db(self, db: QuotaDB) -> None:
+        tmp = self.path.with_name(f'.{self.path.name}.tmp')
+        await tmp.write_text(json.dumps(db, sort_keys=True, indent=2), encoding='utf-8')
+        await tmp.replace(self.path)
+
+    async def load(self) -> None:
+        """Load the usage of the account. Usage that has not been saved yet is kept."""
+        async with file_lock(self._lock_file()):
+            record = (await self._load_db()).get(self.email, {})
+        self._usage = dict(record.get('usage', {}))
+        self._prune()
+
+    async def save(self) -> None:
+        """Add the usage since the last save to the file, keeping the rest of it intact."""
+        async with file_lock(self._lock_file()):
+            db = await self._load_db()
+            record = db.setdefault(self.email, {})
+            # Usage added while the file is written is saved the next time.
+            pending, self._pending = self._pending, {}
+            usage = dict(record.get('usage', {}))
+            for key, size in pending.items():
+                usage[key] = usage.get(key, 0) + size
+            record['usage'] = usage = self._recent(usage)
+            try:
+                await self._write_db(db)
+            except BaseException:
+                for key, size in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + size
+                raise
+            self._usage = usage
+
+    async def resume_uids(self, mailbox: str, uidvalidity: str | None) -> list[str]:
+        """
+        Get the UIDs of the messages archived by a run that stopped because the budget was spent.
+
+        Parameters
+        ----------
+        mailbox : str
+            The mailbox.
+        uidvalidity : str | None
+            ``UIDVALIDITY`` of the selected mailbox.
+
+        Returns
+        -------
+        list[str]
+            The UIDs. Empty if there is no resume state or the mailbox ``UIDVALIDITY`` changed since
+            it was stored.
+        """
+        async with file_lock(self._lock_file()):
+            resume = (await self._load_db()).get(self.email, {}).get('resume')
+        if not isinstance(resume, dict) or not (state := resume.get(mailbox)):
+            return []
+        if state.get('uidvalidity') != uidvalidity:
+            log.warning('UIDVALIDITY of %s changed; archived messages will be downloaded again.',
+                        mailbox)
+            return []
+        return parse_message_set(state['uids'])
+
+    async def set_resume(self, mailbox: str, uidvalidity: str | None, uids: Sequence[str]) -> None:
+        """
+        Store the UIDs of the messages archived by a run that stopped because the budget was spent.
+
+        Parameters
+        ----------
+        mailbox : str
+            The mailbox.
+        uidvalidity : str | None
+            ``UIDVALIDITY`` of the selected mailbox.
+        uids : Sequence[str]
+            The UIDs. The resume state of the mailbox is removed if empty.
+        """
+        async with file_lock(self._lock_file()):
+            db = await self._load_db()
+            record = db.setdefault(self.email, {})
+            resume = record.get('resume')
+            resume = resume if isinstance(resume, dict) else {}
+            if uids:
+                resume[mailbox] = {'uids': message_set(uids)}
+                if uidvalidity:
+                    resume[mailbox]['uidvalidity'] = uidvalidity
+            elif resume.pop(mailbox, None) is None:
+                return
+            if resume:
+                record['resume'] = resume
+            else:
+                record.pop('resume', None)
+            await self._write_db(db)
+
+    @property
+    def used(self) -> int:
+        """Bytes downloaded in the last 24 hours."""
+        self._prune()
+        return sum(self._usage.values()) + sum(self._pending.values())
+
+    @property
+    def remaining(self) -> int:
+        """Bytes that may still be downloaded in the current window."""
+        return max(self.limit - self.used, 0)
+
+    def allows(self, size: int = 0) -> bool:
+        """
+        Check whether a download fits in the remaining budget.
+
+        Parameters
+        ----------
+        size : int
+            Expected size of the download. When unknown (``0``), any remaining budget allows it.
+
+        Returns
+        -------
+        bool
+            ``True`` if the download may proceed.
+        """
+        remaining = self.remaining
+        return remaining > 0 and size <= remaining
+
+    def add(self, size: int) -> None:
+        """
+        Record downloaded bytes.
+
+        Parameters
+        ----------
+        size : int
+            Number of bytes downloaded.
+        """
+        key = str(int(self._clock() // _BUCKET_SECONDS))
+        self._pending[key] = self._pending.get(key, 0) + size
@@ -0,0 +1,175 @@
+"""Authorisation database shared by concurrent processes."""
+from __future__ import annotations
+
+from contextlib import asynccontextmanager
+from hashlib import sha1
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+
+if sys.platform != 'win32':
+    import fcntl
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+
+    from anyio import Path as AsyncPath
+
+    from .typing import AuthInfo
+
+__all__ = ('LOCK_POLL_INTERVAL', 'TokenStore', 'file_lock')
+
+log = logging.getLogger(__name__)
+
+LOCK_POLL_INTERVAL = 0.05
+"""Seconds between attempts to take an account lock held by another process."""
+
+
+def _try_lock(fd: int) -> bool:
+    if sys.platform == 'win32':
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+@asynccontextmanager
+async def file_lock(path: Path) -> AsyncIterator[None]:
+    """
+    Hold an advisory lock on a file while the body of an ``async with`` statement runs.
+
+    The lock excludes other processes as well as other holders in the same process. It is not
+    taken on Windows.
+
+    Parameters
+    ----------
+    path : Path
+        The lock file. It is created if missing.
+
+    Yields
+    ------
+    None
+        Control once the lock is held.
+    """
+    # Polling rather than blocking in a thread keeps the wait cancellable.
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        while not _try_lock(fd):  # noqa: ASYNC110
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+        yield
+    finally:
+        os.close(fd)  # Also releases the lock.
+
+
+class TokenStore:
+    """
+    The ``oauth.json`` authorisation database.
+
+    Several processes may archive different accounts (or the same account) at the same time, so
+    the file is never rewritten from a copy read earlier. :py:meth:`save` re-reads the file and
+    replaces only the record of one account while holding a lock that is released as soon as the
+    file is written. The new content is written to a temporary file that is renamed over the
+    database, so readers never see a partially written file and do not need to lock.
+
+    :py:meth:`lock` serialises token changes of one account (for example a refresh) across
+    processes without blocking other accounts. A process that waited for the lock should
+    :py:meth:`load` the database again as another process may have refreshed the token meanwhile.
+
+    Locks are advisory (:py:func:`fcntl.flock`) and live in files next to the database. They are
+    not taken on Windows.
+
+    Parameters
+    ----------
+    path : AsyncPath
+        Path to the JSON file.
+    """
+    def __init__(self, path: AsyncPath) -> None:
+        self.path = path
+        """Path to the JSON file."""
+
+    def _lock_file(self, email: str | None = None) -> Path:
+        suffix = f'.{sha1(email.encode(), usedforsecurity=False).hexdigest()[:16]}' if email else ''
+        return Path(self.path.with_name(f'.{self.path.name}{suffix}.lock'))
+
+    async def load(self) -> Any:
+        """
+        Read the database.
+
+        Returns
+        -------
+        Any
+            The decoded JSON, normally a mapping of account to
+            :py:class:`~gmail_archiver.typing.AuthInfo`. Empty if the file is missing or invalid.
+        """
+        if not await self.path.exists():
+            return {}
+        try:
+            return json.loads(await self.path.read_text(encoding='utf-8'))
+        except json.JSONDecodeError:
+            return {}
+
+    @asynccontextmanager
+    async def lock(self, email: str) -> AsyncIterator[None]:
+        """
+        Hold the lock of an account while the body of an ``async with`` statement runs.
+
+        Parameters
+        ----------
+        email : str
+            The account.
+
+        Yields
+        ------
+        None
+            Control once the lock is held.
+        """
+        async with file_lock(self._lock_file(email)):
+            yield
+
+    def _save(self, email: str, record: AuthInfo) -> None:
+        # Called with the database lock held.
+        path = Path(self.path)
+        try:
+            db = json.loads(path.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            db = {}
+        except json.JSONDecodeError:
+            log.warning('Replacing invalid authorisation database %s.', path)
+            db = {}
+        if not isinstance(db, dict):
+            log.warning('Replacing authorisation database %s that is not an object.', path)
+            db = {}
+        db[email] = record
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(db, f, allow_nan=False, sort_keys=True, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            Path(tmp).replace(path)
+        except BaseException:
+            Path(tmp).unlink()
+            raise
+
+    async def save(self, email: str, record: AuthInfo) -> None:
+        """
+        Replace the record of one account, keeping the records of other accounts on disk.
+
+        The file is created with mode ``0600``.
+
+        Parameters
+        ----------
+        email : str
+            The account.
+        record : AuthInfo
+            The new record.
+        """
+        async with file_lock(self._lock_file()):
+            await asyncio.to_thread(self._save, email, record)
@@ -0,0 +1,241 @@
+"""Structured tracing of individual operations to a JSON Lines file."""
+from __future__ import annotations
+
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Any
+import json
+import random
+import time
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from contextlib import AbstractContextManager
+    from pathlib import Path
+    from types import TracebackType
+
+    from typing_extensions import Self
+
+    from .stats import RunStats
+
+__all__ = ('DEFAULT_SAMPLE_RATE', 'Span', 'Tracer', 'span', 'timed')
+
+DEFAULT_SAMPLE_RATE = 0.01
+"""Fraction of per-message traces recorded by default."""
+
+_current_span: ContextVar[Span | None] = ContextVar('gmail_archiver_span', default=None)
+_current_tracer: ContextVar[Tracer | None] = ContextVar('gmail_archiver_tracer', default=None)
+
+
+class Span:
+    """
+    A timed operation.
+
+    Spans created while another span is current become its children and share its trace. Spans of
+    a trace that was not sampled do not record anything.
+    """
+    def __init__(self,
+                 name: str,
+                 trace_id: str = '',
+                 span_id: str = '',
+                 parent_id: str | None = None,
+                 attributes: dict[str, Any] | None = None) -> None:
+        self.attributes = attributes or {}
+        """Attributes written with the span."""
+        self.name = name
+        """Operation name."""
+        self.parent_id = parent_id
+        """Identifier of the parent span."""
+        self.span_id = span_id
+        """Identifier of the span. Empty if the span is not recording."""
+        self.trace_id = trace_id
+        """Identifier of the trace. Empty if the span is not recording."""
+
+    @property
+    def recording(self) -> bool:
+        """Whether the span will be written."""
+        return bool(self.span_id)
+
+    def set_attributes(self, **attributes: Any) -> None:
+        """
+        Add attributes to the span.
+
+        Parameters
+        ----------
+        **attributes : Any
+            JSON-serialisable values.
+        """
+        if self.recording:
+            self.attributes.update(attributes)
+
+
+_NON_RECORDING = Span('')
+
+
+class Tracer:
+    """
+    Writes spans to a JSON Lines file.
+
+    Use as a context manager to make the tracer current; :py:func:`span` is a no-op otherwise. Each
+    line has the span name, trace, span and parent identifiers, the start time (Unix time), the
+    duration in seconds, the attributes and the exception type if the operation raised.
+
+    Sampling is decided when a trace starts (a span without a parent), so a trace is either recorded
+    completely or not at all. Traces started with ``always`` (one-off operations such as
+    authentication) are always recorded.
+
+    Parameters
+    ----------
+    path : Path
+        File to append spans to.
+    sample_rate : float
+        Fraction of traces to record.
+    seed : int | None
+        Seed for the sampling decisions.
+    """
+    def __init__(self,
+                 path: Path,
+                 sample_rate: float = DEFAULT_SAMPLE_RATE,
+                 *,
+                 seed: int | None = None) -> None:
+        self.path = path
+        """File spans are appended to."""
+        self.sample_rate = sample_rate
+        """Fraction of traces to record."""
+        self._file = path.open('a', encoding='utf-8')
+        self._random = random.Random(seed)  # noqa: S311
+        self._token: Any = None
+
+    def __enter__(self) -> Self:
+        """
+        Make this the current tracer.
+
+        Returns
+        -------
+        Self
+            This tracer.
+        """
+        self._token = _current_tracer.set(self)
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, exc_val: BaseException | None,
+                 exc_tb: TracebackType | None) -> None:
+        """Restore the previous tracer and close the file."""
+        _current_tracer.reset(self._token)
+        self.close()
+
+    def close(self) -> None:
+        """Flush and close the file."""
+        self._file.close()
+
+    def _new_id(self, bits: int) -> str:
+        return f'{self._random.getrandbits(bits):0{bits // 4}x}'
+
+    @contextmanager
+    def span(self, name: str, *, always: bool = False, **attributes: Any) -> Iterator[Span]:
+        """
+        Trace the body of a ``with`` statement.
+
+        Parameters
+        ----------
+        name : str
+            Operation name.
+        always : bool
+            Record the span even if sampling would skip it, when it starts a trace.
+        **attributes : Any
+            JSON-serialisable values written with the span.
+
+        Yields
+        ------
+        Span
+            The span, which may be non-recording.
+        """
+        parent = _current_span.get()
+        if parent is None:
+            current = (Span(name, self._new_id(128), self._new_id(64), None, attributes)
+                       if always or self._random.random() < self.sample_rate else _NON_RECORDING)
+        elif parent.recording:
+            current = Span(name, parent.trace_id, self._new_id(64), parent.span_id, attributes)
+        else:
+            current = _NON_RECORDING
+        token = _current_span.set(current)
+        started = time.time()
+        started_counter = time.perf_counter()
+        error = None
+        try:
+            yield current
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            _current_span.reset(token)
+            if current.recording:
+                self._file.write(
+                    json.dumps(
+                        {
+                            'attributes': current.attributes,
+                            'duration': time.perf_counter() - started_counter,
+                            'error': error,
+                            'name': name,
+                            'parent_id': current.parent_id,
+                            'span_id': current.span_id,
+                            'start': started,
+                            'trace_id': current.trace_id
+                        },
+                        default=str) + '\n')
+
+
+def span(name: str, *, always: bool = False, **attributes: Any) -> AbstractContextManager[Span]:
+    """
+    Trace the body of a ``with`` statement with the current tracer.
+
+    Parameters
+    ----------
+    name : str
+        Operation name.
+    always : bool
+        Record the span even if sampling would skip it, when it starts a trace.
+    **attributes : Any
+        JSON-serialisable values written with the span.
+
+    Returns
+    -------
+    AbstractContextManager[Span]
+        Context manager yielding the span. A non-recording span if no tracer is current.
+    """
+    if (tracer := _current_tracer.get()) is None:
+        return nullcontext(_NON_RECORDING)
+    return tracer.span(name, always=always, **attributes)
+
+
+@contextmanager
+def timed(stats: RunStats | None,
+          phase: str,
+          size: int = 0,
+          *,
+          always: bool = False,
+          **attributes: Any) -> Iterator[None]:
+    """
+    Time the body of a ``with`` statement as a phase of ``stats`` and trace it as a span.
+
+    Parameters
+    ----------
+    stats : RunStats | None
+        Statistics object in which the phase is recorded.
+    phase : str
+        Phase name, also used as the span name.
+    size : int
+        Bytes handled.
+    always : bool
+        Record the span even if sampling would skip it, when it starts a trace.
+    **attributes : Any
+        JSON-serialisable values written with the span.
+
+    Yields
+    ------
+    None
+        Control to the timed block.
+    """
+    with span(phase, always=always,
+              **attributes), (stats.timed(phase, size) if stats else nullcontext()):
+        yield
@@ -1,7 +1,39 @@
 """Typing helpers."""
 from __future__ import annotations
 
-from typing import TypedDict
+from typing import TYPE_CHECKING, Any, Literal, TypedDict
+
+if TYPE_CHECKING:
+    from datetime import datetime
+
+    from anyio import Path as AsyncPath
+    from typing_extensions import NotRequired
+
+
+class MailboxConfig(TypedDict, total=False):
+    """A mailbox (Gmail label) to archive."""
+    days: int
+    """Archive messages older than this many days. Defaults to the ``--days`` option."""
+    name: str
+    """Name of the mailbox, such as ``[Gmail]/Sent Mail`` or the name of a label."""
+    query: str
+    """Gmail search query messages must also match. Defaults to the ``--query`` option."""
+
+
+class S3Config(TypedDict):
+    """S3-compatible object storage to upload messages to."""
+    access_key_id: str
+    """Access key ID."""
+    bucket: str
+    """Bucket objects are stored in."""
+    endpoint: str
+    """Base URL of the server, such as ``https://s3.us-east-1.amazonaws.com``."""
+    prefix: NotRequired[str]
+    """Prefix of the key of every object."""
+    region: NotRequired[str]
+    """Region requests are signed for. Defaults to ``us-east-1``."""
+    secret_access_key: str
+    """Secret access key."""
 
 
 class Config(TypedDict, total=False):
@@ -10,6 +42,10 @@ class Config(TypedDict, total=False):
     """Client ID for OAuth2."""
     client_secret: str
     """Client secret for OAuth2."""
+    mailboxes: list[MailboxConfig]
+    """Mailboxes to archive instead of ``[Gmail]/All Mail``."""
+    s3: S3Config
+    """Object storage messages are uploaded to with ``--format s3``."""
 
 
 class AuthInfo(TypedDict, total=False):
@@ -26,3 +62,241 @@ class AuthInfo(TypedDict, total=False):
 
 AuthDataDB = dict[str, AuthInfo]
 """Dictionary of OAuth information for different users."""
+
+
+class DiscoveryDocument(TypedDict):
+    """Endpoints used from the OpenID Connect discovery document."""
+    authorization_endpoint: str
+    """OAuth authorisation endpoint URL."""
+    device_authorization_endpoint: str
+    """Device authorisation endpoint URL."""
+    token_endpoint: str
+    """Token endpoint URL."""
+
+
+class DiscoveryCache(TypedDict, total=False):
+    """Cached discovery document."""
+    document: DiscoveryDocument
+    """The document."""
+    etag: str
+    """Entity tag of the response, used to revalidate the document."""
+    expires: str
+    """Time the document must be revalidated in ISO 8601 format."""
+
+
+Backend = Literal['api', 'imap']
+"""How messages are fetched: the Gmail REST API or IMAP."""
+
+
+class ApiMessage(TypedDict, total=False):
+    """Message resource of the Gmail API as returned by ``messages.get`` with ``format=raw``."""
+    id: str
+    """Message ID, the hexadecimal form of ``X-GM-MSGID``."""
+    internalDate: str
+    """Arrival time in milliseconds since the epoch."""
+    labelIds: list[str]
+    """IDs of the labels of the message."""
+    raw: str
+    """The complete message, base64url encoded."""
+    sizeEstimate: int
+    """Estimated size in bytes."""
+    threadId: str
+    """Thread ID, the hexadecimal form of ``X-GM-THRID``."""
+
+
+BatchResult = tuple[int, Any]
+"""Status code and decoded JSON body of one request of a batch."""
+
+WorkOrder = Literal['large-first', 'oldest-first', 'sequence', 'small-first']
+"""Order in which planned messages are processed."""
+
+OutputFormat = Literal['eml', 'maildir', 'mbox', 's3', 'tar']
+"""Layout archived messages are written in."""
+
+
+class WrittenMessage(TypedDict):
+    """Where a message was written."""
+    files: list[AsyncPath]
+    """Files written for the message, to be synced before it is moved to the trash."""
+    labels: AsyncPath
+    """Labels file, whether or not it was written."""
+    member: NotRequired[bool]
+    """Whether ``message`` and ``labels`` name tar members or objects in storage, not files."""
+    message: AsyncPath
+    """File holding the message."""
+
+
+class FetchedMessage(TypedDict):
+    """One message of a multi-message ``FETCH`` response."""
+    data: bytes
+    """Response text outside of the literal, such as the ``X-GM-LABELS`` list."""
+    number: str
+    """Message sequence number."""
+    raw: bytes | None
+    """The message literal (``RFC822``), if present."""
+
+
+class MessageInfo(TypedDict):
+    """Size and arrival time of a message, fetched without its body."""
+    internal_date: datetime | None
+    """Internal date (arrival time) reported by the server."""
+    number: str
+    """Message sequence number."""
+    size: int
+    """Size of the message in bytes (``RFC822.SIZE``)."""
+
+
+class WorkPlan(TypedDict):
+    """Result of size-aware planning."""
+    bins: list[list[MessageInfo]]
+    """Ordered work for each connection."""
+    large: list[MessageInfo]
+    """Messages to download with the streaming path."""
+    total_bytes: int
+    """Total number of bytes across all planned messages."""
+
+
+class RunRecord(TypedDict):
+    """A finished run recorded in the history database."""
+    bytes: int
+    """Number of message bytes downloaded."""
+    finished: str
+    """Time the run finished in ISO 8601 format."""
+    messages: int
+    """Number of messages archived."""
+    seconds: float
+    """Duration of the run in seconds."""
+
+
+HistoryDB = dict[str, list[RunRecord]]
+"""Previous runs keyed by account."""
+
+
+class YearEstimate(TypedDict):
+    """Number of messages and bytes for one year."""
+    bytes: int
+    """Total size in bytes."""
+    count: int
+    """Number of messages."""
+
+
+class Estimate(TypedDict):
+    """Result of a dry run."""
+    by_year: dict[int | None, YearEstimate]
+    """Breakdown by year of the internal date. ``None`` collects messages without one."""
+    count: int
+    """Number of messages that would be archived."""
+    total_bytes: int
+    """Total size in bytes."""
+
+
+class PhaseReport(TypedDict):
+    """Timings of one phase of a run."""
+    bytes: int
+    """Bytes handled by the phase."""
+    count: int
+    """Number of calls."""
+    p50: float
+    """Median call duration in seconds."""
+    p95: float
+    """95th percentile call duration in seconds."""
+    p99: float
+    """99th percentile call duration in seconds."""
+    total: float
+    """Total duration in seconds."""
+
+
+class StatsReport(TypedDict):
+    """Statistics of a run as written by ``--stats-file``."""
+    batch_size: int | None
+    """Final fetch batch size when adaptive batching was used."""
+    bytes: int
+    """Number of message bytes downloaded."""
+    compressed_received: int
+    """Bytes received on the wire while compression was active."""
+    compressed_sent: int
+    """Bytes sent on the wire while compression was active."""
+    messages: int
+    """Number of messages archived."""
+    phases: dict[str, PhaseReport]
+    """Timings keyed by phase name."""
+    retries: int
+    """Number of fetches retried after a server error."""
+    seconds: float
+    """Duration of the run in seconds."""
+    uncompressed_received: int
+    """Bytes received after decompression."""
+    uncompressed_sent: int
+    """Bytes sent before compression."""
+    window: int | None
+    """Final in-flight window when adaptive batching was used."""
+
+
+class ResumeState(TypedDict):
+    """Messages of a mailbox archived by a run that stopped because the budget was spent."""
+    uids: str
+    """Message set of the UIDs of the archived messages."""
+    uidvalidity: NotRequired[str]
+    """``UIDVALIDITY`` of the mailbox the UIDs belong to."""
+
+
+class QuotaRecord(TypedDict, total=False):
+    """Persisted download usage for an account."""
+    resume: dict[str, ResumeState]
+    """Messages archived by runs that stopped because the budget was spent, keyed by mailbox."""
+    usage: dict[str, int]
+    """Bytes downloaded keyed by minute since the epoch."""
+
+
+QuotaDB = dict[str, QuotaRecord]
+"""Download usage keyed by account."""
+
+
+class FailureRecord(TypedDict):
+    """A message that could not be archived normally."""
+    archived: bool
+    """Whether the message was archived anyway (under ``unknown-date``)."""
+    number: str
+    """Message sequence number in the run that failed."""
+    reason: str
+    """What went wrong."""
+    snippet: str
+    """Start of the offending server response or header."""
+    time: str
+    """Time of the failure in ISO 8601 format."""
+    uid: str | None
+    """UID of the message, if it could be determined."""
+
+
+class FailureManifest(TypedDict, total=False):
+    """Failures of the last run of an account."""
+    failures: list[FailureRecord]
+    """The failures."""
+    uidvalidity: str
+    """``UIDVALIDITY`` of the mailbox the UIDs belong to."""
+
+
+FailureDB = dict[str, FailureManifest]
+"""Failures keyed by account."""
+
+
+class IndexEntry(TypedDict):
+    """Files of an archived message, relative to the directory of the index."""
+    labels: str
+    """Labels file. It does not exist while the message has no labels."""
+    member: NotRequired[bool]
+    """Whether ``message`` and ``labels`` name tar members or objects in storage, not files."""
+    message: str
+    """Message file."""
+    thread: NotRequired[str]
+    """``X-GM-THRID`` of the conversation of the message, if known."""
+
+
+class MessageIndexData(TypedDict, total=False):
+    """Archived messages of an account as stored in the message index."""
+    highestmodseq: str
+    """``HIGHESTMODSEQ`` of the mailbox when labels were last known to be current."""
+    messages: dict[str, IndexEntry]
+    """Files keyed by ``X-GM-MSGID``."""
+    uidvalidity: str
+    """``UIDVALIDITY`` of the mailbox ``highestmodseq`` belongs to."""
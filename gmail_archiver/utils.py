@@ -1,29 +1,99 @@
 """Utilities."""
 from __future__ import annotations
 
+from collections import Counter
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
 from email import message_from_bytes
 from email.utils import parsedate_tz
 from functools import cache
 from hashlib import sha1
+from itertools import islice
+from pathlib import Path
 from typing import TYPE_CHECKING, Any, cast
+import abc
 import asyncio
-import http.server
 import json
 import logging
+import re
 import socket
+import time
 import urllib.parse
 
 from anyio import Path as AsyncPath
-import niquests
+from typing_extensions import override
+
+from .batching import AdaptiveBatchSize
+from .commit import GroupCommit
+from .compress import enable_compression
+from .failures import ErrorManifest
+from .gmail_api import (
+    API_UIDVALIDITY,
+    DEFAULT_CONCURRENCY,
+    GMAIL_API_URL,
+    MAX_BATCH_SIZE,
+    GmailApiClient,
+    decode_raw,
+    message_id,
+    message_number,
+)
+from .imap import (
+    parse_exists,
+    parse_fetch_response,
+    parse_highestmodseq,
+    parse_labels,
+    parse_msgid,
+    parse_thrid,
+    parse_uids,
+    parse_uidvalidity,
+)
+from .index import INDEX_FILE, MessageIndex
+from .lazy import lazy_import
+from .planning import (
+    DEFAULT_INFO_BATCH_SIZE,
+    DEFAULT_LARGE_MESSAGE_SIZE,
+    fetch_message_info,
+    message_set,
+    plan_work,
+)
+from .stats import format_size
+from .tracing import span, timed
+from .writers import UNKNOWN_DATE_DIRECTORY, EmlWriter
 
 if TYPE_CHECKING:
-    from collections.abc import AsyncIterator, Callable, Mapping
+    from collections.abc import (
+        AsyncIterator,
+        Callable,
+        Container,
+        Iterable,
+        Mapping,
+        Sequence,
+    )
+    from contextlib import AbstractAsyncContextManager
+    import http.server as http_server
 
     import aioimaplib  # type: ignore[import-untyped]
+    import niquests
 
-    from .typing import AuthInfo
+    from .stats import RunStats
+    from .throttle import DailyQuota, TokenBucket
+    from .typing import (
+        ApiMessage,
+        AuthInfo,
+        BatchResult,
+        DiscoveryCache,
+        DiscoveryDocument,
+        Estimate,
+        FetchedMessage,
+        MailboxConfig,
+        WorkOrder,
+        WrittenMessage,
+        YearEstimate,
+    )
+    from .writers import MessageWriter
+else:
+    http_server = lazy_import('http.server')
+    niquests = lazy_import('niquests')
 
 
 @asynccontextmanager
@@ -40,13 +110,53 @@ async def _imap_debug_session(*, debug: bool) -> AsyncIterator[None]:
         aioimaplib_logger.setLevel(previous)
 
 
-__all__ = ('GoogleOAuthClient', 'archive_emails', 'authorize_tokens', 'get_auth_http_handler',
-           'get_localhost_redirect_uri', 'refresh_token')
+__all__ = ('ALL_MAIL', 'DEFAULT_DISCOVERY_TTL', 'DISCOVERY_URL', 'UNKNOWN_DATE_DIRECTORY',
+           'GoogleOAuthClient', 'archive_emails', 'archive_emails_api', 'archive_mailboxes',
+           'authorize_tokens', 'estimate_archive', 'get_auth_http_handler',
+           'get_localhost_redirect_uri', 'mailbox_key', 'oauth_session', 'refresh_token',
+           'sync_labels')
 
 log = logging.getLogger(__name__)
 
+ALL_MAIL = '[Gmail]/All Mail'
+"""The mailbox archived by default. It holds every message except spam and trash."""
+DEFAULT_DISCOVERY_TTL = 86400
+"""Seconds a cached discovery document is used without revalidation if the response has no
+``max-age``."""
+DISCOVERY_URL = 'https://accounts.google.com/.well-known/openid-configuration'
+"""Google's OpenID Connect discovery document."""
 _FETCH_MIN_LINES = 2
+_MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+_NOT_MODIFIED = 304
 _LISTEN_PORT_TYPE_ERROR = 'Expected an integer listen port from the bound socket.'
+_QUOTA_SAVE_INTERVAL = 100
+_STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def oauth_session() -> niquests.AsyncSession:
+    """
+    Create an HTTP session for OAuth requests.
+
+    Pass it to :py:func:`authorize_tokens`, :py:func:`refresh_token` and
+    :py:class:`GoogleOAuthClient` so all of them share one connection pool. Use it as an
+    asynchronous context manager to close the connections when done.
+
+    Returns
+    -------
+    niquests.AsyncSession
+        The session.
+    """
+    return niquests.AsyncSession()
+
+
+@asynccontextmanager
+async def _use_session(
+        session: niquests.AsyncSession | None) -> AsyncIterator[niquests.AsyncSession]:
+    if session is not None:
+        yield session
+        return
+    async with oauth_session() as new_session:
+        yield new_session
 
 
 @cache
@@ -75,7 +185,9 @@ async def authorize_tokens(url: str,
                            authorization_code: str,
                            verifier: str,
                            redirect_uri: str,
-                           scope: str = 'https://mail.google.com/') -> AuthInfo:
+                           scope: str = 'https://mail.google.com/',
+                           *,
+                           session: niquests.AsyncSession | None = None) -> AuthInfo:
     """
     Exchange the authorisation code for an access token.
 
@@ -95,30 +207,37 @@ async def authorize_tokens(url: str,
         The redirect URI used in the authorisation request.
     scope : str
         The requested OAuth scope.
+    session : niquests.AsyncSession | None
+        Session to send the request with. A new session is used if not given.
 
     Returns
     -------
     AuthInfo
         Token response fields from the authorisation server.
     """
-    async with niquests.AsyncSession() as session:
-        response = await session.post(url,
-                                      params={
-                                          'client_id': client_id,
-                                          'client_secret': client_secret,
-                                          'code': authorization_code,
-                                          'code_verifier': verifier,
-                                          'grant_type': 'authorization_code',
-                                          'redirect_uri': redirect_uri,
-                                          'scope': scope
-                                      },
-                                      timeout=15)
+    with span('authorize_tokens', always=True):
+        async with _use_session(session) as http:
+            response = await http.post(url,
+                                       params={
+                                           'client_id': client_id,
+                                           'client_secret': client_secret,
+                                           'code': authorization_code,
+                                           'code_verifier': verifier,
+                                           'grant_type': 'authorization_code',
+                                           'redirect_uri': redirect_uri,
+                                           'scope': scope
+                                       },
+                                       timeout=15)
     response.raise_for_status()
     return cast('AuthInfo', response.json())
 
 
-async def refresh_token(url: str, client_id: str, client_secret: str,
-                        refresh_token: str) -> AuthInfo:
+async def refresh_token(url: str,
+                        client_id: str,
+                        client_secret: str,
+                        refresh_token: str,
+                        *,
+                        session: niquests.AsyncSession | None = None) -> AuthInfo:
     """
     Refresh the access token using the refresh token.
 
@@ -132,21 +251,24 @@ async def refresh_token(url: str, client_id: str, client_secret: str,
         The OAuth client secret.
     refresh_token : str
         The refresh token.
+    session : niquests.AsyncSession | None
+        Session to send the request with. A new session is used if not given.
 
     Returns
     -------
     AuthInfo
         Token response fields from the authorisation server.
     """
-    async with niquests.AsyncSession() as session:
-        response = await session.post(url,
-                                      params={
-                                          'client_id': client_id,
-                                          'client_secret': client_secret,
-                                          'grant_type': 'refresh_token',
-                                          'refresh_token': refresh_token
-                                      },
-                                      timeout=15)
+    with span('refresh_token', always=True):
+        async with _use_session(session) as http:
+            response = await http.post(url,
+                                       params={
+                                           'client_id': client_id,
+                                           'client_secret': client_secret,
+                                           'grant_type': 'refresh_token',
+                                           'refresh_token': refresh_token
+                                       },
+                                       timeout=15)
     response.raise_for_status()
     return cast('AuthInfo', response.json())
 
@@ -154,7 +276,9 @@ async def refresh_token(url: str, client_id: str, client_secret: str,
 @cache
 def dq(s: str) -> str:
     """
-    Quote a string for use in an IMAP search.
+    Quote a string for use in an IMAP command.
+
+    Backslashes and double quotes in the string are escaped.
 
     Parameters
     ----------
@@ -164,9 +288,709 @@ def dq(s: str) -> str:
     Returns
     -------
     str
-        The string wrapped in double quotes for IMAP.
+        The string as an IMAP quoted string.
     """
-    return f'"{s}"'
+    escaped = s.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+async def _search_messages(imap_conn: aioimaplib.IMAP4_SSL,
+                           days: int,
+                           query: str | None = None,
+                           stats: RunStats | None = None) -> list[str]:
+    before_date = (datetime.now(tz=timezone.utc).date() - timedelta(days=days)).strftime('%d-%b-%Y')
+    criteria = f'BEFORE {dq(before_date)}'
+    if query:
+        # Gmail search syntax is evaluated by the server (X-GM-EXT-1).
+        criteria += f' X-GM-RAW {dq(query)}'
+    log.debug('Searching for emails: %s', criteria)
+    with timed(stats, 'search', always=True):
+        response = await imap_conn.search(criteria)
+    match response.result:
+        case 'OK' if response.lines and response.lines[0]:
+            return cast('list[str]', response.lines[0].decode().split())
+        case _:
+            return []
+
+
+async def _fetch_uids(imap_conn: aioimaplib.IMAP4_SSL, numbers: Sequence[str]) -> dict[str, str]:
+    # Returns UIDs keyed by message sequence number.
+    uids: dict[str, str] = {}
+    it = iter(numbers)
+    while batch := list(islice(it, DEFAULT_INFO_BATCH_SIZE)):
+        response = await imap_conn.fetch(message_set(batch), '(UID)')
+        if response.result == 'OK':
+            uids.update(parse_uids(response.lines))
+        else:
+            log.warning('Could not look up the UIDs of %d messages.', len(batch))
+    return uids
+
+
+async def _uid_numbers(imap_conn: aioimaplib.IMAP4_SSL,
+                       uids: Sequence[str],
+                       stats: RunStats | None = None) -> list[str]:
+    # Returns the sequence numbers of the messages with the UIDs that are still in the mailbox.
+    numbers: list[str] = []
+    it = iter(uids)
+    while batch := list(islice(it, DEFAULT_INFO_BATCH_SIZE)):
+        with timed(stats, 'search', always=True):
+            response = await imap_conn.search(f'UID {message_set(batch)}')
+        if response.result == 'OK' and response.lines and response.lines[0]:
+            numbers.extend(response.lines[0].decode().split())
+    return numbers
+
+
+async def _failed_messages(imap_conn: aioimaplib.IMAP4_SSL,
+                           errors: ErrorManifest | None,
+                           uidvalidity: str | None,
+                           stats: RunStats | None = None) -> list[str]:
+    if not errors or not (uids := errors.retry_uids(uidvalidity)):
+        return []
+    log.debug('Retrying %d messages that failed in the previous run.', len(uids))
+    return await _uid_numbers(imap_conn, uids, stats)
+
+
+async def _claim_messages(imap_conn: aioimaplib.IMAP4_SSL,
+                          messages: Sequence[str],
+                          index: MessageIndex,
+                          stats: RunStats | None = None) -> tuple[list[str], dict[str, str]]:
+    # Returns the messages to archive and the X-GM-MSGID of those archived by a previous run.
+    ret: list[str] = []
+    archived: dict[str, str] = {}
+    it = iter(messages)
+    while batch := list(islice(it, DEFAULT_INFO_BATCH_SIZE)):
+        with timed(stats, 'search', count=len(batch)):
+            response = await imap_conn.fetch(message_set(batch), '(X-GM-MSGID)')
+        if response.result != 'OK':
+            log.warning('Message ID fetch failed for %d messages.', len(batch))
+            ret.extend(batch)
+            continue
+        msgids = {
+            num: msgid
+            for num, record in parse_fetch_response(response.lines).items()
+            if (msgid := parse_msgid(record['data'])) is not None
+        }
+        for num in batch:
+            if (msgid := msgids.get(num)) is None:
+                ret.append(num)
+            elif not index.claim(msgid):
+                continue
+            elif index.archived(msgid):
+                archived[num] = msgid
+            else:
+                ret.append(num)
+    return ret, archived
+
+
+def _message_date(date: str | None) -> datetime | None:
+    if not (date_tuple := parsedate_tz(cast('str', date))):
+        log.error('Error converting date: %s', date)
+        return None
+    return datetime(*date_tuple[0:6], tzinfo=timezone.utc)
+
+
+class _BaseArchiver(abc.ABC):
+    """State shared by the steps of one archive run, independent of how messages are fetched."""
+    def __init__(self,
+                 writer: MessageWriter,
+                 email: str,
+                 *,
+                 delete: bool = False,
+                 errors: ErrorManifest | None = None,
+                 index: MessageIndex | None = None,
+                 keep_going: bool = False,
+                 mailbox: str = ALL_MAIL,
+                 quota: DailyQuota | None = None,
+                 rate_limiter: TokenBucket | None = None,
+                 stats: RunStats | None = None,
+                 uidvalidity: str | None = None) -> None:
+        self.delete = delete
+        self.done: list[str] = []
+        self.email = email
+        self.errors = errors
+        self.index = index
+        self.keep_going = keep_going
+        self.mailbox = mailbox
+        self.quota = quota
+        self.rate_limiter = rate_limiter
+        self.stats = stats
+        self.uidvalidity = uidvalidity
+        self.writer = writer
+        self._commit = GroupCommit(
+            Path(writer.root), self._trash, prepare=writer.flush, stats=stats) if delete else None
+        self._failed = False
+        self._in_flight: set[asyncio.Task[tuple[list[str], bool]]] = set()
+        self._quota_countdown = _QUOTA_SAVE_INTERVAL
+
+    async def _account(self, size: int) -> None:
+        if self.stats:
+            self.stats.add_message(size)
+        if self.quota:
+            self.quota.add(size)
+            self._quota_countdown -= 1
+            if self._quota_countdown == 0:
+                self._quota_countdown = _QUOTA_SAVE_INTERVAL
+                await self.quota.save()
+        if self.rate_limiter:
+            await self.rate_limiter.consume(size)
+
+    def _record(self, phase: str, started: float, size: int = 0) -> None:
+        if self.stats:
+            self.stats.add_timing(phase, time.perf_counter() - started, size)
+
+    def _failure(self,
+                 num: str,
+                 reason: str,
+                 data: Iterable[bytes | bytearray | str] | bytes | str | None = None,
+                 *,
+                 archived: bool = False) -> bool:
+        # Returns whether the run continues.
+        if self.errors:
+            self.errors.add(num, reason, data, archived=archived)
+        return self.keep_going
+
+    def _date(self, num: str, date: str | None) -> tuple[bool, datetime | None]:
+        # Returns whether the message is archived and its date, if it can be parsed.
+        if parsed := _message_date(date):
+            return True, parsed
+        self._failure(num, 'unparseable date', date, archived=self.keep_going)
+        return self.keep_going, None
+
+    async def _reap(self, limit: int) -> bool:
+        while len(self._in_flight) > limit:
+            finished, _ = await asyncio.wait(self._in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                self._in_flight.discard(task)
+                written, ok = task.result()
+                self.done.extend(written)
+                self._failed = self._failed or not ok
+            self._update_queue_depths()
+        return not self._failed
+
+    def _update_queue_depths(self, pending: int | None = None) -> None:
+        if self.stats:
+            self.stats.in_flight = len(self._in_flight)
+            if pending is not None:
+                self.stats.pending = pending
+
+    async def _resume(self, messages: list[str]) -> list[str]:
+        # The resume state is stored by UID, as sequence numbers change when messages are expunged.
+        if not self.quota or self.delete or not (uids := await self.quota.resume_uids(
+                self.mailbox, self.uidvalidity)):
+            return messages
+        skip = set(await self._numbers(uids))
+        self.done = [x for x in messages if x in skip]
+        log.info('Resuming: skipping %d messages archived by a previous run.', len(self.done))
+        return [x for x in messages if x not in skip]
+
+    async def _stop_for_quota(self) -> int:
+        if not await self._reap(0):
+            return 1
+        quota = cast('DailyQuota', self.quota)
+        log.warning(
+            'Daily download budget of %s reached after %d messages. Stopping; run again later to '
+            'continue.', format_size(quota.limit), len(self.done))
+        if not self.delete:
+            await quota.set_resume(self.mailbox, self.uidvalidity, await self._uids(self.done))
+        return 0
+
+    async def _finished(self) -> None:
+        if self.quota:
+            await self.quota.set_resume(self.mailbox, self.uidvalidity, [])
+
+    def _indexed(self, msgid: str | None, thrid: str | None, written: WrittenMessage) -> None:
+        if self.index and msgid:
+            self.index.add(msgid,
+                           written['message'],
+                           written['labels'],
+                           thrid,
+                           member=written.get('member', False))
+
+    async def trash_archived(self, archived: Mapping[str, str]) -> None:
+        """
+        Move messages archived by a previous run to the trash once their files are durable.
+
+        Messages whose file is no longer present are left in the mailbox. Messages written to a tar
+        archive or to object storage are moved to the trash without a check, as their files never
+        existed.
+
+        Parameters
+        ----------
+        archived : Mapping[str, str]
+            ``X-GM-MSGID`` of the messages keyed by message number.
+        """
+        if not self._commit or not self.index or not archived:
+            return
+        nums: list[str] = []
+        files: list[AsyncPath] = []
+        for num, msgid in archived.items():
+            if self.index.is_member(msgid):
+                nums.append(num)
+            elif (path := self.index.message_file(msgid)) and await path.exists():
+                nums.append(num)
+                files.append(path)
+        if missing := len(archived) - len(nums):
+            log.warning('Not deleting %d archived messages whose files are missing.', missing)
+        await self._written(nums, files)
+
+    async def _written(self, nums: list[str], files: list[AsyncPath]) -> None:
+        # Messages are only moved to the trash once their files are on stable storage.
+        if self._commit and nums:
+            await self._commit.add(nums, files)
+
+    async def commit(self) -> None:
+        """Make all written messages durable and move them to the trash if deleting."""
+        if self._commit:
+            await self._commit.flush()
+
+    @abc.abstractmethod
+    async def _trash(self, nums: list[str]) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def _uids(self, nums: list[str]) -> list[str]:
+        # Returns the UIDs of the messages.
+        pass
+
+    @abc.abstractmethod
+    async def _numbers(self, uids: list[str]) -> list[str]:
+        # Returns the numbers of the messages with the UIDs.
+        pass
+
+
+class _Archiver(_BaseArchiver):
+    """State shared by the steps of one archive run over IMAP."""
+    def __init__(self,
+                 imap_conn: aioimaplib.IMAP4_SSL,
+                 writer: MessageWriter,
+                 email: str,
+                 *,
+                 batcher: AdaptiveBatchSize | None = None,
+                 delete: bool = False,
+                 errors: ErrorManifest | None = None,
+                 index: MessageIndex | None = None,
+                 keep_going: bool = False,
+                 mailbox: str = ALL_MAIL,
+                 quota: DailyQuota | None = None,
+                 rate_limiter: TokenBucket | None = None,
+                 stats: RunStats | None = None,
+                 uidvalidity: str | None = None) -> None:
+        super().__init__(writer,
+                         email,
+                         delete=delete,
+                         errors=errors,
+                         index=index,
+                         keep_going=keep_going,
+                         mailbox=mailbox,
+                         quota=quota,
+                         rate_limiter=rate_limiter,
+                         stats=stats,
+                         uidvalidity=uidvalidity)
+        self.batcher = batcher
+        self.imap_conn = imap_conn
+        self._imap_lock = asyncio.Lock()
+
+    async def record_uids(self) -> None:
+        """Look up the UIDs of the failed messages so the next run can find them."""
+        if not self.errors or not (numbers := self.errors.numbers):
+            return
+        async with self._imap_lock:
+            self.errors.set_uids(await _fetch_uids(self.imap_conn, numbers))
+
+    @override
+    async def _uids(self, nums: list[str]) -> list[str]:
+        async with self._imap_lock:
+            return list((await _fetch_uids(self.imap_conn, nums)).values())
+
+    @override
+    async def _numbers(self, uids: list[str]) -> list[str]:
+        async with self._imap_lock:
+            return await _uid_numbers(self.imap_conn, uids, self.stats)
+
+    async def _fetch_metadata(self, num: str) -> tuple[list[str] | None, str | None, str | None]:
+        # Returns the labels, X-GM-MSGID and X-GM-THRID.
+        with timed(self.stats, 'labels'):
+            response = await self.imap_conn.fetch(num, '(X-GM-MSGID X-GM-THRID X-GM-LABELS)')
+        if response.result != 'OK' or not (record := parse_fetch_response(response.lines).get(num)):
+            return None, None, None
+        data = record['data']
+        return parse_labels(data), parse_msgid(data), parse_thrid(data)
+
+    async def _trash(self, nums: list[str]) -> None:
+        async with self._imap_lock:
+            with timed(self.stats, 'trash', count=len(nums)):
+                await self.imap_conn.store(message_set(nums), '+X-GM-LABELS', '\\Trash')
+
+    async def archive_message(self, num: str) -> bool:
+        with span('message', number=num):
+            started = time.perf_counter()
+            with span('fetch'):
+                fetch_response = await self.imap_conn.fetch(num, '(RFC822)')
+            if fetch_response.result != 'OK':
+                log.error('Error getting message #%s.', num)
+                self._failure(num, 'fetch failed', fetch_response.lines)
+                return False
+            if len(fetch_response.lines) < _FETCH_MIN_LINES:
+                log.error('Unexpected empty message data for message #%s.', num)
+                self._failure(num, 'empty message data', fetch_response.lines)
+                return False
+            raw_message = fetch_response.lines[1]
+            if not isinstance(raw_message, (bytes, bytearray)):
+                log.error('Unexpected message data type for message #%s.', num)
+                self._failure(num, 'unexpected message data type', fetch_response.lines)
+                return False
+            raw_message = bytes(raw_message)
+            self._record('fetch', started, len(raw_message))
+            started = time.perf_counter()
+            with timed(self.stats, 'parse', len(raw_message)):
+                msg = message_from_bytes(raw_message)
+            archived, date = self._date(num, msg['Date'])
+            if not archived:
+                return False
+            labels, msgid, thrid = await self._fetch_metadata(num)
+            written = await self.writer.write(self.email, num, msgid, date, raw_message, labels)
+            self._indexed(msgid, thrid, written)
+            self._record('message', started, len(raw_message))
+            await self._written([num], written['files'])
+            await self._account(len(raw_message))
+            return True
+
+    async def archive_large_message(self, num: str, size: int) -> bool:
+        with span('message', number=num, size=size):
+            part_file = self.writer.part_file(self.email, num)
+            await part_file.parent.mkdir(parents=True, exist_ok=True)
+            hasher = sha1(usedforsecurity=False)
+            head = b''
+            log.debug('Streaming message #%s (%d bytes).', num, size)
+            async with await part_file.open('wb') as f:
+                for offset in range(0, max(size, 1), _STREAM_CHUNK_SIZE):
+                    started = time.perf_counter()
+                    with span('fetch', offset=offset):
+                        response = await self.imap_conn.fetch(
+                            num, f'(BODY.PEEK[]<{offset}.{_STREAM_CHUNK_SIZE}>)')
+                    if (response.result != 'OK' or len(response.lines) < _FETCH_MIN_LINES
+                            or not isinstance(response.lines[1], (bytes, bytearray))):
+                        log.error('Error streaming message #%s at offset %d.', num, offset)
+                        self._failure(num, f'fetch failed at offset {offset}', response.lines)
+                        await f.aclose()
+                        await part_file.unlink(missing_ok=True)
+                        return False
+                    chunk = bytes(response.lines[1])
+                    self._record('fetch', started, len(chunk))
+                    if b'\r\n\r\n' not in head and b'\n\n' not in head:
+                        head += chunk
+                    hasher.update(chunk)
+                    with timed(self.stats, 'write', len(chunk)):
+                        await f.write(chunk)
+                    if len(chunk) < _STREAM_CHUNK_SIZE:
+                        break
+            started = time.perf_counter()
+            with timed(self.stats, 'parse', len(head)):
+                msg = message_from_bytes(head)
+            archived, date = self._date(num, msg['Date'])
+            if not archived:
+                await part_file.unlink(missing_ok=True)
+                return False
+            labels, msgid, thrid = await self._fetch_metadata(num)
+            written = await self.writer.write_file(self.email,
+                                                   num,
+                                                   msgid,
+                                                   date,
+                                                   part_file,
+                                                   labels,
+                                                   digest=hasher.hexdigest,
+                                                   size=size)
+            self._indexed(msgid, thrid, written)
+            self._record('message', started, size)
+            await self._written([num], written['files'])
+            await self._account(size)
+            return True
+
+    async def _fetch_batch(self, batcher: AdaptiveBatchSize,
+                           batch: list[str]) -> dict[str, FetchedMessage] | None:
+        with span('fetch', count=len(batch), numbers=message_set(batch)) as fetch_span:
+            async with self._imap_lock:
+                started = time.monotonic()
+                response = await self.imap_conn.fetch(message_set(batch),
+                                                      '(X-GM-MSGID X-GM-THRID X-GM-LABELS RFC822)')
+                latency = time.monotonic() - started
+            if response.result != 'OK':
+                batcher.record(latency, 0, ok=False)
+                return None
+            with timed(self.stats, 'parse-fetch'):
+                records = parse_fetch_response(response.lines)
+            size = sum(len(x['raw'] or b'') for x in records.values())
+            batcher.record(latency, size)
+            fetch_span.set_attributes(size=size)
+            if self.stats:
+                self.stats.add_timing('fetch', latency, size)
+            return records
+
+    async def _write_batch(self, batch: list[str],
+                           records: Mapping[str, FetchedMessage]) -> tuple[list[str], bool]:
+        written: list[str] = []
+        files: list[AsyncPath] = []
+        ok = True
+        for num in batch:
+            with span('message', number=num):
+                if not (record := records.get(num)) or (raw_message := record['raw']) is None:
+                    log.error('Unexpected empty message data for message #%s.', num)
+                    if self._failure(num, 'empty message data', record['data'] if record else None):
+                        continue
+                    ok = False
+                    break
+                started = time.perf_counter()
+                with timed(self.stats, 'parse', len(raw_message)):
+                    msg = message_from_bytes(raw_message)
+                archived, date = self._date(num, msg['Date'])
+                if not archived:
+                    ok = False
+                    break
+                msgid = parse_msgid(record['data'])
+                message = await self.writer.write(self.email, num, msgid, date, raw_message,
+                                                  parse_labels(record['data']))
+                self._indexed(msgid, parse_thrid(record['data']), message)
+                files.extend(message['files'])
+                self._record('message', started, len(raw_message))
+                written.append(num)
+        await self._written(written, files)
+        return written, ok
+
+    async def _archive_single(self, num: str, large_size: int | None) -> bool:
+        # Returns whether the run continues.
+        if await (self.archive_message(num) if large_size is None else self.archive_large_message(
+                num, large_size)):
+            self.done.append(num)
+            return True
+        return self.keep_going
+
+    def _take(self, messages: list[str], count: int, sizes: Mapping[str, int],
+              large: Container[str]) -> list[str]:
+        batch: list[str] = []
+        taken = 0
+        for num in messages:
+            if len(batch) >= count or (batch and num in large):
+                break
+            taken += sizes.get(num, 0)
+            if self.quota and not self.quota.allows(taken):
+                break
+            batch.append(num)
+            if num in large:
+                break
+        return batch
+
+    async def run(self, messages: list[str], sizes: Mapping[str, int],
+                  large: Container[str]) -> int:
+        messages = await self._resume(messages)
+        pos = 0
+        try:
+            while pos < len(messages):
+                self._update_queue_depths(len(messages) - pos)
+                if not await self._reap(self.batcher.window - 1 if self.batcher else 0):
+                    return 1
+                batched = self.batcher is not None and messages[pos] not in large
+                if not (batch := self._take(
+                        messages[pos:], self.batcher.batch_size if self.batcher and batched else 1,
+                        sizes, large)):
+                    return await self._stop_for_quota()
+                if not self.batcher or not batched:
+                    num = batch[0]
+                    if not await self._reap(0) or not await self._archive_single(
+                            num, sizes[num] if num in large else None):
+                        return 1
+                elif (records := await self._fetch_batch(self.batcher, batch)) is None:
+                    if len(batch) == 1:
+                        log.error('Error getting message #%s.', batch[0])
+                        if not self._failure(batch[0], 'fetch failed'):
+                            return 1
+                        pos += 1
+                        continue
+                    log.warning('Fetching %d messages failed. Retrying with a smaller batch.',
+                                len(batch))
+                    if self.stats:
+                        self.stats.retries += 1
+                    continue
+                else:
+                    for record in records.values():
+                        if record['raw'] is not None:
+                            await self._account(len(record['raw']))
+                    task = asyncio.create_task(self._write_batch(batch, records))
+                    self._in_flight.add(task)
+                    self._update_queue_depths()
+                pos += len(batch)
+            self._update_queue_depths(0)
+            if not await self._reap(0):
+                return 1
+        finally:
+            await asyncio.gather(*self._in_flight)
+            if self.stats and self.batcher:
+                self.stats.batch_size = self.batcher.batch_size
+                self.stats.window = self.batcher.window
+        await self._finished()
+        return 0
+
+
+class _ApiArchiver(_BaseArchiver):
+    """State shared by the steps of one archive run over the Gmail API."""
+    def __init__(self,
+                 client: GmailApiClient,
+                 writer: MessageWriter,
+                 email: str,
+                 *,
+                 batch_size: int = MAX_BATCH_SIZE,
+                 concurrency: int = DEFAULT_CONCURRENCY,
+                 delete: bool = False,
+                 errors: ErrorManifest | None = None,
+                 index: MessageIndex | None = None,
+                 keep_going: bool = False,
+                 quota: DailyQuota | None = None,
+                 rate_limiter: TokenBucket | None = None,
+                 stats: RunStats | None = None) -> None:
+        super().__init__(writer,
+                         email,
+                         delete=delete,
+                         errors=errors,
+                         index=index,
+                         keep_going=keep_going,
+                         quota=quota,
+                         rate_limiter=rate_limiter,
+                         stats=stats,
+                         uidvalidity=API_UIDVALIDITY)
+        self.batch_size = batch_size
+        self.client = client
+        self.concurrency = concurrency
+        self.labels: dict[str, str] = {}
+        self._fetched_bytes = 0
+        self._fetched_count = 0
+        self._reserved = 0
+
+    def record_uids(self) -> None:
+        """Record the message IDs of the failed messages so the next run can find them."""
+        if self.errors:
+            self.errors.set_uids({x: message_id(x) for x in self.errors.numbers})
+
+    @override
+    async def _uids(self, nums: list[str]) -> list[str]:
+        # Message IDs do not change, so they are used as is.
+        return nums
+
+    @override
+    async def _numbers(self, uids: list[str]) -> list[str]:
+        return uids
+
+    async def _trash(self, nums: list[str]) -> None:
+        with timed(self.stats, 'trash', count=len(nums)):
+            await self.client.trash([message_id(x) for x in nums])
+
+    async def _fetch_batch(self, batch: list[str]) -> dict[str, tuple[BatchResult, bytes | None]]:
+        with span('fetch', count=len(batch)) as fetch_span:
+            started = time.monotonic()
+            results = await self.client.get_raw([message_id(x) for x in batch])
+            latency = time.monotonic() - started
+            with timed(self.stats, 'parse-fetch'):
+                records: dict[str, tuple[BatchResult, bytes | None]] = {}
+                for num in batch:
+                    result = results.get(message_id(num), (0, None))
+                    message = GmailApiClient.message(result)
+                    records[num] = (result, decode_raw(message) if message else None)
+            size = sum(len(raw or b'') for _, raw in records.values())
+            fetch_span.set_attributes(size=size)
+            if self.stats:
+                self.stats.add_timing('fetch', latency, size)
+            return records
+
+    def _average_size(self) -> int | None:
+        # Returns the average size of the messages fetched so far, rounded up.
+        if not self._fetched_count:
+            return None
+        return max(-(-self._fetched_bytes // self._fetched_count), 1)
+
+    async def _archive_batch(self,
+                             batch: list[str],
+                             reservation: int = 0) -> tuple[list[str], bool]:
+        try:
+            records = await self._fetch_batch(batch)
+            for _, raw_message in records.values():
+                if raw_message is not None:
+                    self._fetched_bytes += len(raw_message)
+                    self._fetched_count += 1
+                    await self._account(len(raw_message))
+        finally:
+            self._reserved -= reservation
+        written: list[str] = []
+        files: list[AsyncPath] = []
+        ok = True
+        for num in batch:
+            with span('message', number=num):
+                result, raw_message = records[num]
+                if raw_message is None:
+                    log.error('Error getting message #%s (status %d).', num, result[0])
+                    if self._failure(
+                            num, 'fetch failed',
+                            f'HTTP {result[0]}' if result[1] is None else json.dumps(result[1])):
+                        continue
+                    ok = False
+                    break
+                started = time.perf_counter()
+                with timed(self.stats, 'parse', len(raw_message)):
+                    msg = message_from_bytes(raw_message)
+                archived, date = self._date(num, msg['Date'])
+                if not archived:
+                    ok = False
+                    break
+                message = cast('ApiMessage', result[1])
+                labels = [self.labels[x] for x in message.get('labelIds', []) if x in self.labels]
+                message_files = await self.writer.write(self.email, num, num, date, raw_message,
+                                                        labels)
+                self._indexed(
+                    num,
+                    message_number(thread_id) if (thread_id := message.get('threadId')) else None,
+                    message_files)
+                files.extend(message_files['files'])
+                self._record('message', started, len(raw_message))
+                written.append(num)
+        await self._written(written, files)
+        return written, ok
+
+    async def run(self, messages: list[str]) -> int:
+        messages = await self._resume(messages)
+        self.labels = await self.client.labels()
+        pos = 0
+        try:
+            while pos < len(messages):
+                self._update_queue_depths(len(messages) - pos)
+                if not await self._reap(self.concurrency - 1):
+                    return 1
+                count = min(self.batch_size, len(messages) - pos)
+                reservation = 0
+                if self.quota:
+                    # Sizes are only known once messages are fetched, so every batch in flight
+                    # reserves the average size of the messages fetched so far. The first batch
+                    # runs alone to measure it, as do batches once the budget is nearly spent.
+                    average = self._average_size()
+                    if self._in_flight and (
+                            average is None
+                            or not self.quota.allows(self._reserved + average * count)):
+                        if not await self._reap(0):
+                            return 1
+                        average = self._average_size()
+                    if average is not None:
+                        count = min(count, (self.quota.remaining - self._reserved) // average)
+                    if count <= 0 or not self.quota.allows():
+                        return await self._stop_for_quota()
+                    reservation = (average or 0) * count
+                    self._reserved += reservation
+                batch = messages[pos:pos + count]
+                self._in_flight.add(asyncio.create_task(self._archive_batch(batch, reservation)))
+                self._update_queue_depths()
+                pos += len(batch)
+            self._update_queue_depths(0)
+            if not await self._reap(0):
+                return 1
+        finally:
+            await asyncio.gather(*self._in_flight)
+        await self._finished()
+        return 0
 
 
 async def archive_emails(imap_conn: aioimaplib.IMAP4_SSL,
@@ -175,11 +999,75 @@ async def archive_emails(imap_conn: aioimaplib.IMAP4_SSL,
                          out_dir: AsyncPath,
                          days: int = 90,
                          *,
+                         adaptive: bool = False,
+                         compress: bool = False,
                          debug: bool = False,
-                         delete: bool = False) -> int:
+                         delete: bool = False,
+                         errors: ErrorManifest | None = None,
+                         index: MessageIndex | None = None,
+                         keep_going: bool = False,
+                         large_message_size: int = DEFAULT_LARGE_MESSAGE_SIZE,
+                         mailbox: str = ALL_MAIL,
+                         order: WorkOrder = 'small-first',
+                         plan: bool = False,
+                         query: str | None = None,
+                         quota: DailyQuota | None = None,
+                         rate_limiter: TokenBucket | None = None,
+                         retry_failed: bool = False,
+                         stats: RunStats | None = None,
+                         writer: MessageWriter | None = None) -> int:
     """
     Download emails and optionally move them to the trash.
 
+    Messages are archived from ``mailbox``, by default :py:data:`ALL_MAIL`. When ``index`` is
+    given, the ``X-GM-MSGID`` of every matched message is fetched first and messages already
+    claimed in the index are skipped, so concurrent runs over several mailboxes sharing the index
+    download each message once (see :py:func:`archive_mailboxes`).
+
+    By default the run stops at the first message that cannot be fetched or whose ``Date`` header
+    cannot be parsed. With ``keep_going``, such messages are skipped and the run continues; messages
+    with an unparseable date are archived under :py:data:`UNKNOWN_DATE_DIRECTORY`. Failures are
+    recorded in ``errors`` with the message UID, the reason and the start of the server response.
+    With ``retry_failed``, only the messages that failed in the previous run (as recorded in
+    ``errors``) are archived instead of searching by date.
+
+    When ``query`` is given, only messages that also match it are archived. It uses Gmail search
+    syntax (for example ``-category:promotions larger:5M``) and is passed to the server with
+    ``X-GM-RAW``, so messages that do not match are never downloaded.
+
+    Messages are written by ``writer``, by default one ``.eml`` file per message (see
+    :py:class:`~gmail_archiver.writers.EmlWriter`). Messages it buffers are written out before
+    they are synced and when the run ends.
+
+    When ``plan`` is set, the size and internal date of every matched message are fetched first
+    (without bodies). The sizes are used to order the work and to download messages larger than
+    ``large_message_size`` in chunks so they are never held in memory whole.
+
+    When ``adaptive`` is set, messages are fetched in batches (bodies and labels in one command).
+    The batch size and the number of batches being written while the next is fetched are tuned
+    from the observed latency, throughput and server errors (see
+    :py:class:`~gmail_archiver.batching.AdaptiveBatchSize`). A failed batch is retried with a
+    smaller batch size.
+
+    When ``compress`` is set and the server supports ``COMPRESS=DEFLATE`` (RFC 4978), the
+    connection is compressed after authentication. Compressed and uncompressed byte counts are
+    recorded in ``stats``.
+
+    With ``delete``, messages are moved to the trash only once their files and directories have been
+    synced to disk. This is done for groups of messages (see
+    :py:class:`~gmail_archiver.commit.GroupCommit`), with one ``STORE`` per group.
+
+    When ``stats`` is given, every phase (``search``, ``fetch``, ``parse``, ``mkdir``, ``exists``,
+    ``write``, ``labels``, ``sync``, ``trash``) is timed, as is the handling of each message once
+    its body has been received (``message``). See
+    :py:meth:`~gmail_archiver.stats.RunStats.phase_report`.
+
+    When ``quota`` is given and the daily download budget would be exceeded, archiving stops cleanly
+    before the next message. The sizes of the messages are fetched first for this if ``plan`` is not
+    set. With ``delete`` the archived messages are already in the trash, so the
+    next run continues where this one stopped. Without it, the UIDs of the archived messages are
+    stored in the quota state with the mailbox ``UIDVALIDITY`` and skipped by the next run.
+
     Parameters
     ----------
     imap_conn : aioimaplib.IMAP4_SSL
@@ -189,85 +1077,616 @@ async def archive_emails(imap_conn: aioimaplib.IMAP4_SSL,
     access_token : str
         The OAuth2 access token for authentication.
     out_dir : AsyncPath
-        The root directory for archived messages.
+        The root directory for archived messages. Not used if ``writer`` is given.
     days : int
         Archive messages older than this many days.
+    adaptive : bool
+        When True, fetch messages in adaptively sized batches.
+    compress : bool
+        When True, negotiate ``COMPRESS=DEFLATE`` if the server supports it.
     debug : bool
         When True, enable verbose IMAP protocol logging.
     delete : bool
         When True, move archived messages to trash.
+    errors : ErrorManifest | None
+        Manifest in which failures are recorded. It is loaded and saved by this function.
+    index : MessageIndex | None
+        Index in which archived messages are recorded and claimed by ``X-GM-MSGID``. Messages
+        already in it are not downloaded again. It is loaded and saved by this function.
+    keep_going : bool
+        When True, continue past messages that cannot be archived.
+    large_message_size : int
+        With ``plan``, messages above this many bytes are streamed to disk in chunks.
+    mailbox : str
+        The mailbox to archive.
+    order : WorkOrder
+        With ``plan``, the order in which messages are archived.
+    plan : bool
+        When True, run the size-aware planning phase before downloading.
+    query : str | None
+        Gmail search query the messages must also match.
+    quota : DailyQuota | None
+        Daily download budget for the account.
+    rate_limiter : TokenBucket | None
+        Limits the download rate.
+    retry_failed : bool
+        When True, archive only the messages recorded as failed in ``errors`` by the previous run.
+    stats : RunStats | None
+        Statistics object updated as messages are archived.
+    writer : MessageWriter | None
+        Writes the messages in the output layout. An
+        :py:class:`~gmail_archiver.writers.EmlWriter` of ``out_dir`` is used if not given.
 
     Returns
     -------
     int
-        ``0`` on success, ``1`` if an error occurred while processing messages.
+        ``0`` on success, ``1`` if the mailbox could not be selected or an error occurred while
+        processing messages. With ``keep_going``, ``1`` if any message could not be archived.
     """
     async with _imap_debug_session(debug=debug):
         log.info('Deleting emails: %s', delete)
-        await imap_conn.xoauth2(email, access_token.encode())
-        await imap_conn.select(dq('[Gmail]/All Mail'))
-        before_date = (datetime.now(tz=timezone.utc).date() -
-                       timedelta(days=days)).strftime('%d-%b-%Y')
-        log.debug('Searching for emails before %s.', before_date)
-        response = await imap_conn.search(f'BEFORE {dq(before_date)}')
-        match response.result:
-            case 'OK' if response.lines and response.lines[0]:
-                messages = response.lines[0].decode().split()
-                if not messages:
-                    log.info('No messages matched criteria.')
-                    return 0
-            case _:
-                log.info('No messages matched criteria.')
-                return 0
+        with span('xoauth2', always=True, account=email):
+            await imap_conn.xoauth2(email, access_token)
+        if compress:
+            with span('compress', always=True) as compress_span:
+                compress_span.set_attributes(enabled=await enable_compression(imap_conn, stats))
+        with span('select', always=True):
+            select_response = await imap_conn.select(dq(mailbox))
+        if select_response.result != 'OK':
+            log.error('Could not select %s.', mailbox)
+            return 1
+        uidvalidity = parse_uidvalidity(select_response.lines)
+        if errors:
+            await errors.load()
+        if index:
+            await index.load()
+        if retry_failed:
+            messages = await _failed_messages(imap_conn, errors, uidvalidity, stats)
+        else:
+            messages = await _search_messages(imap_conn, days, query, stats)
+        archived: dict[str, str] = {}
+        if index and messages:
+            messages, archived = await _claim_messages(imap_conn, messages, index, stats)
+            if archived:
+                log.info('Skipping %d messages archived by a previous run.', len(archived))
+        if not messages and not (delete and archived):
+            log.info('No messages matched criteria.')
+            if errors:
+                await errors.save(uidvalidity)
+            return 0
+        log.info('Archiving %d messages from %s.', len(messages), mailbox)
+        writer = writer or EmlWriter(await AsyncPath(out_dir).resolve(), stats=stats)
+        sizes: dict[str, int] = {}
+        large: set[str] = set()
+        if plan and messages:
+            work_plan = plan_work(await fetch_message_info(imap_conn, messages),
+                                  large_message_size=large_message_size,
+                                  order=order)
+            planned = [x['number'] for x in work_plan['bins'][0]]
+            seen = set(planned)
+            messages = planned + [x for x in messages if x not in seen]
+            sizes = {x['number']: x['size'] for x in work_plan['bins'][0]}
+            large = {x['number'] for x in work_plan['large']}
+            log.info('Planned %d bytes across %d messages, %d to be streamed.',
+                     work_plan['total_bytes'], len(messages), len(large))
+        elif quota and messages:
+            # Without sizes a batch could take the run past the daily budget.
+            sizes = {x['number']: x['size'] for x in await fetch_message_info(imap_conn, messages)}
+        if quota:
+            await quota.load()
+        archiver = _Archiver(imap_conn,
+                             writer,
+                             email,
+                             batcher=AdaptiveBatchSize() if adaptive else None,
+                             delete=delete,
+                             errors=errors,
+                             index=index,
+                             keep_going=keep_going,
+                             mailbox=mailbox,
+                             quota=quota,
+                             rate_limiter=rate_limiter,
+                             stats=stats,
+                             uidvalidity=uidvalidity)
+        try:
+            await archiver.trash_archived(archived)
+            ret = await archiver.run(messages, sizes, large)
+            await archiver.commit()
+            await archiver.record_uids()
+        finally:
+            await writer.flush()
+            if quota:
+                await quota.save()
+            if errors:
+                await errors.save(uidvalidity)
+            if index:
+                await index.save()
+        if keep_going and errors and (failed := sum(not x['archived'] for x in errors.failures)):
+            log.warning('%d messages could not be archived. See %s.', failed, errors.path)
+            return 1
+        return ret
+
+
+async def archive_emails_api(email: str,
+                             access_token: str,
+                             out_dir: AsyncPath,
+                             days: int = 90,
+                             *,
+                             base_url: str = GMAIL_API_URL,
+                             batch_size: int = MAX_BATCH_SIZE,
+                             concurrency: int = DEFAULT_CONCURRENCY,
+                             delete: bool = False,
+                             errors: ErrorManifest | None = None,
+                             index: MessageIndex | None = None,
+                             keep_going: bool = False,
+                             query: str | None = None,
+                             quota: DailyQuota | None = None,
+                             rate_limiter: TokenBucket | None = None,
+                             retry_failed: bool = False,
+                             session: niquests.AsyncSession | None = None,
+                             stats: RunStats | None = None,
+                             writer: MessageWriter | None = None) -> int:
+    """
+    Download emails with the Gmail REST API and optionally move them to the trash.
+
+    This is an alternative to :py:func:`archive_emails` that needs no IMAP connection. Message IDs
+    are listed with ``messages.list`` and the messages are fetched with batch requests of up to
+    ``batch_size`` ``messages.get`` calls (``format=raw``), with ``concurrency`` batches in flight.
+    Messages are written by ``writer`` in the same layouts with the same label files; they are
+    numbered by their decimal ``X-GM-MSGID`` rather than their IMAP sequence number. With
+    ``delete``, durable groups of messages are moved to the trash with ``messages.batchModify``.
+
+    Failures, ``keep_going``, ``query``, ``quota`` and ``stats`` behave as in
+    :py:func:`archive_emails`; ``query`` is added to the ``messages.list`` search. Sizes are not
+    known before messages are fetched, so each batch in flight reserves the average size of the
+    messages fetched so far against ``quota`` and batches are shortened to fit. As message IDs
+    never change, ``retry_failed`` retries failures recorded by a previous run of this
+    function but not those recorded over IMAP.
+
+    Parameters
+    ----------
+    email : str
+        The mailbox account label used in output paths.
+    access_token : str
+        The OAuth2 access token.
+    out_dir : AsyncPath
+        The root directory for archived messages. Not used if ``writer`` is given.
+    days : int
+        Archive messages older than this many days.
+    base_url : str
+        Base URL of the Gmail API.
+    batch_size : int
+        Number of messages fetched per batch request, at most
+        :py:data:`~gmail_archiver.gmail_api.MAX_BATCH_SIZE`.
+    concurrency : int
+        Number of batch requests in flight at the same time.
+    delete : bool
+        When True, move archived messages to trash.
+    errors : ErrorManifest | None
+        Manifest in which failures are recorded. It is loaded and saved by this function.
+    index : MessageIndex | None
+        Index in which archived messages are recorded by ``X-GM-MSGID``. Messages already in it are
+        not downloaded again. It is loaded and saved by this function.
+    keep_going : bool
+        When True, continue past messages that cannot be archived.
+    query : str | None
+        Gmail search query the messages must also match.
+    quota : DailyQuota | None
+        Daily download budget for the account.
+    rate_limiter : TokenBucket | None
+        Limits the download rate.
+    retry_failed : bool
+        When True, archive only the messages recorded as failed in ``errors`` by the previous run.
+    session : niquests.AsyncSession | None
+        Session to send requests with. A new session is used if not given.
+    stats : RunStats | None
+        Statistics object updated as messages are archived.
+    writer : MessageWriter | None
+        Writes the messages in the output layout. An
+        :py:class:`~gmail_archiver.writers.EmlWriter` of ``out_dir`` is used if not given.
+
+    Returns
+    -------
+    int
+        ``0`` on success, ``1`` if an error occurred while processing messages. With
+        ``keep_going``, ``1`` if any message could not be archived.
+    """
+    log.info('Deleting emails: %s', delete)
+    async with _use_session(session) as http:
+        client = GmailApiClient(http, access_token, base_url=base_url, stats=stats)
+        if errors:
+            await errors.load()
+        if index:
+            await index.load()
+        if retry_failed:
+            ids = errors.retry_uids(API_UIDVALIDITY) if errors else []
+        else:
+            before_date = datetime.now(tz=timezone.utc).date() - timedelta(days=days)
+            search = f'before:{before_date:%Y/%m/%d}{f" ({query})" if query else ""}'
+            log.debug('Searching for emails: %s', search)
+            with timed(stats, 'search', always=True):
+                ids = await client.list_messages(search)
+        # Listed newest first; archive in arrival order as over IMAP.
+        messages = sorted((message_number(x) for x in ids), key=int)
+        archived: dict[str, str] = {}
+        if index and (archived := {x: x for x in messages if index.archived(x)}):
+            log.info('Skipping %d messages archived by a previous run.', len(archived))
+            messages = [x for x in messages if x not in archived]
+        if not messages and not (delete and archived):
+            log.info('No messages matched criteria.')
+            if errors:
+                await errors.save(API_UIDVALIDITY)
+            return 0
         log.info('Archiving %d messages.', len(messages))
-        resolved = await AsyncPath(out_dir).resolve()
-        for num in messages:
-            fetch_response = await imap_conn.fetch(num, '(RFC822)')
-            if fetch_response.result != 'OK':
-                log.error('Error getting message #%s.', num)
-                return 1
-            if len(fetch_response.lines) < _FETCH_MIN_LINES:
-                log.error('Unexpected empty message data for message #%s.', num)
-                return 1
-            raw_message = fetch_response.lines[1]
-            if not isinstance(raw_message, (bytes, bytearray)):
-                log.error('Unexpected message data type for message #%s.', num)
-                return 1
-            msg = message_from_bytes(bytes(raw_message))
-            if not (date_tuple := parsedate_tz(cast('str', msg['Date']))):
-                log.error('Error converting date: %s', msg['Date'])
+        if quota:
+            await quota.load()
+        writer = writer or EmlWriter(await AsyncPath(out_dir).resolve(), stats=stats)
+        archiver = _ApiArchiver(client,
+                                writer,
+                                email,
+                                batch_size=min(batch_size, MAX_BATCH_SIZE),
+                                concurrency=concurrency,
+                                delete=delete,
+                                errors=errors,
+                                index=index,
+                                keep_going=keep_going,
+                                quota=quota,
+                                rate_limiter=rate_limiter,
+                                stats=stats)
+        try:
+            await archiver.trash_archived(archived)
+            ret = await archiver.run(messages)
+            await archiver.commit()
+            archiver.record_uids()
+        finally:
+            await writer.flush()
+            if quota:
+                await quota.save()
+            if errors:
+                await errors.save(API_UIDVALIDITY)
+            if index:
+                await index.save()
+    if keep_going and errors and (failed := sum(not x['archived'] for x in errors.failures)):
+        log.warning('%d messages could not be archived. See %s.', failed, errors.path)
+        return 1
+    return ret
+
+
+def mailbox_key(email: str, mailbox: str) -> str:
+    """
+    Get the key of the records of a mailbox in the error manifest.
+
+    Parameters
+    ----------
+    email : str
+        The account.
+    mailbox : str
+        The mailbox.
+
+    Returns
+    -------
+    str
+        ``email`` for :py:data:`ALL_MAIL`, otherwise the account followed by the mailbox name.
+    """
+    return email if mailbox == ALL_MAIL else f'{email} {mailbox}'
+
+
+async def archive_mailboxes(connect: Callable[[],
+                                              AbstractAsyncContextManager[aioimaplib.IMAP4_SSL]],
+                            email: str,
+                            access_token: str,
+                            out_dir: AsyncPath,
+                            mailboxes: Sequence[MailboxConfig],
+                            days: int = 90,
+                            *,
+                            adaptive: bool = False,
+                            compress: bool = False,
+                            debug: bool = False,
+                            delete: bool = False,
+                            errors: ErrorManifest | None = None,
+                            index: MessageIndex | None = None,
+                            keep_going: bool = False,
+                            large_message_size: int = DEFAULT_LARGE_MESSAGE_SIZE,
+                            order: WorkOrder = 'small-first',
+                            plan: bool = False,
+                            query: str | None = None,
+                            quota: DailyQuota | None = None,
+                            rate_limiter: TokenBucket | None = None,
+                            retry_failed: bool = False,
+                            stats: RunStats | None = None,
+                            writer: MessageWriter | None = None) -> int:
+    """
+    Archive several mailboxes concurrently, each over its own connection.
+
+    Every mailbox is archived with :py:func:`archive_emails`, keeping messages newer than its own
+    ``days`` and matching its own ``query``. Runs share ``index``, in which messages are claimed by
+    ``X-GM-MSGID``, so a message in several of the mailboxes is downloaded once, by whichever run
+    reaches it first. An index in the directory of the account is used if none is given.
+
+    Each mailbox has its own record in the file of ``errors`` (see :py:func:`mailbox_key`), as UIDs
+    are per mailbox. ``quota`` is shared by all runs, as Gmail limits the downloads of the whole
+    account; only the messages to skip after stopping at the budget are kept per mailbox.
+    ``rate_limiter``, ``stats`` and ``writer`` are shared too, so messages of all mailboxes end up
+    in the same files where the layout groups them (for example mbox).
+
+    Parameters
+    ----------
+    connect : Callable[[], AbstractAsyncContextManager[aioimaplib.IMAP4_SSL]]
+        Opens a new connection to the server and closes it on exit.
+    email : str
+        The account.
+    access_token : str
+        The OAuth2 access token for authentication.
+    out_dir : AsyncPath
+        The root directory for archived messages.
+    mailboxes : Sequence[MailboxConfig]
+        The mailboxes to archive.
+    days : int
+        Archive messages older than this many days in mailboxes that do not set ``days``.
+    adaptive : bool
+        When True, fetch messages in adaptively sized batches.
+    compress : bool
+        When True, negotiate ``COMPRESS=DEFLATE`` if the server supports it.
+    debug : bool
+        When True, enable verbose IMAP protocol logging.
+    delete : bool
+        When True, move archived messages to trash.
+    errors : ErrorManifest | None
+        Error manifest of the account. Failures are recorded in its file.
+    index : MessageIndex | None
+        Index in which archived messages are recorded and claimed by ``X-GM-MSGID``.
+    keep_going : bool
+        When True, continue past messages that cannot be archived.
+    large_message_size : int
+        With ``plan``, messages above this many bytes are streamed to disk in chunks.
+    order : WorkOrder
+        With ``plan``, the order in which messages are archived.
+    plan : bool
+        When True, run the size-aware planning phase before downloading.
+    query : str | None
+        Gmail search query the messages of mailboxes that do not set ``query`` must also match.
+    quota : DailyQuota | None
+        Daily download budget of the account. Usage is recorded in its file.
+    rate_limiter : TokenBucket | None
+        Limits the download rate of all connections together.
+    retry_failed : bool
+        When True, archive only the messages of each mailbox recorded as failed by the previous run.
+    stats : RunStats | None
+        Statistics object updated as messages are archived.
+    writer : MessageWriter | None
+        Writes the messages in the output layout. An
+        :py:class:`~gmail_archiver.writers.EmlWriter` of ``out_dir`` is used if not given.
+
+    Returns
+    -------
+    int
+        ``0`` if every mailbox was archived successfully, otherwise ``1``.
+    """
+    shared_index = index or MessageIndex(out_dir / email / INDEX_FILE)
+    shared_writer = writer or EmlWriter(await AsyncPath(out_dir).resolve(), stats=stats)
+
+    async def archive(mailbox: MailboxConfig) -> int:
+        key = mailbox_key(email, mailbox['name'])
+        async with connect() as imap_conn:
+            return await archive_emails(imap_conn,
+                                        email,
+                                        access_token,
+                                        out_dir,
+                                        mailbox.get('days', days),
+                                        adaptive=adaptive,
+                                        compress=compress,
+                                        debug=debug,
+                                        delete=delete,
+                                        errors=ErrorManifest(errors.path, key) if errors else None,
+                                        index=shared_index,
+                                        keep_going=keep_going,
+                                        large_message_size=large_message_size,
+                                        mailbox=mailbox['name'],
+                                        order=order,
+                                        plan=plan,
+                                        query=mailbox.get('query', query),
+                                        quota=quota,
+                                        rate_limiter=rate_limiter,
+                                        retry_failed=retry_failed,
+                                        stats=stats,
+                                        writer=shared_writer)
+
+    return max(await asyncio.gather(*(archive(x) for x in mailboxes)), default=0)
+
+
+async def _update_label_files(index: MessageIndex,
+                              lines: Iterable[bytes | bytearray | str],
+                              stats: RunStats | None = None) -> Counter[str]:
+    # Returns the number of messages updated, skipped, missing and failed.
+    counts: Counter[str] = Counter()
+    for record in parse_fetch_response(lines).values():
+        if ((msgid := parse_msgid(record['data'])) is None
+                or (path := index.labels_file(msgid)) is None):
+            continue
+        if index.is_member(msgid):
+            counts['skipped'] += 1
+            continue
+        try:
+            with timed(stats, 'write'):
+                if labels := parse_labels(record['data']):
+                    await path.write_text(json.dumps(labels, indent=2, sort_keys=True))
+                else:
+                    await path.unlink(missing_ok=True)
+        except FileNotFoundError:
+            counts['missing'] += 1
+        except OSError:
+            log.exception('Could not update %s.', path)
+            counts['failed'] += 1
+        else:
+            counts['updated'] += 1
+    return counts
+
+
+async def sync_labels(imap_conn: aioimaplib.IMAP4_SSL,
+                      email: str,
+                      access_token: str,
+                      index: MessageIndex,
+                      *,
+                      compress: bool = False,
+                      debug: bool = False,
+                      stats: RunStats | None = None) -> int:
+    """
+    Update the label files of archived messages whose labels changed on the server.
+
+    Useful after archiving with ``delete`` off, as label files are otherwise frozen at archive time.
+    No message bodies are downloaded and nothing is moved to the trash.
+
+    The mailbox is selected with ``CONDSTORE`` (RFC 7162) and ``X-GM-MSGID`` and ``X-GM-LABELS``
+    are fetched only for messages changed since the ``HIGHESTMODSEQ`` stored in ``index`` by the
+    previous sync (``CHANGEDSINCE``). The first sync, or one after the mailbox ``UIDVALIDITY``
+    changed, fetches them for all messages. They are fetched in batches of
+    :py:data:`~gmail_archiver.planning.DEFAULT_INFO_BATCH_SIZE` messages. Messages are matched to
+    their files by ``X-GM-MSGID`` through ``index``, so only messages archived with an index are
+    updated. Labels of messages written to a tar archive or to object storage cannot be updated and
+    are skipped, as are messages whose directory was removed. If a labels file cannot be written,
+    the other messages are still updated but ``HIGHESTMODSEQ`` is not advanced, so the next sync
+    fetches the changes again.
+
+    Parameters
+    ----------
+    imap_conn : aioimaplib.IMAP4_SSL
+        The IMAP connection.
+    email : str
+        The account.
+    access_token : str
+        The OAuth2 access token for authentication.
+    index : MessageIndex
+        Index of the archived messages of the account. It is loaded and saved by this function.
+    compress : bool
+        When True, negotiate ``COMPRESS=DEFLATE`` if the server supports it.
+    debug : bool
+        When True, enable verbose IMAP protocol logging.
+    stats : RunStats | None
+        Statistics object in which the ``labels`` and ``write`` phases are timed.
+
+    Returns
+    -------
+    int
+        ``0`` on success, ``1`` if the mailbox could not be selected or labels could not be
+        fetched or written.
+    """
+    async with _imap_debug_session(debug=debug):
+        with span('xoauth2', always=True, account=email):
+            await imap_conn.xoauth2(email, access_token)
+        if compress:
+            with span('compress', always=True) as compress_span:
+                compress_span.set_attributes(enabled=await enable_compression(imap_conn, stats))
+        with span('select', always=True):
+            select_response = await imap_conn.select(f'{dq(ALL_MAIL)} (CONDSTORE)')
+        if select_response.result != 'OK':
+            log.error('Could not select the mailbox.')
+            return 1
+        uidvalidity = parse_uidvalidity(select_response.lines)
+        highestmodseq = parse_highestmodseq(select_response.lines)
+        await index.load()
+        if not index.messages:
+            log.info('No archived messages are indexed.')
+            return 0
+        since = index.changed_since(uidvalidity) if highestmodseq else None
+        if since and since == highestmodseq:
+            log.info('No labels changed since the last sync.')
+            return 0
+        if since:
+            log.info('Fetching labels changed since modification sequence %s.', since)
+        else:
+            log.info('Fetching the labels of all messages.')
+        exists = parse_exists(select_response.lines)
+        batches = (['1:*'] if exists is None else [
+            f'{x}:{min(x + DEFAULT_INFO_BATCH_SIZE - 1, exists)}'
+            for x in range(1, exists + 1, DEFAULT_INFO_BATCH_SIZE)
+        ])
+        items = f'(X-GM-MSGID X-GM-LABELS){f" (CHANGEDSINCE {since})" if since else ""}'
+        counts: Counter[str] = Counter()
+        for batch in batches:
+            with timed(stats, 'labels', always=True):
+                response = await imap_conn.fetch(batch, items)
+            if response.result != 'OK':
+                log.error('Error fetching labels.')
                 return 1
-            the_date = datetime(*cast('tuple[int, int, int, int, int, int]', date_tuple[0:7]),
-                                tzinfo=timezone.utc)
-            month = the_date.strftime('%m-%b')
-            day = the_date.strftime('%d-%a')
-            path = resolved / email / str(date_tuple[0]) / month / day
-            await path.mkdir(parents=True, exist_ok=True)
-            number = int(num)
-            eml_filename = f'{number:010d}.eml'
-            labels_response = await imap_conn.fetch(num, '(X-GM-LABELS)')
-            labels = None
-            labels_filename = f'{number:010d}.labels.json'
-            if labels_response.result == 'OK' and labels_response.lines:
-                labels = [
-                    x.decode() if isinstance(x, (bytes, bytearray)) else str(x)
-                    for x in labels_response.lines
-                ]
-            out_path = path / eml_filename
-            if await out_path.exists():
-                sha = sha1(bytes(raw_message), usedforsecurity=False).hexdigest()[:7]
-                out_path = path / f'{number:010d}-{sha}.eml'
-            log.debug('Writing %s to %s.', num, out_path)
-            write_tasks: list[Any] = [out_path.write_bytes(bytes(raw_message) + b'\n')]
-            if labels:
-                write_tasks.append((path / labels_filename).write_text(
-                    json.dumps(labels, indent=2, sort_keys=True)))
-            await asyncio.gather(*write_tasks)
-            if delete:
-                await imap_conn.store(num, '+X-GM-LABELS', '\\Trash')
+            counts.update(await _update_label_files(index, response.lines, stats))
+        if not counts['failed']:
+            index.set_modseq(uidvalidity, highestmodseq)
+        await index.save()
+        log.info('Updated the labels of %d archived messages.', counts['updated'])
+        if counts['skipped']:
+            log.warning('Labels of %d messages in tar archives or object storage were not updated.',
+                        counts['skipped'])
+        if counts['missing']:
+            log.warning('Labels of %d archived messages whose files are missing were not updated.',
+                        counts['missing'])
+        if counts['failed']:
+            log.error('Labels of %d archived messages could not be written.', counts['failed'])
+            return 1
         return 0
 
 
+async def _examine(imap_conn: aioimaplib.IMAP4_SSL, mailbox: str) -> bool:
+    # Returns whether the mailbox was opened read-only. aioimaplib only enters its SELECTED state
+    # after SELECT and would refuse SEARCH and FETCH after EXAMINE, so the state of its protocol is
+    # set here. This is the only place that touches it.
+    with span('examine', always=True):
+        response = await imap_conn.examine(dq(mailbox))
+    if response.result != 'OK':
+        return False
+    imap_conn.protocol.state = 'SELECTED'
+    return True
+
+
+async def estimate_archive(imap_conn: aioimaplib.IMAP4_SSL,
+                           email: str,
+                           access_token: str,
+                           days: int = 90,
+                           *,
+                           debug: bool = False,
+                           query: str | None = None) -> Estimate | None:
+    """
+    Estimate what :py:func:`archive_emails` would download without downloading anything.
+
+    The mailbox is opened read-only with ``EXAMINE`` and only ``RFC822.SIZE`` and ``INTERNALDATE``
+    are fetched, so no message bodies are transferred and nothing is moved to the trash.
+
+    Parameters
+    ----------
+    imap_conn : aioimaplib.IMAP4_SSL
+        The IMAP connection.
+    email : str
+        The account.
+    access_token : str
+        The OAuth2 access token for authentication.
+    days : int
+        Consider messages older than this many days.
+    debug : bool
+        When True, enable verbose IMAP protocol logging.
+    query : str | None
+        Gmail search query the messages must also match.
+
+    Returns
+    -------
+    Estimate | None
+        Message count, total size and per-year breakdown. ``None`` if the mailbox could not be
+        examined.
+    """
+    async with _imap_debug_session(debug=debug):
+        with span('xoauth2', always=True, account=email):
+            await imap_conn.xoauth2(email, access_token)
+        if not await _examine(imap_conn, ALL_MAIL):
+            log.error('Could not examine the mailbox.')
+            return None
+        messages = await _search_messages(imap_conn, days, query)
+        infos = await fetch_message_info(imap_conn, messages) if messages else []
+    by_year: dict[int | None, YearEstimate] = {}
+    for info in infos:
+        year = info['internal_date'].year if info['internal_date'] else None
+        entry = by_year.setdefault(year, {'bytes': 0, 'count': 0})
+        entry['bytes'] += info['size']
+        entry['count'] += 1
+    return {'by_year': by_year, 'count': len(infos), 'total_bytes': sum(x['size'] for x in infos)}
+
+
 def log_oauth2_error(data: Mapping[str, Any]) -> None:
     """
     Log OAuth2 error information.
@@ -288,18 +1707,62 @@ class OAuth2Error(Exception):
 
 
 class GoogleOAuthClient:
-    """Uses discovery to get the appropriate endpoint URIs."""
-    def __init__(self, client_id: str, client_secret: str) -> None:
+    """
+    Uses discovery to get the appropriate endpoint URIs.
+
+    Parameters
+    ----------
+    client_id : str
+        The OAuth client identifier.
+    client_secret : str
+        The OAuth client secret.
+    cache_file : AsyncPath | None
+        File to cache the discovery document in.
+    session : niquests.AsyncSession | None
+        Session to send requests with. A new session is used for each request if not given.
+    ttl : int
+        Seconds to use the cached document without revalidation if the server did not send
+        ``max-age``.
+    """
+    def __init__(self,
+                 client_id: str,
+                 client_secret: str,
+                 *,
+                 cache_file: AsyncPath | None = None,
+                 session: niquests.AsyncSession | None = None,
+                 ttl: int = DEFAULT_DISCOVERY_TTL) -> None:
         self.authorization_endpoint = ''
         """OAuth authorisation endpoint URL populated by :py:meth:`discover`."""
+        self.cache_file = cache_file
+        """File the discovery document is cached in."""
         self.client_id = client_id
         """OAuth client identifier."""
         self.client_secret = client_secret
         """OAuth client secret."""
         self.device_authorization_endpoint = ''
         """Device authorisation endpoint URL populated by :py:meth:`discover`."""
+        self.session = session
+        """Session requests are sent with."""
         self.token_endpoint = ''
         """Token endpoint URL populated by :py:meth:`discover`."""
+        self.ttl = ttl
+        """Seconds to use a cached document without ``max-age`` before revalidating it."""
+
+    async def _load_cache(self) -> DiscoveryCache | None:
+        if not self.cache_file or not await self.cache_file.exists():
+            return None
+        try:
+            data = json.loads(await self.cache_file.read_text(encoding='utf-8'))
+        except json.JSONDecodeError:
+            log.warning('Ignoring invalid discovery cache %s.', self.cache_file)
+            return None
+        return cast('DiscoveryCache',
+                    data) if isinstance(data, dict) and 'document' in data else None
+
+    def _use(self, document: DiscoveryDocument) -> None:
+        self.authorization_endpoint = document['authorization_endpoint']
+        self.device_authorization_endpoint = document['device_authorization_endpoint']
+        self.token_endpoint = document['token_endpoint']
 
     async def discover(self) -> None:
         """
@@ -308,14 +1771,44 @@ class GoogleOAuthClient:
         Queries Google's well-known OpenID Connect configuration and sets
         :py:attr:`authorization_endpoint`, :py:attr:`device_authorization_endpoint`,
         and :py:attr:`token_endpoint`.
+
+        With :py:attr:`cache_file`, the document is reused until it expires (``max-age`` of the
+        response, otherwise :py:attr:`ttl`). An expired document with an ``ETag`` is revalidated
+        with a conditional request.
         """
-        async with niquests.AsyncSession() as session:
-            r = await session.get('https://accounts.google.com/.well-known/openid-configuration')
-        r.raise_for_status()
-        data = r.json()
-        self.authorization_endpoint = data['authorization_endpoint']
-        self.device_authorization_endpoint = data['device_authorization_endpoint']
-        self.token_endpoint = data['token_endpoint']
+        cached = await self._load_cache()
+        now = datetime.now(timezone.utc)
+        if cached and datetime.fromisoformat(cached['expires']) > now:
+            log.debug('Using cached discovery document.')
+            self._use(cached['document'])
+            return
+        with span('discover', always=True):
+            async with _use_session(self.session) as http:
+                if cached and cached.get('etag'):
+                    r = await http.get(DISCOVERY_URL, headers={'If-None-Match': cached['etag']})
+                else:
+                    r = await http.get(DISCOVERY_URL)
+        if cached and r.status_code == _NOT_MODIFIED:
+            log.debug('Cached discovery document is still valid.')
+            document = cached['document']
+            etag = cached.get('etag')
+        else:
+            r.raise_for_status()
+            document = cast('DiscoveryDocument', r.json())
+            etag = r.headers.get('ETag')
+        self._use(document)
+        if self.cache_file:
+            max_age = _MAX_AGE_RE.search(r.headers.get('Cache-Control') or '')
+            new_cache: DiscoveryCache = {
+                'document':
+                    document,
+                'expires':
+                    (now + timedelta(seconds=int(max_age[1]) if max_age else self.ttl)).isoformat()
+            }
+            if etag:
+                new_cache['etag'] = etag
+            await self.cache_file.write_text(json.dumps(new_cache, indent=2, sort_keys=True),
+                                             encoding='utf-8')
 
 
 def get_localhost_redirect_uri() -> tuple[int, str]:
@@ -345,7 +1838,7 @@ def get_localhost_redirect_uri() -> tuple[int, str]:
 
 
 def get_auth_http_handler(
-        auth_code_callback: Callable[[str], None]) -> type[http.server.BaseHTTPRequestHandler]:
+        auth_code_callback: Callable[[str], None]) -> type[http_server.BaseHTTPRequestHandler]:
     """
     Build a request handler class for the local authorisation redirect server.
 
@@ -359,7 +1852,7 @@ def get_auth_http_handler(
     type[http.server.BaseHTTPRequestHandler]
         The handler class to pass to :py:class:`~http.server.HTTPServer`.
     """
-    class MyHandler(http.server.BaseHTTPRequestHandler):
+    class MyHandler(http_server.BaseHTTPRequestHandler):
         def do_HEAD(self) -> None:
             self.send_response(200)
             self.send_header('Content-type', 'text/html')
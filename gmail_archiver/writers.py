@@ -0,0 +1,641 @@
+"""Writers of archived messages in the supported output layouts."""
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from hashlib import sha1
+from typing import TYPE_CHECKING
+import abc
+import asyncio
+import io
+import itertools
+import json
+import logging
+import os
+import re
+import socket
+import stat
+import sys
+import tarfile
+import time
+
+from anyio import wrap_file
+from typing_extensions import override
+
+from .tracing import timed
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+    from anyio import AsyncFile, Path as AsyncPath
+
+    from .s3 import S3Client
+    from .stats import RunStats
+    from .typing import OutputFormat, WrittenMessage
+
+__all__ = ('LABELS_DIRECTORY', 'MBOX_BUFFER_SIZE', 'UNKNOWN_DATE_DIRECTORY', 'EmlWriter',
+           'MaildirWriter', 'MboxWriter', 'MessageWriter', 'S3Writer', 'TarWriter', 'create_writer')
+
+log = logging.getLogger(__name__)
+
+LABELS_DIRECTORY = 'labels'
+"""Directory under the account for the label files of messages written to Maildir or mbox."""
+MBOX_BUFFER_SIZE = 4 * 1024 * 1024
+"""Number of bytes of messages buffered before they are appended to the mbox files."""
+UNKNOWN_DATE_DIRECTORY = 'unknown-date'
+"""Directory under the account for messages whose ``Date`` header cannot be parsed."""
+_FROM_RE = re.compile(rb'^(>*From )', re.MULTILINE)
+_MESSAGE_TYPE = 'message/rfc822'
+_READ_CHUNK_SIZE = 1024 * 1024
+
+
+def _labels_json(labels: list[str]) -> str:
+    return json.dumps(labels, indent=2, sort_keys=True)
+
+
+def _date_path(date: datetime | None) -> str:
+    return (f'{date.year}/{date:%m-%b}/{date:%d-%a}' if date else UNKNOWN_DATE_DIRECTORY)
+
+
+def _sequence_stem(num: str, digest: Callable[[], str]) -> str:
+    # Sequence numbers change between runs, so a digest of the message keeps the name unique.
+    return f'{int(num):010d}-{digest()[:7]}'
+
+
+class MessageWriter(abc.ABC):
+    """
+    Writes archived messages under the output directory.
+
+    Subclasses define the layout by implementing :py:meth:`write` and :py:meth:`write_file`. Each
+    account has a directory of its own (which also holds the message index), and messages are named
+    by ``X-GM-MSGID`` where the layout names them at all. Labels are written as a JSON list next to
+    the message or in :py:data:`LABELS_DIRECTORY`.
+
+    Writes may be buffered until :py:meth:`flush`, which is called before written files are synced
+    and at the end of every run.
+
+    Parameters
+    ----------
+    root : AsyncPath
+        Resolved output directory.
+    stats : RunStats | None
+        Statistics object in which the ``mkdir``, ``exists`` and ``write`` phases are recorded.
+    """
+    def __init__(self, root: AsyncPath, *, stats: RunStats | None = None) -> None:
+        self.root = root
+        """Resolved output directory."""
+        self.stats = stats
+        """Statistics object."""
+        self._numbered: set[str] = set()
+
+    def part_file(self, email: str, num: str) -> AsyncPath:
+        """
+        Get the file a large message is streamed to before it is passed to :py:meth:`write_file`.
+
+        Parameters
+        ----------
+        email : str
+            The account.
+        num : str
+            Message sequence number.
+
+        Returns
+        -------
+        AsyncPath
+            The path. Its directory may not exist yet.
+        """
+        return self.root / email / f'.{int(num):010d}.eml.part'
+
+    @abc.abstractmethod
+    async def write(self, email: str, num: str, msgid: str | None, date: datetime | None,
+                    raw_message: bytes, labels: list[str] | None) -> WrittenMessage:
+        """
+        Write a message.
+
+        Parameters
+        ----------
+        email : str
+            The account.
+        num : str
+            Message sequence number, used in names if ``msgid`` is unknown.
+        msgid : str | None
+            ``X-GM-MSGID`` of the message.
+        date : datetime | None
+            Date of the message, or ``None`` if its ``Date`` header cannot be parsed.
+        raw_message : bytes
+            The complete message.
+        labels : list[str] | None
+            Labels of the message. No labels file is written if there are none.
+
+        Returns
+        -------
+        WrittenMessage
+            Where the message was written.
+        """
+
+    @abc.abstractmethod
+    async def write_file(self, email: str, num: str, msgid: str | None, date: datetime | None,
+                         part_file: AsyncPath, labels: list[str] | None, *,
+                         digest: Callable[[], str], size: int) -> WrittenMessage:
+        """
+        Write a message streamed to :py:meth:`part_file`, which is consumed.
+
+        Parameters
+        ----------
+        email : str
+            The account.
+        num : str
+            Message sequence number, used in names if ``msgid`` is unknown.
+        msgid : str | None
+            ``X-GM-MSGID`` of the message.
+        date : datetime | None
+            Date of the message, or ``None`` if its ``Date`` header cannot be parsed.
+        part_file : AsyncPath
+            File holding the complete message.
+        labels : list[str] | None
+            Labels of the message. No labels file is written if there are none.
+        digest : Callable[[], str]
+            Returns the hexadecimal SHA-1 digest of the message.
+        size : int
+            Size of the message in bytes.
+
+        Returns
+        -------
+        WrittenMessage
+            Where the message was written.
+        """
+
+    async def flush(self) -> None:  # noqa: B027
+        """Write out buffered messages."""
+
+    async def close(self) -> None:
+        """Finish the output after the last message."""
+        await self.flush()
+
+    async def _mkdir(self, path: AsyncPath) -> None:
+        with timed(self.stats, 'mkdir'):
+            await path.mkdir(parents=True, exist_ok=True)
+
+    def _eml_names(self, email: str, num: str, msgid: str | None, date: datetime | None,
+                   digest: Callable[[], str]) -> tuple[str, str]:
+        # Names of the message and labels in the .eml layout for writers that cannot check whether
+        # a name is taken. Names used in this run are remembered instead.
+        stem = f'{email}/{_date_path(date)}/{msgid or f"{int(num):010d}"}'
+        if not msgid:
+            if stem in self._numbered:
+                stem = f'{email}/{_date_path(date)}/{_sequence_stem(num, digest)}'
+            self._numbered.add(stem)
+        return f'{stem}.eml', f'{stem}.labels.json'
+
+
+class EmlWriter(MessageWriter):
+    """
+    Writes each message to its own ``.eml`` file in a directory per day.
+
+    Messages are written to ``<account>/<year>/<month>/<day>/<X-GM-MSGID>.eml``, for example
+    ``2021/01-Jan/01-Fri``, with labels in ``<X-GM-MSGID>.labels.json`` next to them. Messages
+    whose date cannot be parsed are written to :py:data:`UNKNOWN_DATE_DIRECTORY`. If the message ID
+    is unknown, the sequence number is used instead, with a digest of the message appended if the
+    file already exists.
+    """
+    async def _directory(self, email: str, date: datetime | None) -> AsyncPath:
+        path = self.root / email / _date_path(date)
+        await self._mkdir(path)
+        return path
+
+    async def _save(self, email: str, num: str, msgid: str | None, date: datetime | None,
+                    write: Callable[[AsyncPath], Awaitable[object]], digest: Callable[[], str],
+                    labels: list[str] | None, size: int) -> WrittenMessage:
+        path = await self._directory(email, date)
+        stem = msgid or f'{int(num):010d}'
+        out_path = path / f'{stem}.eml'
+        if not msgid:
+            with timed(self.stats, 'exists'):
+                exists = await out_path.exists()
+            if exists:
+                out_path = path / f'{_sequence_stem(num, digest)}.eml'
+        log.debug('Writing %s to %s.', num, out_path)
+        labels_path = out_path.with_suffix('.labels.json')
+        files = [out_path]
+        write_tasks: list[Awaitable[object]] = [write(out_path)]
+        if labels:
+            files.append(labels_path)
+            write_tasks.append(labels_path.write_text(_labels_json(labels)))
+        with timed(self.stats, 'write', size):
+            await asyncio.gather(*write_tasks)
+        return {'files': files, 'labels': labels_path, 'message': out_path}
+
+    @override
+    async def write(self, email: str, num: str, msgid: str | None, date: datetime | None,
+                    raw_message: bytes, labels: list[str] | None) -> WrittenMessage:
+        return await self._save(
+            email, num, msgid, date, lambda out_path: out_path.write_bytes(raw_message + b'\n'),
+            lambda: sha1(raw_message, usedforsecurity=False).hexdigest(), labels,
+            len(raw_message) + 1)
+
+    @override
+    async def write_file(self, email: str, num: str, msgid: str | None, date: datetime | None,
+                         part_file: AsyncPath, labels: list[str] | None, *,
+                         digest: Callable[[], str], size: int) -> WrittenMessage:
+        async with await part_file.open('ab') as f:
+            await f.write(b'\n')
+        return await self._save(email, num, msgid, date, part_file.rename, digest, labels, 0)
+
+
+class MaildirWriter(MessageWriter):
+    """
+    Writes messages to a Maildir per account.
+
+    The directory of the account is the Maildir. Each message is written to ``tmp`` under a unique
+    name (``<seconds>.M<microseconds>P<pid>Q<count>.<host>``) and renamed into ``new`` once
+    complete, so readers never see a partial message. Labels are written to
+    :py:data:`LABELS_DIRECTORY` as ``<X-GM-MSGID>.labels.json`` (or the unique name if the message
+    ID is unknown).
+    """
+    def __init__(self, root: AsyncPath, *, stats: RunStats | None = None) -> None:
+        super().__init__(root, stats=stats)
+        self._counter = itertools.count(1)
+        self._created: set[str] = set()
+        self._host = socket.gethostname().replace('/', r'\057').replace(':', r'\072')
+
+    def _unique_name(self) -> str:
+        now = time.time()
+        return (f'{int(now)}.M{int(now % 1 * 1_000_000)}P{os.getpid()}Q{next(self._counter)}.'
+                f'{self._host}')
+
+    async def _maildir(self, email: str) -> AsyncPath:
+        path = self.root / email
+        if email not in self._created:
+            for name in ('cur', 'new', 'tmp', LABELS_DIRECTORY):
+                await self._mkdir(path / name)
+            self._created.add(email)
+        return path
+
+    @override
+    def part_file(self, email: str, num: str) -> AsyncPath:
+        return self.root / email / 'tmp' / self._unique_name()
+
+    async def _deliver(self, email: str, msgid: str | None, tmp_file: AsyncPath,
+                       labels: list[str] | None, size: int) -> WrittenMessage:
+        maildir = await self._maildir(email)
+        out_path = maildir / 'new' / tmp_file.name
+        labels_path = maildir / LABELS_DIRECTORY / f'{msgid or tmp_file.name}.labels.json'
+        log.debug('Writing %s.', out_path)
+        files = [out_path]
+        with timed(self.stats, 'write', size):
+            await tmp_file.rename(out_path)
+            if labels:
+                files.append(labels_path)
+                await labels_path.write_text(_labels_json(labels))
+        return {'files': files, 'labels': labels_path, 'message': out_path}
+
+    @override
+    async def write(self, email: str, num: str, msgid: str | None, date: datetime | None,
+                    raw_message: bytes, labels: list[str] | None) -> WrittenMessage:
+        tmp_file = (await self._maildir(email)) / 'tmp' / self._unique_name()
+        with timed(self.stats, 'write', len(raw_message)):
+            await tmp_file.write_bytes(raw_message)
+        return await self._deliver(email, msgid, tmp_file, labels, 0)
+
+    @override
+    async def write_file(self, email: str, num: str, msgid: str | None, date: datetime | None,
+                         part_file: AsyncPath, labels: list[str] | None, *,
+                         digest: Callable[[], str], size: int) -> WrittenMessage:
+        return await self._deliver(email, msgid, part_file, labels, 0)
+
+
+class MboxWriter(MessageWriter):
+    """
+    Appends messages to an mbox file per month.
+
+    Messages are appended to ``<account>/<year>/<month>.mbox``, for example ``2021/01-Jan.mbox``
+    (``unknown-date.mbox`` if the date cannot be parsed), in the ``mboxrd`` format: each message
+    starts with a ``From`` line, lines starting with ``From`` (after any number of ``>``) get
+    another ``>``, and line endings are converted to LF. Labels are written to
+    :py:data:`LABELS_DIRECTORY` as ``<X-GM-MSGID>.labels.json``.
+
+    Messages are collected in memory and appended with one write per file once
+    :py:data:`MBOX_BUFFER_SIZE` bytes are buffered, or on :py:meth:`flush`. Large messages are
+    copied from their part file in chunks.
+
+    Parameters
+    ----------
+    root : AsyncPath
+        Resolved output directory.
+    buffer_size : int
+        Number of bytes buffered before the mbox files are appended to.
+    stats : RunStats | None
+        Statistics object in which the ``mkdir`` and ``write`` phases are recorded.
+    """
+    def __init__(self,
+                 root: AsyncPath,
+                 *,
+                 buffer_size: int = MBOX_BUFFER_SIZE,
+                 stats: RunStats | None = None) -> None:
+        super().__init__(root, stats=stats)
+        self.buffer_size = buffer_size
+        """Number of bytes buffered before the mbox files are appended to."""
+        self._buffered = 0
+        self._buffers: dict[AsyncPath, bytearray] = {}
+        self._lock = asyncio.Lock()
+
+    def _mbox(self, email: str, date: datetime | None) -> AsyncPath:
+        if not date:
+            return self.root / email / f'{UNKNOWN_DATE_DIRECTORY}.mbox'
+        return self.root / email / str(date.year) / f'{date:%m-%b}.mbox'
+
+    @staticmethod
+    def _from_line(date: datetime | None) -> bytes:
+        when = date.astimezone(timezone.utc) if date else datetime.now(timezone.utc)
+        return f'From MAILER-DAEMON {when.ctime()}\n'.encode()
+
+    @staticmethod
+    def _escape(data: bytes) -> bytes:
+        return _FROM_RE.sub(rb'>\1', data.replace(b'\r\n', b'\n'))
+
+    async def _write_labels(self, email: str, stem: str,
+                            labels: list[str] | None) -> tuple[AsyncPath, list[AsyncPath]]:
+        path = self.root / email / LABELS_DIRECTORY / f'{stem}.labels.json'
+        if not labels:
+            return path, []
+        await self._mkdir(path.parent)
+        with timed(self.stats, 'write'):
+            await path.write_text(_labels_json(labels))
+        return path, [path]
+
+    @override
+    async def write(self, email: str, num: str, msgid: str | None, date: datetime | None,
+                    raw_message: bytes, labels: list[str] | None) -> WrittenMessage:
+        mbox = self._mbox(email, date)
+        data = self._from_line(date) + self._escape(raw_message)
+        data += b'\n' if data.endswith(b'\n') else b'\n\n'
+        self._buffers.setdefault(mbox, bytearray()).extend(data)
+        self._buffered += len(data)
+        labels_path, files = await self._write_labels(
+            email, msgid
+            or _sequence_stem(num, lambda: sha1(raw_message, usedforsecurity=False).hexdigest()),
+            labels)
+        if self._buffered >= self.buffer_size:
+            await self.flush()
+        return {'files': [mbox, *files], 'labels': labels_path, 'message': mbox}
+
+    @override
+    async def write_file(self, email: str, num: str, msgid: str | None, date: datetime | None,
+                         part_file: AsyncPath, labels: list[str] | None, *,
+                         digest: Callable[[], str], size: int) -> WrittenMessage:
+        mbox = self._mbox(email, date)
+        async with self._lock:
+            # Messages buffered for the file come first.
+            pending = self._buffers.pop(mbox, bytearray())
+            self._buffered -= len(pending)
+            await self._mkdir(mbox.parent)
+            with timed(self.stats, 'write', size):
+                async with await mbox.open('ab') as out, await part_file.open('rb') as f:
+                    await out.write(bytes(pending) + self._from_line(date))
+                    tail = b''
+                    while chunk := await f.read(_READ_CHUNK_SIZE):
+                        # Only complete lines are escaped.
+                        lines, newline, tail = (tail + chunk).rpartition(b'\n')
+                        await out.write(self._escape(lines + newline))
+                    tail = self._escape(tail)
+                    await out.write(tail + (b'\n\n' if tail else b'\n'))
+        await part_file.unlink()
+        labels_path, files = await self._write_labels(email, msgid or _sequence_stem(num, digest),
+                                                      labels)
+        return {'files': [mbox, *files], 'labels': labels_path, 'message': mbox}
+
+    @override
+    async def flush(self) -> None:
+        async with self._lock:
+            buffers, self._buffers, self._buffered = self._buffers, {}, 0
+            for mbox, data in buffers.items():
+                await self._mkdir(mbox.parent)
+                with timed(self.stats, 'write', len(data)):
+                    async with await mbox.open('ab') as f:
+                        await f.write(bytes(data))
+
+
+def _padding(size: int) -> bytes:
+    return b'\0' * (-size % tarfile.BLOCKSIZE)
+
+
+class TarWriter(MessageWriter):
+    """
+    Writes messages to a tar stream.
+
+    Members have the paths of the ``.eml`` layout (see :py:class:`EmlWriter`) relative to the
+    output directory, labels files included. The archive (POSIX ``pax`` format) is written
+    sequentially and never seeked, so the stream can be a pipe, for example to a compressor or an
+    upload. Only the message being written is held in memory; large messages are copied from their
+    part file in chunks. The output directory holds the message index, in which members are
+    recorded by their paths under it and marked as members, and the part files of large messages.
+
+    :py:meth:`flush` flushes the stream and syncs it if it is a regular file. Data written to a
+    pipe cannot be made durable, so messages must not be moved to the trash in that case.
+    :py:meth:`close` writes the end-of-archive marker but leaves the stream open.
+
+    Parameters
+    ----------
+    root : AsyncPath
+        Resolved output directory.
+    stream : AsyncFile[bytes]
+        Binary stream the archive is written to.
+    stats : RunStats | None
+        Statistics object in which the ``write`` phase is recorded.
+    """
+    def __init__(self,
+                 root: AsyncPath,
+                 stream: AsyncFile[bytes],
+                 *,
+                 stats: RunStats | None = None) -> None:
+        super().__init__(root, stats=stats)
+        self.stream = stream
+        """Binary stream the archive is written to."""
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _header(name: str, size: int, date: datetime | None) -> bytes:
+        info = tarfile.TarInfo(name)
+        info.mode = 0o644
+        info.mtime = int((date or datetime.now(timezone.utc)).timestamp())
+        info.size = size
+        return info.tobuf(tarfile.PAX_FORMAT)
+
+    async def _add(self, name: str, data: bytes, date: datetime | None) -> None:
+        await self.stream.write(self._header(name, len(data), date) + data + _padding(len(data)))
+
+    async def _write(self, email: str, num: str, msgid: str | None, date: datetime | None,
+                     add_message: Callable[[str], Awaitable[None]], digest: Callable[[], str],
+                     labels: list[str] | None, size: int) -> WrittenMessage:
+        message_name, labels_name = self._eml_names(email, num, msgid, date, digest)
+        log.debug('Writing %s to %s.', num, message_name)
+        async with self._lock:
+            with timed(self.stats, 'write', size):
+                await add_message(message_name)
+                if labels:
+                    await self._add(labels_name, _labels_json(labels).encode(), date)
+        # Nothing is written to the output directory, so there are no files to sync.
+        return {
+            'files': [],
+            'labels': self.root / labels_name,
+            'member': True,
+            'message': self.root / message_name
+        }
+
+    @override
+    async def write(self, email: str, num: str, msgid: str | None, date: datetime | None,
+                    raw_message: bytes, labels: list[str] | None) -> WrittenMessage:
+        return await self._write(
+            email, num, msgid, date, lambda name: self._add(name, raw_message + b'\n', date),
+            lambda: sha1(raw_message, usedforsecurity=False).hexdigest(), labels,
+            len(raw_message) + 1)
+
+    @override
+    async def write_file(self, email: str, num: str, msgid: str | None, date: datetime | None,
+                         part_file: AsyncPath, labels: list[str] | None, *,
+                         digest: Callable[[], str], size: int) -> WrittenMessage:
+        member_size = (await part_file.stat()).st_size + 1
+
+        async def add_message(name: str) -> None:
+            await self.stream.write(self._header(name, member_size, date))
+            async with await part_file.open('rb') as f:
+                while chunk := await f.read(_READ_CHUNK_SIZE):
+                    await self.stream.write(chunk)
+            await self.stream.write(b'\n' + _padding(member_size))
+
+        ret = await self._write(email, num, msgid, date, add_message, digest, labels, size)
+        await part_file.unlink()
+        return ret
+
+    def _sync(self) -> None:
+        try:
+            fd = self.stream.wrapped.fileno()
+        except io.UnsupportedOperation:
+            return
+        if stat.S_ISREG(os.fstat(fd).st_mode):
+            os.fsync(fd)
+
+    @override
+    async def flush(self) -> None:
+        async with self._lock:
+            await self.stream.flush()
+            await asyncio.to_thread(self._sync)
+
+    @override
+    async def close(self) -> None:
+        async with self._lock:
+            await self.stream.write(b'\0' * 2 * tarfile.BLOCKSIZE)
+        await self.flush()
+
+
+class S3Writer(MessageWriter):
+    """
+    Uploads messages to S3-compatible object storage.
+
+    Objects are keyed by the paths of the ``.eml`` layout (see :py:class:`EmlWriter`), labels files
+    included, after the prefix of the client. A message and its labels are uploaded concurrently
+    and writing returns once both are stored, so there are no files to sync before the message is
+    moved to the trash. Large messages are uploaded from their part file in parts. The output
+    directory holds the message index, in which objects are recorded by their paths under it and
+    marked as members, and the part files of large messages.
+
+    Parameters
+    ----------
+    root : AsyncPath
+        Resolved output directory.
+    client : S3Client
+        Client of the bucket.
+    stats : RunStats | None
+        Statistics object in which the ``write`` phase is recorded.
+    """
+    def __init__(self, root: AsyncPath, client: S3Client, *, stats: RunStats | None = None) -> None:
+        super().__init__(root, stats=stats)
+        self.client = client
+        """Client of the bucket."""
+
+    async def _upload_labels(self, key: str, labels: list[str] | None) -> None:
+        if labels:
+            await self.client.put_object(key, _labels_json(labels).encode(), 'application/json')
+
+    async def _write(self, email: str, num: str, msgid: str | None, date: datetime | None,
+                     upload_message: Callable[[str], Awaitable[None]], digest: Callable[[], str],
+                     labels: list[str] | None, size: int) -> WrittenMessage:
+        message_key, labels_key = self._eml_names(email, num, msgid, date, digest)
+        log.debug('Uploading %s to %s.', num, message_key)
+        with timed(self.stats, 'write', size):
+            await asyncio.gather(upload_message(message_key), self._upload_labels(
+                labels_key, labels))
+        # The objects are stored once uploaded, so there are no files to sync.
+        return {
+            'files': [],
+            'labels': self.root / labels_key,
+            'member': True,
+            'message': self.root / message_key
+        }
+
+    @override
+    async def write(self, email: str, num: str, msgid: str | None, date: datetime | None,
+                    raw_message: bytes, labels: list[str] | None) -> WrittenMessage:
+        return await self._write(
+            email, num, msgid, date,
+            lambda key: self.client.put_object(key, raw_message + b'\n', _MESSAGE_TYPE),
+            lambda: sha1(raw_message, usedforsecurity=False).hexdigest(), labels,
+            len(raw_message) + 1)
+
+    @override
+    async def write_file(self, email: str, num: str, msgid: str | None, date: datetime | None,
+                         part_file: AsyncPath, labels: list[str] | None, *,
+                         digest: Callable[[], str], size: int) -> WrittenMessage:
+        ret = await self._write(
+            email, num, msgid, date, lambda key: self.client.upload_file(
+                key, part_file, content_type=_MESSAGE_TYPE, suffix=b'\n'), digest, labels, size)
+        await part_file.unlink()
+        return ret
+
+
+_WRITERS: dict[OutputFormat, type[MessageWriter]] = {
+    'eml': EmlWriter,
+    'maildir': MaildirWriter,
+    'mbox': MboxWriter
+}
+
+
+def create_writer(output_format: OutputFormat,
+                  root: AsyncPath,
+                  *,
+                  stats: RunStats | None = None,
+                  stream: AsyncFile[bytes] | None = None,
+                  client: S3Client | None = None) -> MessageWriter:
+    """
+    Create the writer of an output format.
+
+    Parameters
+    ----------
+    output_format : OutputFormat
+        The layout.
+    root : AsyncPath
+        Resolved output directory.
+    stats : RunStats | None
+        Statistics object in which writing is timed.
+    stream : AsyncFile[bytes] | None
+        Stream a tar archive is written to. Standard output is used if not given.
+    client : S3Client | None
+        Client of the bucket messages are uploaded to. Required for ``s3``.
+
+    Returns
+    -------
+    MessageWriter
+        The writer.
+
+    Raises
+    ------
+    ValueError
+        If the output format is ``s3`` and no client is given.
+    """
+    if output_format == 's3':
+        if not client:
+            msg = 'An S3 client is required to upload messages.'
+            raise ValueError(msg)
+        return S3Writer(root, client, stats=stats)
+    if output_format == 'tar':
+        return TarWriter(root, stream or wrap_file(sys.stdout.buffer), stats=stats)
+    return _WRITERS[output_format](root, stats=stats)
@@ -0,0 +1,231 @@
+"""
+Fake Gmail REST API for tests of the API backend.
+
+Implements ``messages.list`` (with ``before:`` and the search terms of
+:py:meth:`~tests.fake_imap_server.FakeMessage.matches`), ``labels.list``,
+``messages.batchModify`` and batch requests of ``messages.get`` with ``format=raw`` over plain
+HTTP/1.1, serving the same :py:class:`~tests.fake_imap_server.FakeMessage` objects as the fake IMAP
+server. Rate limiting and missing messages can be injected.
+"""
+from __future__ import annotations
+
+from base64 import urlsafe_b64encode
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Any
+import asyncio
+import collections
+import json
+import logging
+import re
+import urllib.parse
+
+from gmail_archiver.gmail_api import SYSTEM_LABELS
+
+if TYPE_CHECKING:
+    from collections.abc import Container
+
+    from tests.fake_imap_server import FakeMessage
+    from typing_extensions import Self
+
+__all__ = ('FakeGmailApi',)
+
+log = logging.getLogger(__name__)
+
+_BOUNDARY_RE = re.compile(r'boundary=([^;]+)')
+_GET_RE = re.compile(r'^GET /gmail/v1/users/me/messages/([0-9a-f]+)\?format=raw', re.MULTILINE)
+_REASONS = {200: 'OK', 401: 'Unauthorized', 404: 'Not Found', 429: 'Too Many Requests'}
+_SYSTEM_IDS = {v: k for k, v in SYSTEM_LABELS.items()}
+
+
+class FakeGmailApi:
+    """
+    Asyncio HTTP server standing in for the Gmail API.
+
+    Use as an async context manager. The base URL is available as :py:attr:`url` once entered.
+
+    Parameters
+    ----------
+    messages : list[FakeMessage]
+        Messages of the account. Message IDs are the hexadecimal ``msgid`` of each message.
+    access_token : str
+        Bearer token accepted by every request.
+    missing : Container[int]
+        UIDs of messages answered with ``404`` by ``messages.get``.
+    rate_limited : int
+        Number of ``messages.get`` requests answered with ``429`` before any is served.
+    """
+    def __init__(
+            self,
+            messages: list[FakeMessage],
+            *,
+            access_token: str = 'token',  # noqa: S107
+            missing: Container[int] = (),
+            rate_limited: int = 0) -> None:
+        self.access_token = access_token
+        """Bearer token accepted by every request."""
+        self.messages = messages
+        """Messages of the account."""
+        self.missing = missing
+        """UIDs of messages answered with ``404``."""
+        self.rate_limited = rate_limited
+        """Remaining ``messages.get`` requests to answer with ``429``."""
+        self.requests: collections.Counter[str] = collections.Counter()
+        """Number of requests received by method name."""
+        self.trash: list[FakeMessage] = []
+        """Messages moved to the trash."""
+        self.url = ''
+        """Base URL of the server."""
+        self._server: asyncio.Server | None = None
+        self._user_labels = {
+            name: f'Label_{i}'
+            for i, name in enumerate(
+                sorted({x
+                        for m in messages
+                        for x in m.labels if x not in _SYSTEM_IDS}))
+        }
+
+    def _label_ids(self, message: FakeMessage) -> list[str]:
+        return [
+            *(_SYSTEM_IDS.get(x) or self._user_labels[x] for x in message.labels),
+            'CATEGORY_PERSONAL'
+        ]
+
+    def _list(self, query: dict[str, list[str]]) -> tuple[int, Any]:
+        self.requests['messages.list'] += 1
+        matched = self.messages
+        if (q := query.get('q', [''])[0]).startswith('before:'):
+            date, _, q = q.partition(' ')
+            before = datetime.strptime(date[7:], '%Y/%m/%d').replace(tzinfo=timezone.utc)
+            matched = [x for x in matched if x.internal_date < before]
+        if q:
+            matched = [x for x in matched if x.matches(q.removeprefix('(').removesuffix(')'))]
+        matched = sorted(matched, key=lambda x: x.internal_date, reverse=True)
+        start = int(query.get('pageToken', ['0'])[0])
+        end = start + int(query.get('maxResults', ['100'])[0])
+        ret: dict[str, Any] = {
+            'messages': [{
+                'id': f'{x.msgid:x}',
+                'threadId': f'{x.thrid:x}'
+            } for x in matched[start:end]],
+            'resultSizeEstimate': len(matched)
+        }
+        if end < len(matched):
+            ret['nextPageToken'] = str(end)
+        return 200, ret
+
+    def _labels(self) -> tuple[int, Any]:
+        self.requests['labels.list'] += 1
+        return 200, {
+            'labels': [
+                *({
+                    'id': x,
+                    'name': x,
+                    'type': 'system'
+                } for x in (*SYSTEM_LABELS, 'UNREAD', 'CATEGORY_PERSONAL')), *({
+                    'id': id_,
+                    'name': name,
+                    'type': 'user'
+                } for name, id_ in self._user_labels.items())
+            ]
+        }
+
+    def _get(self, id_: str) -> tuple[int, Any]:
+        self.requests['messages.get'] += 1
+        if self.rate_limited:
+            self.rate_limited -= 1
+            return 429, {'error': {'code': 429, 'message': 'Rate limit exceeded'}}
+        for message in self.messages:
+            if f'{message.msgid:x}' == id_ and message.uid not in self.missing:
+                return 200, {
+                    'id': id_,
+                    'internalDate': str(int(message.internal_date.timestamp() * 1000)),
+                    'labelIds': self._label_ids(message),
+                    'raw': urlsafe_b64encode(message.body).decode().rstrip('='),
+                    'sizeEstimate': len(message.body),
+                    'threadId': f'{message.thrid:x}'
+                }
+        return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+
+    def _batch(self, content_type: str, body: bytes) -> tuple[int, bytes, str]:
+        self.requests['batch'] += 1
+        boundary = _BOUNDARY_RE.search(content_type).group(1)  # type: ignore[union-attr]
+        parts: list[str] = []
+        for part in body.decode().split(f'--{boundary}')[1:]:
+            if not (match := _GET_RE.search(part)):
+                continue
+            content_id = re.search(r'Content-ID: <([^>]+)>',
+                                   part).group(1)  # type: ignore[union-attr]
+            status, data = self._get(match.group(1))
+            content = json.dumps(data)
+            parts.append(f'--batch_response\r\nContent-Type: application/http\r\n'
+                         f'Content-ID: <response-{content_id}>\r\n\r\n'
+                         f'HTTP/1.1 {status} {_REASONS[status]}\r\n'
+                         'Content-Type: application/json; charset=UTF-8\r\n'
+                         f'Content-Length: {len(content)}\r\n\r\n{content}\r\n')
+        return 200, ''.join([*parts, '--batch_response--\r\n']).encode(), \
+            'multipart/mixed; boundary=batch_response'
+
+    def _batch_modify(self, body: bytes) -> tuple[int, Any]:
+        self.requests['messages.batchModify'] += 1
+        data = json.loads(body)
+        ids = set(data['ids'])
+        if 'TRASH' in data.get('addLabelIds', []):
+            self.trash += [x for x in self.messages if f'{x.msgid:x}' in ids]
+            self.messages = [x for x in self.messages if f'{x.msgid:x}' not in ids]
+        return 204, None
+
+    def _route(self, method: str, target: str, headers: dict[str, str],
+               body: bytes) -> tuple[int, bytes, str]:
+        if headers.get('authorization') != f'Bearer {self.access_token}':
+            status, data = 401, {'error': {'code': 401, 'message': 'Invalid Credentials'}}
+        else:
+            url = urllib.parse.urlsplit(target)
+            query = urllib.parse.parse_qs(url.query)
+            match method, url.path:
+                case 'GET', '/gmail/v1/users/me/messages':
+                    status, data = self._list(query)
+                case 'GET', '/gmail/v1/users/me/labels':
+                    status, data = self._labels()
+                case 'POST', '/batch/gmail/v1':
+                    return self._batch(headers.get('content-type', ''), body)
+                case 'POST', '/gmail/v1/users/me/messages/batchModify':
+                    status, data = self._batch_modify(body)
+                case _:
+                    status, data = 404, {'error': {'code': 404, 'message': 'Not Found'}}
+        return (status, b'' if data is None else json.dumps(data).encode(),
+                'application/json; charset=UTF-8')
+
+    async def _respond(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        if not (request_line := await reader.readline()):
+            return False
+        method, target, _ = request_line.decode().split(' ', 2)
+        headers: dict[str, str] = {}
+        while (line := await reader.readline()) not in {b'\r\n', b'\n', b''}:
+            name, _, value = line.decode().partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', '0')))
+        status, content, content_type = self._route(method, target, headers, body)
+        writer.write(f'HTTP/1.1 {status} {_REASONS.get(status, "No Content")}\r\n'
+                     f'Content-Type: {content_type}\r\n'
+                     f'Content-Length: {len(content)}\r\n\r\n'.encode() + content)
+        await writer.drain()
+        return True
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while await self._respond(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            log.debug('Client disconnected.')
+        finally:
+            writer.close()
+
+    async def __aenter__(self) -> Self:
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.url = f'http://127.0.0.1:{self._server.sockets[0].getsockname()[1]}'
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
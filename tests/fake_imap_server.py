@@ -0,0 +1,589 @@
+"""
+Fake Gmail IMAP server for end-to-end and load tests.
+
+Implements the subset of IMAP4rev1 and the Gmail extensions used by the archiver over a real
+socket, so :py:mod:`aioimaplib` and :py:func:`gmail_archiver.utils.archive_emails` can be exercised
+without network access. Latency, dropped connections and server errors can be injected.
+"""
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Any
+import asyncio
+import base64
+import collections
+import logging
+import math
+import random
+import re
+import string
+import zlib
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable, Sequence
+    import ssl
+
+    from typing_extensions import Self
+
+__all__ = ('FakeGmailServer', 'FakeMessage', 'generate_mailbox')
+
+log = logging.getLogger(__name__)
+
+_ATOM_RE = re.compile(r'^\\?[A-Za-z0-9_]+$')
+_BODY_PARTIAL_RE = re.compile(r'^BODY(?:\.PEEK)?\[\](?:<(\d+)\.(\d+)>)?$')
+_CHANGEDSINCE_RE = re.compile(r'\s*\(CHANGEDSINCE (\d+)\)\s*$', re.IGNORECASE)
+_FETCH_ITEM_RE = re.compile(r'BODY(?:\.PEEK)?\[\](?:<\d+\.\d+>)?|[A-Z0-9.\-]+')
+_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2}
+_CAPABILITIES = ('IMAP4rev1 UNSELECT IDLE NAMESPACE QUOTA ID XLIST CHILDREN X-GM-EXT-1 UIDPLUS '
+                 'ENABLE MOVE CONDSTORE ESEARCH UTF8=ACCEPT LIST-EXTENDED LIST-STATUS LITERAL- '
+                 'SPECIAL-USE')
+_PRE_AUTH_CAPABILITIES = f'{_CAPABILITIES} AUTH=XOAUTH2 AUTH=PLAIN AUTH=OAUTHBEARER'
+_POST_AUTH_CAPABILITIES = f'{_CAPABILITIES} COMPRESS=DEFLATE APPENDLIMIT=35651584'
+_SYSTEM_MAILBOXES = {
+    '[Gmail]/Important': '\\Important',
+    '[Gmail]/Sent Mail': '\\Sent',
+    '[Gmail]/Starred': '\\Starred',
+    'INBOX': '\\Inbox'
+}
+_FILLER = b'The quick brown fox jumps over the lazy dog.\r\n'
+_WBITS = -15
+
+
+class FakeMessage:
+    """
+    A message in the fake mailbox.
+
+    Parameters
+    ----------
+    uid : int
+        Unique identifier.
+    body : bytes
+        The complete RFC 822 message.
+    internal_date : datetime
+        Arrival time.
+    labels : Iterable[str] | None
+        Gmail labels.
+    msgid : int | None
+        ``X-GM-MSGID``. Defaults to a value derived from ``uid``.
+    thrid : int | None
+        ``X-GM-THRID``. Defaults to ``msgid``.
+    """
+    def __init__(self,
+                 uid: int,
+                 body: bytes,
+                 internal_date: datetime,
+                 labels: Iterable[str] | None = None,
+                 msgid: int | None = None,
+                 thrid: int | None = None) -> None:
+        self.body = body
+        """The complete RFC 822 message."""
+        self.internal_date = internal_date
+        """Arrival time."""
+        self.labels = list(labels or [])
+        """Gmail labels."""
+        self.modseq = 1
+        """Modification sequence, incremented when labels change."""
+        self.msgid = msgid if msgid is not None else 1_600_000_000_000_000_000 + uid
+        """Gmail message ID."""
+        self.thrid = thrid if thrid is not None else self.msgid
+        """Gmail thread ID."""
+        self.uid = uid
+        """Unique identifier."""
+
+    def matches(self, query: str) -> bool:
+        """
+        Check if the message matches a Gmail search query.
+
+        Only a subset is supported: ``label:``, ``larger:`` and ``smaller:`` terms and words of the
+        message, each optionally negated with ``-``. All terms must match.
+
+        Parameters
+        ----------
+        query : str
+            The query.
+
+        Returns
+        -------
+        bool
+            Whether the message matches.
+        """
+        for term in query.split():
+            negated = term.startswith('-')
+            key, _, value = term.removeprefix('-').partition(':')
+            value = value.strip('"')
+            match key.lower():
+                case 'label' if value:
+                    found = value.lower() in {x.lower() for x in self.labels}
+                case 'larger' if value:
+                    found = len(self.body) > _parse_size(value)
+                case 'smaller' if value:
+                    found = len(self.body) < _parse_size(value)
+                case _:
+                    found = term.removeprefix('-').lower().encode() in self.body.lower()
+            if found == negated:
+                return False
+        return True
+
+
+def generate_mailbox(
+    count: int,
+    *,
+    end: datetime | None = None,
+    labels: Sequence[str] = ('\\Inbox', '\\Important', 'Work', 'My label'),
+    mean_size: int = 20_000,
+    seed: int = 0,
+    sigma: float = 1.0,
+    size: Callable[[random.Random], int] | None = None,
+    span: timedelta = timedelta(days=3650)
+) -> list[FakeMessage]:
+    """
+    Generate a synthetic mailbox.
+
+    Message sizes follow a log-normal distribution by default, which roughly matches real mail: most
+    messages are small and a few are very large.
+
+    Parameters
+    ----------
+    count : int
+        Number of messages.
+    end : datetime | None
+        Date of the newest message. Defaults to a year ago.
+    labels : Sequence[str]
+        Labels to pick from.
+    mean_size : int
+        Median message size in bytes for the default distribution.
+    seed : int
+        Random seed, so the same mailbox can be generated again.
+    sigma : float
+        Shape of the default log-normal distribution.
+    size : Callable[[random.Random], int] | None
+        Custom size distribution.
+    span : timedelta
+        Time between the oldest and newest messages.
+
+    Returns
+    -------
+    list[FakeMessage]
+        Messages in arrival order.
+    """
+    rng = random.Random(seed)  # noqa: S311
+    end = end or datetime.now(timezone.utc) - timedelta(days=365)
+    start = end - span
+    ret: list[FakeMessage] = []
+    for uid in range(1, count + 1):
+        date = start + span * (uid / max(count, 1))
+        headers = (f'From: sender{uid}@example.com\r\n'
+                   'To: user@example.com\r\n'
+                   f'Subject: Message {uid}\r\n'
+                   f'Date: {date.strftime("%a, %d %b %Y %H:%M:%S %z")}\r\n'
+                   f'Message-ID: <{uid}@example.com>\r\n\r\n').encode()
+        target = size(rng) if size else int(rng.lognormvariate(math.log(mean_size), sigma))
+        filler = _FILLER * (max(target - len(headers), 0) // len(_FILLER) + 1)
+        ret.append(
+            FakeMessage(uid,
+                        headers + filler[:max(target - len(headers), 0)],
+                        date,
+                        rng.sample(list(labels), rng.randint(0, len(labels))),
+                        thrid=1_600_000_000_000_000_000 + (uid + 1) // 2))
+    return ret
+
+
+def _quote(value: str) -> str:
+    if _ATOM_RE.match(value):
+        return value
+    escaped = value.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+def _parse_list(value: str) -> list[str]:
+    return [
+        re.sub(r'\\(.)', r'\1', quoted) if quoted else atom
+        for quoted, atom in re.findall(r'"((?:[^"\\]|\\.)*)"|([^\s()"]+)', value)
+    ]
+
+
+def _parse_set(value: str, maximum: int) -> list[int]:
+    ret: list[int] = []
+    for part in value.split(','):
+        first, _, last = part.partition(':')
+        start = maximum if first == '*' else int(first)
+        end = start if not last else (maximum if last == '*' else int(last))
+        ret.extend(range(min(start, end), max(start, end) + 1))
+    return ret
+
+
+def _parse_fetch_items(items: str, *, by_uid: bool) -> tuple[list[str], int]:
+    changed_since = -1
+    if modifier := _CHANGEDSINCE_RE.search(items):
+        changed_since = int(modifier.group(1))
+        items = items[:modifier.start()]
+    names = _FETCH_ITEM_RE.findall(items.upper())
+    if by_uid and 'UID' not in names:
+        names.insert(0, 'UID')
+    if modifier and 'MODSEQ' not in names:
+        names.append('MODSEQ')
+    return names, changed_since
+
+
+def _parse_size(value: str) -> int:
+    return int(value.rstrip('KMkm')) * _SIZE_UNITS[value.lstrip(string.digits).upper()]
+
+
+def _parse_date(value: str) -> datetime:
+    return datetime.strptime(value.strip('"'), '%d-%b-%Y').replace(tzinfo=timezone.utc)
+
+
+class _Session:
+    def __init__(self, server: FakeGmailServer, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter) -> None:
+        self.authenticated = False
+        self.buffer = b''
+        self.compressor: Any = None
+        self.decompressor: Any = None
+        self.label: str | None = None
+        self.reader = reader
+        self.selected = False
+        self.server = server
+        self.writer = writer
+
+    @property
+    def messages(self) -> list[FakeMessage]:
+        if self.label is None:
+            return self.server.messages
+        return [x for x in self.server.messages if self.label in x.labels]
+
+    async def read_line(self) -> bytes | None:
+        while b'\r\n' not in self.buffer:
+            if not (data := await self.reader.read(65536)):
+                return None
+            self.buffer += self.decompressor.decompress(data) if self.decompressor else data
+        line, _, self.buffer = self.buffer.partition(b'\r\n')
+        return line
+
+    def send(self, *parts: bytes | str) -> None:
+        data = b''.join(x.encode() if isinstance(x, str) else x for x in parts)
+        self.server.bytes_sent += len(data)
+        if self.compressor:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.server.wire_bytes_sent += len(data)
+        self.writer.write(data)
+
+    async def run(self) -> None:
+        self.send('* OK Gimap ready for requests from 127.0.0.1\r\n')
+        while (line := await self.read_line()) is not None:
+            tag, _, command = line.decode().partition(' ')
+            name, _, args = command.partition(' ')
+            by_uid = name.upper() == 'UID'
+            if by_uid:
+                name, _, args = args.partition(' ')
+            name = name.upper()
+            self.server.commands[name] += 1
+            if self.server.latency:
+                await asyncio.sleep(self.server.latency)
+            if self.server.rng.random() < self.server.drop_rate:
+                log.debug('Dropping connection on %s.', name)
+                break
+            if not await self.handle(tag, name, args, by_uid=by_uid):
+                break
+            await self.writer.drain()
+        self.writer.close()
+
+    async def handle(self, tag: str, name: str, args: str, *, by_uid: bool) -> bool:
+        match name:
+            case 'CAPABILITY':
+                capabilities = (_POST_AUTH_CAPABILITIES
+                                if self.authenticated else _PRE_AUTH_CAPABILITIES)
+                self.send(f'* CAPABILITY {capabilities}\r\n{tag} OK Thats all she wrote!\r\n')
+            case 'AUTHENTICATE':
+                return self.authenticate(tag, args)
+            case 'COMPRESS':
+                self.send(f'{tag} OK Success\r\n')
+                self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                                   _WBITS)
+                self.decompressor = zlib.decompressobj(_WBITS)
+                self.buffer = self.decompressor.decompress(self.buffer)
+            case 'SELECT' | 'EXAMINE':
+                self.select(tag, name, args)
+            case 'SEARCH':
+                self.search(tag, args, by_uid=by_uid)
+            case 'FETCH':
+                self.fetch(tag, args, by_uid=by_uid)
+            case 'STORE':
+                self.store(tag, args, by_uid=by_uid)
+            case 'CLOSE' | 'EXPUNGE':
+                self.expunge(tag, name)
+            case 'IDLE':
+                self.send('+ idling\r\n')
+                await self.writer.drain()
+                while (line := await self.read_line()) is not None and line != b'DONE':
+                    pass
+                self.send(f'{tag} OK IDLE terminated (Success)\r\n')
+            case 'NOOP':
+                self.send(f'{tag} OK Success\r\n')
+            case 'LOGOUT':
+                self.send(f'* BYE LOGOUT Requested\r\n{tag} OK 73 good day (Success)\r\n')
+                return False
+            case _:
+                self.send(f'{tag} BAD Unknown command\r\n')
+        return True
+
+    def authenticate(self, tag: str, args: str) -> bool:
+        mechanism, _, initial = args.partition(' ')
+        try:
+            decoded = base64.b64decode(initial).decode()
+        except ValueError:
+            decoded = ''
+        if (mechanism.upper() != 'XOAUTH2'
+                or f'auth=Bearer {self.server.access_token}\1' not in decoded):
+            self.send(f'{tag} NO [AUTHENTICATIONFAILED] Invalid credentials (Failure)\r\n')
+            return True
+        self.authenticated = True
+        self.send(f'{tag} OK user@example.com authenticated (Success)\r\n')
+        return True
+
+    def select(self, tag: str, name: str, args: str) -> None:
+        if not self.authenticated:
+            self.send(f'{tag} BAD Not authenticated\r\n')
+            return
+        mailbox = next(iter(_parse_list(args)), '')
+        labels = {x for m in self.server.messages for x in m.labels}
+        if mailbox == '[Gmail]/All Mail':
+            self.label = None
+        elif (label := _SYSTEM_MAILBOXES.get(mailbox, mailbox)) in labels:
+            self.label = label
+        else:
+            self.send(f'{tag} NO [NONEXISTENT] Unknown Mailbox: {mailbox} (Failure)\r\n')
+            return
+        messages = self.messages
+        self.selected = True
+        highest = max((x.modseq for x in messages), default=1)
+        uid_next = max((x.uid for x in messages), default=0) + 1
+        self.send(
+            '* FLAGS (\\Answered \\Flagged \\Draft \\Deleted \\Seen)\r\n'
+            f'* OK [UIDVALIDITY {self.server.uid_validity}] UIDs valid.\r\n'
+            f'* {len(messages)} EXISTS\r\n'
+            '* 0 RECENT\r\n'
+            f'* OK [UIDNEXT {uid_next}] Predicted next UID.\r\n'
+            f'* OK [HIGHESTMODSEQ {highest}]\r\n'
+            f'{tag} OK [{"READ-ONLY" if name == "EXAMINE" else "READ-WRITE"}] {args} selected. '
+            '(Success)\r\n')
+
+    def _resolve(self, value: str, *, by_uid: bool) -> list[tuple[int, FakeMessage]]:
+        messages = self.messages
+        if by_uid:
+            wanted = set(_parse_set(value, max((x.uid for x in messages), default=0)))
+            return [(i, x) for i, x in enumerate(messages, 1) if x.uid in wanted]
+        return [(i, messages[i - 1]) for i in _parse_set(value, len(messages))
+                if 1 <= i <= len(messages)]
+
+    def search(self, tag: str, args: str, *, by_uid: bool) -> None:
+        if not self.selected:
+            self.send(f'{tag} BAD Not selected\r\n')
+            return
+        tokens = _parse_list(args)
+        if tokens[:1] == ['CHARSET']:
+            tokens = tokens[2:]
+        matched = list(enumerate(self.messages, 1))
+        while tokens:
+            key = tokens.pop(0).upper()
+            if key == 'ALL':
+                continue
+            if key in {'BEFORE', 'SINCE'} and tokens:
+                date = _parse_date(tokens.pop(0))
+                matched = [(i, x) for i, x in matched
+                           if (x.internal_date < date) == (key == 'BEFORE')]
+            elif key == 'X-GM-RAW' and tokens:
+                query = tokens.pop(0)
+                matched = [(i, x) for i, x in matched if x.matches(query)]
+            elif key == 'UID' and tokens:
+                uids = {x.uid for _, x in self._resolve(tokens.pop(0), by_uid=True)}
+                matched = [(i, x) for i, x in matched if x.uid in uids]
+            else:
+                self.send(f'{tag} BAD Could not parse command\r\n')
+                return
+        found = ' '.join(str(x.uid if by_uid else i) for i, x in matched)
+        self.send(f'* SEARCH {found}'.rstrip() + f'\r\n{tag} OK SEARCH completed (Success)\r\n')
+
+    def fetch(self, tag: str, args: str, *, by_uid: bool) -> None:
+        if not self.selected:
+            self.send(f'{tag} BAD Not selected\r\n')
+            return
+        if self.server.rng.random() < self.server.error_rate:
+            self.send(f'{tag} NO [UNAVAILABLE] Temporary System Error\r\n')
+            return
+        message_set, _, items = args.partition(' ')
+        names, changed_since = _parse_fetch_items(items, by_uid=by_uid)
+        for number, message in self._resolve(message_set, by_uid=by_uid):
+            if message.modseq <= changed_since:
+                continue
+            simple: list[str] = []
+            literals: list[tuple[str, bytes]] = []
+            for item in names:
+                match item:
+                    case 'UID':
+                        simple.append(f'UID {message.uid}')
+                    case 'RFC822.SIZE':
+                        simple.append(f'RFC822.SIZE {len(message.body)}')
+                    case 'INTERNALDATE':
+                        date = message.internal_date.strftime('%d-%b-%Y %H:%M:%S %z')
+                        simple.append(f'INTERNALDATE "{date}"')
+                    case 'X-GM-LABELS':
+                        simple.append(
+                            f'X-GM-LABELS ({" ".join(_quote(x) for x in message.labels)})')
+                    case 'X-GM-MSGID':
+                        simple.append(f'X-GM-MSGID {message.msgid}')
+                    case 'X-GM-THRID':
+                        simple.append(f'X-GM-THRID {message.thrid}')
+                    case 'MODSEQ':
+                        simple.append(f'MODSEQ ({message.modseq})')
+                    case 'FLAGS':
+                        simple.append('FLAGS (\\Seen)')
+                    case 'RFC822':
+                        literals.append(('RFC822', message.body))
+                    case _ if partial := _BODY_PARTIAL_RE.match(item):
+                        if partial.group(1) is None:
+                            literals.append(('BODY[]', message.body))
+                        else:
+                            offset, length = int(partial.group(1)), int(partial.group(2))
+                            literals.append(
+                                (f'BODY[]<{offset}>', message.body[offset:offset + length]))
+            parts = [' '.join(simple)] if simple else []
+            self.send(f'* {number} FETCH (', ' '.join(parts))
+            for index, (name, data) in enumerate(literals):
+                self.send(' ' if parts or index else '', f'{name} {{{len(data)}}}\r\n', data)
+            self.send(')\r\n')
+        self.send(f'{tag} OK Success\r\n')
+
+    def store(self, tag: str, args: str, *, by_uid: bool) -> None:
+        message_set, _, rest = args.partition(' ')
+        action, _, value = rest.partition(' ')
+        labels = _parse_list(value)
+        for number, message in self._resolve(message_set, by_uid=by_uid):
+            match action.upper():
+                case '+X-GM-LABELS':
+                    message.labels += [x for x in labels if x not in message.labels]
+                case '-X-GM-LABELS':
+                    message.labels = [x for x in message.labels if x not in labels]
+                case 'X-GM-LABELS':
+                    message.labels = labels
+                case _:
+                    continue
+            message.modseq = self.server.next_modseq()
+            uid = f'UID {message.uid} ' if by_uid else ''
+            self.send(f'* {number} FETCH ({uid}X-GM-LABELS '
+                      f'({" ".join(_quote(x) for x in message.labels)}))\r\n')
+        self.send(f'{tag} OK Success\r\n')
+
+    def expunge(self, tag: str, name: str) -> None:
+        kept = [x for x in self.server.messages if '\\Trash' not in x.labels]
+        if name == 'EXPUNGE':
+            for number in reversed(
+                [i for i, x in enumerate(self.server.messages, 1) if '\\Trash' in x.labels]):
+                self.send(f'* {number} EXPUNGE\r\n')
+        self.server.trash += [x for x in self.server.messages if '\\Trash' in x.labels]
+        self.server.messages = kept
+        if name == 'CLOSE':
+            self.selected = False
+        self.send(f'{tag} OK Success\r\n')
+
+
+class FakeGmailServer:
+    """
+    Asyncio IMAP server standing in for Gmail.
+
+    Use as an async context manager. The listening port is available as :py:attr:`port` once
+    entered.
+
+    Parameters
+    ----------
+    messages : list[FakeMessage]
+        Contents of ``[Gmail]/All Mail``. Other mailboxes hold the messages with the label of the
+        same name, or with the matching system label for mailboxes such as ``[Gmail]/Sent Mail``.
+    access_token : str
+        Bearer token accepted by ``AUTHENTICATE XOAUTH2``.
+    drop_rate : float
+        Probability of closing the connection instead of answering a command.
+    error_rate : float
+        Probability of answering a ``FETCH`` with ``NO``.
+    latency : float
+        Seconds to wait before answering each command.
+    seed : int
+        Random seed for injected failures.
+    ssl_context : ssl.SSLContext | None
+        Serve TLS with this context.
+    """
+    def __init__(
+            self,
+            messages: list[FakeMessage],
+            *,
+            access_token: str = 'token',  # noqa: S107
+            drop_rate: float = 0.0,
+            error_rate: float = 0.0,
+            latency: float = 0.0,
+            seed: int = 0,
+            ssl_context: ssl.SSLContext | None = None) -> None:
+        self.access_token = access_token
+        """Bearer token accepted by ``AUTHENTICATE XOAUTH2``."""
+        self.bytes_sent = 0
+        """Response bytes before compression."""
+        self.commands: collections.Counter[str] = collections.Counter()
+        """Number of commands received by name."""
+        self.drop_rate = drop_rate
+        """Probability of closing the connection instead of answering a command."""
+        self.error_rate = error_rate
+        """Probability of answering a ``FETCH`` with ``NO``."""
+        self.latency = latency
+        """Seconds to wait before answering each command."""
+        self.messages = messages
+        """Messages in the mailbox."""
+        self.port = 0
+        """Listening port."""
+        self.rng = random.Random(seed)  # noqa: S311
+        """Random source for injected failures."""
+        self.ssl_context = ssl_context
+        """TLS context, if serving TLS."""
+        self.trash: list[FakeMessage] = []
+        """Messages expunged after being labelled ``\\Trash``."""
+        self.uid_validity = 1
+        """``UIDVALIDITY`` of the mailbox."""
+        self.wire_bytes_sent = 0
+        """Response bytes written to the socket."""
+        self._modseq = max((x.modseq for x in messages), default=1)
+        self._server: asyncio.Server | None = None
+        self._writers: set[asyncio.StreamWriter] = set()
+
+    def next_modseq(self) -> int:
+        """
+        Allocate a modification sequence number.
+
+        Returns
+        -------
+        int
+            The new highest modification sequence.
+        """
+        self._modseq += 1
+        return self._modseq
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._writers.add(writer)
+        try:
+            await _Session(self, reader, writer).run()
+        except ConnectionError:
+            log.debug('Client disconnected.')
+        finally:
+            self._writers.discard(writer)
+
+    async def __aenter__(self) -> Self:
+        self._server = await asyncio.start_server(self._handle,
+                                                  '127.0.0.1',
+                                                  0,
+                                                  ssl=self.ssl_context)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        if self._server:
+            self._server.close()
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
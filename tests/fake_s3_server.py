@@ -0,0 +1,213 @@
+"""
+Fake S3-compatible object storage for tests of the S3 backend.
+
+Implements ``PutObject`` and multipart uploads (create, upload part, complete and abort) of one
+bucket over plain HTTP/1.1, addressed path-style like MinIO. Every request must be signed with
+AWS Signature Version 4 for the configured credentials. Server errors can be injected.
+"""
+from __future__ import annotations
+
+from datetime import datetime
+from hashlib import md5, sha256
+from typing import TYPE_CHECKING
+import asyncio
+import collections
+import itertools
+import logging
+import re
+import urllib.parse
+
+from gmail_archiver.s3 import sign_request
+
+if TYPE_CHECKING:
+    from typing_extensions import Self
+
+__all__ = ('FakeS3Server',)
+
+log = logging.getLogger(__name__)
+
+_AMZ_HEADERS = frozenset({'host', 'x-amz-content-sha256', 'x-amz-date'})
+_PART_RE = re.compile(rb'<PartNumber>(\d+)</PartNumber><ETag>([^<]+)</ETag>')
+_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    503: 'Service Unavailable'
+}
+_SIGNED_HEADERS_RE = re.compile(r'SignedHeaders=([^,]+)')
+
+
+def _error(status: int, code: str) -> tuple[int, bytes, dict[str, str]]:
+    return status, f'<Error><Code>{code}</Code></Error>'.encode(), {}
+
+
+class FakeS3Server:
+    """
+    Asyncio HTTP server standing in for S3-compatible object storage.
+
+    Use as an async context manager. The endpoint is available as :py:attr:`url` once entered.
+
+    Parameters
+    ----------
+    bucket : str
+        The only bucket.
+    access_key_id : str
+        Access key ID requests must be signed with.
+    secret_access_key : str
+        Secret access key requests must be signed with.
+    unavailable : int
+        Number of requests answered with ``503`` before any is served.
+    complete_error : bool
+        Answer completing a multipart upload with an error in a ``200`` response.
+    part_delay : float
+        Seconds each part upload takes, so concurrent uploads overlap.
+    """
+    def __init__(
+            self,
+            bucket: str = 'archive',
+            *,
+            access_key_id: str = 'minio',
+            secret_access_key: str = 'minio-secret',  # noqa: S107
+            unavailable: int = 0,
+            complete_error: bool = False,
+            part_delay: float = 0) -> None:
+        self.access_key_id = access_key_id
+        """Access key ID requests must be signed with."""
+        self.aborted: list[str] = []
+        """Keys of aborted multipart uploads."""
+        self.bucket = bucket
+        """The only bucket."""
+        self.complete_error = complete_error
+        """Answer completing a multipart upload with an error."""
+        self.content_types: dict[str, str] = {}
+        """Media types of stored objects by key."""
+        self.max_parts_in_flight = 0
+        """Largest number of part uploads handled at the same time."""
+        self.objects: dict[str, bytes] = {}
+        """Stored objects by key."""
+        self.part_delay = part_delay
+        """Seconds each part upload takes."""
+        self.requests: collections.Counter[str] = collections.Counter()
+        """Number of requests received by operation name."""
+        self.secret_access_key = secret_access_key
+        """Secret access key requests must be signed with."""
+        self.unavailable = unavailable
+        """Remaining requests to answer with ``503``."""
+        self.uploads: dict[str, tuple[str, str, dict[int, bytes]]] = {}
+        """Key, media type and parts of multipart uploads in progress by upload ID."""
+        self.url = ''
+        """Endpoint of the server."""
+        self._parts_in_flight = 0
+        self._upload_ids = itertools.count(1)
+        self._server: asyncio.Server | None = None
+
+    def _authorised(self, method: str, target: str, headers: dict[str, str], body: bytes) -> bool:
+        if (sha256(body).hexdigest() != headers.get('x-amz-content-sha256')
+                or not (match := _SIGNED_HEADERS_RE.search(headers.get('authorization', '')))):
+            return False
+        amz_date = datetime.strptime(headers['x-amz-date'] + '+0000', '%Y%m%dT%H%M%SZ%z')
+        signed = sign_request(method,
+                              f'http://{headers["host"]}{target}',
+                              {x: headers[x]
+                               for x in match[1].split(';') if x not in _AMZ_HEADERS},
+                              headers['x-amz-content-sha256'],
+                              access_key_id=self.access_key_id,
+                              secret_access_key=self.secret_access_key,
+                              now=amz_date)
+        return signed['Authorization'] == headers['authorization']
+
+    def _complete(self, upload_id: str, body: bytes) -> tuple[int, bytes, dict[str, str]]:
+        self.requests['CompleteMultipartUpload'] += 1
+        if self.complete_error:
+            return 200, b'<Error><Code>InternalError</Code></Error>', {}
+        key, content_type, parts = self.uploads.pop(upload_id)
+        listed = [(int(number), etag.decode()) for number, etag in _PART_RE.findall(body)]
+        uploaded = [(i, f'"{md5(data, usedforsecurity=False).hexdigest()}"')
+                    for i, data in sorted(parts.items())]
+        if listed != uploaded:
+            return _error(400, 'InvalidPart')
+        self.objects[key] = b''.join(parts[i] for i in sorted(parts))
+        self.content_types[key] = content_type
+        return 200, b'<CompleteMultipartUploadResult/>', {}
+
+    def _route(self, method: str, target: str, headers: dict[str, str],
+               body: bytes) -> tuple[int, bytes, dict[str, str]]:
+        if self.unavailable:
+            self.unavailable -= 1
+            return _error(503, 'SlowDown')
+        if not self._authorised(method, target, headers, body):
+            return _error(403, 'SignatureDoesNotMatch')
+        url = urllib.parse.urlsplit(target)
+        bucket, _, key = urllib.parse.unquote(url.path).removeprefix('/').partition('/')
+        if bucket != self.bucket:
+            return _error(404, 'NoSuchBucket')
+        query = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        content_type = headers.get('content-type', 'application/octet-stream')
+        match method, query:
+            case 'PUT', {'partNumber': number, 'uploadId': upload_id}:
+                self.requests['UploadPart'] += 1
+                if upload_id not in self.uploads:
+                    return _error(404, 'NoSuchUpload')
+                self.uploads[upload_id][2][int(number)] = body
+                return 200, b'', {'ETag': f'"{md5(body, usedforsecurity=False).hexdigest()}"'}
+            case 'PUT', {}:
+                self.requests['PutObject'] += 1
+                self.objects[key] = body
+                self.content_types[key] = content_type
+                return 200, b'', {}
+            case 'POST', {'uploads': ''}:
+                self.requests['CreateMultipartUpload'] += 1
+                upload_id = f'upload-{next(self._upload_ids)}'
+                self.uploads[upload_id] = (key, content_type, {})
+                return 200, (f'<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId>'
+                             '</InitiateMultipartUploadResult>').encode(), {}
+            case 'POST', {'uploadId': upload_id}:
+                return self._complete(upload_id, body)
+            case 'DELETE', {'uploadId': upload_id}:
+                self.requests['AbortMultipartUpload'] += 1
+                self.uploads.pop(upload_id, None)
+                self.aborted.append(key)
+                return 204, b'', {}
+        return _error(400, 'NotImplemented')
+
+    async def _respond(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        if not (request_line := await reader.readline()):
+            return False
+        method, target, _ = request_line.decode().split(' ', 2)
+        headers: dict[str, str] = {}
+        while (line := await reader.readline()) not in {b'\r\n', b'\n', b''}:
+            name, _, value = line.decode().partition(':')
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', '0')))
+        if 'partNumber=' in target:
+            self._parts_in_flight += 1
+            self.max_parts_in_flight = max(self.max_parts_in_flight, self._parts_in_flight)
+            await asyncio.sleep(self.part_delay)
+            self._parts_in_flight -= 1
+        status, content, extra_headers = self._route(method, target, headers, body)
+        writer.write(f'HTTP/1.1 {status} {_REASONS.get(status, "No Content")}\r\n'
+                     'Content-Type: application/xml\r\n'.encode() +
+                     ''.join(f'{k}: {v}\r\n' for k, v in extra_headers.items()).encode() +
+                     f'Content-Length: {len(content)}\r\n\r\n'.encode() + content)
+        await writer.drain()
+        return True
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while await self._respond(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            log.debug('Client disconnected.')
+        finally:
+            writer.close()
+
+    async def __aenter__(self) -> Self:
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.url = f'http://127.0.0.1:{self._server.sockets[0].getsockname()[1]}'
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+from gmail_archiver.batching import AdaptiveBatchSize
+import pytest
+
+
+def test_adaptive_batch_size_additive_increase() -> None:
+    batcher = AdaptiveBatchSize(initial_size=10, initial_window=1, max_window=2, max_size=18)
+    batcher.record(1.0, 1000)
+    assert batcher.batch_size == 15
+    assert batcher.window == 2
+    assert batcher.throughput == pytest.approx(1000.0)
+    batcher.record(1.0, 2000)
+    assert batcher.batch_size == 18
+    assert batcher.window == 2
+    assert batcher.throughput == pytest.approx(1300.0)
+
+
+def test_adaptive_batch_size_slow_fetch_decreases() -> None:
+    batcher = AdaptiveBatchSize(initial_size=10, target_latency=1.0)
+    batcher.record(2.0, 1000)
+    assert batcher.batch_size == 5
+    assert batcher.window == 2
+    assert batcher.errors == 0
+
+
+def test_adaptive_batch_size_error_decreases() -> None:
+    batcher = AdaptiveBatchSize(initial_size=3, initial_window=4)
+    batcher.record(0.5, 0, ok=False)
+    assert batcher.batch_size == 1
+    assert batcher.window == 2
+    batcher.record(0.5, 0, ok=False)
+    assert batcher.batch_size == 1
+    assert batcher.window == 1
+    assert batcher.errors == 2
+
+
+def test_adaptive_batch_size_throughput_collapse_shrinks_window() -> None:
+    batcher = AdaptiveBatchSize(initial_window=4, max_window=8)
+    batcher.record(1.0, 10000)
+    assert batcher.window == 5
+    batcher.record(1.0, 8000)
+    assert batcher.window == 5
+    batcher.record(1.0, 100)
+    assert batcher.window == 2
+    batcher.record(0.0, 0)
+    assert batcher.window == 1
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+import json
+
+from benchmarks.archive import compare_results, main, run_benchmark
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from benchmarks.archive import BenchmarkResult
+    from click.testing import CliRunner
+    from pytest_mock import MockerFixture
+
+
+def make_result(name: str, messages_per_second: float) -> BenchmarkResult:
+    return {
+        'adaptive': True,
+        'bytes': 100,
+        'compress': True,
+        'cpu_seconds': 1.0,
+        'latency': 0.0,
+        'mailbox_bytes': 100,
+        'mb_per_second': 0.0,
+        'messages': 1,
+        'messages_per_second': messages_per_second,
+        'name': name,
+        'peak_rss_kib': 1000,
+        'seconds': 1.0
+    }
+
+
+def test_run_benchmark() -> None:
+    result = run_benchmark('mixed', scale=0.005, latency=0.001)
+    assert result['name'] == 'mixed'
+    assert result['messages'] == 10
+    assert result['bytes'] == result['mailbox_bytes']
+    assert result['messages_per_second'] > 0
+    assert result['peak_rss_kib'] > 0
+
+
+def test_compare_results() -> None:
+    lines = compare_results(
+        [make_result('tiny', 110.0), make_result('huge', 1.0)], [make_result('tiny', 100.0)])
+    assert lines == [('tiny: messages_per_second +10.0%, mb_per_second n/a, peak_rss_kib +0.0%, '
+                      'cpu_seconds +0.0%')]
+
+
+def test_main_runs_workers_and_compares(mocker: MockerFixture, runner: CliRunner,
+                                        tmp_path: Path) -> None:
+    run = mocker.patch('benchmarks.archive.sp.run')
+    run.return_value.stdout = json.dumps(make_result('tiny', 200.0))
+    baseline = tmp_path / 'baseline.json'
+    baseline.write_text(json.dumps({'results': [make_result('tiny', 100.0)]}))
+    output = tmp_path / 'results.json'
+    result = runner.invoke(main, [
+        '-c', 'tiny', '--latency', '0.01', '--no-compress', '--compare',
+        str(baseline), '-o',
+        str(output)
+    ])
+    assert result.exit_code == 0
+    assert 'tiny: 200.0 messages/s' in result.output
+    assert 'messages_per_second +100.0%' in result.output
+    assert '--no-compress' in run.call_args_list[0][0][0]
+    data = json.loads(output.read_text())
+    assert data['results'][0]['name'] == 'tiny'
+    assert data['revision']
+
+
+def test_main_worker(mocker: MockerFixture, runner: CliRunner) -> None:
+    run_benchmark = mocker.patch('benchmarks.archive.run_benchmark',
+                                 return_value=make_result('huge', 1.0))
+    result = runner.invoke(main, ['--worker', '-c', 'huge', '--no-adaptive-batching'])
+    assert result.exit_code == 0
+    assert json.loads(result.output)['name'] == 'huge'
+    run_benchmark.assert_called_once_with('huge',
+                                          adaptive=False,
+                                          compress=True,
+                                          latency=0.0,
+                                          scale=1.0)
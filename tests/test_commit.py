@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+import os
+
+from gmail_archiver.commit import GroupCommit
+from gmail_archiver.stats import RunStats
+import pytest
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from pytest_mock import MockerFixture
+
+
+@pytest.fixture
+def synced(mocker: MockerFixture) -> list[str]:
+    synced: list[str] = []
+    real_open = os.open
+
+    def record_open(path: Path, flags: int, *args: int) -> int:
+        fd = real_open(path, flags, *args)
+        names[fd] = str(path)
+        return fd
+
+    names: dict[int, str] = {}
+    mocker.patch('gmail_archiver.commit.os.open', side_effect=record_open)
+    mocker.patch('gmail_archiver.commit.os.fsync', side_effect=lambda fd: synced.append(names[fd]))
+    return synced
+
+
+def make_files(root: Path, *names: str) -> list[Path]:
+    ret = []
+    for name in names:
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'message')
+        ret.append(path)
+    return ret
+
+
+async def test_group_commit_syncs_before_action(tmp_path: Path, synced: list[str]) -> None:
+    root = tmp_path / 'out'
+    actions: list[tuple[list[str], int]] = []
+
+    async def action(nums: list[str]) -> None:
+        actions.append((nums, len(synced)))
+
+    stats = RunStats()
+    commit = GroupCommit(root, action, size=3, stats=stats)
+    await commit.add(['1'], make_files(root, 'a/2021/1.eml', 'a/2021/1.labels.json'))
+    await commit.add(['2'], make_files(root, 'a/2022/2.eml'))
+    assert not synced
+    assert commit.pending == 2
+    await commit.add(['3'], make_files(root, 'a/2022/3.eml'))
+    assert commit.pending == 0
+    assert actions == [(['1', '2', '3'], 8)]
+    assert set(synced[:4]) == {
+        str(root / 'a/2021/1.eml'),
+        str(root / 'a/2021/1.labels.json'),
+        str(root / 'a/2022/2.eml'),
+        str(root / 'a/2022/3.eml')
+    }
+    directories = {root, root / 'a', root / 'a/2021', root / 'a/2022'}
+    assert set(synced[4:]) == {str(x) for x in directories}
+    assert stats.phases['sync'].count == 1
+
+
+async def test_group_commit_flush(tmp_path: Path, synced: list[str]) -> None:
+    actions: list[list[str]] = []
+
+    async def action(nums: list[str]) -> None:
+        actions.append(nums)
+
+    commit = GroupCommit(tmp_path, action)
+    await commit.flush()
+    assert not actions
+    await commit.add(['5', '6'], make_files(tmp_path, '5.eml', '6.eml'))
+    await commit.flush()
+    assert actions == [['5', '6']]
+    assert len(synced) == 3
+
+
+async def test_group_commit_prepares_and_syncs_shared_files_once(tmp_path: Path,
+                                                                 synced: list[str]) -> None:
+    root = tmp_path / 'out'
+    mbox = root / 'a/2021/01-Jan.mbox'
+    prepared: list[int] = []
+
+    async def prepare() -> None:
+        prepared.append(len(synced))
+        mbox.parent.mkdir(parents=True)
+        mbox.write_bytes(b'From MAILER-DAEMON\n')
+
+    async def action(nums: list[str]) -> None:
+        pass
+
+    commit = GroupCommit(root, action, prepare=prepare)
+    await commit.add(['1', '2'], [mbox, mbox])
+    await commit.flush()
+    assert prepared == [0]
+    assert synced.count(str(mbox)) == 1
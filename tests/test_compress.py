@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+from unittest.mock import AsyncMock, MagicMock
+import zlib
+
+from aioimaplib import Response  # type: ignore[import-untyped]
+from gmail_archiver.compress import enable_compression
+from gmail_archiver.stats import RunStats
+
+if TYPE_CHECKING:
+    from pytest_mock import MockerFixture
+
+
+def make_imap_conn(*, capable: bool = True, result: str = 'OK') -> MagicMock:
+    imap_conn = MagicMock()
+    imap_conn.has_capability.side_effect = [False, capable]
+    imap_conn.protocol.capability = AsyncMock()
+    imap_conn.protocol.execute = AsyncMock(return_value=Response(result, [b'Done']))
+    imap_conn.protocol.new_tag.return_value = 'A1'
+    return imap_conn
+
+
+async def test_enable_compression_wraps_connection() -> None:
+    imap_conn = make_imap_conn()
+    transport = imap_conn.protocol.transport
+    data_received = imap_conn.protocol.data_received
+    stats = RunStats()
+    assert await enable_compression(imap_conn, stats) is True
+    imap_conn.protocol.capability.assert_awaited_once()
+    assert str(imap_conn.protocol.execute.call_args[0][0]) == 'A1 COMPRESS DEFLATE'
+    imap_conn.protocol.transport.write(b'A1 NOOP\r\n')
+    sent = transport.write.call_args[0][0]
+    assert zlib.decompressobj(-15).decompress(sent) == b'A1 NOOP\r\n'
+    assert stats.compressed_sent == len(sent)
+    assert stats.uncompressed_sent == len(b'A1 NOOP\r\n')
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    payload = b'* 1 FETCH (RFC822 {100}\r\n' + b'x' * 100 + b')\r\n'
+    wire = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    imap_conn.protocol.data_received(wire[:10])
+    imap_conn.protocol.data_received(wire[10:])
+    assert b''.join(x.args[0] for x in data_received.call_args_list) == payload
+    assert stats.compressed_received == len(wire)
+    assert stats.uncompressed_received == len(payload)
+    assert stats.compression_savings > 0
+    assert imap_conn.protocol.transport.is_closing is transport.is_closing
+
+
+async def test_enable_compression_without_stats() -> None:
+    imap_conn = make_imap_conn()
+    transport = imap_conn.protocol.transport
+    data_received = imap_conn.protocol.data_received
+    assert await enable_compression(imap_conn) is True
+    imap_conn.protocol.transport.write(b'x')
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    imap_conn.protocol.data_received(
+        compressor.compress(b'y') + compressor.flush(zlib.Z_SYNC_FLUSH))
+    transport.write.assert_called_once()
+    data_received.assert_called_once_with(b'y')
+
+
+async def test_enable_compression_not_supported() -> None:
+    imap_conn = make_imap_conn(capable=False)
+    assert await enable_compression(imap_conn) is False
+    imap_conn.protocol.execute.assert_not_awaited()
+
+
+async def test_enable_compression_refused(mocker: MockerFixture) -> None:
+    log_warning = mocker.patch('gmail_archiver.compress.log.warning')
+    imap_conn = make_imap_conn(result='NO')
+    transport = imap_conn.protocol.transport
+    assert await enable_compression(imap_conn) is False
+    assert imap_conn.protocol.transport is transport
+    log_warning.assert_called_once()
+
+
+async def test_enable_compression_already_advertised() -> None:
+    imap_conn = make_imap_conn()
+    imap_conn.has_capability.side_effect = None
+    imap_conn.has_capability.return_value = True
+    assert await enable_compression(imap_conn) is True
+    imap_conn.protocol.capability.assert_not_awaited()
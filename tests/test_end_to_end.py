@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+import asyncio
+import json
+import mailbox
+import shutil
+import ssl
+import subprocess as sp
+
+from anyio import Path as AsyncPath
+from gmail_archiver.stats import RunStats
+from gmail_archiver.utils import archive_emails, estimate_archive
+from gmail_archiver.writers import MboxWriter
+from tests.fake_imap_server import FakeGmailServer, FakeMessage, generate_mailbox
+import aioimaplib  # type: ignore[import-untyped]
+import pytest
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+async def connect(server: FakeGmailServer,
+                  ssl_context: ssl.SSLContext | None = None) -> aioimaplib.IMAP4:
+    imap_conn = aioimaplib.IMAP4('127.0.0.1', server.port, ssl_context=ssl_context)
+    await imap_conn.wait_hello_from_server()
+    return imap_conn
+
+
+def archived(tmp_path: Path) -> dict[str, bytes]:
+    return {x.name: x.read_bytes() for x in tmp_path.rglob('*.eml')}
+
+
+async def test_archive_emails_end_to_end(tmp_path: Path) -> None:
+    messages = generate_mailbox(30, seed=1)
+    bodies = {f'{x.msgid}.eml': x.body + b'\n' for x in messages}
+    labels = {x.msgid: list(x.labels) for x in messages}
+    async with FakeGmailServer(messages) as server:
+        imap_conn = await connect(server)
+        stats = RunStats()
+        result = await archive_emails(imap_conn,
+                                      'user@example.com',
+                                      'token',
+                                      AsyncPath(tmp_path),
+                                      adaptive=True,
+                                      compress=True,
+                                      delete=True,
+                                      stats=stats)
+        await imap_conn.close()
+        await imap_conn.logout()
+    assert result == 0
+    assert archived(tmp_path) == bodies
+    for labels_file in tmp_path.rglob('*.labels.json'):
+        assert json.loads(labels_file.read_text()) == labels[int(labels_file.name.split('.')[0])]
+    assert not server.messages
+    assert len(server.trash) == 30
+    assert stats.messages == 30
+    assert stats.uncompressed_received > stats.compressed_received > 0
+    assert server.wire_bytes_sent < server.bytes_sent
+
+
+async def test_archive_emails_end_to_end_streaming(tmp_path: Path) -> None:
+    messages = generate_mailbox(6, seed=2, mean_size=3000, sigma=0.5)
+    messages.append(FakeMessage(7, messages[0].body * 1000, messages[0].internal_date))
+    bodies = {f'{x.msgid}.eml': x.body + b'\n' for x in messages}
+    async with FakeGmailServer(messages) as server:
+        imap_conn = await connect(server)
+        result = await archive_emails(imap_conn,
+                                      'user@example.com',
+                                      'token',
+                                      AsyncPath(tmp_path),
+                                      large_message_size=10000,
+                                      order='large-first',
+                                      plan=True)
+        await imap_conn.logout()
+    assert result == 0
+    assert archived(tmp_path) == bodies
+    assert len(server.messages) == 7
+
+
+async def test_archive_emails_end_to_end_mbox(tmp_path: Path) -> None:
+    messages = generate_mailbox(20, seed=4, mean_size=3000, sigma=0.5)
+    messages.append(FakeMessage(21, messages[0].body * 100, messages[0].internal_date))
+    async with FakeGmailServer(messages) as server:
+        imap_conn = await connect(server)
+        result = await archive_emails(imap_conn,
+                                      'user@example.com',
+                                      'token',
+                                      AsyncPath(tmp_path),
+                                      adaptive=True,
+                                      delete=True,
+                                      large_message_size=100000,
+                                      plan=True,
+                                      writer=MboxWriter(AsyncPath(tmp_path.resolve())))
+        await imap_conn.close()
+        await imap_conn.logout()
+    assert result == 0
+    assert len(server.trash) == 21
+    boxes = [mailbox.mbox(x) for x in tmp_path.rglob('*.mbox')]
+    # Line endings are converted and the message ends with a line.
+    assert sorted(box.get_bytes(key) for box in boxes for key in box.iterkeys()) == sorted(
+        x.body.replace(b'\r\n', b'\n').rstrip(b'\n') + b'\n' for x in messages)
+
+
+async def test_archive_emails_end_to_end_retries_errors(tmp_path: Path) -> None:
+    messages = generate_mailbox(40, seed=3, mean_size=2000)
+    async with FakeGmailServer(messages, error_rate=0.3, seed=4) as server:
+        imap_conn = await connect(server)
+        stats = RunStats()
+        result = await archive_emails(imap_conn,
+                                      'user@example.com',
+                                      'token',
+                                      AsyncPath(tmp_path),
+                                      adaptive=True,
+                                      stats=stats)
+        await imap_conn.logout()
+    assert result == 0
+    assert len(archived(tmp_path)) == 40
+    assert stats.retries > 0
+
+
+async def test_estimate_archive_end_to_end() -> None:
+    messages = generate_mailbox(10, seed=5)
+    async with FakeGmailServer(messages, latency=0.001) as server:
+        imap_conn = await connect(server)
+        estimate = await estimate_archive(imap_conn, 'user@example.com', 'token')
+        await imap_conn.logout()
+    assert estimate is not None
+    assert estimate['count'] == 10
+    assert estimate['total_bytes'] == sum(len(x.body) for x in messages)
+    assert server.commands['EXAMINE'] == 1
+    assert server.commands['SELECT'] == 0
+
+
+async def test_fake_server_rejects_bad_token() -> None:
+    async with FakeGmailServer([], access_token='good') as server:
+        imap_conn = await connect(server)
+        response = await imap_conn.xoauth2('user@example.com', 'bad')
+        assert response.result == 'NO'
+        await imap_conn.logout()
+
+
+async def test_fake_server_uid_search_store_and_idle() -> None:
+    messages = generate_mailbox(5, seed=6)
+    async with FakeGmailServer(messages) as server:
+        imap_conn = await connect(server)
+        await imap_conn.xoauth2('user@example.com', 'token')
+        await imap_conn.select('"[Gmail]/All Mail"')
+        response = await imap_conn.uid_search('UID', '2:4')
+        assert response.lines[0] == b'2 3 4'
+        response = await imap_conn.uid('fetch', '3', '(X-GM-MSGID X-GM-THRID MODSEQ FLAGS)')
+        assert b'UID 3 X-GM-MSGID' in response.lines[0]
+        await imap_conn.store('1', 'X-GM-LABELS', '("A b")')
+        await imap_conn.store('1', '-X-GM-LABELS', '"A b"')
+        await imap_conn.uid('store', '2', '+X-GM-LABELS', '\\Trash')
+        response = await imap_conn.expunge()
+        assert response.lines[0] == b'2 EXPUNGE'
+        idle = await imap_conn.idle_start(timeout=10)
+        imap_conn.idle_done()
+        assert (await asyncio.wait_for(idle, 10)).result == 'OK'
+        await imap_conn.logout()
+    assert messages[0].labels == []
+    assert [x.uid for x in server.trash] == [2]
+
+
+async def test_fake_server_unknown_command() -> None:
+    async with FakeGmailServer([]) as server:
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        await reader.readline()
+        writer.write(b'A1 BOGUS\r\nA2 SEARCH ALL\r\nA3 SELECT INBOX\r\nA4 LOGOUT\r\n')
+        assert await reader.read() == (b'A1 BAD Unknown command\r\nA2 BAD Not selected\r\n'
+                                       b'A3 BAD Not authenticated\r\n* BYE LOGOUT Requested\r\n'
+                                       b'A4 OK 73 good day (Success)\r\n')
+        writer.close()
+
+
+async def test_fake_server_drops_connection() -> None:
+    async with FakeGmailServer([], drop_rate=1.0) as server:
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        assert (await reader.readline()).startswith(b'* OK')
+        writer.write(b'A1 NOOP\r\n')
+        assert await reader.read() == b''
+        writer.close()
+
+
+@pytest.fixture
+def certificate(tmp_path: Path) -> tuple[Path, Path]:
+    if not (openssl := shutil.which('openssl')):
+        pytest.skip('openssl is not available')
+    cert = tmp_path / 'cert.pem'
+    key = tmp_path / 'key.pem'
+    sp.run((openssl, 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', str(key), '-out',
+            str(cert), '-subj', '/CN=localhost', '-days', '1', '-addext',
+            'subjectAltName=IP:127.0.0.1'),
+           check=True,
+           capture_output=True)
+    return cert, key
+
+
+async def test_fake_server_tls(certificate: tuple[Path, Path]) -> None:
+    cert, key = certificate
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_context.load_cert_chain(cert, key)
+    client_context = ssl.create_default_context(cafile=str(cert))
+    async with FakeGmailServer(generate_mailbox(2), ssl_context=server_context) as server:
+        imap_conn = await connect(server, client_context)
+        estimate = await estimate_archive(imap_conn, 'user@example.com', 'token')
+        await imap_conn.logout()
+    assert estimate is not None
+    assert estimate['count'] == 2
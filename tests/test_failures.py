@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+import json
+
+from anyio import Path as AsyncPath
+from gmail_archiver.failures import SNIPPET_LENGTH, ErrorManifest
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    import pytest
+
+
+def test_snippet() -> None:
+    manifest = ErrorManifest(AsyncPath('errors.json'), 'a@example.com')
+    manifest.add('1', 'fetch failed', b'x' * 300)
+    manifest.add('2', 'fetch failed', 'y' * 300)
+    manifest.add('3', 'fetch failed', [b'BAD', bytearray(b'\xff'), 'more'])
+    manifest.add('4', 'fetch failed')
+    assert [x['snippet'] for x in manifest.failures] == [
+        'x' * SNIPPET_LENGTH, 'y' * SNIPPET_LENGTH, 'BAD \\xff more', ''
+    ]
+    assert manifest.numbers == ['1', '2', '3', '4']
+
+
+async def test_save_load_keeps_other_accounts(tmp_path: Path) -> None:
+    path = tmp_path / 'errors.json'
+    path.write_text(json.dumps({'b@example.com': {'failures': []}}), encoding='utf-8')
+    manifest = ErrorManifest(AsyncPath(path), 'a@example.com')
+    manifest.add('4', 'fetch failed', b'NO')
+    manifest.add('5', 'unknown date', archived=True)
+    manifest.set_uids({'4': '104'})
+    await manifest.save('7')
+    data = json.loads(path.read_text(encoding='utf-8'))
+    assert set(data) == {'a@example.com', 'b@example.com'}
+    assert data['a@example.com']['uidvalidity'] == '7'
+    assert [x['uid'] for x in data['a@example.com']['failures']] == ['104', None]
+    loaded = ErrorManifest(AsyncPath(path), 'a@example.com')
+    await loaded.load()
+    assert loaded.previous['failures'][0]['reason'] == 'fetch failed'
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+async def test_save_without_failures(tmp_path: Path) -> None:
+    path = tmp_path / 'errors.json'
+    manifest = ErrorManifest(AsyncPath(path), 'a@example.com')
+    await manifest.save('7')
+    assert not path.exists()
+    path.write_text(json.dumps({
+        'a@example.com': {
+            'failures': []
+        },
+        'b@example.com': {
+            'failures': []
+        }
+    }),
+                    encoding='utf-8')
+    await manifest.save('7')
+    assert set(json.loads(path.read_text(encoding='utf-8'))) == {'b@example.com'}
+
+
+async def test_load_invalid(tmp_path: Path, caplog: pytest.LogCaptureFixture) -> None:
+    path = tmp_path / 'errors.json'
+    path.write_text('{{{', encoding='utf-8')
+    manifest = ErrorManifest(AsyncPath(path), 'a@example.com')
+    await manifest.load()
+    assert manifest.previous == {}
+    assert 'Ignoring invalid' in caplog.text
+
+
+def test_retry_uids(caplog: pytest.LogCaptureFixture) -> None:
+    manifest = ErrorManifest(AsyncPath('errors.json'), 'a@example.com')
+    assert manifest.retry_uids('7') == []
+    manifest.previous = {
+        'failures': [{
+            'archived': False,
+            'number': '1',
+            'reason': 'fetch failed',
+            'snippet': '',
+            'time': '',
+            'uid': '101'
+        }, {
+            'archived': True,
+            'number': '2',
+            'reason': 'unknown date',
+            'snippet': '',
+            'time': '',
+            'uid': '102'
+        }, {
+            'archived': False,
+            'number': '3',
+            'reason': 'fetch failed',
+            'snippet': '',
+            'time': '',
+            'uid': None
+        }],
+        'uidvalidity': '7'
+    }
+    assert manifest.retry_uids('7') == ['101']
+    assert manifest.retry_uids('8') == []
+    assert 'UIDVALIDITY' in caplog.text
@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+from base64 import urlsafe_b64encode
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING
+import json
+
+from anyio import Path as AsyncPath
+from gmail_archiver.failures import ErrorManifest
+from gmail_archiver.gmail_api import (
+    API_UIDVALIDITY,
+    GmailApiClient,
+    decode_raw,
+    encode_batch,
+    message_id,
+    message_number,
+    parse_batch_response,
+)
+from gmail_archiver.index import INDEX_FILE, MessageIndex
+from gmail_archiver.stats import RunStats
+from gmail_archiver.throttle import DailyQuota
+from gmail_archiver.utils import ALL_MAIL, archive_emails_api
+from tests.fake_gmail_api import FakeGmailApi
+from tests.fake_imap_server import FakeMessage, generate_mailbox
+import niquests
+import pytest
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from pytest_mock import MockerFixture
+
+BATCH_RESPONSE = (b'--batch_abc\r\n'
+                  b'Content-Type: application/http\r\n'
+                  b'Content-ID: <response-1>\r\n\r\n'
+                  b'HTTP/1.1 404 Not Found\r\n'
+                  b'Content-Type: application/json\r\n\r\n'
+                  b'{"error": {"code": 404}}\r\n'
+                  b'--batch_abc\r\n'
+                  b'Content-Type: application/http\r\n'
+                  b'Content-ID: <response-0>\r\n\r\n'
+                  b'HTTP/1.1 200 OK\r\n'
+                  b'Content-Type: application/json\r\n\r\n'
+                  b'{"id": "a", "raw": "SGk"}\r\n'
+                  b'--batch_abc--\r\n')
+
+
+def make_message(uid: int, days_ago: int, labels: list[str] | None = None) -> FakeMessage:
+    date = datetime.now(timezone.utc) - timedelta(days=days_ago)
+    return FakeMessage(
+        uid, f'Date: {date.strftime("%a, %d %b %Y %H:%M:%S %z")}\r\n'
+        f'Subject: {uid}\r\n\r\nBody {uid}\r\n'.encode(), date, labels)
+
+
+def test_message_number_round_trip() -> None:
+    assert message_number('1633ab4e9c8d7f01') == '1599810646768975617'
+    assert message_id('1599810646768975617') == '1633ab4e9c8d7f01'
+
+
+def test_decode_raw() -> None:
+    raw = urlsafe_b64encode(b'Subject: ?\r\n\r\n\xff\xfe').decode()
+    assert decode_raw({'raw': raw.rstrip('=')}) == b'Subject: ?\r\n\r\n\xff\xfe'
+    assert decode_raw({'id': 'a'}) is None
+
+
+def test_encode_batch() -> None:
+    assert encode_batch(
+        ['/a?format=raw', '/b'],
+        'xyz') == (b'--xyz\r\nContent-Type: application/http\r\nContent-ID: <0>\r\n\r\n'
+                   b'GET /a?format=raw\r\n\r\n'
+                   b'--xyz\r\nContent-Type: application/http\r\nContent-ID: <1>\r\n\r\n'
+                   b'GET /b\r\n\r\n'
+                   b'--xyz--\r\n')
+
+
+def test_parse_batch_response() -> None:
+    assert parse_batch_response('multipart/mixed; boundary=batch_abc', BATCH_RESPONSE) == {
+        '0': (200, {
+            'id': 'a',
+            'raw': 'SGk'
+        }),
+        '1': (404, {
+            'error': {
+                'code': 404
+            }
+        })
+    }
+    assert parse_batch_response('multipart/mixed; boundary="batch_abc"',
+                                BATCH_RESPONSE.replace(b'\r\n', b'\n'))['0'][0] == 200
+
+
+def test_parse_batch_response_no_boundary() -> None:
+    with pytest.raises(ValueError, match='No boundary'):
+        parse_batch_response('multipart/mixed', BATCH_RESPONSE)
+
+
+async def test_client_list_messages_pages(mocker: MockerFixture) -> None:
+    mocker.patch('gmail_archiver.gmail_api._LIST_PAGE_SIZE', 2)
+    messages = [make_message(i, 100 - i) for i in range(1, 6)]
+    async with FakeGmailApi(messages) as api, niquests.AsyncSession() as session:
+        client = GmailApiClient(session, 'token', base_url=api.url)
+        before = datetime.now(timezone.utc).date() - timedelta(days=95)
+        ids = await client.list_messages(f'before:{before:%Y/%m/%d}')
+    assert ids == [f'{x.msgid:x}' for x in reversed(messages[:4])]
+    assert api.requests['messages.list'] == 2
+
+
+async def test_client_labels() -> None:
+    async with FakeGmailApi([make_message(1, 100, ['\\Inbox', 'Work'])]) as api, \
+            niquests.AsyncSession() as session:
+        labels = await GmailApiClient(session, 'token', base_url=api.url).labels()
+    assert labels['INBOX'] == '\\Inbox'
+    assert labels['Label_0'] == 'Work'
+    assert 'UNREAD' not in labels
+    assert 'CATEGORY_PERSONAL' not in labels
+
+
+async def test_client_get_raw_retries_rate_limited() -> None:
+    messages = [make_message(i, 100) for i in range(1, 4)]
+    stats = RunStats()
+    async with FakeGmailApi(messages, rate_limited=2, missing={3}) as api, \
+            niquests.AsyncSession() as session:
+        client = GmailApiClient(session, 'token', base_url=api.url, retry_delay=0, stats=stats)
+        results = await client.get_raw([f'{x.msgid:x}' for x in messages])
+    assert api.requests['batch'] == 2
+    assert stats.retries == 1
+    first = GmailApiClient.message(results[f'{messages[0].msgid:x}'])
+    assert first is not None
+    assert decode_raw(first) == messages[0].body
+    assert results[f'{messages[2].msgid:x}'][0] == 404
+    assert GmailApiClient.message(results[f'{messages[2].msgid:x}']) is None
+
+
+async def test_client_raises_for_status() -> None:
+    async with FakeGmailApi([]) as api, niquests.AsyncSession() as session:
+        client = GmailApiClient(session, 'bad', base_url=api.url)
+        with pytest.raises(niquests.HTTPError):
+            await client.labels()
+
+
+async def test_archive_emails_api(tmp_path: Path) -> None:
+    messages = [make_message(1, 200, ['\\Inbox', 'Work']), make_message(2, 150), make_message(3, 1)]
+    stats = RunStats()
+    async with FakeGmailApi(list(messages)) as api:
+        ret = await archive_emails_api('a@example.com',
+                                       'token',
+                                       AsyncPath(tmp_path),
+                                       90,
+                                       base_url=api.url,
+                                       batch_size=1,
+                                       delete=True,
+                                       stats=stats)
+    assert ret == 0
+    assert {x.uid for x in api.trash} == {1, 2}
+    assert [x.uid for x in api.messages] == [3]
+    assert api.requests['messages.batchModify'] == 1
+    assert stats.messages == 2
+    files = sorted(tmp_path.rglob('*.eml'))
+    assert [x.name
+            for x in files] == [f'{messages[0].msgid:010d}.eml', f'{messages[1].msgid:010d}.eml']
+    assert files[0].read_bytes() == messages[0].body + b'\n'
+    labels_file = files[0].with_name(f'{messages[0].msgid:010d}.labels.json')
+    assert json.loads(labels_file.read_text()) == ['\\Inbox', 'Work']
+    assert not files[1].with_name(f'{messages[1].msgid:010d}.labels.json').exists()
+
+
+async def test_archive_emails_api_skips_indexed_messages(tmp_path: Path) -> None:
+    messages = [make_message(i, 200 - i) for i in range(1, 4)]
+    index_path = AsyncPath(tmp_path / 'a@example.com' / INDEX_FILE)
+    async with FakeGmailApi(messages[:2]) as api:
+        index = MessageIndex(index_path)
+        assert await archive_emails_api('a@example.com',
+                                        'token',
+                                        AsyncPath(tmp_path),
+                                        base_url=api.url,
+                                        index=index) == 0
+    assert [x.name for x in index.thread(str(messages[0].thrid))] == [f'{messages[0].msgid}.eml']
+    async with FakeGmailApi(messages) as api:
+        assert await archive_emails_api('a@example.com',
+                                        'token',
+                                        AsyncPath(tmp_path),
+                                        base_url=api.url,
+                                        delete=True,
+                                        index=MessageIndex(index_path)) == 0
+    assert api.requests['messages.get'] == 1
+    assert {x.uid for x in api.trash} == {1, 2, 3}
+    assert len(list(tmp_path.rglob('*.eml'))) == 3
+
+
+async def test_archive_emails_api_query(tmp_path: Path) -> None:
+    messages = [make_message(1, 200, ['Promotions']), make_message(2, 150), make_message(3, 1)]
+    async with FakeGmailApi(messages) as api:
+        assert await archive_emails_api('a@example.com',
+                                        'token',
+                                        AsyncPath(tmp_path),
+                                        base_url=api.url,
+                                        query='-label:Promotions') == 0
+    assert [x.name for x in tmp_path.rglob('*.eml')] == [f'{messages[1].msgid}.eml']
+
+
+async def test_archive_emails_api_many(tmp_path: Path) -> None:
+    messages = generate_mailbox(250, mean_size=2000)
+    async with FakeGmailApi(messages) as api:
+        assert await archive_emails_api('a@example.com',
+                                        'token',
+                                        AsyncPath(tmp_path),
+                                        base_url=api.url,
+                                        concurrency=2) == 0
+    assert api.requests['batch'] == 3
+    assert len(list(tmp_path.rglob('*.eml'))) == 250
+
+
+async def test_archive_emails_api_nothing(tmp_path: Path) -> None:
+    async with FakeGmailApi([make_message(1, 1)]) as api:
+        assert await archive_emails_api('a@example.com',
+                                        'token',
+                                        AsyncPath(tmp_path),
+                                        base_url=api.url,
+                                        delete=True) == 0
+    assert not api.requests['batch']
+
+
+async def test_archive_emails_api_stops_at_failure(tmp_path: Path) -> None:
+    messages = [make_message(i, 200 - i) for i in range(1, 4)]
+    errors = ErrorManifest(AsyncPath(tmp_path / 'errors.json'), 'a@example.com')
+    async with FakeGmailApi(messages, missing={2}) as api:
+        assert await archive_emails_api('a@example.com',
+                                        'token',
+                                        AsyncPath(tmp_path / 'out'),
+                                        base_url=api.url,
+                                        delete=True,
+                                        errors=errors) == 1
+    assert [x.uid for x in api.trash] == [1]
+    assert errors.failures[0]['reason'] == 'fetch failed'
+    assert errors.failures[0]['uid'] == f'{messages[1].msgid:x}'
+
+
+async def test_archive_emails_api_keep_going_and_retry(tmp_path: Path) -> None:
+    messages = [make_message(i, 200 - i) for i in range(1, 4)]
+    errors_file = AsyncPath(tmp_path / 'errors.json')
+    async with FakeGmailApi(messages, missing={2}) as api:
+        assert await archive_emails_api('a@example.com',
+                                        'token',
+                                        AsyncPath(tmp_path / 'out'),
+                                        base_url=api.url,
+                                        delete=True,
+                                        errors=ErrorManifest(errors_file, 'a@example.com'),
+                                        keep_going=True) == 1
+        assert {x.uid for x in api.trash} == {1, 3}
+        manifest = json.loads(await errors_file.read_text())
+        assert manifest['a@example.com']['uidvalidity'] == API_UIDVALIDITY
+        api.missing = ()
+        assert await archive_emails_api('a@example.com',
+                                        'token',
+                                        AsyncPath(tmp_path / 'out'),
+                                        base_url=api.url,
+                                        delete=True,
+                                        errors=ErrorManifest(errors_file, 'a@example.com'),
+                                        retry_failed=True) == 0
+    assert {x.uid for x in api.trash} == {1, 2, 3}
+    assert api.requests['messages.list'] == 1
+    assert json.loads(await errors_file.read_text()) == {}
+
+
+async def test_archive_emails_api_quota(tmp_path: Path) -> None:
+    messages = [make_message(i, 200 - i) for i in range(1, 4)]
+    quota = DailyQuota(AsyncPath(tmp_path / 'quota.json'), 'a@example.com', 100)
+    async with FakeGmailApi(messages) as api:
+        assert await archive_emails_api('a@example.com',
+                                        'token',
+                                        AsyncPath(tmp_path / 'out'),
+                                        base_url=api.url,
+                                        batch_size=1,
+                                        concurrency=1,
+                                        quota=quota) == 0
+    assert api.requests['messages.get'] == 1
+    assert await quota.resume_uids(ALL_MAIL,
+                                   API_UIDVALIDITY) == [str(x.msgid) for x in messages[:1]]
+    assert quota.used <= quota.limit
+
+
+async def test_archive_emails_api_quota_concurrent(tmp_path: Path) -> None:
+    messages = [make_message(i, 200 - i) for i in range(1, 11)]
+    size = len(messages[0].body)
+    quota = DailyQuota(AsyncPath(tmp_path / 'quota.json'), 'a@example.com', size * 6 + size // 2)
+    async with FakeGmailApi(messages) as api:
+        assert await archive_emails_api('a@example.com',
+                                        'token',
+                                        AsyncPath(tmp_path / 'out'),
+                                        base_url=api.url,
+                                        batch_size=2,
+                                        concurrency=4,
+                                        quota=quota) == 0
+    assert quota.used == size * 6
+    assert await quota.resume_uids(ALL_MAIL,
+                                   API_UIDVALIDITY) == [str(x.msgid) for x in messages[:6]]
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+import asyncio
+import json
+
+from anyio import Path as AsyncPath
+from gmail_archiver.history import (
+    MAX_HISTORY_ENTRIES,
+    average_throughput,
+    load_history,
+    record_run,
+)
+from gmail_archiver.stats import RunStats
+import pytest
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from pytest_mock import MockerFixture
+
+
+async def test_load_history_missing(tmp_path: Path) -> None:
+    assert await load_history(AsyncPath(tmp_path / 'history.json')) == {}
+
+
+async def test_load_history_invalid(tmp_path: Path) -> None:
+    path = tmp_path / 'history.json'
+    path.write_text('{{{')
+    assert await load_history(AsyncPath(path)) == {}
+    path.write_text('[]')
+    assert await load_history(AsyncPath(path)) == {}
+
+
+async def test_record_run_keeps_recent_entries(tmp_path: Path) -> None:
+    path = AsyncPath(tmp_path / 'history.json')
+    stats = RunStats()
+    stats.add_message(100)
+    stats.finish()
+    for _ in range(MAX_HISTORY_ENTRIES + 2):
+        await record_run(path, 'user@example.com', stats)
+    data = json.loads(await path.read_text())
+    assert len(data['user@example.com']) == MAX_HISTORY_ENTRIES
+    assert data['user@example.com'][0]['bytes'] == 100
+    assert data['user@example.com'][0]['messages'] == 1
+
+
+async def test_record_run_concurrent(tmp_path: Path) -> None:
+    path = AsyncPath(tmp_path / 'history.json')
+    stats = RunStats()
+    stats.finish()
+    emails = [f'user{x}@example.com' for x in range(5)]
+    await asyncio.gather(*(record_run(path, email, stats) for email in emails))
+    assert sorted(json.loads(await path.read_text())) == emails
+    assert not (tmp_path / '.history.json.tmp').exists()
+
+
+async def test_record_run_replaces_file(tmp_path: Path, mocker: MockerFixture) -> None:
+    path = tmp_path / 'history.json'
+    path.write_text('{}')
+    stats = RunStats()
+    stats.finish()
+    mocker.patch.object(AsyncPath, 'replace', side_effect=OSError)
+    with pytest.raises(OSError):  # noqa: PT011
+        await record_run(AsyncPath(path), 'user@example.com', stats)
+    assert path.read_text() == '{}'
+
+
+def test_average_throughput() -> None:
+    assert average_throughput([]) is None
+    assert average_throughput([{
+        'bytes': 100,
+        'finished': '',
+        'messages': 1,
+        'seconds': 1.0
+    }, {
+        'bytes': 300,
+        'finished': '',
+        'messages': 1,
+        'seconds': 3.0
+    }, {
+        'bytes': 0,
+        'finished': '',
+        'messages': 0,
+        'seconds': 5.0
+    }]) == pytest.approx(100.0)
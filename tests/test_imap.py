@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+from gmail_archiver.imap import (
+    parse_exists,
+    parse_fetch_response,
+    parse_highestmodseq,
+    parse_labels,
+    parse_msgid,
+    parse_thrid,
+    parse_uids,
+    parse_uidvalidity,
+)
+
+
+def test_parse_labels() -> None:
+    assert parse_labels(b'1 FETCH (X-GM-LABELS (\\Inbox "A \\"b\\" (c)" Work) UID 5)') == [
+        '\\Inbox', 'A "b" (c)', 'Work'
+    ]
+
+
+def test_parse_labels_empty() -> None:
+    assert parse_labels(b'1 FETCH (X-GM-LABELS ())') == []
+
+
+def test_parse_labels_missing() -> None:
+    assert parse_labels(b'1 FETCH (UID 5)') is None
+
+
+def test_parse_fetch_response() -> None:
+    records = parse_fetch_response([
+        b'1 FETCH (RFC822 {5}',
+        bytearray(b'Hello'),
+        b' X-GM-LABELS (\\Sent))',
+        b'2 FETCH (X-GM-LABELS () RFC822 {3}',
+        bytearray(b'Bye'),
+        bytearray(b'ignored'),
+        b')',
+        'ignored',
+        b'Success',
+    ])
+    assert records == {
+        '1': {
+            'data': b'1 FETCH (RFC822 {5}  X-GM-LABELS (\\Sent))',
+            'number': '1',
+            'raw': b'Hello'
+        },
+        '2': {
+            'data': b'2 FETCH (X-GM-LABELS () RFC822 {3} ) Success',
+            'number': '2',
+            'raw': b'Bye'
+        }
+    }
+    assert parse_labels(records['1']['data']) == ['\\Sent']
+
+
+def test_parse_fetch_response_literal_without_header() -> None:
+    assert parse_fetch_response([bytearray(b'Hello'), b'Success']) == {}
+
+
+def test_parse_uids() -> None:
+    assert parse_uids([
+        b'1 FETCH (UID 7)',
+        b'3 FETCH (FLAGS (\\Seen) UID 9)',
+        b'4 FETCH (FLAGS ())',
+        b'Success',
+    ]) == {
+        '1': '7',
+        '3': '9'
+    }
+
+
+def test_parse_uidvalidity() -> None:
+    assert parse_uidvalidity([b'FLAGS (\\Seen)', b'[UIDVALIDITY 12] UIDs valid.', b'OK']) == '12'
+    assert parse_uidvalidity(['[UIDVALIDITY 12]', b'OK']) is None
+
+
+def test_parse_exists() -> None:
+    assert parse_exists([b'FLAGS (\\Seen)', b'172 EXISTS', b'1 RECENT']) == 172
+    assert parse_exists([b'OK [UIDVALIDITY 12] UIDs valid.']) is None
+
+
+def test_parse_highestmodseq() -> None:
+    assert parse_highestmodseq([b'[UIDVALIDITY 12] UIDs valid.', b'OK [HIGHESTMODSEQ 4567]',
+                                b'OK']) == '4567'
+    assert parse_highestmodseq([b'[NOMODSEQ] Sorry, modsequences are not supported']) is None
+
+
+def test_parse_msgid() -> None:
+    assert parse_msgid(b'1 FETCH (X-GM-MSGID 1278455344230334865 X-GM-LABELS ())') == (
+        '1278455344230334865')
+    assert parse_msgid(b'1 FETCH (UID 4 X-GM-MSGID 12)') == '12'
+    assert parse_msgid(b'1 FETCH (X-GM-THRID 12)') is None
+
+
+def test_parse_thrid() -> None:
+    assert parse_thrid(b'1 FETCH (X-GM-MSGID 13 X-GM-THRID 12 X-GM-LABELS ())') == '12'
+    assert parse_thrid(b'1 FETCH (X-GM-MSGID 12)') is None
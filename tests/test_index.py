@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+import json
+
+from anyio import Path as AsyncPath
+from gmail_archiver.index import INDEX_FILE, MessageIndex
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+async def test_message_index_round_trip(tmp_path: Path) -> None:
+    path = AsyncPath(tmp_path / 'a@example.com' / INDEX_FILE)
+    index = MessageIndex(path)
+    index.add('123', path.parent / '2024' / '01' / '0000000001.eml',
+              path.parent / '2024' / '01' / '0000000001.labels.json')
+    index.set_modseq('7', '99')
+    await index.save()
+    loaded = MessageIndex(path)
+    await loaded.load()
+    assert loaded.messages == {
+        '123': {
+            'labels': '2024/01/0000000001.labels.json',
+            'message': '2024/01/0000000001.eml'
+        }
+    }
+    assert loaded.labels_file('123') == path.parent / '2024' / '01' / '0000000001.labels.json'
+    assert loaded.labels_file('456') is None
+    assert not loaded.is_member('123')
+    assert loaded.changed_since('7') == '99'
+    assert loaded.changed_since('8') is None
+
+
+async def test_message_index_save_unchanged(tmp_path: Path) -> None:
+    path = AsyncPath(tmp_path / INDEX_FILE)
+    await MessageIndex(path).save()
+    assert not await path.exists()
+
+
+async def test_message_index_save_without_modseq(tmp_path: Path) -> None:
+    path = AsyncPath(tmp_path / INDEX_FILE)
+    index = MessageIndex(path)
+    index.add('1', path.parent / 'a.eml', path.parent / 'a.labels.json')
+    await index.save()
+    assert json.loads(await path.read_text()) == {
+        'messages': {
+            '1': {
+                'labels': 'a.labels.json',
+                'message': 'a.eml'
+            }
+        }
+    }
+    assert index.changed_since(None) is None
+
+
+async def test_message_index_load_invalid(tmp_path: Path) -> None:
+    path = AsyncPath(tmp_path / INDEX_FILE)
+    index = MessageIndex(path)
+    await index.load()
+    assert index.messages == {}
+    await path.write_text('{')
+    await index.load()
+    assert index.messages == {}
+    await path.write_text('[]')
+    await index.load()
+    assert index.messages == {}
+
+
+async def test_message_index_claim_and_load_keeps_entries(tmp_path: Path) -> None:
+    path = AsyncPath(tmp_path / INDEX_FILE)
+    await path.write_text(json.dumps({'messages': {'1': {'labels': 'a', 'message': 'b'}}}))
+    index = MessageIndex(path)
+    index.add('2', path.parent / 'c.eml', path.parent / 'c.labels.json')
+    await index.load()
+    assert set(index.messages) == {'1', '2'}
+    assert index.claim('3')
+    assert not index.claim('3')
+
+
+async def test_message_index_threads(tmp_path: Path) -> None:
+    path = AsyncPath(tmp_path / INDEX_FILE)
+    index = MessageIndex(path)
+    index.add('1', path.parent / '1.eml', path.parent / '1.labels.json', '1')
+    index.add('2', path.parent / '2.eml', path.parent / '2.labels.json', '1')
+    index.add('3', path.parent / '3.eml', path.parent / '3.labels.json')
+    await index.save()
+    loaded = MessageIndex(path)
+    await loaded.load()
+    assert loaded.messages['1']['thread'] == '1'
+    assert 'thread' not in loaded.messages['3']
+    assert loaded.thread('1') == [path.parent / '1.eml', path.parent / '2.eml']
+    assert loaded.thread('3') == []
+    assert loaded.archived('3')
+    assert not loaded.archived('4')
+    assert loaded.message_file('3') == path.parent / '3.eml'
+    assert loaded.message_file('4') is None
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING
+import json
+import subprocess as sp
+import sys
+import types
+
+from gmail_archiver.lazy import lazy_import
+import pytest
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from pytest_mock import MockerFixture
+
+LAZY_MODULES = ('aioimaplib', 'http.server', 'niquests', 'tomlkit')
+"""Modules that must not be loaded by importing :py:mod:`gmail_archiver.main`."""
+
+
+def test_lazy_import_defers_execution(mocker: MockerFixture) -> None:
+    mocker.patch.dict(sys.modules)
+    sys.modules.pop('colorsys', None)
+    module = lazy_import('colorsys')
+    assert sys.modules['colorsys'] is module
+    assert type(module) is not types.ModuleType
+    assert module.rgb_to_hsv(1, 0, 0) == (0, 1, 1)
+    assert type(module) is types.ModuleType
+
+
+def test_lazy_import_sets_parent_attribute(mocker: MockerFixture) -> None:
+    mocker.patch.dict(sys.modules)
+    sys.modules.pop('email.quoprimime', None)
+    import email
+    mocker.patch.object(email, 'quoprimime', None, create=True)
+    module = lazy_import('email.quoprimime')
+    assert vars(email)['quoprimime'] is module
+
+
+def test_lazy_import_returns_loaded_module() -> None:
+    assert lazy_import('sys') is sys
+
+
+def test_lazy_import_missing() -> None:
+    with pytest.raises(ModuleNotFoundError):
+        lazy_import('gmail_archiver_missing_module')
+
+
+def _loaded_modules(code: str, *args: str, modules: tuple[str, ...] = LAZY_MODULES) -> list[str]:
+    # Returns the modules (and their submodules) that were executed after running ``code`` in a
+    # new interpreter. Lazily imported modules that were never used do not count.
+    process = sp.run(
+        (sys.executable, '-c', (f'{code}\n'
+                                'import sys, types\n'
+                                'print(*sorted(k for k, v in sys.modules.items()\n'
+                                '              if type(v) is types.ModuleType and any(\n'
+                                '                  k == x or k.startswith(f"{x}.")\n'
+                                f'                  for x in {modules!r})))'), *args),
+        check=True,
+        capture_output=True,
+        text=True)
+    return process.stdout.split()
+
+
+def test_import_defers_heavy_modules() -> None:
+    assert not _loaded_modules('import gmail_archiver.main')
+
+
+def test_valid_token_does_not_load_niquests(tmp_path: Path) -> None:
+    oauth_file = tmp_path / 'oauth.json'
+    oauth_file.write_text(
+        json.dumps({
+            'user@example.com': {
+                'access_token': 'access_token_value',
+                'expiration_time': (datetime.now(timezone.utc) + timedelta(hours=1)).isoformat(),
+                'refresh_token': 'refresh_token_value'
+            }
+        }))
+    assert not _loaded_modules(
+        'import asyncio, sys\n'
+        'from anyio import Path\n'
+        'from gmail_archiver.main import _ensure_token\n'
+        'from gmail_archiver.tokens import TokenStore\n'
+        'path = Path(sys.argv[1])\n'
+        "config = {'client_id': 'id', 'client_secret': 'secret'}\n"
+        "asyncio.run(_ensure_token('user@example.com', config, TokenStore(path),\n"
+        "                          path.with_name('discovery.json'), force_refresh=False))",
+        str(oauth_file),
+        modules=('niquests',))
@@ -4,9 +4,14 @@ from datetime import datetime, timedelta, timezone
 from types import MappingProxyType
 from typing import TYPE_CHECKING, Any
 from unittest.mock import AsyncMock, MagicMock
+import asyncio
 import json
 
+from anyio import Path as AsyncPath
+from gmail_archiver.failures import ErrorManifest
+from gmail_archiver.index import INDEX_FILE, MessageIndex
 from gmail_archiver.main import main
+from gmail_archiver.writers import MboxWriter, S3Writer, TarWriter
 from typing_extensions import Self
 import pytest
 
@@ -144,7 +149,7 @@ def test_main_auth_json_loads_return_invalid_type(mocker: MockerFixture,
             assert callback is not None
             callback('auth_code')
 
-    mocker.patch('gmail_archiver.main.http.server.HTTPServer', new=MockHTTPServer)
+    mocker.patch('gmail_archiver.main.http_server.HTTPServer', new=MockHTTPServer)
     imap_ssl = mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL')
     result = runner.invoke(main, [email, str(tmp_path), '--auth-only'])
     assert result.exit_code == 1
@@ -205,7 +210,7 @@ def test_main_new_token_authorization(mocker: MockerFixture, patch_platformdirs:
             callback('auth_code')
             callback_called = True
 
-    mocker.patch('gmail_archiver.main.http.server.HTTPServer', new=MockHTTPServer)
+    mocker.patch('gmail_archiver.main.http_server.HTTPServer', new=MockHTTPServer)
     imap_ssl = mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL')
     result = runner.invoke(main, [email, str(tmp_path), '--auth-only'])
     assert result.exit_code == 0
@@ -274,7 +279,7 @@ def test_main_new_token_authorization_invalid_db(mocker: MockerFixture,
             callback('auth_code')
             callback_called = True
 
-    mocker.patch('gmail_archiver.main.http.server.HTTPServer', new=MockHTTPServer)
+    mocker.patch('gmail_archiver.main.http_server.HTTPServer', new=MockHTTPServer)
     imap_ssl = mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL')
     result = runner.invoke(main, [email, str(tmp_path), '--auth-only'])
     assert result.exit_code == 0
@@ -338,7 +343,7 @@ def test_main_new_token_authorization_no_code_returned(mocker: MockerFixture,
         def handle_request(self) -> None:
             pass
 
-    mocker.patch('gmail_archiver.main.http.server.HTTPServer', new=MockHTTPServer)
+    mocker.patch('gmail_archiver.main.http_server.HTTPServer', new=MockHTTPServer)
     imap_ssl = mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL')
     result = runner.invoke(main, [email, str(tmp_path), '--auth-only'])
     assert result.exit_code == 1
@@ -406,7 +411,7 @@ def test_main_new_auth_aborts_non_mutable_oauth_db(mocker: MockerFixture,
             assert callback is not None
             callback('auth_code')
 
-    mocker.patch('gmail_archiver.main.http.server.HTTPServer', new=MockHTTPServer)
+    mocker.patch('gmail_archiver.main.http_server.HTTPServer', new=MockHTTPServer)
     mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL')
     result = runner.invoke(main, [email, str(tmp_path), '--auth-only'])
     assert result.exit_code == 1
@@ -469,7 +474,7 @@ def test_main_new_auth_aborts_missing_refresh_in_token_response(mocker: MockerFi
             assert callback is not None
             callback('auth_code')
 
-    mocker.patch('gmail_archiver.main.http.server.HTTPServer', new=MockHTTPServer)
+    mocker.patch('gmail_archiver.main.http_server.HTTPServer', new=MockHTTPServer)
     mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL')
     result = runner.invoke(main, [email, str(tmp_path), '--auth-only'])
     assert result.exit_code == 1
@@ -645,3 +650,888 @@ def test_main_invalid_oauth_json_and_empty_config(mocker: MockerFixture, tmp_pat
     result = runner.invoke(main, [email, str(tmp_path)])
     assert result.exit_code != 0
     assert 'client_id and client_secret must be set' in result.output
+
+
+def test_main_process_plan_options(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                                   tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test6@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+    process_mock = mocker.patch('gmail_archiver.main.archive_emails',
+                                new_callable=AsyncMock,
+                                return_value=0)
+    result = runner.invoke(
+        main,
+        [email,
+         str(tmp_path), '--plan', '--order', 'oldest-first', '--large-message-size', '100'])
+    assert result.exit_code == 0
+    call_kwargs = process_mock.call_args[1]
+    assert call_kwargs['plan'] is True
+    assert call_kwargs['order'] == 'oldest-first'
+    assert call_kwargs['large_message_size'] == 100
+    assert call_kwargs['adaptive'] is True
+    assert call_kwargs['compress'] is True
+
+
+def test_main_process_disable_batching_and_compression(mocker: MockerFixture,
+                                                       patch_platformdirs: tuple[Path, Path],
+                                                       tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test6@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+    process_mock = mocker.patch('gmail_archiver.main.archive_emails',
+                                new_callable=AsyncMock,
+                                return_value=0)
+    result = runner.invoke(main, [email, str(tmp_path), '--no-adaptive-batching', '--no-compress'])
+    assert result.exit_code == 0
+    assert process_mock.call_args[1]['adaptive'] is False
+    assert process_mock.call_args[1]['compress'] is False
+
+
+def test_main_dry_run(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path], tmp_path: Path,
+                      runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test7@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    (tmp_path / 'history.json').write_text(
+        json.dumps({email: [{
+            'bytes': 1024,
+            'finished': '',
+            'messages': 1,
+            'seconds': 1.0
+        }]}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+    process_mock = mocker.patch('gmail_archiver.main.archive_emails', new_callable=AsyncMock)
+    mocker.patch('gmail_archiver.main.estimate_archive',
+                 new_callable=AsyncMock,
+                 return_value={
+                     'by_year': {
+                         2020: {
+                             'bytes': 2048,
+                             'count': 2
+                         },
+                         None: {
+                             'bytes': 1024,
+                             'count': 1
+                         }
+                     },
+                     'count': 3,
+                     'total_bytes': 3072
+                 })
+    result = runner.invoke(main, [email, str(tmp_path), '--dry-run'])
+    assert result.exit_code == 0
+    process_mock.assert_not_called()
+    assert 'Messages: 3' in result.output
+    assert 'Total size: 3.0 KiB' in result.output
+    assert '2020: 2 messages, 2.0 KiB' in result.output
+    assert 'unknown: 1 messages, 1.0 KiB' in result.output
+    assert 'Estimated time: 0:00:03' in result.output
+
+
+def test_main_dry_run_no_history(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                                 tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test8@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+    mocker.patch('gmail_archiver.main.estimate_archive',
+                 new_callable=AsyncMock,
+                 return_value={
+                     'by_year': {},
+                     'count': 0,
+                     'total_bytes': 0
+                 })
+    result = runner.invoke(main, [email, str(tmp_path), '--estimate'])
+    assert result.exit_code == 0
+    assert 'Estimated time: unknown' in result.output
+
+
+def test_main_estimate_fails(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                             tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test30@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+    mocker.patch('gmail_archiver.main.estimate_archive', new_callable=AsyncMock, return_value=None)
+    result = runner.invoke(main, [email, str(tmp_path), '--estimate'])
+    assert result.exit_code == 1
+    assert 'Messages:' not in result.output
+
+
+def test_main_records_history(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                              tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test9@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+
+    async def archive(*args: Any, **kwargs: Any) -> int:
+        kwargs['stats'].add_message(500)
+        return 0
+
+    mocker.patch('gmail_archiver.main.archive_emails', new=archive)
+    result = runner.invoke(main, [email, str(tmp_path)])
+    assert result.exit_code == 0
+    history = json.loads((tmp_path / 'history.json').read_text())
+    assert history[email][0]['bytes'] == 500
+    assert history[email][0]['messages'] == 1
+
+
+def test_main_quota_options(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                            tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test10@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+    process_mock = mocker.patch('gmail_archiver.main.archive_emails',
+                                new_callable=AsyncMock,
+                                return_value=0)
+    result = runner.invoke(main, [email, str(tmp_path)])
+    assert result.exit_code == 0
+    call_kwargs = process_mock.call_args[1]
+    assert call_kwargs['quota'].email == email
+    assert call_kwargs['quota'].limit == 2_400_000_000
+    assert call_kwargs['rate_limiter'] is None
+    result = runner.invoke(main, [email, str(tmp_path), '--daily-limit', '0', '--max-rate', '1000'])
+    assert result.exit_code == 0
+    call_kwargs = process_mock.call_args[1]
+    assert call_kwargs['quota'] is None
+    assert call_kwargs['rate_limiter'].rate == 1000
+
+
+def test_main_writes_stats_file(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                                tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test11@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+
+    async def archive(*args: Any, **kwargs: Any) -> int:
+        kwargs['stats'].add_message(500)
+        kwargs['stats'].add_timing('fetch', 0.5, 500)
+        return 0
+
+    mocker.patch('gmail_archiver.main.archive_emails', new=archive)
+    stats_file = tmp_path / 'stats.json'
+    result = runner.invoke(main, [email, str(tmp_path / 'out'), '--stats-file', str(stats_file)])
+    assert result.exit_code == 0
+    report = json.loads(stats_file.read_text())
+    assert report['messages'] == 1
+    assert report['phases']['fetch']['bytes'] == 500
+    assert report['phases']['fetch']['p99'] == pytest.approx(0.5)
+
+
+def test_main_writes_metrics_file(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                                  tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test12@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+
+    async def archive(*args: Any, **kwargs: Any) -> int:
+        kwargs['stats'].add_message(500)
+        return 0
+
+    mocker.patch('gmail_archiver.main.archive_emails', new=archive)
+    metrics_file = tmp_path / 'gmail.prom'
+    result = runner.invoke(
+        main, [email, str(tmp_path / 'out'), '--metrics-file',
+               str(metrics_file)])
+    assert result.exit_code == 0
+    text = metrics_file.read_text()
+    assert f'gmail_archiver_messages_archived_total{{account="{email}"}} 1' in text
+    assert f'gmail_archiver_token_expiry_timestamp_seconds{{account="{email}"}}' in text
+
+
+def test_main_profiling(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                        tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test13@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+    mocker.patch('gmail_archiver.main.archive_emails', new_callable=AsyncMock, return_value=1)
+    cpu_file = tmp_path / 'cpu.pstats'
+    memory_file = tmp_path / 'memory.txt'
+    result = runner.invoke(main, [
+        email,
+        str(tmp_path / 'out'), '--profile-cpu',
+        str(cpu_file), '--profile-memory',
+        str(memory_file)
+    ])
+    assert result.exit_code == 1
+    assert cpu_file.exists()
+    assert 'Peak RSS: ' in memory_file.read_text()
+
+
+def test_main_trace_file(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                         tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test14@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+    tracer = mocker.patch('gmail_archiver.main.Tracer')
+    mocker.patch('gmail_archiver.main.archive_emails', new_callable=AsyncMock, return_value=0)
+    trace_file = tmp_path / 'trace.jsonl'
+    result = runner.invoke(main, [
+        email,
+        str(tmp_path / 'out'), '--trace-file',
+        str(trace_file), '--trace-sample-rate', '0.5'
+    ])
+    assert result.exit_code == 0
+    tracer.assert_called_once_with(trace_file, 0.5)
+    tracer.return_value.__enter__.assert_called_once()
+
+
+def test_main_refresh_uses_discovery_cache_and_session(mocker: MockerFixture,
+                                                       patch_platformdirs: tuple[Path, Path],
+                                                       tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test15@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+    mocker.patch('gmail_archiver.main.archive_emails', new_callable=AsyncMock, return_value=0)
+    session = mocker.patch('gmail_archiver.main.oauth_session').return_value.__aenter__.return_value
+    client = mocker.patch('gmail_archiver.main.GoogleOAuthClient')
+    client.return_value.discover = AsyncMock()
+    refresh = mocker.patch('gmail_archiver.main.refresh_token',
+                           new_callable=AsyncMock,
+                           return_value={
+                               'access_token': 'new',
+                               'expires_in': 3600
+                           })
+    result = runner.invoke(main, [email, str(tmp_path / 'out'), '--force-refresh'])
+    assert result.exit_code == 0
+    client.assert_called_once_with('test_client_id',
+                                   'test_client_secret',
+                                   cache_file=AsyncPath(tmp_path / 'discovery.json'),
+                                   session=session)
+    assert refresh.call_args.kwargs['session'] is session
+
+
+def test_main_connects_while_refreshing_token(mocker: MockerFixture,
+                                              patch_platformdirs: tuple[Path, Path], tmp_path: Path,
+                                              runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test16@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data(expired=True)}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    imap_conn = AsyncMock()
+    imap_ssl = mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=imap_conn)
+    archive = mocker.patch('gmail_archiver.main.archive_emails',
+                           new_callable=AsyncMock,
+                           return_value=0)
+    mocker.patch('gmail_archiver.main.GoogleOAuthClient').return_value.discover = AsyncMock()
+
+    async def refresh(*args: Any, **kwargs: Any) -> dict[str, Any]:
+        await asyncio.sleep(0)
+        assert imap_ssl.called
+        return {'access_token': 'new_token', 'expires_in': 3600}
+
+    mocker.patch('gmail_archiver.main.refresh_token', new=refresh)
+    result = runner.invoke(main, [email, str(tmp_path / 'out')])
+    assert result.exit_code == 0
+    imap_ssl.assert_called_once_with('imap.gmail.com')
+    assert archive.call_args.args[0] is imap_conn
+    assert archive.call_args.args[2] == 'new_token'
+
+
+def test_main_closes_connection_when_refresh_fails(mocker: MockerFixture,
+                                                   patch_platformdirs: tuple[Path, Path],
+                                                   tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test17@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data(expired=True)}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    imap_conn = AsyncMock()
+    imap_conn.protocol = MagicMock()
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=imap_conn)
+    mocker.patch('gmail_archiver.main.GoogleOAuthClient').return_value.discover = AsyncMock()
+
+    async def refresh(*args: Any, **kwargs: Any) -> dict[str, Any]:
+        await asyncio.sleep(0.01)
+        msg = 'invalid_grant'
+        raise ValueError(msg)
+
+    mocker.patch('gmail_archiver.main.refresh_token', new=refresh)
+    result = runner.invoke(main, [email, str(tmp_path / 'out')])
+    assert isinstance(result.exception, ValueError)
+    imap_conn.logout.assert_awaited_once()
+
+
+def test_main_closes_transport_when_refresh_fails_before_greeting(mocker: MockerFixture,
+                                                                  patch_platformdirs: tuple[Path,
+                                                                                            Path],
+                                                                  tmp_path: Path,
+                                                                  runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test29@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data(expired=True)}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    imap_conn = AsyncMock()
+    imap_conn.protocol = MagicMock()
+    imap_conn.protocol.transport.is_closing.return_value = False
+    hello_cancelled = False
+
+    async def wait_hello_from_server() -> None:
+        nonlocal hello_cancelled
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            hello_cancelled = True
+            raise
+
+    imap_conn.wait_hello_from_server = wait_hello_from_server
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=imap_conn)
+    mocker.patch('gmail_archiver.main.GoogleOAuthClient').return_value.discover = AsyncMock()
+
+    async def refresh(*args: Any, **kwargs: Any) -> dict[str, Any]:
+        await asyncio.sleep(0)
+        msg = 'invalid_grant'
+        raise ValueError(msg)
+
+    mocker.patch('gmail_archiver.main.refresh_token', new=refresh)
+    result = runner.invoke(main, [email, str(tmp_path / 'out')])
+    assert isinstance(result.exception, ValueError)
+    assert hello_cancelled
+    imap_conn.logout.assert_not_called()
+    imap_conn.protocol.transport.close.assert_called_once_with()
+
+
+def test_main_refresh_reloads_token_under_lock(mocker: MockerFixture,
+                                               patch_platformdirs: tuple[Path, Path],
+                                               tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test18@example.com'
+    other = {'access_token': 'other', 'refresh_token': 'other_refresh'}
+    oauth_file.write_text(json.dumps({email: make_auth_data(expired=True)}))
+    fresh = make_auth_data()
+    mocker.patch('gmail_archiver.main.TokenStore.load',
+                 side_effect=[{
+                     email: make_auth_data(expired=True)
+                 }, {
+                     email: fresh,
+                     'other@example.com': other
+                 }])
+    refresh_token_mock = mocker.patch('gmail_archiver.main.refresh_token', new_callable=AsyncMock)
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL')
+    result = runner.invoke(main, [email, str(tmp_path), '--auth-only'])
+    assert result.exit_code == 0
+    refresh_token_mock.assert_not_called()
+
+
+def test_main_refresh_keeps_other_accounts(mocker: MockerFixture, patch_platformdirs: tuple[Path,
+                                                                                            Path],
+                                           tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test19@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data(expired=True)}))
+    mock_client = MagicMock()
+    mock_client.token_endpoint = 'https://oauth2.googleapis.com/token'
+    mock_client.discover = AsyncMock()
+    mocker.patch('gmail_archiver.main.GoogleOAuthClient', return_value=mock_client)
+
+    async def refresh(*args: Any, **kwargs: Any) -> dict[str, Any]:
+        # Simulates another process saving a different account during the refresh.
+        data = json.loads(oauth_file.read_text())
+        data['other@example.com'] = make_auth_data()
+        oauth_file.write_text(json.dumps(data))
+        return {'access_token': 'new_access_token', 'expires_in': 3600}
+
+    mocker.patch('gmail_archiver.main.refresh_token', new=refresh)
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL')
+    result = runner.invoke(main, [email, str(tmp_path), '--auth-only'])
+    assert result.exit_code == 0
+    data = json.loads(oauth_file.read_text())
+    assert set(data) == {email, 'other@example.com'}
+    assert data[email]['access_token'] == 'new_access_token'
+    assert data[email]['refresh_token'] == 'refresh_token_value'
+    assert oauth_file.stat().st_mode & 0o777 == 0o600
+
+
+def test_main_process_keep_going_retry_failed(mocker: MockerFixture,
+                                              patch_platformdirs: tuple[Path, Path], tmp_path: Path,
+                                              runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test20@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+    process_mock = mocker.patch('gmail_archiver.main.archive_emails',
+                                new_callable=AsyncMock,
+                                return_value=0)
+    result = runner.invoke(main, [email, str(tmp_path), '--keep-going', '--retry-failed'])
+    assert result.exit_code == 0
+    call_kwargs = process_mock.call_args[1]
+    assert call_kwargs['keep_going'] is True
+    assert call_kwargs['retry_failed'] is True
+    assert isinstance(call_kwargs['errors'], ErrorManifest)
+    assert call_kwargs['errors'].email == email
+    assert call_kwargs['errors'].path.name == 'errors.json'
+
+
+def test_main_process_api_backend(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                                  tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test21@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    imap_mock = mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL')
+    imap_process_mock = mocker.patch('gmail_archiver.main.archive_emails', new_callable=AsyncMock)
+    process_mock = mocker.patch('gmail_archiver.main.archive_emails_api',
+                                new_callable=AsyncMock,
+                                return_value=0)
+    result = runner.invoke(main, [email, str(tmp_path), '--backend', 'api', '--no-delete'])
+    assert result.exit_code == 0
+    imap_mock.assert_not_called()
+    imap_process_mock.assert_not_called()
+    assert process_mock.call_args[0][:2] == (email, 'access_token_value')
+    call_kwargs = process_mock.call_args[1]
+    assert call_kwargs['delete'] is False
+    assert isinstance(call_kwargs['errors'], ErrorManifest)
+
+
+def test_main_process_sync_labels(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                                  tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test22@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mock_imap_conn = AsyncMock()
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=mock_imap_conn)
+    archive_mock = mocker.patch('gmail_archiver.main.archive_emails_api', new_callable=AsyncMock)
+    sync_mock = mocker.patch('gmail_archiver.main.sync_labels',
+                             new_callable=AsyncMock,
+                             return_value=0)
+    result = runner.invoke(main, [email, str(tmp_path), '--backend', 'api', '--sync-labels'])
+    assert result.exit_code == 0
+    archive_mock.assert_not_called()
+    assert sync_mock.call_args[0][:3] == (mock_imap_conn, email, 'access_token_value')
+    index = sync_mock.call_args[0][3]
+    assert isinstance(index, MessageIndex)
+    assert index.path == AsyncPath(tmp_path.resolve() / email / INDEX_FILE)
+    mock_imap_conn.logout.assert_awaited_once()
+
+
+def test_main_process_mailboxes(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                                tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test23@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mailboxes = [{
+        'name': '[Gmail]/Sent Mail',
+        'days': 365
+    }, {
+        'name': 'Projects',
+        'query': 'has:attachment'
+    }]
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret',
+                'mailboxes': mailboxes
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    imap_mock = mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL')
+    imap_mock.return_value = AsyncMock()
+    single_mock = mocker.patch('gmail_archiver.main.archive_emails', new_callable=AsyncMock)
+    process_mock = mocker.patch('gmail_archiver.main.archive_mailboxes',
+                                new_callable=AsyncMock,
+                                return_value=0)
+    result = runner.invoke(main, [email, str(tmp_path), '--days', '30', '--query', 'larger:1M'])
+    assert result.exit_code == 0
+    imap_mock.assert_not_called()
+    single_mock.assert_not_called()
+    connect = process_mock.call_args[0][0]
+    assert process_mock.call_args[0][1:3] == (email, 'access_token_value')
+    assert process_mock.call_args[0][4] == mailboxes
+    call_kwargs = process_mock.call_args[1]
+    assert call_kwargs['days'] == 30
+    assert call_kwargs['query'] == 'larger:1M'
+    assert isinstance(call_kwargs['index'], MessageIndex)
+
+    async def use_connection() -> None:
+        async with connect() as imap_conn:
+            assert imap_conn is imap_mock.return_value
+
+    asyncio.run(use_connection())
+    imap_mock.return_value.logout.assert_awaited_once()
+
+
+def test_main_invalid_mailboxes(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                                tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test24@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret',
+                'mailboxes': [{
+                    'days': 30
+                }]
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    process_mock = mocker.patch('gmail_archiver.main.archive_mailboxes', new_callable=AsyncMock)
+    result = runner.invoke(main, [email, str(tmp_path)])
+    assert result.exit_code != 0
+    assert 'mailboxes must be a list of tables' in result.output
+    process_mock.assert_not_called()
+
+
+def test_main_process_query(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                            tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test25@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+    process_mock = mocker.patch('gmail_archiver.main.archive_emails',
+                                new_callable=AsyncMock,
+                                return_value=0)
+    result = runner.invoke(main, [email, str(tmp_path), '-q', '-category:promotions larger:5M'])
+    assert result.exit_code == 0
+    assert process_mock.call_args[1]['query'] == '-category:promotions larger:5M'
+
+
+def test_main_query_on_one_line(mocker: MockerFixture, tmp_path: Path, runner: CliRunner) -> None:
+    process_mock = mocker.patch('gmail_archiver.main.archive_emails', new_callable=AsyncMock)
+    result = runner.invoke(main, ['test25@example.com', str(tmp_path), '--query', 'a\r\nb'])
+    assert result.exit_code == 2
+    assert 'The search query must be on one line.' in result.output
+    process_mock.assert_not_called()
+
+
+def test_main_process_format(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                             tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test26@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+    process_mock = mocker.patch('gmail_archiver.main.archive_emails',
+                                new_callable=AsyncMock,
+                                return_value=0)
+    result = runner.invoke(main, [email, str(tmp_path), '--format', 'mbox'])
+    assert result.exit_code == 0
+    writer = process_mock.call_args[1]['writer']
+    assert isinstance(writer, MboxWriter)
+    assert writer.root == AsyncPath(tmp_path.resolve())
+
+
+def test_main_process_tar_to_stdout(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                                    tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test27@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+    process_mock = mocker.patch('gmail_archiver.main.archive_emails',
+                                new_callable=AsyncMock,
+                                return_value=0)
+    result = runner.invoke(main, [email, str(tmp_path), '--format', 'tar', '--no-delete'])
+    assert result.exit_code == 0
+    assert isinstance(process_mock.call_args[1]['writer'], TarWriter)
+    assert result.stdout_bytes == bytes(1024)
+
+
+def test_main_tar_to_stdout_requires_no_delete(mocker: MockerFixture, tmp_path: Path,
+                                               runner: CliRunner) -> None:
+    process_mock = mocker.patch('gmail_archiver.main.archive_emails', new_callable=AsyncMock)
+    result = runner.invoke(main, ['test27@example.com', str(tmp_path), '--format', 'tar'])
+    assert result.exit_code == 2
+    assert 'cannot be synced' in result.output
+    process_mock.assert_not_called()
+
+
+def test_main_process_tar_file(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                               tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test27@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret'
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+    process_mock = mocker.patch('gmail_archiver.main.archive_emails',
+                                new_callable=AsyncMock,
+                                return_value=0)
+    tar_file = tmp_path / 'archive.tar'
+    result = runner.invoke(
+        main, [email, str(tmp_path), '--format', 'tar', '--tar-file',
+               str(tar_file)])
+    assert result.exit_code == 0
+    assert process_mock.call_args[1]['delete'] is True
+    assert tar_file.read_bytes() == bytes(1024)
+    assert not result.stdout_bytes
+
+
+def test_main_process_s3(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                         tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test28@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret',
+                's3': {
+                    'access_key_id': 'minio',
+                    'bucket': 'archive',
+                    'endpoint': 'http://127.0.0.1:9000/',
+                    'prefix': 'mail/',
+                    'secret_access_key': 'minio-secret'
+                }
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    mocker.patch('gmail_archiver.main.aioimaplib.IMAP4_SSL', return_value=AsyncMock())
+    process_mock = mocker.patch('gmail_archiver.main.archive_emails',
+                                new_callable=AsyncMock,
+                                return_value=0)
+    result = runner.invoke(main, [email, str(tmp_path), '--format', 's3'])
+    assert result.exit_code == 0
+    assert process_mock.call_args[1]['delete'] is True
+    writer = process_mock.call_args[1]['writer']
+    assert isinstance(writer, S3Writer)
+    assert writer.root == AsyncPath(tmp_path.resolve())
+    assert writer.client.url('a@example.com/1.eml') == (
+        'http://127.0.0.1:9000/archive/mail/a%40example.com/1.eml')
+    assert writer.client.region == 'us-east-1'
+
+
+def test_main_s3_requires_config(mocker: MockerFixture, patch_platformdirs: tuple[Path, Path],
+                                 tmp_path: Path, runner: CliRunner) -> None:
+    oauth_file, _config_file = patch_platformdirs
+    email = 'test28@example.com'
+    oauth_file.write_text(json.dumps({email: make_auth_data()}))
+    mocker.patch('gmail_archiver.main.tomlkit.loads').return_value.unwrap.return_value = {
+        'tool': {
+            'gmail-archiver': {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret',
+                's3': {
+                    'bucket': 'archive'
+                }
+            }
+        }
+    }
+    mocker.patch('gmail_archiver.main.setup_logging')
+    process_mock = mocker.patch('gmail_archiver.main.archive_emails', new_callable=AsyncMock)
+    result = runner.invoke(main, [email, str(tmp_path), '--format', 's3'])
+    assert result.exit_code != 0
+    assert 's3 must be a table' in result.output
+    process_mock.assert_not_called()
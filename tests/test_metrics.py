@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
+import asyncio
+import urllib.error
+import urllib.request
+
+from anyio import Path as AsyncPath
+from gmail_archiver.metrics import CONTENT_TYPE, MetricsExporter
+from gmail_archiver.stats import RunStats
+import pytest
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def make_exporter() -> tuple[MetricsExporter, RunStats]:
+    stats = RunStats()
+    stats.add_message(1000)
+    stats.add_timing('fetch', 0.02, 1000)
+    stats.add_timing('fetch', 0.7, 0)
+    stats.add_timing('write', 0.001, 1001)
+    stats.retries = 2
+    stats.pending = 5
+    stats.in_flight = 1
+    exporter = MetricsExporter()
+    exporter.add_account('user"@example.com', stats, datetime(2025, 1, 1, tzinfo=timezone.utc))
+    return exporter, stats
+
+
+def test_render() -> None:
+    exporter, _ = make_exporter()
+    lines = exporter.render().splitlines()
+    account = 'account="user\\"@example.com"'
+    assert '# TYPE gmail_archiver_messages_archived_total counter' in lines
+    assert f'gmail_archiver_messages_archived_total{{{account}}} 1' in lines
+    assert f'gmail_archiver_downloaded_bytes_total{{{account}}} 1000' in lines
+    assert f'gmail_archiver_written_bytes_total{{{account}}} 1001' in lines
+    assert f'gmail_archiver_retries_total{{{account}}} 2' in lines
+    assert f'gmail_archiver_pending_messages{{{account}}} 5' in lines
+    assert f'gmail_archiver_in_flight_batches{{{account}}} 1' in lines
+    assert '# TYPE gmail_archiver_fetch_latency_seconds histogram' in lines
+    assert f'gmail_archiver_fetch_latency_seconds_bucket{{{account},le="0.01"}} 0' in lines
+    assert f'gmail_archiver_fetch_latency_seconds_bucket{{{account},le="0.025"}} 1' in lines
+    assert f'gmail_archiver_fetch_latency_seconds_bucket{{{account},le="1"}} 2' in lines
+    assert f'gmail_archiver_fetch_latency_seconds_bucket{{{account},le="+Inf"}} 2' in lines
+    assert f'gmail_archiver_fetch_latency_seconds_sum{{{account}}} 0.72' in lines
+    assert f'gmail_archiver_fetch_latency_seconds_count{{{account}}} 2' in lines
+    assert f'gmail_archiver_token_expiry_timestamp_seconds{{{account}}} 1735689600.0' in lines
+
+
+def test_render_without_phases() -> None:
+    exporter = MetricsExporter()
+    exporter.add_account('user@example.com', RunStats())
+    text = exporter.render()
+    assert 'gmail_archiver_written_bytes_total{account="user@example.com"} 0' in text
+    assert 'gmail_archiver_fetch_latency_seconds_count{account="user@example.com"} 0' in text
+    assert 'gmail_archiver_token_expiry_timestamp_seconds{' not in text
+
+
+async def test_serve_textfile(tmp_path: Path) -> None:
+    exporter, stats = make_exporter()
+    path = AsyncPath(tmp_path / 'gmail.prom')
+    async with exporter.serve(textfile=path, interval=0.01) as port:
+        assert port is None
+        await asyncio.sleep(0.05)
+        assert 'gmail_archiver_messages_archived_total' in await path.read_text()
+        stats.add_message(10)
+    assert 'gmail_archiver_messages_archived_total{account="user\\"@example.com"} 2' in (
+        await path.read_text())
+    assert not await (path.parent / '.gmail.prom.tmp').exists()
+
+
+def _get(url: str) -> tuple[str, str]:
+    with urllib.request.urlopen(url, timeout=5) as response:  # noqa: S310
+        return response.headers['Content-Type'], response.read().decode()
+
+
+async def test_serve_http() -> None:
+    exporter, _ = make_exporter()
+    async with exporter.serve(port=0) as port:
+        assert port
+        content_type, body = await asyncio.to_thread(_get, f'http://127.0.0.1:{port}/metrics')
+        assert content_type == CONTENT_TYPE
+        assert 'gmail_archiver_retries_total' in body
+        with pytest.raises(urllib.error.HTTPError, match='404'):
+            await asyncio.to_thread(_get, f'http://127.0.0.1:{port}/other')
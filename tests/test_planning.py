@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING
+from unittest.mock import AsyncMock
+
+from aioimaplib import Response  # type: ignore[import-untyped]
+from gmail_archiver.planning import (
+    fetch_message_info,
+    message_set,
+    parse_message_info,
+    parse_message_set,
+    plan_work,
+)
+
+if TYPE_CHECKING:
+    from gmail_archiver.typing import MessageInfo
+
+
+def make_info(number: int, size: int, day: int | None = None) -> MessageInfo:
+    return {
+        'internal_date': (datetime(2021, 1, day, tzinfo=timezone.utc) if day else None),
+        'number': str(number),
+        'size': size
+    }
+
+
+def test_message_set_collapses_ranges() -> None:
+    assert message_set(['5', '1', '2', '3', '7', '8']) == '1:3,5,7:8'
+
+
+def test_message_set_single_and_empty() -> None:
+    assert message_set([4]) == '4'
+    assert not message_set([])
+
+
+def test_parse_message_set() -> None:
+    assert parse_message_set('1:3,5,7:8') == ['1', '2', '3', '5', '7', '8']
+    assert parse_message_set('') == []
+
+
+def test_parse_message_info() -> None:
+    lines: list[bytes | str] = [
+        b'1 FETCH (RFC822.SIZE 1234 INTERNALDATE "17-Jul-1996 02:44:25 -0700")',
+        b'2 FETCH (INTERNALDATE " 1-Jan-2021 00:00:00 +0000" RFC822.SIZE 10)',
+        b'3 FETCH (RFC822.SIZE 99 INTERNALDATE "garbage")', b'4 FETCH (UID 5)', 'not-bytes',
+        b'Success'
+    ]
+    infos = parse_message_info(lines)
+    assert [x['number'] for x in infos] == ['1', '2', '3']
+    assert infos[0]['size'] == 1234
+    assert infos[0]['internal_date'] == datetime(1996,
+                                                 7,
+                                                 17,
+                                                 2,
+                                                 44,
+                                                 25,
+                                                 tzinfo=timezone(timedelta(hours=-7)))
+    assert infos[1]['internal_date'] == datetime(2021, 1, 1, tzinfo=timezone.utc)
+    assert infos[2]['internal_date'] is None
+
+
+async def test_fetch_message_info_batches() -> None:
+    imap_conn = AsyncMock()
+    imap_conn.fetch.side_effect = [
+        Response('OK', [b'1 FETCH (RFC822.SIZE 10)', b'2 FETCH (RFC822.SIZE 20)', b'Success']),
+        Response('NO', []),
+    ]
+    infos = await fetch_message_info(imap_conn, ['1', '2', '3'], batch_size=2)
+    assert [x['size'] for x in infos] == [10, 20]
+    assert imap_conn.fetch.call_args_list[0].args == ('1:2', '(RFC822.SIZE INTERNALDATE)')
+    assert imap_conn.fetch.call_args_list[1].args == ('3', '(RFC822.SIZE INTERNALDATE)')
+
+
+def test_plan_work_balances_bins() -> None:
+    infos = [make_info(1, 100), make_info(2, 60), make_info(3, 50), make_info(4, 10)]
+    plan = plan_work(infos, connections=2, large_message_size=80)
+    assert plan['total_bytes'] == 220
+    assert [x['number'] for x in plan['large']] == ['1']
+    loads = sorted(sum(x['size'] for x in bin_) for bin_ in plan['bins'])
+    assert loads == [110, 110]
+    for bin_ in plan['bins']:
+        assert [x['size'] for x in bin_] == sorted(x['size'] for x in bin_)
+
+
+def test_plan_work_orders() -> None:
+    infos = [make_info(1, 30, 3), make_info(2, 10), make_info(3, 20, 1)]
+    assert [x['number']
+            for x in plan_work(infos, order='large-first')['bins'][0]] == ['1', '3', '2']
+    assert [x['number']
+            for x in plan_work(infos, order='oldest-first')['bins'][0]] == ['3', '1', '2']
+    assert [x['number'] for x in plan_work(infos, order='sequence')['bins'][0]] == ['1', '2', '3']
+    assert [x['number'] for x in plan_work(infos)['bins'][0]] == ['2', '3', '1']
+
+
+def test_plan_work_no_connections() -> None:
+    plan = plan_work([], connections=0)
+    assert plan['bins'] == [[]]
+    assert plan['total_bytes'] == 0
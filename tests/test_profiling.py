@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+import pstats
+import sys
+import tracemalloc
+
+from gmail_archiver.profiling import peak_rss, profiled
+import pytest
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from pytest_mock import MockerFixture
+
+
+def allocate() -> list[bytes]:
+    return [bytes(1024) for _ in range(100)]
+
+
+def test_profiled(tmp_path: Path) -> None:
+    cpu_file = tmp_path / 'cpu.pstats'
+    memory_file = tmp_path / 'memory.txt'
+    with profiled(cpu_file=cpu_file, memory_file=memory_file, top=3):
+        kept = allocate()
+    assert kept
+    assert not tracemalloc.is_tracing()
+    stats = pstats.Stats(str(cpu_file))
+    assert any(name == 'allocate' for _, _, name in stats.stats)  # type: ignore[attr-defined]
+    lines = memory_file.read_text().splitlines()
+    assert lines[0].startswith('Peak traced memory: ')
+    assert lines[1].startswith('Peak RSS: ')
+    assert lines[2] == 'Top 3 allocation sites:'
+    assert len(lines) == 6
+    assert 'test_profiling.py' in lines[3]
+
+
+def test_profiled_writes_on_error(tmp_path: Path) -> None:
+    cpu_file = tmp_path / 'cpu.pstats'
+    with pytest.raises(ZeroDivisionError), profiled(cpu_file=cpu_file):
+        _ = 1 / 0
+    assert cpu_file.exists()
+
+
+def test_profiled_nothing(mocker: MockerFixture) -> None:
+    profile = mocker.patch('gmail_archiver.profiling.cProfile.Profile')
+    start = mocker.patch('gmail_archiver.profiling.tracemalloc.start')
+    with profiled():
+        pass
+    profile.assert_not_called()
+    start.assert_not_called()
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='resource is not available on Windows')
+def test_peak_rss() -> None:
+    rss = peak_rss()
+    assert rss is not None
+    assert rss > 1024 * 1024
+
+
+def test_peak_rss_windows(mocker: MockerFixture) -> None:
+    mocker.patch('gmail_archiver.profiling.sys.platform', 'win32')
+    assert peak_rss() is None
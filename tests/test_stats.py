@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+from gmail_archiver.stats import LATENCY_BUCKETS, PhaseTimer, RunStats, bucket_bounds, format_size
+import pytest
+
+if TYPE_CHECKING:
+    from pytest_mock import MockerFixture
+
+
+def test_run_stats_throughput(mocker: MockerFixture) -> None:
+    monotonic = mocker.patch('gmail_archiver.stats.time.monotonic', side_effect=[10.0, 12.0, 14.0])
+    stats = RunStats()
+    stats.add_message(100)
+    stats.add_message(300)
+    assert stats.elapsed == pytest.approx(2.0)
+    stats.finish()
+    assert stats.messages == 2
+    assert stats.bytes_downloaded == 400
+    assert stats.throughput == pytest.approx(100.0)
+    assert monotonic.call_count == 3
+
+
+def test_run_stats_zero_elapsed(mocker: MockerFixture) -> None:
+    mocker.patch('gmail_archiver.stats.time.monotonic', return_value=5.0)
+    stats = RunStats()
+    stats.finish()
+    assert stats.throughput == pytest.approx(0.0)
+
+
+def test_format_size() -> None:
+    assert format_size(512) == '512 B'
+    assert format_size(1536) == '1.5 KiB'
+    assert format_size(3 * 1024 ** 3) == '3.0 GiB'
+    assert format_size(2 * 1024 ** 4) == '2.0 TiB'
+
+
+def test_run_stats_summary(mocker: MockerFixture) -> None:
+    mocker.patch('gmail_archiver.stats.time.monotonic', side_effect=[0.0, 2.0])
+    stats = RunStats()
+    stats.add_message(2048)
+    stats.finish()
+    assert stats.summary() == 'Archived 1 messages (2.0 KiB) in 2.0 s (1.0 KiB/s).'
+    stats.batch_size = 20
+    stats.window = 3
+    stats.retries = 1
+    assert stats.summary() == ('Archived 1 messages (2.0 KiB) in 2.0 s (1.0 KiB/s). Final batch '
+                               'size 20, window 3, 1 retries.')
+
+
+def test_run_stats_summary_compression(mocker: MockerFixture) -> None:
+    mocker.patch('gmail_archiver.stats.time.monotonic', side_effect=[0.0, 1.0])
+    stats = RunStats()
+    assert stats.compression_savings == pytest.approx(0.0)
+    stats.add_compressed_received(256, 1024)
+    stats.add_compressed_sent(10, 20)
+    stats.finish()
+    assert stats.compression_savings == pytest.approx(0.75)
+    assert stats.summary() == ('Archived 0 messages (0 B) in 1.0 s (0 B/s). Received 256 B '
+                               'compressed for 1.0 KiB (75% saved).')
+
+
+def test_phase_timer_percentiles() -> None:
+    timer = PhaseTimer()
+    assert timer.percentile(0.5) == pytest.approx(0.0)
+    for x in range(1, 101):
+        timer.add(x / 1000, 10)
+    assert timer.count == 100
+    assert timer.bytes == 1000
+    assert timer.total == pytest.approx(5.05)
+    assert timer.percentile(0.5) == pytest.approx(0.05, rel=0.025)
+    assert timer.percentile(0.95) == pytest.approx(0.095, rel=0.025)
+    assert timer.percentile(0.99) == pytest.approx(0.099, rel=0.025)
+    assert timer.percentile(1) == pytest.approx(0.1)
+    assert timer.percentile(0) == pytest.approx(0.001)
+    assert sum(timer.buckets.values()) == 100
+    assert len(timer.buckets) < 100
+
+
+def test_phase_timer_zero_duration() -> None:
+    timer = PhaseTimer()
+    timer.add(0)
+    timer.add(0)
+    assert timer.percentile(0.5) == pytest.approx(0.0)
+    assert timer.total == pytest.approx(0.0)
+
+
+def test_phase_timer_histogram() -> None:
+    timer = PhaseTimer()
+    for seconds in (0.001, 0.01, 0.02, 60.0):
+        timer.add(seconds)
+    assert dict(zip(LATENCY_BUCKETS, timer.histogram, strict=True)) == {
+        0.005: 1,
+        0.01: 2,
+        0.025: 3,
+        0.05: 3,
+        0.1: 3,
+        0.25: 3,
+        0.5: 3,
+        1.0: 3,
+        2.5: 3,
+        5.0: 3,
+        10.0: 3,
+        30.0: 3
+    }
+
+
+def test_bucket_bounds() -> None:
+    assert bucket_bounds(0) == pytest.approx((1.0, 2 ** (1 / 16)))
+    assert bucket_bounds(-16) == pytest.approx((0.5, 0.5 * 2 ** (1 / 16)))
+
+
+def test_run_stats_timed(mocker: MockerFixture) -> None:
+    mocker.patch('gmail_archiver.stats.time.perf_counter', side_effect=[1.0, 1.5, 2.0, 4.0])
+    stats = RunStats()
+    with stats.timed('fetch', 2048):
+        pass
+    with pytest.raises(ZeroDivisionError), stats.timed('write'):
+        _ = 1 / 0
+    assert stats.phases['fetch'].total == pytest.approx(0.5)
+    assert stats.phases['fetch'].bytes == 2048
+    assert stats.phases['write'].count == 1
+    assert stats.phases['write'].total == pytest.approx(2.0)
+    assert stats.phase_report() == [
+        'write: 1 calls, 2.000 s total, p50 2000.0 ms, p95 2000.0 ms, p99 2000.0 ms',
+        'fetch: 1 calls, 0.500 s total, p50 500.0 ms, p95 500.0 ms, p99 500.0 ms, 2.0 KiB'
+    ]
+
+
+def test_run_stats_report(mocker: MockerFixture) -> None:
+    mocker.patch('gmail_archiver.stats.time.monotonic', side_effect=[0.0, 3.0])
+    stats = RunStats()
+    stats.add_message(100)
+    stats.add_timing('search', 0.25)
+    stats.finish()
+    assert stats.report() == {
+        'batch_size': None,
+        'bytes': 100,
+        'compressed_received': 0,
+        'compressed_sent': 0,
+        'messages': 1,
+        'phases': {
+            'search': {
+                'bytes': 0,
+                'count': 1,
+                'p50': 0.25,
+                'p95': 0.25,
+                'p99': 0.25,
+                'total': 0.25
+            }
+        },
+        'retries': 0,
+        'seconds': 3.0,
+        'uncompressed_received': 0,
+        'uncompressed_sent': 0,
+        'window': None
+    }
@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+import json
+
+from anyio import Path as AsyncPath
+from gmail_archiver.throttle import DailyQuota, TokenBucket
+import pytest
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from pytest_mock import MockerFixture
+
+
+class FakeClock:
+    def __init__(self, now: float = 0.0) -> None:
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+async def test_token_bucket_within_capacity(mocker: MockerFixture) -> None:
+    sleep = mocker.patch('gmail_archiver.throttle.asyncio.sleep')
+    clock = FakeClock()
+    bucket = TokenBucket(100, clock=clock)
+    await bucket.consume(60)
+    clock.now = 0.5
+    await bucket.consume(60)
+    sleep.assert_not_called()
+
+
+async def test_token_bucket_sleeps_on_deficit(mocker: MockerFixture) -> None:
+    sleep = mocker.patch('gmail_archiver.throttle.asyncio.sleep')
+    clock = FakeClock()
+    bucket = TokenBucket(100, capacity=50, clock=clock)
+    await bucket.consume(250)
+    sleep.assert_called_once_with(2.0)
+
+
+async def test_daily_quota_rolling_window(tmp_path: Path) -> None:
+    clock = FakeClock(1_000_000.0)
+    quota = DailyQuota(AsyncPath(tmp_path / 'quota.json'), 'a@example.com', 1000, clock=clock)
+    await quota.load()
+    assert quota.remaining == 1000
+    quota.add(600)
+    assert quota.used == 600
+    assert quota.allows(400)
+    assert not quota.allows(401)
+    quota.add(400)
+    assert not quota.allows()
+    clock.now += 86400 + 60
+    assert quota.used == 0
+    assert quota.allows(1000)
+
+
+async def test_daily_quota_persists_per_account(tmp_path: Path) -> None:
+    path = tmp_path / 'quota.json'
+    path.write_text(json.dumps({'b@example.com': {'usage': {'1': 5}}}))
+    clock = FakeClock(120.0)
+    quota = DailyQuota(AsyncPath(path), 'a@example.com', 1000, clock=clock)
+    await quota.load()
+    quota.add(10)
+    await quota.set_resume('INBOX', '7', ['4', '5', '6'])
+    await quota.save()
+    data = json.loads(path.read_text())
+    assert data['a@example.com'] == {
+        'resume': {
+            'INBOX': {
+                'uids': '4:6',
+                'uidvalidity': '7'
+            }
+        },
+        'usage': {
+            '2': 10
+        }
+    }
+    assert 'b@example.com' in data
+    other = DailyQuota(AsyncPath(path), 'a@example.com', 1000, clock=clock)
+    await other.load()
+    assert other.used == 10
+    assert await other.resume_uids('INBOX', '7') == ['4', '5', '6']
+    assert await other.resume_uids('Work', '7') == []
+    await other.set_resume('INBOX', '7', [])
+    assert 'resume' not in json.loads(path.read_text())['a@example.com']
+
+
+async def test_daily_quota_save_merges_usage(tmp_path: Path) -> None:
+    path = AsyncPath(tmp_path / 'quota.json')
+    clock = FakeClock(120.0)
+    first = DailyQuota(path, 'a@example.com', 1000, clock=clock)
+    second = DailyQuota(path, 'a@example.com', 1000, clock=clock)
+    await first.load()
+    await second.load()
+    first.add(10)
+    second.add(20)
+    await first.save()
+    await second.save()
+    assert second.used == 30
+    first.add(5)
+    await first.load()
+    assert first.used == 35
+    await first.save()
+    assert json.loads(await path.read_text()) == {'a@example.com': {'usage': {'2': 35}}}
+
+
+async def test_daily_quota_resume_uidvalidity_changed(tmp_path: Path,
+                                                      caplog: pytest.LogCaptureFixture) -> None:
+    path = tmp_path / 'quota.json'
+    path.write_text(json.dumps({'a@example.com': {'resume': '1:3', 'usage': {}}}))
+    quota = DailyQuota(AsyncPath(path), 'a@example.com')
+    assert await quota.resume_uids('INBOX', '7') == []
+    await quota.set_resume('INBOX', None, ['1'])
+    await quota.set_resume('Work', '7', ['2'])
+    assert await quota.resume_uids('INBOX', None) == ['1']
+    assert await quota.resume_uids('Work', '8') == []
+    assert 'UIDVALIDITY of Work changed' in caplog.text
+
+
+async def test_daily_quota_invalid_file(tmp_path: Path) -> None:
+    path = tmp_path / 'quota.json'
+    quota = DailyQuota(AsyncPath(path), 'a@example.com')
+    path.write_text('{{')
+    await quota.load()
+    assert quota.used == 0
+    path.write_text('[]')
+    await quota.load()
+    assert await quota.resume_uids('INBOX', '7') == []
+
+
+async def test_daily_quota_save_replaces_file(tmp_path: Path, mocker: MockerFixture) -> None:
+    path = tmp_path / 'quota.json'
+    path.write_text(json.dumps({'a@example.com': {'usage': {'1': 5}}}))
+    quota = DailyQuota(AsyncPath(path), 'a@example.com', clock=FakeClock(120.0))
+    await quota.load()
+    quota.add(10)
+    mocker.patch.object(AsyncPath, 'replace', side_effect=OSError)
+    with pytest.raises(OSError):  # noqa: PT011
+        await quota.save()
+    assert json.loads(path.read_text()) == {'a@example.com': {'usage': {'1': 5}}}
+    mocker.stopall()
+    await quota.save()
+    assert json.loads(path.read_text()) == {'a@example.com': {'usage': {'1': 5, '2': 10}}}
+    assert not (tmp_path / '.quota.json.tmp').exists()
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+import asyncio
+import json
+import stat
+import subprocess as sp
+import sys
+
+from anyio import Path as AsyncPath
+from gmail_archiver.tokens import LOCK_POLL_INTERVAL, TokenStore, file_lock
+import pytest
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from gmail_archiver.typing import AuthInfo
+
+WORKER = """
+import asyncio, sys
+from anyio import Path
+from gmail_archiver.tokens import TokenStore
+
+async def run():
+    store = TokenStore(Path(sys.argv[1]))
+    for i in range(20):
+        await store.save(f'{sys.argv[2]}-{i}@example.com', {'access_token': sys.argv[2]})
+
+asyncio.run(run())
+"""
+
+
+def make_record(token: str) -> AuthInfo:
+    return {'access_token': token, 'refresh_token': 'refresh'}
+
+
+async def test_load_missing_and_invalid(tmp_path: Path) -> None:
+    path = tmp_path / 'oauth.json'
+    store = TokenStore(AsyncPath(path))
+    assert await store.load() == {}
+    path.write_text('{{{', encoding='utf-8')
+    assert await store.load() == {}
+    path.write_text('[]', encoding='utf-8')
+    assert await store.load() == []
+
+
+async def test_save_keeps_other_accounts(tmp_path: Path) -> None:
+    path = tmp_path / 'oauth.json'
+    path.write_text(json.dumps({'a@example.com': make_record('a')}), encoding='utf-8')
+    store = TokenStore(AsyncPath(path))
+    await store.save('b@example.com', make_record('b'))
+    assert await store.load() == {
+        'a@example.com': make_record('a'),
+        'b@example.com': make_record('b')
+    }
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+async def test_save_concurrent(tmp_path: Path) -> None:
+    path = AsyncPath(tmp_path / 'oauth.json')
+    stores = [TokenStore(path) for _ in range(4)]
+    await asyncio.gather(*(store.save(f'{i}-{j}@example.com', make_record(str(i)))
+                           for j in range(10) for i, store in enumerate(stores)))
+    assert len(await stores[0].load()) == 40
+
+
+def test_save_concurrent_processes(tmp_path: Path) -> None:
+    path = tmp_path / 'oauth.json'
+    processes = [
+        sp.Popen((sys.executable, '-c', WORKER, str(path), f'worker{i}')) for i in range(4)
+    ]
+    assert all(process.wait() == 0 for process in processes)
+    data = json.loads(path.read_text(encoding='utf-8'))
+    assert len(data) == 80
+    assert data['worker3-19@example.com'] == {'access_token': 'worker3'}
+
+
+@pytest.mark.parametrize('content', ['{{{', '[]'])
+async def test_save_replaces_invalid_database(tmp_path: Path, content: str,
+                                              caplog: pytest.LogCaptureFixture) -> None:
+    path = tmp_path / 'oauth.json'
+    path.write_text(content, encoding='utf-8')
+    store = TokenStore(AsyncPath(path))
+    await store.save('a@example.com', make_record('a'))
+    assert await store.load() == {'a@example.com': make_record('a')}
+    assert 'Replacing' in caplog.text
+
+
+async def test_save_failure_keeps_database(tmp_path: Path) -> None:
+    path = tmp_path / 'oauth.json'
+    path.write_text(json.dumps({'a@example.com': make_record('a')}), encoding='utf-8')
+    store = TokenStore(AsyncPath(path))
+    record = make_record('b')
+    record['expires_in'] = float('nan')  # type: ignore[typeddict-item]
+    with pytest.raises(ValueError, match='JSON compliant'):
+        await store.save('b@example.com', record)
+    assert await store.load() == {'a@example.com': make_record('a')}
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+async def test_save_waiting_for_lock_is_cancellable(tmp_path: Path) -> None:
+    path = tmp_path / 'oauth.json'
+    async with file_lock(tmp_path / '.oauth.json.lock'):
+        task = asyncio.create_task(
+            TokenStore(AsyncPath(path)).save('a@example.com', make_record('a')))
+        await asyncio.sleep(LOCK_POLL_INTERVAL * 2)
+        assert not task.done()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    assert not path.exists()
+
+
+async def test_lock_serialises_account(tmp_path: Path) -> None:
+    path = AsyncPath(tmp_path / 'oauth.json')
+    events: list[str] = []
+
+    async def hold(store: TokenStore, email: str, name: str) -> None:
+        async with store.lock(email):
+            events.append(f'{name} start')
+            await asyncio.sleep(0.1)
+            events.append(f'{name} end')
+
+    await asyncio.gather(hold(TokenStore(path), 'a@example.com', 'first'),
+                         hold(TokenStore(path), 'a@example.com', 'second'))
+    assert [x.split()[1] for x in events] == ['start', 'end', 'start', 'end']
+
+
+async def test_lock_does_not_block_other_accounts(tmp_path: Path) -> None:
+    path = AsyncPath(tmp_path / 'oauth.json')
+
+    async def take(email: str) -> bool:
+        async with TokenStore(path).lock(email):
+            return True
+
+    async with TokenStore(path).lock('a@example.com'):
+        assert await asyncio.wait_for(take('b@example.com'), 1)
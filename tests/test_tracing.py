@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any
+import json
+
+from anyio import Path as AsyncPath
+from gmail_archiver.tracing import Tracer, span
+from gmail_archiver.utils import archive_emails
+from tests.fake_imap_server import FakeGmailServer, generate_mailbox
+import aioimaplib  # type: ignore[import-untyped]
+import pytest
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def read_spans(path: Path) -> list[dict[str, Any]]:
+    return [json.loads(x) for x in path.read_text(encoding='utf-8').splitlines()]
+
+
+def test_span_without_tracer() -> None:
+    with span('fetch', number='1') as current:
+        current.set_attributes(size=10)
+    assert not current.recording
+    assert not current.attributes
+
+
+def test_tracer_nested_spans(tmp_path: Path) -> None:
+    path = tmp_path / 'trace.jsonl'
+    with Tracer(path, 1.0, seed=1):
+        with span('message', number='1') as root, span('write') as child:
+            child.set_attributes(size=10)
+        with pytest.raises(ZeroDivisionError), span('parse'):
+            _ = 1 / 0
+    assert root.recording
+    child_record, root_record, parse_record = read_spans(path)
+    assert root_record['name'] == 'message'
+    assert root_record['attributes'] == {'number': '1'}
+    assert root_record['parent_id'] is None
+    assert len(root_record['trace_id']) == 32
+    assert child_record['name'] == 'write'
+    assert child_record['attributes'] == {'size': 10}
+    assert child_record['parent_id'] == root_record['span_id']
+    assert child_record['trace_id'] == root_record['trace_id']
+    assert child_record['duration'] <= root_record['duration']
+    assert child_record['error'] is None
+    assert parse_record['error'] == 'ZeroDivisionError'
+    assert parse_record['trace_id'] != root_record['trace_id']
+    with span('after') as current:
+        pass
+    assert not current.recording
+
+
+def test_tracer_sampling(tmp_path: Path) -> None:
+    path = tmp_path / 'trace.jsonl'
+    with Tracer(path, 0.0, seed=1):
+        with span('message'), span('write') as child:
+            pass
+        with span('refresh_token', always=True), span('post'):
+            pass
+    assert not child.recording
+    assert [x['name'] for x in read_spans(path)] == ['post', 'refresh_token']
+
+
+async def test_archive_emails_traced(tmp_path: Path) -> None:
+    path = tmp_path / 'trace.jsonl'
+    async with FakeGmailServer(generate_mailbox(3, seed=1)) as server:
+        imap_conn = aioimaplib.IMAP4('127.0.0.1', server.port)
+        await imap_conn.wait_hello_from_server()
+        with Tracer(path, 1.0, seed=1):
+            result = await archive_emails(imap_conn, 'user@example.com', 'token',
+                                          AsyncPath(tmp_path / 'out'))
+        await imap_conn.logout()
+    assert result == 0
+    spans = read_spans(path)
+    by_id = {x['span_id']: x for x in spans}
+    assert [x['name'] for x in spans if x['parent_id'] is None] == [
+        'xoauth2', 'select', 'search', 'message', 'message', 'message'
+    ]
+    assert {
+        x['name']
+        for x in spans if x['parent_id'] and by_id[x['parent_id']]['name'] == 'message'
+    } == {'fetch', 'labels', 'mkdir', 'parse', 'write'}
@@ -1,25 +1,45 @@
 from __future__ import annotations
 
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
 from typing import TYPE_CHECKING, Any
 from unittest.mock import AsyncMock, MagicMock
+import json
 
 from aioimaplib import Response  # type: ignore[import-untyped]
 from anyio import Path as AsyncPath
+from gmail_archiver.failures import ErrorManifest
+from gmail_archiver.index import INDEX_FILE, MessageIndex
+from gmail_archiver.planning import parse_message_set
+from gmail_archiver.s3 import S3Client
+from gmail_archiver.stats import RunStats
+from gmail_archiver.throttle import DailyQuota
 from gmail_archiver.utils import (
     GoogleOAuthClient,
     archive_emails,
+    archive_mailboxes,
     authorize_tokens,
     dq,
+    estimate_archive,
     generate_oauth2_str,
     get_auth_http_handler,
     get_localhost_redirect_uri,
     log_oauth2_error,
+    mailbox_key,
+    oauth_session,
     refresh_token,
+    sync_labels,
 )
+from gmail_archiver.writers import S3Writer, TarWriter
 from niquests import HTTPError
+from tests.fake_imap_server import FakeGmailServer, FakeMessage, generate_mailbox
+from tests.fake_s3_server import FakeS3Server
+import aioimaplib
+import niquests
 import pytest
 
 if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
     from pathlib import Path
 
     from pytest_mock import MockerFixture
@@ -73,12 +93,22 @@ async def test_authorize_tokens_http_error(mocker: MockerFixture) -> None:
         await authorize_tokens(url, client_id, client_secret, authorization_code, '', '')
 
 
+def labels_response(num: str) -> Response:
+    return Response(
+        'OK',
+        [f'{num} FETCH (X-GM-MSGID {1000 + int(num)} X-GM-LABELS (\\Inbox))'.encode(), b'Success'])
+
+
 def test_dq_quotes_simple_string() -> None:
     s = 'hello'
     result = dq(s)
     assert result == '"hello"'
 
 
+def test_dq_escapes() -> None:
+    assert dq('a "b" c\\d') == '"a \\"b\\" c\\\\d"'
+
+
 async def test_process_success(mocker: MockerFixture, tmp_path: Path) -> None:
     email = 'user@example.com'
     access_token = 'token'
@@ -89,8 +119,10 @@ async def test_process_success(mocker: MockerFixture, tmp_path: Path) -> None:
     imap_conn.select.return_value = Response('OK', [b''])
     msg_bytes = b'From: test@example.com\r\nDate: Fri, 01 Jan 2021 12:00:00 +0000\r\n\r\nBody'
     fetch_rfc822 = Response('OK', [b'1 FETCH (RFC822 {123}', bytearray(msg_bytes), b')'])
-    fetch_labels = Response('OK', [b'\\Inbox'])
-    imap_conn.fetch.side_effect = [fetch_rfc822, fetch_labels, fetch_rfc822, fetch_labels]
+    imap_conn.fetch.side_effect = [
+        fetch_rfc822, labels_response('1'), fetch_rfc822,
+        labels_response('2')
+    ]
     imap_conn.store.return_value = Response('OK', [b''])
     mocker.patch('gmail_archiver.utils.message_from_bytes',
                  return_value={'Date': 'Fri, 01 Jan 2021 12:00:00 +0000'})
@@ -101,7 +133,7 @@ async def test_process_success(mocker: MockerFixture, tmp_path: Path) -> None:
     assert imap_conn.select.called
     assert imap_conn.search.called
     assert imap_conn.fetch.call_count == 4
-    assert imap_conn.store.call_count == 2
+    imap_conn.store.assert_called_once_with('1:2', '+X-GM-LABELS', '\\Trash')
     written_files = list(tmp_path.rglob('*.eml'))
     assert len(written_files) == 2
     written_labels = list(tmp_path.rglob('*.labels.json'))
@@ -118,8 +150,10 @@ async def test_process_no_delete(mocker: MockerFixture, tmp_path: Path) -> None:
     imap_conn.select.return_value = Response('OK', [b''])
     msg_bytes = b'From: test@example.com\r\nDate: Fri, 01 Jan 2021 12:00:00 +0000\r\n\r\nBody'
     fetch_rfc822 = Response('OK', [b'1 FETCH (RFC822 {123}', bytearray(msg_bytes), b')'])
-    fetch_labels = Response('OK', [b'\\Inbox'])
-    imap_conn.fetch.side_effect = [fetch_rfc822, fetch_labels, fetch_rfc822, fetch_labels]
+    imap_conn.fetch.side_effect = [
+        fetch_rfc822, labels_response('1'), fetch_rfc822,
+        labels_response('2')
+    ]
     imap_conn.store.return_value = Response('OK', [b''])
     mocker.patch('gmail_archiver.utils.message_from_bytes',
                  return_value={'Date': 'Fri, 01 Jan 2021 12:00:00 +0000'})
@@ -147,8 +181,10 @@ async def test_process_invalid_date_tuple(mocker: MockerFixture, tmp_path: Path)
     imap_conn.select.return_value = Response('OK', [b''])
     msg_bytes = b'From: test@example.com\r\nDate: Fri, 01 Jan 2021 12:00:00 +0000\r\n\r\nBody'
     fetch_rfc822 = Response('OK', [b'1 FETCH (RFC822 {123}', bytearray(msg_bytes), b')'])
-    fetch_labels = Response('OK', [b'\\Inbox'])
-    imap_conn.fetch.side_effect = [fetch_rfc822, fetch_labels, fetch_rfc822, fetch_labels]
+    imap_conn.fetch.side_effect = [
+        fetch_rfc822, labels_response('1'), fetch_rfc822,
+        labels_response('2')
+    ]
     imap_conn.store.return_value = Response('OK', [b''])
     mocker.patch('gmail_archiver.utils.message_from_bytes',
                  return_value={'Date': 'Fri, 01 Jan 2021 12:00:00 +0000'})
@@ -204,8 +240,7 @@ async def test_archive_emails_out_path_exists(mocker: MockerFixture, tmp_path: P
     imap_conn.select.return_value = Response('OK', [b''])
     msg_bytes = b'From: test@example.com\r\nDate: Fri, 01 Jan 2021 12:00:00 +0000\r\n\r\nBody'
     fetch_rfc822 = Response('OK', [b'1 FETCH (RFC822 {123}', bytearray(msg_bytes), b')'])
-    fetch_labels = Response('OK', [b'\\Inbox'])
-    imap_conn.fetch.side_effect = [fetch_rfc822, fetch_labels]
+    imap_conn.fetch.side_effect = [fetch_rfc822, Response('NO', [b''])]
     imap_conn.store.return_value = Response('OK', [b''])
     mocker.patch('gmail_archiver.utils.message_from_bytes',
                  return_value={'Date': 'Fri, 01 Jan 2021 12:00:00 +0000'})
@@ -218,8 +253,8 @@ async def test_archive_emails_out_path_exists(mocker: MockerFixture, tmp_path: P
     eml_filename = '0000000001.eml'
     eml_path = out_dir_path / eml_filename
     eml_path.write_bytes(b'existing content')
-    mocker.patch('gmail_archiver.utils.sha1', autospec=True)
-    gmail_archiver_sha1 = mocker.patch('gmail_archiver.utils.sha1')
+    mocker.patch('gmail_archiver.writers.sha1', autospec=True)
+    gmail_archiver_sha1 = mocker.patch('gmail_archiver.writers.sha1')
     gmail_archiver_sha1.return_value.hexdigest.return_value = 'abcdef1234567890'
     result = await archive_emails(imap_conn, email, access_token, AsyncPath(tmp_path))
     assert result == 0
@@ -247,6 +282,7 @@ async def test_process_search_zero_results(mocker: MockerFixture, tmp_path: Path
     access_token = 'token'
     out_dir = AsyncPath(tmp_path)
     imap_conn = AsyncMock()
+    imap_conn.select.return_value = Response('OK', [b''])
     imap_conn.xoauth2.return_value = Response('OK', [])
     mock_log_info = mocker.patch('gmail_archiver.utils.log.info')
     imap_conn.search.return_value = Response('OK', [])
@@ -260,6 +296,7 @@ async def test_process_search_empty_id_string(mocker: MockerFixture, tmp_path: P
     access_token = 'token'
     out_dir = AsyncPath(tmp_path)
     imap_conn = AsyncMock()
+    imap_conn.select.return_value = Response('OK', [b''])
     imap_conn.xoauth2.return_value = Response('OK', [])
     mock_log_info = mocker.patch('gmail_archiver.utils.log.info')
     imap_conn.search.return_value = Response('OK', [b' '])
@@ -446,7 +483,7 @@ def test_get_auth_http_handler_calls_callback_with_code(mocker: MockerFixture) -
         wfile = mocker.MagicMock()
 
     mocker.patch('gmail_archiver.utils.urllib.parse.urlparse')
-    mocker.patch('gmail_archiver.utils.http.server.BaseHTTPRequestHandler',
+    mocker.patch('gmail_archiver.utils.http_server.BaseHTTPRequestHandler',
                  new=MockBaseHTTPRequestHandler)
     mock_parse_qs = mocker.patch('gmail_archiver.utils.urllib.parse.parse_qs')
     mock_parse_qs.return_value = {'code': ['abc123']}
@@ -460,3 +497,963 @@ def test_get_auth_http_handler_calls_callback_with_code(mocker: MockerFixture) -
         200)
     handler.send_header.assert_called_once_with(  # type: ignore[attr-defined]  # ty: ignore[unresolved-attribute]
         'Content-type', 'text/html')
+
+
+async def test_archive_emails_plan_streams_large_messages(mocker: MockerFixture,
+                                                          tmp_path: Path) -> None:
+    mocker.patch('gmail_archiver.utils._STREAM_CHUNK_SIZE', 16)
+    email = 'user@example.com'
+    imap_conn = AsyncMock()
+    imap_conn.xoauth2.return_value = Response('OK', [])
+    imap_conn.select.return_value = Response('OK', [b''])
+    imap_conn.search.return_value = Response('OK', [b'1 2 3'])
+    small = b'Date: Fri, 01 Jan 2021 12:00:00 +0000\r\n\r\nBody'
+    large = b'Date: Sat, 02 Jan 2021 12:00:00 +0000\r\n\r\n' + b'x' * 30
+    fetches = {
+        '(RFC822.SIZE INTERNALDATE)':
+            Response('OK', [
+                b'1 FETCH (RFC822.SIZE %d)' % len(large),
+                b'2 FETCH (RFC822.SIZE %d)' % len(small), b'Success'
+            ]),
+        '(RFC822)':
+            Response('OK',
+                     [b'2 FETCH (RFC822 {10}', bytearray(small), b')']),
+    }
+
+    async def fetch(num: str, parts: str) -> Response:
+        if parts.startswith('(BODY.PEEK[]<'):
+            offset, length = (int(x) for x in parts[13:-2].split('.'))
+            return Response(
+                'OK', [b'1 FETCH (BODY[] {1}',
+                       bytearray(large[offset:offset + length]), b')'])
+        if parts == '(X-GM-MSGID X-GM-THRID X-GM-LABELS)':
+            return labels_response(num)
+        return fetches[parts]
+
+    imap_conn.fetch.side_effect = fetch
+    result = await archive_emails(imap_conn,
+                                  email,
+                                  'token',
+                                  AsyncPath(tmp_path),
+                                  delete=True,
+                                  large_message_size=len(small),
+                                  plan=True)
+    assert result == 0
+    stored = [x.args[0] for x in imap_conn.store.call_args_list]
+    assert stored == ['1:3']
+    assert (tmp_path / email / '2021' / '01-Jan' / '02-Sat' /
+            '1001.eml').read_bytes() == large + b'\n'
+    assert (tmp_path / email / '2021' / '01-Jan' / '01-Fri' /
+            '1002.eml').read_bytes() == small + b'\n'
+    assert not list((tmp_path / email).glob('*.part'))
+
+
+async def test_archive_emails_stream_error(mocker: MockerFixture, tmp_path: Path) -> None:
+    email = 'user@example.com'
+    imap_conn = AsyncMock()
+    imap_conn.select.return_value = Response('OK', [b''])
+    imap_conn.search.return_value = Response('OK', [b'1'])
+    imap_conn.fetch.side_effect = [
+        Response('OK', [b'1 FETCH (RFC822.SIZE 100)']),
+        Response('NO', []),
+    ]
+    logger = mocker.patch('gmail_archiver.utils.log')
+    result = await archive_emails(imap_conn,
+                                  email,
+                                  'token',
+                                  AsyncPath(tmp_path),
+                                  large_message_size=10,
+                                  plan=True)
+    assert result == 1
+    logger.error.assert_called_with('Error streaming message #%s at offset %d.', '1', 0)
+    assert not list((tmp_path / email).glob('*.part'))
+
+
+async def test_archive_emails_stream_bad_date(mocker: MockerFixture, tmp_path: Path) -> None:
+    email = 'user@example.com'
+    imap_conn = AsyncMock()
+    imap_conn.select.return_value = Response('OK', [b''])
+    imap_conn.search.return_value = Response('OK', [b'1'])
+    imap_conn.fetch.side_effect = [
+        Response('OK', [b'1 FETCH (RFC822.SIZE 100)']),
+        Response('OK',
+                 [b'1 FETCH (BODY[] {5}', bytearray(b'\r\n\r\nx'), b')']),
+    ]
+    logger = mocker.patch('gmail_archiver.utils.log')
+    result = await archive_emails(imap_conn,
+                                  email,
+                                  'token',
+                                  AsyncPath(tmp_path),
+                                  large_message_size=10,
+                                  plan=True)
+    assert result == 1
+    logger.error.assert_called_with('Error converting date: %s', None)
+    assert not list((tmp_path / email).glob('*.part'))
+
+
+async def test_estimate_archive() -> None:
+    imap_conn = AsyncMock()
+    imap_conn.examine.return_value = Response('OK', [b''])
+    imap_conn.search.return_value = Response('OK', [b'1 2 3'])
+    imap_conn.fetch.return_value = Response('OK', [
+        b'1 FETCH (RFC822.SIZE 100 INTERNALDATE "01-Jan-2020 00:00:00 +0000")',
+        b'2 FETCH (RFC822.SIZE 50 INTERNALDATE "01-Jan-2020 00:00:00 +0000")',
+        b'3 FETCH (RFC822.SIZE 7)', b'Success'
+    ])
+    estimate = await estimate_archive(imap_conn, 'user@example.com', 'token', 30)
+    assert imap_conn.protocol.state == 'SELECTED'
+    assert estimate == {
+        'by_year': {
+            2020: {
+                'bytes': 150,
+                'count': 2
+            },
+            None: {
+                'bytes': 7,
+                'count': 1
+            }
+        },
+        'count': 3,
+        'total_bytes': 157
+    }
+    imap_conn.examine.assert_called_once_with('"[Gmail]/All Mail"')
+    imap_conn.select.assert_not_called()
+    imap_conn.store.assert_not_called()
+
+
+async def test_estimate_archive_no_messages() -> None:
+    imap_conn = AsyncMock()
+    imap_conn.examine.return_value = Response('OK', [b''])
+    imap_conn.search.return_value = Response('NO', [])
+    estimate = await estimate_archive(imap_conn, 'user@example.com', 'token')
+    assert estimate == {'by_year': {}, 'count': 0, 'total_bytes': 0}
+    imap_conn.fetch.assert_not_called()
+
+
+async def test_estimate_archive_examine_fails() -> None:
+    imap_conn = AsyncMock()
+    imap_conn.examine.return_value = Response('NO', [b'Unknown mailbox'])
+    assert await estimate_archive(imap_conn, 'user@example.com', 'token') is None
+    imap_conn.search.assert_not_called()
+    assert imap_conn.protocol.state != 'SELECTED'
+
+
+def make_sized_imap(sizes: dict[str, int], uids: dict[str, str] | None = None) -> AsyncMock:
+    imap_conn = AsyncMock()
+    imap_conn.select.return_value = Response('OK', [b'OK [UIDVALIDITY 7] UIDs valid'])
+    msg_bytes = b'Date: Fri, 01 Jan 2021 12:00:00 +0000\r\n\r\nBody'
+    uids = uids or {x: str(int(x) * 10) for x in sizes}
+
+    async def search(criteria: str) -> Response:
+        if criteria.startswith('UID '):
+            wanted = parse_message_set(criteria.removeprefix('UID '))
+            return Response('OK',
+                            [' '.join(x for x, uid in uids.items() if uid in wanted).encode()])
+        return Response('OK', [' '.join(sizes).encode()])
+
+    async def fetch(num: str, parts: str) -> Response:
+        if parts == '(RFC822.SIZE INTERNALDATE)':
+            return Response('OK', [
+                f'{number} FETCH (RFC822.SIZE {size})'.encode()
+                for number, size in sizes.items() if number in parse_message_set(num)
+            ])
+        if parts == '(RFC822)':
+            return Response('OK', [f'{num} FETCH (RFC822 {{1}}'.encode(), bytearray(msg_bytes)])
+        if parts == '(UID)':
+            return Response('OK', [
+                f'{number} FETCH (UID {uid})'.encode()
+                for number, uid in uids.items() if number in parse_message_set(num)
+            ])
+        return Response('OK', [])
+
+    imap_conn.search.side_effect = search
+    imap_conn.fetch.side_effect = fetch
+    return imap_conn
+
+
+async def test_archive_emails_stops_at_quota_and_resumes(tmp_path: Path) -> None:
+    email = 'user@example.com'
+    quota_path = AsyncPath(tmp_path / 'quota.json')
+    imap_conn = make_sized_imap({'1': 40, '2': 40, '3': 40})
+    quota = DailyQuota(quota_path, email, 100)
+    stats = RunStats()
+    rate_limiter = AsyncMock()
+    result = await archive_emails(imap_conn,
+                                  email,
+                                  'token',
+                                  AsyncPath(tmp_path / 'out'),
+                                  plan=True,
+                                  quota=quota,
+                                  rate_limiter=rate_limiter,
+                                  stats=stats)
+    assert result == 0
+    assert stats.messages == 2
+    assert rate_limiter.consume.call_count == 2
+    assert set(stats.phases) == {
+        'exists', 'fetch', 'labels', 'message', 'mkdir', 'parse', 'search', 'write'
+    }
+    assert stats.phases['fetch'].count == 2
+    assert stats.phases['fetch'].bytes == stats.bytes_downloaded
+    data = json.loads(await quota_path.read_text())
+    assert data[email]['resume'] == {'[Gmail]/All Mail': {'uids': '10,20', 'uidvalidity': '7'}}
+    assert sum(data[email]['usage'].values()) == stats.bytes_downloaded
+    # Message 1 was expunged by another client, so the others moved down one sequence number.
+    imap_conn = make_sized_imap({'1': 40, '2': 40}, {'1': '20', '2': '30'})
+    quota = DailyQuota(quota_path, email, 1000)
+    stats = RunStats()
+    result = await archive_emails(imap_conn,
+                                  email,
+                                  'token',
+                                  AsyncPath(tmp_path / 'out'),
+                                  plan=True,
+                                  quota=quota,
+                                  stats=stats)
+    assert result == 0
+    assert stats.messages == 1
+    assert [x.args[0] for x in imap_conn.fetch.await_args_list if x.args[1] == '(RFC822)'] == ['2']
+    assert 'resume' not in json.loads(await quota_path.read_text())[email]
+
+
+async def test_archive_emails_quota_without_plan(tmp_path: Path) -> None:
+    imap_conn = make_sized_imap({'1': 40, '2': 40, '3': 40})
+    stats = RunStats()
+    result = await archive_emails(imap_conn,
+                                  'user@example.com',
+                                  'token',
+                                  AsyncPath(tmp_path),
+                                  quota=DailyQuota(AsyncPath(tmp_path / 'quota.json'),
+                                                   'user@example.com', 100),
+                                  stats=stats)
+    assert result == 0
+    assert stats.messages == 2
+    imap_conn.fetch.assert_any_await('1:3', '(RFC822.SIZE INTERNALDATE)')
+
+
+async def test_archive_emails_quota_with_delete_does_not_record_resume(tmp_path: Path) -> None:
+    email = 'user@example.com'
+    quota_path = AsyncPath(tmp_path / 'quota.json')
+    imap_conn = make_sized_imap({'1': 40, '2': 40})
+    quota = DailyQuota(quota_path, email, 50)
+    result = await archive_emails(imap_conn,
+                                  email,
+                                  'token',
+                                  AsyncPath(tmp_path),
+                                  delete=True,
+                                  plan=True,
+                                  quota=quota)
+    assert result == 0
+    assert imap_conn.store.call_count == 1
+    assert 'resume' not in json.loads(await quota_path.read_text())[email]
+
+
+async def test_archive_emails_saves_quota_periodically(mocker: MockerFixture,
+                                                       tmp_path: Path) -> None:
+    mocker.patch('gmail_archiver.utils._QUOTA_SAVE_INTERVAL', 1)
+    email = 'user@example.com'
+    imap_conn = make_sized_imap({'1': 40, '2': 40})
+    quota = DailyQuota(AsyncPath(tmp_path / 'quota.json'), email)
+    save = mocker.spy(quota, 'save')
+    result = await archive_emails(imap_conn, email, 'token', AsyncPath(tmp_path), quota=quota)
+    assert result == 0
+    assert save.call_count == 3
+
+
+def make_batch_imap(labels: dict[str, bytes], failures: int = 0) -> AsyncMock:
+    imap_conn = AsyncMock()
+    imap_conn.select.return_value = Response('OK', [b''])
+    imap_conn.search.return_value = Response('OK', [' '.join(labels).encode()])
+    msg_bytes = b'Date: Fri, 01 Jan 2021 12:00:00 +0000\r\n\r\nBody'
+    remaining_failures = failures
+
+    async def fetch(num: str, parts: str) -> Response:
+        nonlocal remaining_failures
+        if parts == '(X-GM-MSGID X-GM-THRID X-GM-LABELS RFC822)':
+            if remaining_failures:
+                remaining_failures -= 1
+                return Response('NO', [b'Try again'])
+            lines: list[bytes | bytearray] = []
+            for number in parse_message_set(num):
+                if number in labels:
+                    lines += [
+                        f'{number} FETCH (X-GM-LABELS ('.encode() + labels[number] +
+                        f') RFC822 {{{len(msg_bytes)}}}'.encode(),
+                        bytearray(msg_bytes), b')'
+                    ]
+            return Response('OK', [*lines, b'Success'])
+        return Response('OK', [])
+
+    imap_conn.fetch.side_effect = fetch
+    return imap_conn
+
+
+async def test_archive_emails_adaptive_batches(tmp_path: Path) -> None:
+    imap_conn = make_batch_imap({'1': b'\\Inbox "My \\"label\\""', '2': b'\\Sent', '3': b''})
+    stats = RunStats()
+    result = await archive_emails(imap_conn,
+                                  'user@example.com',
+                                  'token',
+                                  AsyncPath(tmp_path),
+                                  adaptive=True,
+                                  delete=True,
+                                  stats=stats)
+    assert result == 0
+    imap_conn.fetch.assert_called_once_with('1:3', '(X-GM-MSGID X-GM-THRID X-GM-LABELS RFC822)')
+    imap_conn.store.assert_called_once_with('1:3', '+X-GM-LABELS', '\\Trash')
+    assert len(list(tmp_path.rglob('*.eml'))) == 3
+    labels = {x.name: json.loads(x.read_text()) for x in tmp_path.rglob('*.labels.json')}
+    assert labels == {
+        '0000000001.labels.json': ['\\Inbox', 'My "label"'],
+        '0000000002.labels.json': ['\\Sent']
+    }
+    assert stats.messages == 3
+    assert stats.batch_size == 15
+    assert stats.window == 3
+    assert stats.retries == 0
+    assert stats.phases['fetch'].count == 1
+    assert stats.phases['parse-fetch'].count == 1
+    assert stats.phases['message'].count == 3
+    assert stats.phases['trash'].count == 1
+
+
+async def test_archive_emails_adaptive_retries_smaller_batch(tmp_path: Path) -> None:
+    imap_conn = make_batch_imap({str(x): b'\\Inbox' for x in range(1, 13)}, failures=1)
+    stats = RunStats()
+    result = await archive_emails(imap_conn,
+                                  'user@example.com',
+                                  'token',
+                                  AsyncPath(tmp_path),
+                                  adaptive=True,
+                                  stats=stats)
+    assert result == 0
+    assert [x.args[0] for x in imap_conn.fetch.call_args_list] == ['1:10', '1:5', '6:12']
+    assert stats.retries == 1
+    assert stats.messages == 12
+
+
+async def test_archive_emails_adaptive_fetch_error(tmp_path: Path) -> None:
+    imap_conn = make_batch_imap({'1': b'\\Inbox'}, failures=1)
+    result = await archive_emails(imap_conn,
+                                  'user@example.com',
+                                  'token',
+                                  AsyncPath(tmp_path),
+                                  adaptive=True)
+    assert result == 1
+
+
+async def test_archive_emails_adaptive_missing_message(tmp_path: Path) -> None:
+    imap_conn = make_batch_imap({'1': b'\\Inbox'})
+    imap_conn.search.return_value = Response('OK', [b'1 2'])
+    result = await archive_emails(imap_conn,
+                                  'user@example.com',
+                                  'token',
+                                  AsyncPath(tmp_path),
+                                  adaptive=True,
+                                  delete=True)
+    assert result == 1
+    imap_conn.store.assert_called_once_with('1', '+X-GM-LABELS', '\\Trash')
+    assert len(list(tmp_path.rglob('*.eml'))) == 1
+
+
+async def test_archive_emails_adaptive_bad_date(mocker: MockerFixture, tmp_path: Path) -> None:
+    mocker.patch('gmail_archiver.utils.parsedate_tz', return_value=None)
+    imap_conn = make_batch_imap({'1': b'\\Inbox'})
+    result = await archive_emails(imap_conn,
+                                  'user@example.com',
+                                  'token',
+                                  AsyncPath(tmp_path),
+                                  adaptive=True)
+    assert result == 1
+
+
+async def test_archive_emails_adaptive_streams_large_messages(mocker: MockerFixture,
+                                                              tmp_path: Path) -> None:
+    mocker.patch('gmail_archiver.utils._STREAM_CHUNK_SIZE', 1024)
+    imap_conn = make_batch_imap({'1': b'\\Inbox', '2': b'\\Inbox'})
+    sized = make_sized_imap({'1': 10, '2': 5000})
+    batch_fetch = imap_conn.fetch.side_effect
+    body = b'Date: Fri, 01 Jan 2021 12:00:00 +0000\r\n\r\nBody'
+
+    async def fetch(num: str, parts: str) -> Response:
+        if parts.startswith('(BODY.PEEK[]'):
+            return Response('OK', [b'2 FETCH (BODY[]<0> {10}', bytearray(body)])
+        if parts == '(X-GM-MSGID X-GM-THRID X-GM-LABELS RFC822)':
+            return await batch_fetch(num, parts)
+        return await sized.fetch.side_effect(num, parts)
+
+    imap_conn.fetch.side_effect = fetch
+    result = await archive_emails(imap_conn,
+                                  'user@example.com',
+                                  'token',
+                                  AsyncPath(tmp_path),
+                                  adaptive=True,
+                                  large_message_size=1000,
+                                  plan=True)
+    assert result == 0
+    fetched = [x.args for x in imap_conn.fetch.call_args_list]
+    assert ('1', '(X-GM-MSGID X-GM-THRID X-GM-LABELS RFC822)') in fetched
+    assert ('2', '(BODY.PEEK[]<0.1024>)') in fetched
+    assert len(list(tmp_path.rglob('*.eml'))) == 2
+
+
+async def test_archive_emails_compress(mocker: MockerFixture, tmp_path: Path) -> None:
+    enable_compression = mocker.patch('gmail_archiver.utils.enable_compression',
+                                      new_callable=AsyncMock)
+    imap_conn = AsyncMock()
+    imap_conn.select.return_value = Response('OK', [b''])
+    imap_conn.search.return_value = Response('OK', [b''])
+    stats = RunStats()
+    result = await archive_emails(imap_conn,
+                                  'user@example.com',
+                                  'token',
+                                  AsyncPath(tmp_path),
+                                  compress=True,
+                                  stats=stats)
+    assert result == 0
+    enable_compression.assert_awaited_once_with(imap_conn, stats)
+
+
+DISCOVERY_DOCUMENT = {
+    'authorization_endpoint': 'https://accounts.google.com/o/oauth2/v2/auth',
+    'device_authorization_endpoint': 'https://oauth2.googleapis.com/device/code',
+    'token_endpoint': 'https://oauth2.googleapis.com/token'
+}
+
+
+def make_discovery_session(status_code: int = 200,
+                           headers: dict[str, str] | None = None) -> MagicMock:
+    mock_response = MagicMock()
+    mock_response.status_code = status_code
+    mock_response.headers = headers or {}
+    mock_response.json.return_value = DISCOVERY_DOCUMENT
+    session = MagicMock()
+    session.get = AsyncMock(return_value=mock_response)
+    return session
+
+
+async def test_google_oauth_client_caches_discovery(tmp_path: Path) -> None:
+    cache_file = AsyncPath(tmp_path / 'discovery.json')
+    session = make_discovery_session(headers={
+        'Cache-Control': 'public, max-age=3600',
+        'ETag': '"abc"'
+    })
+    client = GoogleOAuthClient('cid', 'secret', cache_file=cache_file, session=session)
+    await client.discover()
+    assert client.token_endpoint == DISCOVERY_DOCUMENT['token_endpoint']
+    cached = json.loads(await cache_file.read_text())
+    assert cached['document'] == DISCOVERY_DOCUMENT
+    assert cached['etag'] == '"abc"'
+    expires = datetime.fromisoformat(cached['expires']) - datetime.now(timezone.utc)
+    assert timedelta(minutes=59) < expires <= timedelta(hours=1)
+    client = GoogleOAuthClient('cid', 'secret', cache_file=cache_file, session=session)
+    await client.discover()
+    assert client.authorization_endpoint == DISCOVERY_DOCUMENT['authorization_endpoint']
+    session.get.assert_awaited_once()
+
+
+async def test_google_oauth_client_revalidates_expired_cache(tmp_path: Path) -> None:
+    cache_file = AsyncPath(tmp_path / 'discovery.json')
+    await cache_file.write_text(
+        json.dumps({
+            'document': DISCOVERY_DOCUMENT,
+            'etag': '"abc"',
+            'expires': (datetime.now(timezone.utc) - timedelta(seconds=1)).isoformat()
+        }))
+    session = make_discovery_session(304)
+    client = GoogleOAuthClient('cid', 'secret', cache_file=cache_file, session=session, ttl=60)
+    await client.discover()
+    session.get.assert_awaited_once_with(
+        'https://accounts.google.com/.well-known/openid-configuration',
+        headers={'If-None-Match': '"abc"'})
+    session.get.return_value.raise_for_status.assert_not_called()
+    assert client.device_authorization_endpoint == (
+        DISCOVERY_DOCUMENT['device_authorization_endpoint'])
+    cached = json.loads(await cache_file.read_text())
+    assert cached['etag'] == '"abc"'
+    assert datetime.fromisoformat(cached['expires']) > datetime.now(timezone.utc)
+
+
+async def test_google_oauth_client_ignores_invalid_cache(tmp_path: Path) -> None:
+    cache_file = AsyncPath(tmp_path / 'discovery.json')
+    await cache_file.write_text('{')
+    session = make_discovery_session()
+    client = GoogleOAuthClient('cid', 'secret', cache_file=cache_file, session=session)
+    await client.discover()
+    session.get.assert_awaited_once_with(
+        'https://accounts.google.com/.well-known/openid-configuration')
+    cached = json.loads(await cache_file.read_text())
+    assert 'etag' not in cached
+
+
+async def test_oauth_requests_share_session(mocker: MockerFixture) -> None:
+    new_session = mocker.patch('gmail_archiver.utils.niquests.AsyncSession')
+    response = MagicMock()
+    response.json.return_value = {'access_token': 'token'}
+    session = MagicMock()
+    session.post = AsyncMock(return_value=response)
+    assert await refresh_token('https://test/token', 'cid', 'secret', 'refresh',
+                               session=session) == {
+                                   'access_token': 'token'
+                               }
+    assert await authorize_tokens('https://test/token',
+                                  'cid',
+                                  'secret',
+                                  'code',
+                                  '',
+                                  '',
+                                  session=session) == {
+                                      'access_token': 'token'
+                                  }
+    assert session.post.await_count == 2
+    new_session.assert_not_called()
+    assert oauth_session() is new_session.return_value
+
+
+async def test_archive_emails_syncs_before_trash(mocker: MockerFixture, tmp_path: Path) -> None:
+    imap_conn = make_batch_imap({'1': b'\\Inbox', '2': b''})
+    events: list[str] = []
+    mocker.patch('gmail_archiver.commit.os.fsync', side_effect=lambda _: events.append('fsync'))
+    imap_conn.store.side_effect = lambda *_: events.append('store')
+    stats = RunStats()
+    result = await archive_emails(imap_conn,
+                                  'user@example.com',
+                                  'token',
+                                  AsyncPath(tmp_path),
+                                  adaptive=True,
+                                  delete=True,
+                                  stats=stats)
+    assert result == 0
+    # Two messages, one labels file, the day, month, year, account and output directories.
+    assert events == ['fsync'] * 8 + ['store']
+    assert stats.phases['sync'].count == 1
+
+
+async def test_archive_emails_does_not_sync_without_delete(mocker: MockerFixture,
+                                                           tmp_path: Path) -> None:
+    imap_conn = make_batch_imap({'1': b'\\Inbox'})
+    fsync = mocker.patch('gmail_archiver.commit.os.fsync')
+    assert await archive_emails(imap_conn,
+                                'user@example.com',
+                                'token',
+                                AsyncPath(tmp_path),
+                                adaptive=True) == 0
+    fsync.assert_not_called()
+    imap_conn.store.assert_not_called()
+
+
+async def test_archive_emails_keep_going_unknown_date(tmp_path: Path) -> None:
+    date = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    messages = [
+        FakeMessage(1, b'Date: Fri, 01 Jan 2021 12:00:00 +0000\r\n\r\nOne', date),
+        FakeMessage(5, b'Date: not a date\r\n\r\nTwo', date),
+        FakeMessage(9, b'Date: Fri, 01 Jan 2021 12:00:00 +0000\r\n\r\nThree', date)
+    ]
+    errors = ErrorManifest(AsyncPath(tmp_path / 'errors.json'), 'user@example.com')
+    async with FakeGmailServer(messages) as server:
+        imap_conn = aioimaplib.IMAP4('127.0.0.1', server.port)
+        await imap_conn.wait_hello_from_server()
+        result = await archive_emails(imap_conn,
+                                      'user@example.com',
+                                      'token',
+                                      AsyncPath(tmp_path / 'out'),
+                                      adaptive=True,
+                                      delete=True,
+                                      errors=errors,
+                                      keep_going=True)
+        await imap_conn.logout()
+    assert result == 0
+    assert (tmp_path / 'out' / 'user@example.com' / 'unknown-date' /
+            f'{messages[1].msgid}.eml').read_bytes() == messages[1].body + b'\n'
+    assert len(list((tmp_path / 'out').rglob('*.eml'))) == 3
+    assert all('\\Trash' in x.labels for x in messages)
+    data = json.loads((tmp_path / 'errors.json').read_text(encoding='utf-8'))
+    failure = data['user@example.com']['failures'][0]
+    assert failure['archived']
+    assert failure['number'] == '2'
+    assert failure['reason'] == 'unparseable date'
+    assert failure['snippet'] == 'not a date'
+    assert failure['uid'] == '5'
+    assert data['user@example.com']['uidvalidity'] == str(server.uid_validity)
+
+
+def make_failing_imap() -> AsyncMock:
+    imap_conn = AsyncMock()
+    imap_conn.select.return_value = Response('OK', [b'[UIDVALIDITY 7] UIDs valid.'])
+    imap_conn.search.return_value = Response('OK', [b'1 2'])
+    msg_bytes = b'Date: Fri, 01 Jan 2021 12:00:00 +0000\r\n\r\nBody'
+
+    async def fetch(num: str, parts: str) -> Response:
+        if parts == '(UID)':
+            return Response('OK', [f'{num} FETCH (UID 41)'.encode(), b'Success'])
+        if num == '1':
+            return Response('NO', [b'[UNAVAILABLE] Temporary System Error'])
+        if parts == '(RFC822)':
+            return Response('OK', [b'2 FETCH (RFC822 {44}', bytearray(msg_bytes), b')'])
+        return Response('OK', [])
+
+    imap_conn.fetch.side_effect = fetch
+    return imap_conn
+
+
+async def test_archive_emails_keep_going_fetch_failure(tmp_path: Path) -> None:
+    imap_conn = make_failing_imap()
+    errors = ErrorManifest(AsyncPath(tmp_path / 'errors.json'), 'user@example.com')
+    result = await archive_emails(imap_conn,
+                                  'user@example.com',
+                                  'token',
+                                  AsyncPath(tmp_path / 'out'),
+                                  delete=True,
+                                  errors=errors,
+                                  keep_going=True)
+    assert result == 1
+    assert len(list((tmp_path / 'out').rglob('*.eml'))) == 1
+    imap_conn.store.assert_called_once_with('2', '+X-GM-LABELS', '\\Trash')
+    await errors.load()
+    assert errors.previous['uidvalidity'] == '7'
+    failure = errors.previous['failures'][0]
+    assert not failure['archived']
+    assert failure['reason'] == 'fetch failed'
+    assert failure['snippet'] == '[UNAVAILABLE] Temporary System Error'
+    assert failure['uid'] == '41'
+    assert errors.retry_uids('7') == ['41']
+
+
+async def test_archive_emails_stops_at_failure(tmp_path: Path) -> None:
+    imap_conn = make_failing_imap()
+    errors = ErrorManifest(AsyncPath(tmp_path / 'errors.json'), 'user@example.com')
+    result = await archive_emails(imap_conn,
+                                  'user@example.com',
+                                  'token',
+                                  AsyncPath(tmp_path / 'out'),
+                                  errors=errors)
+    assert result == 1
+    assert not list((tmp_path / 'out').rglob('*.eml'))
+    await errors.load()
+    assert [x['uid'] for x in errors.previous['failures']] == ['41']
+
+
+async def test_archive_emails_retry_failed(tmp_path: Path) -> None:
+    imap_conn = make_failing_imap()
+    imap_conn.search.return_value = Response('OK', [b'2'])
+    path = tmp_path / 'errors.json'
+    path.write_text(json.dumps({
+        'user@example.com': {
+            'failures': [{
+                'archived': False,
+                'number': '9',
+                'reason': 'fetch failed',
+                'snippet': '',
+                'time': '2026-01-01T00:00:00+00:00',
+                'uid': '41'
+            }],
+            'uidvalidity': '7'
+        }
+    }),
+                    encoding='utf-8')
+    errors = ErrorManifest(AsyncPath(path), 'user@example.com')
+    result = await archive_emails(imap_conn,
+                                  'user@example.com',
+                                  'token',
+                                  AsyncPath(tmp_path / 'out'),
+                                  errors=errors,
+                                  retry_failed=True)
+    assert result == 0
+    imap_conn.search.assert_called_once_with('UID 41')
+    assert len(list((tmp_path / 'out').rglob('*.eml'))) == 1
+    assert json.loads(path.read_text(encoding='utf-8')) == {}
+
+
+async def test_archive_emails_retry_failed_nothing_to_retry(tmp_path: Path) -> None:
+    imap_conn = make_failing_imap()
+    errors = ErrorManifest(AsyncPath(tmp_path / 'errors.json'), 'user@example.com')
+    assert await archive_emails(imap_conn,
+                                'user@example.com',
+                                'token',
+                                AsyncPath(tmp_path / 'out'),
+                                errors=errors,
+                                retry_failed=True) == 0
+    imap_conn.search.assert_not_called()
+    imap_conn.fetch.assert_not_called()
+
+
+async def _archive_and_sync(server: FakeGmailServer, out: Path, *, archive: bool = False) -> int:
+    imap_conn = aioimaplib.IMAP4('127.0.0.1', server.port)
+    await imap_conn.wait_hello_from_server()
+    index = MessageIndex(AsyncPath(out / 'user@example.com' / INDEX_FILE))
+    if archive:
+        ret = await archive_emails(imap_conn,
+                                   'user@example.com',
+                                   'token',
+                                   AsyncPath(out),
+                                   delete=False,
+                                   index=index)
+    else:
+        ret = await sync_labels(imap_conn, 'user@example.com', 'token', index)
+    await imap_conn.logout()
+    return ret
+
+
+async def test_sync_labels(tmp_path: Path, caplog: pytest.LogCaptureFixture) -> None:
+    date = datetime(2021, 1, 1, 12, tzinfo=timezone.utc)
+    messages = [
+        FakeMessage(i, f'Date: Fri, 01 Jan 2021 12:00:00 +0000\r\n\r\n{i}'.encode(), date,
+                    ['\\Inbox']) for i in (1, 2, 3)
+    ]
+    labels_files = [
+        tmp_path / 'user@example.com' / '2021' / '01-Jan' / '01-Fri' / f'{x.msgid}.labels.json'
+        for x in messages
+    ]
+    caplog.set_level('INFO', logger='gmail_archiver.utils')
+    async with FakeGmailServer(messages) as server:
+        assert await _archive_and_sync(server, tmp_path, archive=True) == 0
+        fetches = server.commands['FETCH']
+        messages[0].labels = ['Work']
+        messages[0].modseq = server.next_modseq()
+        assert await _archive_and_sync(server, tmp_path) == 0
+        assert 'Updated the labels of 3 archived messages.' in caplog.text
+        assert json.loads(labels_files[0].read_text()) == ['Work']
+        messages[1].labels = []
+        messages[1].modseq = server.next_modseq()
+        caplog.clear()
+        assert await _archive_and_sync(server, tmp_path) == 0
+        assert 'Updated the labels of 1 archived messages.' in caplog.text
+        assert not labels_files[1].exists()
+        assert json.loads(labels_files[2].read_text()) == ['\\Inbox']
+        caplog.clear()
+        assert await _archive_and_sync(server, tmp_path) == 0
+        assert 'No labels changed since the last sync.' in caplog.text
+        assert server.commands['FETCH'] == fetches + 2
+    assert len(server.messages) == 3
+    index = json.loads((tmp_path / 'user@example.com' / INDEX_FILE).read_text())
+    assert index['highestmodseq'] == str(messages[1].modseq)
+    assert index['messages'][str(messages[0].msgid)] == {
+        'labels': f'2021/01-Jan/01-Fri/{messages[0].msgid}.labels.json',
+        'message': f'2021/01-Jan/01-Fri/{messages[0].msgid}.eml',
+        'thread': str(messages[0].thrid)
+    }
+
+
+async def test_archive_emails_skips_indexed_messages(tmp_path: Path,
+                                                     caplog: pytest.LogCaptureFixture) -> None:
+    messages = generate_mailbox(4, seed=1)
+    index_path = AsyncPath(tmp_path / 'user@example.com' / INDEX_FILE)
+    caplog.set_level('INFO', logger='gmail_archiver.utils')
+    async with FakeGmailServer(messages) as server:
+        for delete in (False, True):
+            imap_conn = aioimaplib.IMAP4('127.0.0.1', server.port)
+            await imap_conn.wait_hello_from_server()
+            index = MessageIndex(index_path)
+            assert await archive_emails(imap_conn,
+                                        'user@example.com',
+                                        'token',
+                                        AsyncPath(tmp_path),
+                                        delete=delete,
+                                        index=index) == 0
+            await imap_conn.logout()
+            if not delete:
+                fetches = server.commands['FETCH']
+                next(tmp_path.rglob(f'{messages[3].msgid}.eml')).unlink()
+    assert 'Skipping 4 messages archived by a previous run.' in caplog.text
+    assert 'Not deleting 1 archived messages whose files are missing.' in caplog.text
+    assert server.commands['FETCH'] == fetches + 1
+    assert [x.uid for x in server.messages if '\\Trash' not in x.labels] == [4]
+    assert [x.name for x in index.thread(str(messages[0].thrid))] == [
+        f'{messages[0].msgid}.eml', f'{messages[1].msgid}.eml'
+    ]
+
+
+async def test_archive_emails_tar_members(tmp_path: Path, caplog: pytest.LogCaptureFixture) -> None:
+    messages = generate_mailbox(3, seed=1)
+    index_path = AsyncPath(tmp_path / 'user@example.com' / INDEX_FILE)
+    async with FakeGmailServer(messages) as server:
+        for delete in (False, True):
+            imap_conn = aioimaplib.IMAP4('127.0.0.1', server.port)
+            await imap_conn.wait_hello_from_server()
+            async with await AsyncPath(tmp_path / f'{delete}.tar').open('wb') as stream:
+                writer = TarWriter(AsyncPath(tmp_path), stream)
+                assert await archive_emails(imap_conn,
+                                            'user@example.com',
+                                            'token',
+                                            AsyncPath(tmp_path),
+                                            delete=delete,
+                                            index=MessageIndex(index_path),
+                                            writer=writer) == 0
+                await writer.close()
+            await imap_conn.logout()
+            if not delete:
+                assert await _archive_and_sync(server, tmp_path) == 0
+                assert ('Labels of 3 messages in tar archives or object storage were not '
+                        'updated.') in caplog.text
+    assert all('\\Trash' in x.labels for x in server.messages)
+    assert not list(tmp_path.rglob('*.eml'))
+
+
+async def test_archive_emails_s3_objects(tmp_path: Path) -> None:
+    messages = generate_mailbox(3, seed=1)
+    index_path = AsyncPath(tmp_path / 'user@example.com' / INDEX_FILE)
+    async with (FakeGmailServer(messages) as server, FakeS3Server() as
+                s3_server, niquests.AsyncSession() as session):
+        writer = S3Writer(
+            AsyncPath(tmp_path),
+            S3Client(session,
+                     s3_server.url,
+                     s3_server.bucket,
+                     access_key_id=s3_server.access_key_id,
+                     secret_access_key=s3_server.secret_access_key))
+        for delete in (False, True):
+            imap_conn = aioimaplib.IMAP4('127.0.0.1', server.port)
+            await imap_conn.wait_hello_from_server()
+            assert await archive_emails(imap_conn,
+                                        'user@example.com',
+                                        'token',
+                                        AsyncPath(tmp_path),
+                                        delete=delete,
+                                        index=MessageIndex(index_path),
+                                        writer=writer) == 0
+            await imap_conn.logout()
+    assert len([x for x in s3_server.objects if x.endswith('.eml')]) == 3
+    assert all('\\Trash' in x.labels for x in server.messages)
+
+
+async def test_archive_emails_query(tmp_path: Path) -> None:
+    date = datetime(2021, 1, 1, 12, tzinfo=timezone.utc)
+    head = b'Date: Fri, 01 Jan 2021 12:00:00 +0000\r\n\r\n'
+    messages = [
+        FakeMessage(1, head + b'Keep', date),
+        FakeMessage(2, head + b'Sale', date, ['Promotions']),
+        FakeMessage(3, head + b'x' * 2000, date),
+    ]
+    async with FakeGmailServer(messages) as server:
+        imap_conn = aioimaplib.IMAP4('127.0.0.1', server.port)
+        await imap_conn.wait_hello_from_server()
+        assert await archive_emails(imap_conn,
+                                    'user@example.com',
+                                    'token',
+                                    AsyncPath(tmp_path),
+                                    delete=True,
+                                    query='-label:"Promotions" smaller:1K') == 0
+        await imap_conn.logout()
+    assert [x.name for x in tmp_path.rglob('*.eml')] == [f'{messages[0].msgid}.eml']
+    assert [x.uid for x in server.messages if '\\Trash' in x.labels] == [1]
+
+
+async def test_sync_labels_batches_and_write_errors(mocker: MockerFixture, tmp_path: Path,
+                                                    caplog: pytest.LogCaptureFixture) -> None:
+    mocker.patch('gmail_archiver.utils.DEFAULT_INFO_BATCH_SIZE', 3)
+    index_path = AsyncPath(tmp_path / INDEX_FILE)
+    index = MessageIndex(index_path)
+    for msgid, directory in (('10', 'kept'), ('20', 'removed'), ('30', 'blocked')):
+        index.add(msgid, index_path.parent / directory / f'{msgid}.eml',
+                  index_path.parent / directory / f'{msgid}.labels.json')
+    await index.save()
+    (tmp_path / 'kept').mkdir()
+    (tmp_path / 'blocked' / '30.labels.json').mkdir(parents=True)
+    imap_conn = AsyncMock()
+    imap_conn.select.return_value = Response(
+        'OK', [b'7 EXISTS', b'OK [UIDVALIDITY 7] UIDs valid', b'OK [HIGHESTMODSEQ 99]'])
+
+    async def fetch(batch: str, items: str) -> Response:
+        start = int(batch.partition(':')[0])
+        return Response('OK', [
+            f'{x} FETCH (X-GM-MSGID {x * 10} X-GM-LABELS (Work))'.encode()
+            for x in range(start, min(start + 3, 8))
+        ] + [b'Success'])
+
+    imap_conn.fetch.side_effect = fetch
+    assert await sync_labels(imap_conn, 'user@example.com', 'token', MessageIndex(index_path)) == 1
+    assert [x.args[0] for x in imap_conn.fetch.await_args_list] == ['1:3', '4:6', '7:7']
+    assert json.loads((tmp_path / 'kept' / '10.labels.json').read_text()) == ['Work']
+    assert 'Labels of 1 archived messages whose files are missing were not updated.' in caplog.text
+    assert 'Labels of 1 archived messages could not be written.' in caplog.text
+    assert 'highestmodseq' not in json.loads(await index_path.read_text())
+
+
+async def test_sync_labels_nothing_indexed(tmp_path: Path) -> None:
+    date = datetime(2021, 1, 1, 12, tzinfo=timezone.utc)
+    async with FakeGmailServer([FakeMessage(1, b'Subject: a\r\n\r\nA', date)]) as server:
+        assert await _archive_and_sync(server, tmp_path) == 0
+        assert not server.commands['FETCH']
+    assert not (tmp_path / 'user@example.com' / INDEX_FILE).exists()
+
+
+async def test_sync_labels_select_failure(tmp_path: Path) -> None:
+    imap_conn = AsyncMock()
+    imap_conn.select.return_value = Response('NO', [b'Mailbox does not exist'])
+    index = MessageIndex(AsyncPath(tmp_path / INDEX_FILE))
+    assert await sync_labels(imap_conn, 'user@example.com', 'token', index) == 1
+    imap_conn.fetch.assert_not_called()
+
+
+async def test_sync_labels_fetch_failure(tmp_path: Path) -> None:
+    imap_conn = AsyncMock()
+    imap_conn.select.return_value = Response('OK', [b'[UIDVALIDITY 1]', b'[HIGHESTMODSEQ 9]'])
+    imap_conn.fetch.return_value = Response('NO', [b'Temporary System Error'])
+    index = MessageIndex(AsyncPath(tmp_path / INDEX_FILE))
+    index.add('1', tmp_path / 'a.eml', tmp_path / 'a.labels.json')
+    await index.save()
+    assert await sync_labels(imap_conn, 'user@example.com', 'token', index) == 1
+    imap_conn.fetch.assert_awaited_once_with('1:*', '(X-GM-MSGID X-GM-LABELS)')
+
+
+def test_mailbox_key() -> None:
+    assert mailbox_key('user@example.com', '[Gmail]/All Mail') == 'user@example.com'
+    assert mailbox_key('user@example.com', 'Work') == 'user@example.com Work'
+
+
+async def test_archive_mailboxes(tmp_path: Path) -> None:
+    now = datetime.now(timezone.utc)
+
+    def make(uid: int, days_ago: int, labels: list[str]) -> FakeMessage:
+        date = now - timedelta(days=days_ago)
+        return FakeMessage(uid, f'Date: {date:%a, %d %b %Y %H:%M:%S %z}\r\n\r\n{uid}'.encode(),
+                           date, labels)
+
+    messages = [
+        make(1, 200, ['\\Sent', 'Work']),
+        make(2, 210, ['\\Sent']),
+        make(3, 50, ['Work']),
+        make(4, 10, ['Work']),
+        make(5, 300, ['\\Inbox'])
+    ]
+    connections = 0
+
+    async with FakeGmailServer(messages) as server:
+
+        @asynccontextmanager
+        async def connect() -> AsyncIterator[aioimaplib.IMAP4]:
+            nonlocal connections
+            connections += 1
+            imap_conn = aioimaplib.IMAP4('127.0.0.1', server.port)
+            await imap_conn.wait_hello_from_server()
+            try:
+                yield imap_conn
+            finally:
+                await imap_conn.logout()
+
+        result = await archive_mailboxes(
+            connect,
+            'user@example.com',
+            'token',
+            AsyncPath(tmp_path / 'out'), [{
+                'name': '[Gmail]/Sent Mail',
+                'days': 100
+            }, {
+                'name': 'Work'
+            }, {
+                'name': 'Missing'
+            }],
+            30,
+            delete=True,
+            errors=ErrorManifest(AsyncPath(tmp_path / 'errors.json'), 'user@example.com'),
+            quota=DailyQuota(AsyncPath(tmp_path / 'quota.json'), 'user@example.com', 3000))
+    assert result == 1
+    assert connections == 3
+    bodies = sorted(x.read_bytes() for x in (tmp_path / 'out').rglob('*.eml'))
+    assert bodies == sorted(x.body + b'\n' for x in messages[:3])
+    assert all('\\Trash' in x.labels for x in messages[:3])
+    assert not any('\\Trash' in x.labels for x in messages[3:])
+    quota = json.loads((tmp_path / 'quota.json').read_text())
+    assert set(quota) == {'user@example.com'}
+    assert sum(quota['user@example.com']['usage'].values()) == sum(
+        len(x.body) for x in messages[:3])
+    index = json.loads((tmp_path / 'out' / 'user@example.com' / INDEX_FILE).read_text())
+    assert set(index['messages']) == {str(x.msgid) for x in messages[:3]}
@@ -0,0 +1,303 @@
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
+import io
+import json
+import mailbox
+import tarfile
+
+from anyio import Path as AsyncPath, wrap_file
+from gmail_archiver.s3 import S3Client
+from gmail_archiver.stats import RunStats
+from gmail_archiver.writers import (
+    EmlWriter,
+    MaildirWriter,
+    MboxWriter,
+    S3Writer,
+    TarWriter,
+    create_writer,
+)
+from tests.fake_s3_server import FakeS3Server
+from typing_extensions import override
+import niquests
+import pytest
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from pytest_mock import MockerFixture
+    from typing_extensions import Never
+
+DATE = datetime(2021, 1, 1, 12, tzinfo=timezone.utc)
+MESSAGE = b'Subject: a\r\n\r\nFrom here\r\n>From there\r\nbody\r\n'
+
+
+async def test_eml_writer(tmp_path: Path) -> None:
+    stats = RunStats()
+    writer = EmlWriter(AsyncPath(tmp_path), stats=stats)
+    written = await writer.write('a@example.com', '1', '1600', DATE, MESSAGE, ['\\Inbox'])
+    day = tmp_path / 'a@example.com' / '2021' / '01-Jan' / '01-Fri'
+    assert written == {
+        'files': [AsyncPath(day / '1600.eml'),
+                  AsyncPath(day / '1600.labels.json')],
+        'labels': AsyncPath(day / '1600.labels.json'),
+        'message': AsyncPath(day / '1600.eml')
+    }
+    assert (day / '1600.eml').read_bytes() == MESSAGE + b'\n'
+    assert json.loads((day / '1600.labels.json').read_text()) == ['\\Inbox']
+    assert stats.phases['write'].count == 1
+
+
+async def test_eml_writer_sequence_number_collision(tmp_path: Path) -> None:
+    writer = EmlWriter(AsyncPath(tmp_path))
+    await writer.write('a@example.com', '1', None, None, b'first', None)
+    written = await writer.write('a@example.com', '1', None, None, b'second', ['Work'])
+    unknown = tmp_path / 'a@example.com' / 'unknown-date'
+    assert (unknown / '0000000001.eml').read_bytes() == b'first\n'
+    assert written['message'].name.startswith('0000000001-')
+    assert await written['message'].read_bytes() == b'second\n'
+    assert await written['labels'].exists()
+    assert written['labels'].name == written['message'].name.replace('.eml', '.labels.json')
+
+
+async def test_eml_writer_write_file(tmp_path: Path) -> None:
+    writer = EmlWriter(AsyncPath(tmp_path))
+    part_file = writer.part_file('a@example.com', '3')
+    await part_file.parent.mkdir(parents=True)
+    await part_file.write_bytes(MESSAGE)
+    written = await writer.write_file('a@example.com',
+                                      '3',
+                                      '1600',
+                                      DATE,
+                                      part_file,
+                                      None,
+                                      digest=lambda: 'abcdef1',
+                                      size=len(MESSAGE))
+    assert await written['message'].read_bytes() == MESSAGE + b'\n'
+    assert not await part_file.exists()
+    assert written['files'] == [written['message']]
+
+
+async def test_maildir_writer(tmp_path: Path) -> None:
+    writer = MaildirWriter(AsyncPath(tmp_path))
+    first = await writer.write('a@example.com', '1', '1600', DATE, MESSAGE, ['\\Inbox'])
+    second = await writer.write('a@example.com', '2', None, None, b'Subject: b\r\n\r\nb\r\n',
+                                ['Work'])
+    maildir = tmp_path / 'a@example.com'
+    assert not list((maildir / 'tmp').iterdir())
+    assert sorted(x['subject'] for x in mailbox.Maildir(maildir)) == ['a', 'b']
+    assert await first['message'].read_bytes() == MESSAGE
+    assert first['message'].parent.name == 'new'
+    assert first['message'].name != second['message'].name
+    assert first['labels'] == AsyncPath(maildir / 'labels' / '1600.labels.json')
+    assert second['labels'].name == f'{second["message"].name}.labels.json'
+    assert json.loads(await second['labels'].read_text()) == ['Work']
+    assert second['files'] == [second['message'], second['labels']]
+
+
+async def test_maildir_writer_write_file(tmp_path: Path) -> None:
+    writer = MaildirWriter(AsyncPath(tmp_path))
+    part_file = writer.part_file('a@example.com', '3')
+    assert part_file.parent.name == 'tmp'
+    await part_file.parent.mkdir(parents=True)
+    await part_file.write_bytes(MESSAGE)
+    written = await writer.write_file('a@example.com',
+                                      '3',
+                                      '1600',
+                                      DATE,
+                                      part_file,
+                                      None,
+                                      digest=lambda: 'abcdef1',
+                                      size=len(MESSAGE))
+    assert written['message'] == AsyncPath(tmp_path / 'a@example.com' / 'new' / part_file.name)
+    assert await written['message'].read_bytes() == MESSAGE
+    assert not await part_file.exists()
+
+
+async def test_mbox_writer_buffers_and_escapes(tmp_path: Path) -> None:
+    writer = MboxWriter(AsyncPath(tmp_path))
+    written = await writer.write('a@example.com', '1', '1600', DATE, MESSAGE, ['\\Inbox'])
+    await writer.write('a@example.com', '2', '1601', DATE, b'Subject: b\r\n\r\nno newline', None)
+    await writer.write('a@example.com', '3', None, None, b'Subject: c\r\n\r\nc\r\n', ['Work'])
+    mbox = tmp_path / 'a@example.com' / '2021' / '01-Jan.mbox'
+    assert written['message'] == AsyncPath(mbox)
+    assert written['files'] == [AsyncPath(mbox), written['labels']]
+    assert not mbox.exists()
+    assert json.loads(await written['labels'].read_text()) == ['\\Inbox']
+    await writer.flush()
+    assert mbox.read_bytes() == (b'From MAILER-DAEMON Fri Jan  1 12:00:00 2021\n'
+                                 b'Subject: a\n\n>From here\n>>From there\nbody\n\n'
+                                 b'From MAILER-DAEMON Fri Jan  1 12:00:00 2021\n'
+                                 b'Subject: b\n\nno newline\n\n')
+    assert [x['subject'] for x in mailbox.mbox(mbox)] == ['a', 'b']
+    unknown = tmp_path / 'a@example.com' / 'unknown-date.mbox'
+    assert [x['subject'] for x in mailbox.mbox(unknown)] == ['c']
+    assert len(list((tmp_path / 'a@example.com' / 'labels').glob('0000000003-*.labels.json'))) == 1
+
+
+async def test_mbox_writer_flushes_at_buffer_size(tmp_path: Path) -> None:
+    writer = MboxWriter(AsyncPath(tmp_path), buffer_size=len(MESSAGE))
+    await writer.write('a@example.com', '1', '1600', DATE, MESSAGE, None)
+    assert await (AsyncPath(tmp_path) / 'a@example.com' / '2021' / '01-Jan.mbox').exists()
+
+
+async def test_mbox_writer_write_file(tmp_path: Path, mocker: MockerFixture) -> None:
+    mocker.patch('gmail_archiver.writers._READ_CHUNK_SIZE', 5)
+    writer = MboxWriter(AsyncPath(tmp_path))
+    await writer.write('a@example.com', '1', '1600', DATE, b'Subject: a\r\n\r\na\r\n', None)
+    part_file = writer.part_file('a@example.com', '2')
+    await part_file.parent.mkdir(parents=True)
+    await part_file.write_bytes(MESSAGE * 3)
+    written = await writer.write_file('a@example.com',
+                                      '2',
+                                      None,
+                                      DATE,
+                                      part_file, ['Work'],
+                                      digest=lambda: 'abcdef1234',
+                                      size=len(MESSAGE) * 3)
+    assert not await part_file.exists()
+    assert written['labels'].name == '0000000002-abcdef1.labels.json'
+    escaped = b'Subject: a\n\n>From here\n>>From there\nbody\n'
+    assert await written['message'].read_bytes() == (
+        b'From MAILER-DAEMON Fri Jan  1 12:00:00 2021\nSubject: a\n\na\n\n'
+        b'From MAILER-DAEMON Fri Jan  1 12:00:00 2021\n' + escaped * 3 + b'\n')
+
+
+class Pipe(io.BytesIO):
+    @override
+    def seekable(self) -> bool:
+        return False
+
+    @override
+    def seek(self, *args: object) -> Never:
+        raise io.UnsupportedOperation
+
+    @override
+    def tell(self) -> Never:
+        raise io.UnsupportedOperation
+
+
+async def test_tar_writer(tmp_path: Path) -> None:
+    pipe = Pipe()
+    writer = TarWriter(AsyncPath(tmp_path), wrap_file(pipe))
+    written = await writer.write('a@example.com', '1', '1600', DATE, MESSAGE, ['\\Inbox'])
+    await writer.write('a@example.com', '2', None, None, b'first', None)
+    await writer.write('a@example.com', '2', None, None, b'second', None)
+    await writer.close()
+    assert written == {
+        'files': [],
+        'labels': AsyncPath(tmp_path / 'a@example.com/2021/01-Jan/01-Fri/1600.labels.json'),
+        'member': True,
+        'message': AsyncPath(tmp_path / 'a@example.com/2021/01-Jan/01-Fri/1600.eml')
+    }
+    assert not list(tmp_path.iterdir())
+    data = pipe.getvalue()
+    assert len(data) % tarfile.BLOCKSIZE == 0
+    assert data.endswith(bytes(2 * tarfile.BLOCKSIZE))
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r|') as tar:
+        members = {
+            x.name: (x, tar.extractfile(x).read())  # type: ignore[union-attr]
+            for x in tar
+        }
+    names = sorted(members)
+    assert names[:3] == [
+        'a@example.com/2021/01-Jan/01-Fri/1600.eml',
+        'a@example.com/2021/01-Jan/01-Fri/1600.labels.json',
+        'a@example.com/unknown-date/0000000002-352f782.eml'
+    ]
+    assert names[3] == 'a@example.com/unknown-date/0000000002.eml'
+    info, content = members['a@example.com/2021/01-Jan/01-Fri/1600.eml']
+    assert content == MESSAGE + b'\n'
+    assert info.mtime == DATE.timestamp()
+    assert json.loads(members[names[1]][1]) == ['\\Inbox']
+    assert members[names[2]][1] == b'second\n'
+
+
+async def test_tar_writer_write_file(tmp_path: Path, mocker: MockerFixture) -> None:
+    mocker.patch('gmail_archiver.writers._READ_CHUNK_SIZE', 5)
+    out = tmp_path / 'out.tar'
+    async with await AsyncPath(out).open('wb') as stream:
+        writer = TarWriter(AsyncPath(tmp_path), stream)
+        part_file = writer.part_file('a@example.com', '3')
+        await part_file.parent.mkdir(parents=True)
+        await part_file.write_bytes(MESSAGE * 3)
+        await writer.write_file('a@example.com',
+                                '3',
+                                '1600',
+                                DATE,
+                                part_file, ['Work'],
+                                digest=lambda: 'abcdef1',
+                                size=len(MESSAGE) * 3)
+        assert not await part_file.exists()
+        fsync = mocker.patch('gmail_archiver.writers.os.fsync')
+        await writer.close()
+    fsync.assert_called_once()
+    with tarfile.open(out) as tar:
+        assert tar.getnames() == [
+            'a@example.com/2021/01-Jan/01-Fri/1600.eml',
+            'a@example.com/2021/01-Jan/01-Fri/1600.labels.json'
+        ]
+        message = tar.extractfile('a@example.com/2021/01-Jan/01-Fri/1600.eml')
+        assert message is not None
+        assert message.read() == MESSAGE * 3 + b'\n'
+
+
+async def test_s3_writer(tmp_path: Path) -> None:
+    stats = RunStats()
+    async with FakeS3Server() as server, niquests.AsyncSession() as session:
+        client = S3Client(session,
+                          server.url,
+                          server.bucket,
+                          access_key_id=server.access_key_id,
+                          secret_access_key=server.secret_access_key,
+                          prefix='mail/',
+                          part_size=len(MESSAGE),
+                          stats=stats)
+        writer = S3Writer(AsyncPath(tmp_path), client, stats=stats)
+        written = await writer.write('a@example.com', '1', '1600', DATE, MESSAGE, ['\\Inbox'])
+        await writer.write('a@example.com', '2', None, None, b'first', None)
+        await writer.write('a@example.com', '2', None, None, b'second', None)
+        part_file = writer.part_file('a@example.com', '3')
+        await part_file.parent.mkdir(parents=True)
+        await part_file.write_bytes(MESSAGE * 3)
+        await writer.write_file('a@example.com',
+                                '3',
+                                '1601',
+                                DATE,
+                                part_file,
+                                None,
+                                digest=lambda: 'abcdef1',
+                                size=len(MESSAGE) * 3)
+    assert written == {
+        'files': [],
+        'labels': AsyncPath(tmp_path / 'a@example.com/2021/01-Jan/01-Fri/1600.labels.json'),
+        'member': True,
+        'message': AsyncPath(tmp_path / 'a@example.com/2021/01-Jan/01-Fri/1600.eml')
+    }
+    assert not await part_file.exists()
+    day = 'mail/a@example.com/2021/01-Jan/01-Fri'
+    assert server.objects == {
+        f'{day}/1600.eml': MESSAGE + b'\n',
+        f'{day}/1600.labels.json': b'[\n  "\\\\Inbox"\n]',
+        f'{day}/1601.eml': MESSAGE * 3 + b'\n',
+        'mail/a@example.com/unknown-date/0000000002.eml': b'first\n',
+        'mail/a@example.com/unknown-date/0000000002-352f782.eml': b'second\n'
+    }
+    assert server.content_types[f'{day}/1600.eml'] == 'message/rfc822'
+    assert server.content_types[f'{day}/1600.labels.json'] == 'application/json'
+    assert server.requests['UploadPart'] == 3
+    assert stats.phases['write'].count == 4
+
+
+def test_create_writer(tmp_path: Path, mocker: MockerFixture) -> None:
+    writer = create_writer('maildir', AsyncPath(tmp_path))
+    assert isinstance(writer, MaildirWriter)
+    assert writer.root == AsyncPath(tmp_path)
+    assert isinstance(create_writer('tar', AsyncPath(tmp_path)), TarWriter)
+    client = mocker.Mock()
+    s3_writer = create_writer('s3', AsyncPath(tmp_path), client=client)
+    assert isinstance(s3_writer, S3Writer)
+    assert s3_writer.client is client
+    with pytest.raises(ValueError, match='S3 client'):
+        create_writer('s3', AsyncPath(tmp_path))